@@ -76,6 +76,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger("agent_bot")
 
+# ================= 群发引擎 / Bot 客户端注册表（与总部共用仓库根目录模块，需在加载环境文件后导入） =================
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from bot_clients import get_bot, format_client_metrics
+from broadcast_engine import (BroadcastJobStore, run_job, get_limiter, BLOCKED,
+                              JOB_RUNNING, JOB_PAUSED, JOB_CANCELLED, JOB_DONE)
+from notification_outbox import NotificationOutbox
+from outbound_sender import outbound, log_failure
+from agent_price_sync import (AGENT_SYNC_HQ_PROJECTION, AGENT_SYNC_PRICE_PROJECTION,
+                              build_agent_price_ops, write_agent_price_ops)
+
 # 通知群 / 频道
 # ✅ 代理自己的通知群（订单、充值、提现通知发这里）
 AGENT_NOTIFY_CHAT_ID = os.getenv("AGENT_NOTIFY_CHAT_ID")
@@ -2307,6 +2317,15 @@ class AgentBotConfig:
         self.PRODUCT_SYNC_POLL_SECONDS = int(os.getenv("PRODUCT_SYNC_POLL_SECONDS", "120"))
         if self.PRODUCT_SYNC_POLL_SECONDS < 30:
             self.PRODUCT_SYNC_POLL_SECONDS = 30  # 最小30秒
+        # 同步模式：auto=总部发布器在线时订阅其事件，否则本地同步；hq=始终订阅；local=始终本地同步
+        self.AGENT_PRODUCT_SYNC_MODE = os.getenv("AGENT_PRODUCT_SYNC_MODE", "auto").lower()
+        self.HQ_SYNC_EVENT_POLL_SECONDS = max(2, int(os.getenv("HQ_SYNC_EVENT_POLL_SECONDS", "5")))
+        self.HQ_SYNC_HEARTBEAT_STALE_SECONDS = int(os.getenv("HQ_SYNC_HEARTBEAT_STALE_SECONDS", "120"))
+        # 商品查询缓存有效期（秒），同步事件会主动失效
+        self.AGENT_PRODUCT_CACHE_TTL = float(os.getenv("AGENT_PRODUCT_CACHE_TTL", "10"))
+        # 报表指标快照：定时刷新间隔 / 订单、注册事件触发的最短刷新间隔（秒）
+        self.AGENT_METRICS_REFRESH_SECONDS = max(30, int(os.getenv("AGENT_METRICS_REFRESH_SECONDS", "300")))
+        self.AGENT_METRICS_MIN_INTERVAL = max(5, int(os.getenv("AGENT_METRICS_MIN_INTERVAL", "30")))
         
         # ✅ 协议号分类统一配置
         self.AGENT_PROTOCOL_CATEGORY_UNIFIED = AGENT_PROTOCOL_CATEGORY_UNIFIED
@@ -2417,6 +2436,13 @@ class AgentBotConfig:
             self.hb = self.db['hb']
             self.fenlei = self.db['fenlei']  # ✅ 总部分类表
             self.agent_product_prices = self.db['agent_product_prices']
+            self.product_sync_events = self.db['product_sync_events']
+            self.product_sync_state = self.db['product_sync_state']
+            self.agent_metrics_snapshots = self.db['agent_metrics_snapshots']
+            self.agent_analytics = self.db['agent_analytics']
+            self.broadcast_jobs = self.db['broadcast_jobs']
+            self.broadcast_deliveries = self.db['broadcast_deliveries']
+            self.notification_outbox = self.db['notification_outbox']
             self.agent_profit_account = self.db['agent_profit_account']
             self.withdrawal_requests = self.db['withdrawal_requests']
             self.recharge_orders = self.db['recharge_orders']
@@ -2507,6 +2533,168 @@ class AgentBotConfig:
         return int(user_id) in self.ADMIN_USERS
 
 
+class ProductLookupCache:
+    """
+    商品查询短时缓存（总部 ejfl 记录 + 本代理 agent_product_prices 记录）
+    - 一次点击内多次查询同一商品只访问一次数据库
+    - 未命中的 nowuid 合并为两次 $in 查询
+    - 同步路径（总部事件 / 本地同步 / 改价）调用 invalidate 失效
+    """
+    HQ_PROJECTION = {'_id': 0, 'nowuid': 1, 'projectname': 1, 'leixing': 1, 'money': 1}
+    PRICE_PROJECTION = {
+        '_id': 0, 'original_nowuid': 1, 'agent_markup': 1, 'agent_price': 1,
+        'category': 1, 'is_active': 1, 'needs_price_set': 1
+    }
+
+    def __init__(self, config: 'AgentBotConfig', ttl: float):
+        self.config = config
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, Optional[Dict], Optional[Dict]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _project(doc: Optional[Dict], projection: Dict) -> Optional[Dict]:
+        """只保留投影中的字段（聚合结果里的 $lookup 数组等不进入缓存）"""
+        if doc is None:
+            return None
+        return {k: doc[k] for k, v in projection.items() if v and k in doc}
+
+    def put(self, nowuid: str, hq: Optional[Dict], price: Optional[Dict]):
+        """写入已从其它查询（如聚合结果）拿到的记录（按缓存投影裁剪字段）"""
+        hq, price = self._project(hq, self.HQ_PROJECTION), self._project(price, self.PRICE_PROJECTION)
+        with self._lock:
+            self._entries[nowuid] = (time.time() + self.ttl, hq, price)
+
+    def get_many(self, nowuids: List[str]) -> Dict[str, Tuple[Optional[Dict], Optional[Dict]]]:
+        """批量获取 nowuid -> (hq_doc, price_doc)，未命中部分合并查询"""
+        now = time.time()
+        result = {}
+        misses = []
+        with self._lock:
+            for nowuid in dict.fromkeys(nowuids):
+                entry = self._entries.get(nowuid)
+                if entry and entry[0] > now:
+                    result[nowuid] = (entry[1], entry[2])
+                else:
+                    misses.append(nowuid)
+        if not misses:
+            return result
+
+        hq_map = {
+            doc['nowuid']: doc
+            for doc in self.config.ejfl.find({'nowuid': {'$in': misses}}, self.HQ_PROJECTION)
+        }
+        price_map = {
+            doc['original_nowuid']: doc
+            for doc in self.config.agent_product_prices.find(
+                {'agent_bot_id': self.config.AGENT_BOT_ID, 'original_nowuid': {'$in': misses}},
+                self.PRICE_PROJECTION
+            )
+        }
+        expires = time.time() + self.ttl
+        with self._lock:
+            for nowuid in misses:
+                hq, price = hq_map.get(nowuid), price_map.get(nowuid)
+                self._entries[nowuid] = (expires, hq, price)
+                result[nowuid] = (hq, price)
+            if len(self._entries) > 5000:
+                self._entries = {k: v for k, v in self._entries.items() if v[0] > expires - self.ttl}
+        return result
+
+    def get(self, nowuid: str) -> Tuple[Optional[Dict], Optional[Dict]]:
+        return self.get_many([nowuid]).get(nowuid, (None, None))
+
+    def invalidate(self, nowuids: Optional[List[str]] = None):
+        """nowuids 为 None 时清空全部"""
+        with self._lock:
+            if nowuids is None:
+                self._entries.clear()
+            else:
+                for nowuid in nowuids:
+                    self._entries.pop(nowuid, None)
+
+
+class AgentMetricsSnapshot:
+    """
+    报表指标快照（每个代理一份）
+    - 销售/财务/用户/商品指标由 AgentBotCore.compute_metrics_snapshot 一次算完，报表页面只读快照
+    - 定时任务按 AGENT_METRICS_REFRESH_SECONDS 刷新；下单/注册后标记 dirty，最短 AGENT_METRICS_MIN_INTERVAL 后刷新
+    - 快照写入总部库 agent_metrics_snapshots（_id=agent:<AGENT_BOT_ID>），重启后可直接展示
+    """
+    PERIODS = (7, 30, 90)
+
+    def __init__(self, core: 'AgentBotCore', refresh_seconds: int, min_interval: int):
+        self.core = core
+        self.refresh_seconds = refresh_seconds
+        self.min_interval = min_interval
+        self._data: Optional[Dict] = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    @property
+    def doc_id(self) -> str:
+        return f"agent:{self.core.config.AGENT_BOT_ID}"
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def age(self) -> float:
+        return time.time() - self._data['built_at'] if self._data else float('inf')
+
+    def is_stale(self) -> bool:
+        age = self.age()
+        return age >= self.refresh_seconds or (self._dirty and age >= self.min_interval)
+
+    def _load(self):
+        """首次读取时加载已持久化的快照"""
+        self._loaded = True
+        try:
+            doc = self.core.config.agent_metrics_snapshots.find_one({'_id': self.doc_id})
+            if doc and doc.get('built_at'):
+                doc.pop('_id', None)
+                self._data = doc
+        except Exception as e:
+            logger.debug(f"读取指标快照失败: {e}")
+
+    def refresh(self) -> Optional[Dict]:
+        """重建快照（并发调用只重建一次）"""
+        if not self._lock.acquire(blocking=self._data is None):
+            return self._data
+        try:
+            self._dirty = False
+            started = time.time()
+            data = self.core.compute_metrics_snapshot()
+            data['built_at'] = time.time()
+            data['agent_bot_id'] = self.core.config.AGENT_BOT_ID
+            self._data = data
+            try:
+                self.core.config.agent_metrics_snapshots.replace_one({'_id': self.doc_id}, data, upsert=True)
+            except Exception as e:
+                logger.warning(f"保存指标快照失败: {e}")
+            logger.info(f"📊 报表指标快照已刷新（{time.time() - started:.2f}s）")
+            return data
+        finally:
+            self._lock.release()
+
+    def get(self, allow_refresh: bool = True) -> Dict:
+        """读取快照；过期时重建（重建失败时返回旧快照）"""
+        if not self._loaded:
+            self._load()
+        if allow_refresh and self.is_stale():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"❌ 刷新报表指标快照失败: {e}")
+        return self._data or {}
+
+    def as_of(self) -> str:
+        """快照时间（北京时间）"""
+        if not self._data:
+            return '-'
+        return self.core._to_beijing(datetime.utcfromtimestamp(self._data['built_at'])).strftime('%m-%d %H:%M:%S')
+
+
 class AgentBotCore:
     """核心业务"""
     
@@ -2518,11 +2706,78 @@ class AgentBotCore:
     SYNC_THRESHOLD_MULTIPLIER = 1.05  # 总部商品数超过代理商品数的阈值倍数（5%容差）
     PRICE_COMPARISON_EPSILON = 0.01  # 价格比较精度（避免浮点数误差）
     DEFAULT_SYNC_BATCH_SIZE = 1000  # 默认批量同步大小
+    
+    # 字符串时间字段 -> BSON datetime 字段（与总部 mongo.TIMER_DATETIME_PREFIX_FIELDS 一致，双写 + 回填后按索引查询）
+    TIMER_DATETIME_FIELDS = {
+        'timer': 'timer_at',
+        'creation_time': 'creation_at',
+        'register_time': 'register_at',
+        'last_active': 'last_active_at',
+        'last_contact_time': 'last_contact_at',
+    }
 
     def __init__(self, config: AgentBotConfig):
         self.config = config
+        # 最近一次全量同步结果（供 /diag_sync_stats 展示吞吐量）
+        self.last_full_sync_stats: Optional[Dict] = None
+        self._last_sync_event_id = None
+        self._hq_publisher_check: Optional[Tuple[float, bool]] = None
+        self._hq_restock_check: Optional[Tuple[float, bool]] = None
+        self._timer_migrated: Dict[str, Tuple[float, bool]] = {}
+        self.product_cache = ProductLookupCache(config, config.AGENT_PRODUCT_CACHE_TTL)
+        self.metrics = AgentMetricsSnapshot(self, config.AGENT_METRICS_REFRESH_SECONDS, config.AGENT_METRICS_MIN_INTERVAL)
+        self.broadcasts = BroadcastJobStore(config.broadcast_jobs, config.broadcast_deliveries)
+        self.outbox = NotificationOutbox(config.notification_outbox, config.AGENT_BOT_ID, config.BOT_TOKEN)
 
     # ---------- 时间/工具 ----------
+    @classmethod
+    def _with_timer_datetimes(cls, doc: Dict) -> Dict:
+        """为写入的文档（或 $set 内容）补充 *_at 日期字段"""
+        for src, dst in cls.TIMER_DATETIME_FIELDS.items():
+            if isinstance(doc.get(src), str) and dst not in doc:
+                try:
+                    doc[dst] = datetime.strptime(doc[src][:19], '%Y-%m-%d %H:%M:%S')
+                except ValueError:
+                    pass
+        return doc
+
+    def _is_timer_migrated(self, collection_name: str, field: str) -> bool:
+        """总部迁移工具是否已完成该字段回填（缓存 60 秒）"""
+        key = f"{collection_name}.{field}"
+        cached = self._timer_migrated.get(key)
+        if cached and time.time() - cached[0] < 60:
+            return cached[1]
+        try:
+            state = self.config.db['timer_migration_state'].find_one({'_id': key}, {'done': 1})
+            done = bool(state and state.get('done'))
+        except Exception:
+            done = False
+        self._timer_migrated[key] = (time.time(), done)
+        return done
+
+    def _timer_filter(self, collection, field: str, start: Optional[datetime] = None,
+                      end: Optional[datetime] = None) -> Dict:
+        """时间范围条件：回填完成后按 *_at 日期字段（走索引），否则按字符串比较；区间为 [start, end)（与总部 timer_range_filter 一致）"""
+        dst = self.TIMER_DATETIME_FIELDS.get(field)
+        use_dt = dst is not None and self._is_timer_migrated(collection.name, field)
+        cond = {}
+        if start is not None:
+            cond['$gte'] = start if use_dt else start.strftime('%Y-%m-%d %H:%M:%S')
+        if end is not None:
+            cond['$lt'] = end if use_dt else end.strftime('%Y-%m-%d %H:%M:%S')
+        return {(dst if use_dt else field): cond} if cond else {}
+
+    def _record_analytics(self, inc: Dict):
+        """总部跨代理排行：累加来源计数并标记 dirty（派生字段由总部重算）"""
+        try:
+            self.config.agent_analytics.update_one(
+                {'_id': self.config.AGENT_BOT_ID},
+                {'$inc': inc, '$set': {'dirty': True}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.debug(f"更新代理分析汇总失败: {e}")
+
     def _to_beijing(self, dt: datetime) -> datetime:
         """UTC -> 北京时间（UTC+8）"""
         if dt is None:
@@ -2595,11 +2850,8 @@ class AgentBotCore:
             if not nowuids:
                 return {}
             
-            hq_products = list(self.config.ejfl.find(
-                {'nowuid': {'$in': nowuids}},
-                {'nowuid': 1, 'projectname': 1, 'leixing': 1}
-            ))
-            return {p['nowuid']: p for p in hq_products}
+            records = self.product_cache.get_many(nowuids)
+            return {nowuid: hq for nowuid, (hq, _) in records.items() if hq}
         except Exception as e:
             logger.warning(f"⚠️ 获取HQ商品信息失败: {e}")
             return {}
@@ -2910,11 +3162,15 @@ class AgentBotCore:
             exist = coll.find_one({'user_id': user_id})
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             if exist:
-                coll.update_one({'user_id': user_id}, {'$set': {'last_active': now}})
+                update = {'$set': self._with_timer_datetimes({'last_active': now})}
+                if exist.get('bot_blocked'):
+                    # 重新与机器人交互：恢复接收广告推送
+                    update['$unset'] = {'bot_blocked': '', 'bot_blocked_at': ''}
+                coll.update_one({'user_id': user_id}, update)
                 return True
             max_user = coll.find_one({}, sort=[("count_id", -1)])
             count_id = (max_user.get('count_id', 0) + 1) if max_user else 1
-            coll.insert_one({
+            coll.insert_one(self._with_timer_datetimes({
                 'user_id': user_id,
                 'count_id': count_id,
                 'username': username,
@@ -2929,7 +3185,9 @@ class AgentBotCore:
                 'last_contact_time': now,
                 'status': 'active',
                 'language': DEFAULT_LANGUAGE
-            })
+            }))
+            self.metrics.mark_dirty()
+            self._record_analytics({'total_users': 1})
             logger.info(f"✅ 用户注册成功 {user_id}")
             return True
         except Exception as e:
@@ -3193,9 +3451,115 @@ class AgentBotCore:
             # 返回默认中文消息
             return self.config.PURCHASE_SUCCESS_MSG_ZH
 
+    AD_BROADCAST_KIND = 'agent_ad'
+
+    def ensure_ad_broadcast_indexes(self):
+        """广告推送：收件人按 user_id 顺序扫描，活跃时间过滤在同一索引内完成"""
+        try:
+            self.broadcasts.ensure_indexes()
+            coll = self.config.get_agent_user_collection()
+            coll.create_index([('user_id', 1), ('last_active_at', 1)])
+        except Exception as e:
+            logger.warning(f"⚠️ 广告推送索引初始化失败: {e}")
+
+    def _ad_recipient_query(self, cutoff: Optional[datetime]) -> Dict:
+        """广告推送收件人条件：跳过已拉黑用户，按活跃时间过滤（回填完成后走 last_active_at 日期索引）"""
+        query = {'bot_blocked': {'$ne': True}}
+        if cutoff is not None:
+            query.update(self._timer_filter(self.config.get_agent_user_collection(), 'last_active', cutoff))
+        return query
+
+    def create_ad_broadcast(self, message_text: str, parse_mode: str = ParseMode.HTML):
+        """
+        创建广告推送任务（持久化，可续跑）
+
+        Returns:
+            任务 _id；没有符合条件的用户时返回 None
+        """
+        cutoff = None
+        if self.config.AGENT_AD_DM_ACTIVE_DAYS > 0:
+            cutoff = datetime.now() - timedelta(days=self.config.AGENT_AD_DM_ACTIVE_DAYS)
+            logger.info(f"📊 广告推送筛选条件: 最近 {self.config.AGENT_AD_DM_ACTIVE_DAYS} 天活跃用户（{cutoff.strftime('%Y-%m-%d %H:%M:%S')} 之后）")
+        else:
+            logger.info("📊 广告推送筛选条件: 所有用户")
+
+        total_users = self.config.get_agent_user_collection().count_documents(self._ad_recipient_query(cutoff))
+        max_recipients = self.config.AGENT_AD_DM_MAX_PER_RUN
+        if max_recipients > 0 and total_users > max_recipients:
+            logger.info(f"⚠️ 受 AGENT_AD_DM_MAX_PER_RUN 限制，只发送给前 {max_recipients} 个用户")
+            total_users = max_recipients
+        logger.info(f"📢 准备广播广告到 {total_users} 个用户")
+        if total_users == 0:
+            logger.info("⚠️ 没有符合条件的用户，跳过广播")
+            return None
+
+        payload = {'text': message_text, 'parse_mode': parse_mode, 'cutoff': cutoff}
+        return self.broadcasts.create(self.AD_BROADCAST_KIND, self.config.AGENT_BOT_ID, payload, total_users,
+                                      agent_bot_id=self.config.AGENT_BOT_ID)
+
+    def run_ad_broadcast(self, bot: Bot, job_id):
+        """
+        执行（或续跑）广告推送任务：共享限速器 + 有界并发，逐个收件人记录投递状态
+
+        Returns:
+            (最终状态, 统计)；任务已在运行或已结束时统计为 None
+        """
+        job = self.broadcasts.get(job_id)
+        if job is None:
+            return None, None
+        payload = job['payload']
+        coll = self.config.get_agent_user_collection()
+        query = self._ad_recipient_query(payload.get('cutoff'))
+        limit = job.get('total', 0) if self.config.AGENT_AD_DM_MAX_PER_RUN > 0 else 0
+
+        def recipients(after):
+            remaining = 0
+            if limit:
+                # 最大发送数按已占位的收件人扣减
+                remaining = limit - sum(self.broadcasts.count_statuses(job_id).values())
+                if remaining <= 0:
+                    return
+            cond = dict(query)
+            if after is not None:
+                cond['user_id'] = {'$gt': after}
+            cursor = coll.find(cond, {'_id': 0, 'user_id': 1}).sort('user_id', 1).limit(remaining).batch_size(1000)
+            for doc in cursor:
+                if doc.get('user_id'):
+                    yield doc['user_id']
+
+        def send(chat_id):
+            return outbound.send_message(bot.token, chat_id, payload['text'], parse_mode=payload.get('parse_mode'))
+
+        def on_result(chat_id, status, error):
+            if status == BLOCKED:
+                coll.update_one({'user_id': chat_id}, {'$set': {'bot_blocked': True, 'bot_blocked_at': datetime.now()}})
+
+        def progress(stats, status):
+            logger.info(f"📤 广告推送进度 {stats.done}/{stats.total}（成功 {stats.sent}，失败 {stats.failed}，拉黑 {stats.blocked}，{stats.rate:.1f} 条/秒）")
+
+        return run_job(self.broadcasts, job_id, recipients, send, get_limiter(self.config.BOT_TOKEN),
+                       on_result=on_result, progress=progress, async_send=True)
+
+    def pending_ad_broadcasts(self) -> List[Dict]:
+        """上次进程中断时仍在运行的广告推送任务"""
+        return self.broadcasts.list(self.AD_BROADCAST_KIND, limit=20, status=JOB_RUNNING,
+                                    agent_bot_id=self.config.AGENT_BOT_ID)
+
+    def recent_ad_broadcasts(self, limit: int = 10) -> List[Dict]:
+        """最近的广告推送任务（管理员任务列表）"""
+        return self.broadcasts.list(self.AD_BROADCAST_KIND, limit=limit, agent_bot_id=self.config.AGENT_BOT_ID)
+
+    def set_ad_broadcast_status(self, job_id, status: str) -> bool:
+        """暂停 / 继续 / 取消本代理的广告推送任务"""
+        allowed = {JOB_PAUSED: [JOB_RUNNING], JOB_RUNNING: [JOB_PAUSED], JOB_CANCELLED: [JOB_RUNNING, JOB_PAUSED]}
+        job = self.broadcasts.get(job_id)
+        if job is None or job.get('agent_bot_id') != self.config.AGENT_BOT_ID or status not in allowed:
+            return False
+        return self.broadcasts.set_status(job_id, status, only_from=allowed[status])
+
     def broadcast_ad_to_agent_users(self, message_text: str, parse_mode: str = ParseMode.HTML) -> int:
         """
-        广播广告消息到所有代理用户的私聊
+        广播广告消息到所有代理用户的私聊（同步执行，供脚本/兼容调用；频道消息走后台任务）
         
         Args:
             message_text: 要发送的消息文本
@@ -3205,71 +3569,121 @@ class AgentBotCore:
             成功发送的用户数量
         """
         try:
-            # 构建查询条件
-            query = {}
-            
-            # 根据活跃天数过滤
-            if self.config.AGENT_AD_DM_ACTIVE_DAYS > 0:
-                cutoff_date = datetime.now() - timedelta(days=self.config.AGENT_AD_DM_ACTIVE_DAYS)
-                cutoff_str = cutoff_date.strftime('%Y-%m-%d %H:%M:%S')
-                query['last_active'] = {'$gte': cutoff_str}
-                logger.info(f"📊 广告推送筛选条件: 最近 {self.config.AGENT_AD_DM_ACTIVE_DAYS} 天活跃用户（{cutoff_str} 之后）")
-            else:
-                logger.info("📊 广告推送筛选条件: 所有用户")
-            
-            # 获取用户列表
-            user_collection = self.config.get_agent_user_collection()
-            users = list(user_collection.find(query, {'user_id': 1}))
-            
-            total_users = len(users)
-            logger.info(f"📢 准备广播广告到 {total_users} 个用户")
-            
-            if total_users == 0:
-                logger.info("⚠️ 没有符合条件的用户，跳过广播")
+            job_id = self.create_ad_broadcast(message_text, parse_mode)
+            if job_id is None:
                 return 0
-            
-            # 限制最大发送数量
-            max_recipients = self.config.AGENT_AD_DM_MAX_PER_RUN
-            if max_recipients > 0 and total_users > max_recipients:
-                users = users[:max_recipients]
-                logger.info(f"⚠️ 受 AGENT_AD_DM_MAX_PER_RUN 限制，只发送给前 {max_recipients} 个用户")
-            
-            # 逐个发送
-            success_count = 0
-            bot = Bot(self.config.BOT_TOKEN)
-            
-            for idx, user in enumerate(users, 1):
-                user_id = user.get('user_id')
-                if not user_id:
-                    continue
-                
-                try:
-                    bot.send_message(
-                        chat_id=user_id,
-                        text=message_text,
-                        parse_mode=parse_mode
-                    )
-                    success_count += 1
-                    
-                    if idx % 50 == 0:
-                        logger.info(f"📤 已发送 {idx}/{len(users)} 条广告消息")
-                    
-                    # 添加小延迟避免触发 Telegram 限流
-                    time.sleep(0.05)
-                    
-                except Exception as user_err:
-                    # 单个用户发送失败不影响其他用户
-                    logger.warning(f"⚠️ 向用户 {user_id} 发送广告失败: {user_err}")
-                    continue
-            
-            logger.info(f"✅ 广告推送完成: 成功 {success_count}/{len(users)} 个用户")
+            _, stats = self.run_ad_broadcast(get_bot(self.config.BOT_TOKEN), job_id)
+            success_count = stats.sent if stats else 0
+            logger.info(f"✅ 广告推送完成: 成功 {success_count} 个用户")
             return success_count
-            
         except Exception as e:
             logger.error(f"❌ 广告推送失败: {e}")
             traceback.print_exc()
             return 0
 
+    def uses_hq_sync_publisher(self) -> bool:
+        """判断是否由总部发布器负责同步本代理商品（发布器心跳新鲜且本代理已登记为活跃）"""
+        mode = self.config.AGENT_PRODUCT_SYNC_MODE
+        if mode == 'local':
+            return False
+        if mode == 'hq':
+            return True
+        cached = self._hq_publisher_check
+        if cached and time.time() - cached[0] < self.config.HQ_SYNC_EVENT_POLL_SECONDS:
+            return cached[1]
+        alive = self._check_hq_sync_publisher()
+        self._hq_publisher_check = (time.time(), alive)
+        return alive
+
+    def _check_hq_sync_publisher(self) -> bool:
+        try:
+            state = self.config.product_sync_state.find_one({'_id': 'hq_product_sync'}, {'heartbeat': 1})
+            if not state or not state.get('heartbeat'):
+                return False
+            if (datetime.utcnow() - state['heartbeat']).total_seconds() > self.config.HQ_SYNC_HEARTBEAT_STALE_SECONDS:
+                return False
+            return self.config.db['agent_bots'].count_documents(
+                {'agent_bot_id': self.config.AGENT_BOT_ID, 'status': 'active'}, limit=1
+            ) > 0
+        except Exception as e:
+            logger.warning(f"[SYNC] 检查总部同步发布器状态失败: {e}")
+            return False
+
+    def register_restock_chat(self):
+        """把本代理的补货通知群登记到 agent_bots，供总部补货分发直接推送"""
+        try:
+            chat_id = self.config.AGENT_RESTOCK_NOTIFY_CHAT_ID
+            update = {'$set': {'restock_chat_id': str(chat_id)}} if chat_id else {'$unset': {'restock_chat_id': ''}}
+            self.config.db['agent_bots'].update_one({'agent_bot_id': self.config.AGENT_BOT_ID}, update)
+        except Exception as e:
+            logger.warning(f"⚠️ 登记补货通知群失败: {e}")
+
+    def register_default_markup(self):
+        """把本代理的新商品默认加价登记到 agent_bots，总部发布器为本代理写入新商品时使用"""
+        try:
+            self.config.db['agent_bots'].update_one({'agent_bot_id': self.config.AGENT_BOT_ID},
+                                                    {'$set': {'default_markup': self.config.AGENT_DEFAULT_MARKUP}})
+        except Exception as e:
+            logger.warning(f"⚠️ 登记默认加价失败: {e}")
+
+    def uses_hq_restock_fanout(self) -> bool:
+        """总部补货分发是否在运行（心跳新鲜且已开启），是则频道帖子按 restock_fanout_log 判断是否需要转发"""
+        cached = self._hq_restock_check
+        if cached and time.time() - cached[0] < self.config.HQ_SYNC_EVENT_POLL_SECONDS:
+            return cached[1]
+        try:
+            state = self.config.product_sync_state.find_one({'_id': 'hq_restock_fanout'}, {'heartbeat': 1, 'enabled': 1})
+            alive = bool(state and state.get('enabled') and state.get('heartbeat') and
+                         (datetime.utcnow() - state['heartbeat']).total_seconds() <= self.config.HQ_SYNC_HEARTBEAT_STALE_SECONDS)
+        except Exception as e:
+            logger.warning(f"⚠️ 检查总部补货分发状态失败: {e}")
+            alive = False
+        self._hq_restock_check = (time.time(), alive)
+        return alive
+
+    def restock_fanout_covered(self, nowuids: List[str]) -> bool:
+        """这些商品是否都已由总部补货分发推送到本代理补货群（最近 10 分钟内登记）"""
+        if not nowuids:
+            return False
+        try:
+            ids = [f"{self.config.AGENT_BOT_ID}:{n}" for n in set(nowuids)]
+            covered = self.config.db['restock_fanout_log'].count_documents(
+                {'_id': {'$in': ids}, 'at': {'$gte': datetime.utcnow() - timedelta(minutes=10)}})
+            return covered == len(ids)
+        except Exception as e:
+            logger.warning(f"⚠️ 查询补货分发记录失败: {e}")
+            return False
+
+    def consume_hq_sync_events(self) -> int:
+        """读取总部发布器的新同步事件（按 _id 增量），返回涉及的商品数"""
+        query = {}
+        if self._last_sync_event_id is not None:
+            query['_id'] = {'$gt': self._last_sync_event_id}
+        else:
+            # 首次订阅只从当前位置开始，历史变更已由发布器写入
+            latest = self.config.product_sync_events.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+            self._last_sync_event_id = latest['_id'] if latest else ObjectId()
+            return 0
+
+        changed = set()
+        full = False
+        for event in self.config.product_sync_events.find(query, {'nowuids': 1, 'full': 1}).sort('_id', 1).limit(500):
+            self._last_sync_event_id = event['_id']
+            if event.get('full') or not event.get('nowuids'):
+                full = True
+            else:
+                changed.update(event['nowuids'])
+        if full:
+            self._on_hq_products_changed(None)
+        elif changed:
+            self._on_hq_products_changed(list(changed))
+        return len(changed)
+
+    def _on_hq_products_changed(self, nowuids: Optional[List[str]]):
+        """总部商品变更回调（nowuids 为 None 表示全量变更）"""
+        self.product_cache.invalidate(nowuids)
+        logger.info(f"[SYNC] 📥 收到总部同步事件: {'全量' if nowuids is None else f'{len(nowuids)} 个商品'}")
+
     def auto_sync_new_products(self):
         """自动同步总部新增商品到代理（增强版：支持价格为0的商品预建记录 + 统一协议号分类 + 首次自动全量同步）"""
         try:
@@ -3290,94 +3704,25 @@ class AgentBotCore:
                 logger.warning(f"[SYNC] ⚠️ 总部商品数({hq_count}) > 代理商品数({agent_count}) * {self.SYNC_THRESHOLD_MULTIPLIER}，建议执行全量同步")
                 logger.warning("[SYNC] 💡 使用 /resync_hq_products 命令执行全量同步")
             
-            all_products = list(self.config.ejfl.find({}))
+            # ✅ 按批比对并批量写入（每批一次 $in 查询 + 一次 bulk_write）
             synced = 0
             updated = 0
             activated = 0
-            
-            for p in all_products:
-                nowuid = p.get('nowuid')
-                if not nowuid:
-                    continue
-                
-                # ✅ 检查商品是否已存在于代理价格表
-                exists = self.config.agent_product_prices.find_one({
-                    'agent_bot_id': self.config.AGENT_BOT_ID,
-                    'original_nowuid': nowuid
-                })
-                
-                # ✅ 安全获取总部价格（处理异常情况）
-                original_price = self._safe_price(p.get('money'))
-                
-                # 🔥 存储层保持原样：直接使用原始 leixing，不做转换
-                # 分类统一/映射在展示层（get_product_categories）处理
-                leixing = p.get('leixing')
-                projectname = p.get('projectname', '')
-                category = leixing
-                
-                if not exists:
-                    # ✅ 新商品：创建代理价格记录，使用默认加价
-                    agent_markup = self.config.AGENT_DEFAULT_MARKUP
-                    agent_price = round(original_price + agent_markup, 2)
-                    
-                    # ✅ 即使总部价为0也创建记录，但标记为未激活
-                    is_active = original_price > 0
-                    needs_price_set = original_price <= 0
-                    
-                    self.config.agent_product_prices.insert_one({
-                        'agent_bot_id': self.config.AGENT_BOT_ID,
-                        'original_nowuid': nowuid,
-                        'agent_markup': agent_markup,
-                        'agent_price': agent_price,
-                        'original_price_snapshot': original_price,
-                        'product_name': p.get('projectname', ''),
-                        'category': category,  # ✅ 使用检测后的分类
-                        'is_active': is_active,
-                        'needs_price_set': needs_price_set,
-                        'auto_created': True,
-                        'sync_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        'created_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        'updated_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    })
-                    synced += 1
-                    status_msg = "待补价" if needs_price_set else "已激活"
-                    logger.info(f"✅ 新增同步商品: {p.get('projectname')} (nowuid: {nowuid}, 总部价: {original_price}U, 代理价: {agent_price}U, 状态: {status_msg}, 分类: {category})")
-                else:
-                    # ✅ 已存在的商品：更新商品名称、分类和价格
-                    updates = {}
-                    if exists.get('product_name') != p.get('projectname'):
-                        updates['product_name'] = p.get('projectname', '')
-                    
-                    # ✅ 更新分类（保持原始 leixing）
-                    old_category = exists.get('category')
-                    if old_category != category:
-                        updates['category'] = category
-                    
-                    # ✅ 更新总部价格快照
-                    if abs(exists.get('original_price_snapshot', 0) - original_price) > self.PRICE_COMPARISON_EPSILON:
-                        updates['original_price_snapshot'] = original_price
-                    
-                    # ✅ 重新计算代理价格（总部价 + 加价）
-                    agent_markup = float(exists.get('agent_markup', 0))
-                    new_agent_price = round(original_price + agent_markup, 2)
-                    if abs(exists.get('agent_price', 0) - new_agent_price) > self.PRICE_COMPARISON_EPSILON:
-                        updates['agent_price'] = new_agent_price
-                    
-                    # ✅ 如果之前是待补价状态，现在总部价>0，自动激活
-                    if exists.get('needs_price_set') and original_price > 0:
-                        updates['is_active'] = True
-                        updates['needs_price_set'] = False
-                        activated += 1
-                        logger.info(f"✅ 自动激活商品: {p.get('projectname')} (总部价已补: {original_price}U)")
-                    
-                    if updates:
-                        updates['sync_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        updates['updated_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        self.config.agent_product_prices.update_one(
-                            {'agent_bot_id': self.config.AGENT_BOT_ID, 'original_nowuid': nowuid},
-                            {'$set': updates}
-                        )
-                        updated += 1
+            batch = []
+            cursor = self.config.ejfl.find({}, self.SYNC_HQ_PROJECTION).batch_size(self.DEFAULT_SYNC_BATCH_SIZE)
+            for p in cursor:
+                batch.append(p)
+                if len(batch) >= self.DEFAULT_SYNC_BATCH_SIZE:
+                    stats = self._process_sync_batch(batch, auto_created=True)
+                    synced += stats['inserted']
+                    updated += stats['updated']
+                    activated += stats['activated']
+                    batch = []
+            if batch:
+                stats = self._process_sync_batch(batch, auto_created=True)
+                synced += stats['inserted']
+                updated += stats['updated']
+                activated += stats['activated']
             
             # ✅ 主同步循环已完成分类更新，这里记录最终结果
             logger.info(f"🔄 商品同步完成: 新增 {synced} 个, 更新 {updated} 个, 激活 {activated} 个")
@@ -3467,7 +3812,7 @@ class AgentBotCore:
             # 2. 批量处理总部商品
             # 注意：cursor.batch_size() 控制MongoDB每次返回的文档数
             # 我们的batch列表用于应用层批量处理，两者配合使用避免内存溢出
-            cursor = self.config.ejfl.find({}).batch_size(batch_size)
+            cursor = self.config.ejfl.find({}, self.SYNC_HQ_PROJECTION).batch_size(batch_size)
             batch = []
             
             for product in cursor:
@@ -3497,8 +3842,9 @@ class AgentBotCore:
                 'agent_bot_id': self.config.AGENT_BOT_ID
             })
             
-            # 4. 计算耗时
+            # 4. 计算耗时与吞吐量
             elapsed = (datetime.now() - start_time).total_seconds()
+            rate = round(total_hq_products / elapsed, 1) if elapsed > 0 else float(total_hq_products)
             
             result = {
                 'inserted': inserted_count,
@@ -3507,13 +3853,16 @@ class AgentBotCore:
                 'errors': error_count,
                 'total_hq': total_hq_products,
                 'total_agent': total_agent_products,
-                'elapsed': round(elapsed, 2)
+                'elapsed': round(elapsed, 2),
+                'rate': rate,
+                'finished_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             }
+            self.last_full_sync_stats = result
             
             logger.info(f"[SYNC] ========== 全量同步完成 ==========")
             logger.info(f"[SYNC] 插入: {inserted_count}, 更新: {updated_count}, 跳过: {skipped_count}, 错误: {error_count}")
             logger.info(f"[SYNC] 总部商品数: {total_hq_products}, 代理商品数: {total_agent_products}")
-            logger.info(f"[SYNC] 耗时: {elapsed:.2f}秒")
+            logger.info(f"[SYNC] 耗时: {elapsed:.2f}秒, 吞吐量: {rate} 个/秒")
             
             return result
             
@@ -3529,119 +3878,51 @@ class AgentBotCore:
                 'total_hq': 0,
                 'total_agent': 0,
                 'elapsed': 0,
+                'rate': 0,
                 'error': str(e)
             }
     
-    def _process_sync_batch(self, batch: List[Dict]) -> Dict:
+    # 同步只需要的字段（减少网络传输）
+    SYNC_HQ_PROJECTION = AGENT_SYNC_HQ_PROJECTION
+
+    def _process_sync_batch(self, batch: List[Dict], auto_created: bool = False) -> Dict:
         """
-        处理一批商品的同步
+        处理一批商品的同步（一次 $in 读取已有记录，一次无序 bulk_write 写入）
+
+        比对与写入规则由 agent_price_sync 提供，与总部发布器完全一致
         
         Args:
             batch: 商品列表
+            auto_created: 新建记录的 auto_created 标记（自动同步为 True，全量同步为 False）
         
         Returns:
-            Dict: 统计信息 {inserted, updated, skipped, errors}
+            Dict: 统计信息 {inserted, updated, skipped, activated, errors}
         """
-        inserted = 0
-        updated = 0
-        skipped = 0
-        errors = 0
+        agent_bot_id = self.config.AGENT_BOT_ID
+        nowuids = [p.get('nowuid') for p in batch if p.get('nowuid')]
+        try:
+            existing_map = {
+                doc['original_nowuid']: doc
+                for doc in self.config.agent_product_prices.find(
+                    {'agent_bot_id': agent_bot_id, 'original_nowuid': {'$in': nowuids}},
+                    AGENT_SYNC_PRICE_PROJECTION
+                )
+            } if nowuids else {}
+        except Exception as e:
+            logger.error(f"[SYNC] 批量读取代理价格失败: {e}")
+            return {'inserted': 0, 'updated': 0, 'skipped': 0, 'activated': 0, 'errors': len(batch)}
         
-        for product in batch:
-            try:
-                nowuid = product.get('nowuid')
-                if not nowuid:
-                    skipped += 1
-                    continue
-                
-                # 检查是否已存在
-                exists = self.config.agent_product_prices.find_one({
-                    'agent_bot_id': self.config.AGENT_BOT_ID,
-                    'original_nowuid': nowuid
-                })
-                
-                # 获取商品信息
-                original_price = self._safe_price(product.get('money'))
-                projectname = product.get('projectname', '')
-                leixing = product.get('leixing')
-                
-                # 🔥 存储层保持原样：直接使用原始 leixing，不做转换
-                # 分类统一/映射在展示层（get_product_categories）处理
-                category = leixing
-                
-                now_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                
-                if not exists:
-                    # 插入新商品
-                    agent_markup = self.config.AGENT_DEFAULT_MARKUP
-                    agent_price = round(original_price + agent_markup, 2)
-                    is_active = original_price > 0
-                    
-                    self.config.agent_product_prices.insert_one({
-                        'agent_bot_id': self.config.AGENT_BOT_ID,
-                        'original_nowuid': nowuid,
-                        'agent_markup': agent_markup,
-                        'agent_price': agent_price,
-                        'original_price_snapshot': original_price,
-                        'product_name': projectname,
-                        'category': category,
-                        'is_active': is_active,
-                        'needs_price_set': original_price <= 0,
-                        'auto_created': False,  # 全量同步创建的标记为 False
-                        'synced_at': now_time,
-                        'created_time': now_time,
-                        'updated_time': now_time
-                    })
-                    inserted += 1
-                else:
-                    # 更新已存在的商品
-                    updates = {}
-                    
-                    # 保留原始 projectname 和 leixing，仅在它们变化时更新
-                    if exists.get('product_name') != projectname:
-                        updates['product_name'] = projectname
-                    
-                    if exists.get('category') != category:
-                        updates['category'] = category
-                    
-                    if abs(exists.get('original_price_snapshot', 0) - original_price) > self.PRICE_COMPARISON_EPSILON:
-                        updates['original_price_snapshot'] = original_price
-                        
-                        # 重新计算代理价格
-                        agent_markup = float(exists.get('agent_markup', 0))
-                        new_agent_price = round(original_price + agent_markup, 2)
-                        updates['agent_price'] = new_agent_price
-                    
-                    # 如果之前是待补价状态，现在总部价>0，自动激活
-                    if exists.get('needs_price_set') and original_price > 0:
-                        updates['is_active'] = True
-                        updates['needs_price_set'] = False
-                    
-                    if updates:
-                        # 使用 $set 更新字段，$setOnInsert 确保 synced_at 仅在首次同步时设置
-                        self.config.agent_product_prices.update_one(
-                            {'agent_bot_id': self.config.AGENT_BOT_ID, 'original_nowuid': nowuid},
-                            {
-                                '$set': {**updates, 'updated_time': now_time},
-                                '$setOnInsert': {'synced_at': now_time}
-                            },
-                            upsert=False  # 这里已存在，不需要 upsert
-                        )
-                        updated += 1
-                    else:
-                        skipped += 1
-                        
-            except Exception as e:
-                logger.error(f"[SYNC] 处理商品失败 (nowuid={product.get('nowuid')}): {e}")
-                errors += 1
-                continue
+        now_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ops, stats = build_agent_price_ops(agent_bot_id, batch, existing_map, self.config.AGENT_DEFAULT_MARKUP,
+                                           now_time, auto_created)
+        totals = {'inserted': 0, 'updated': 0, 'skipped': stats['skipped'], 'activated': stats['activated'], 'errors': 0}
+        write_agent_price_ops(self.config.agent_product_prices, ops, totals, f"agent_bot_id={agent_bot_id}")
         
-        return {
-            'inserted': inserted,
-            'updated': updated,
-            'skipped': skipped,
-            'errors': errors
-        }
+        # 本地同步路径：只失效有写操作的商品（无变化的商品保留缓存，每次点击触发的同步不会清空缓存）
+        if stats['changed']:
+            self.product_cache.invalidate(stats['changed'])
+        
+        return totals
     
     def get_sync_diagnostics(self) -> Dict:
         """
@@ -4235,28 +4516,51 @@ class AgentBotCore:
             logger.error(f"❌ 获取库存失败: {e}")
             return 0
 
+    def get_product_stocks(self, nowuids: List[str]) -> Dict[str, int]:
+        """批量获取库存（一次聚合）"""
+        if not nowuids:
+            return {}
+        try:
+            stocks = {nowuid: 0 for nowuid in nowuids}
+            for row in self.config.hb.aggregate([
+                {'$match': {'nowuid': {'$in': list(stocks)}, 'state': 0}},
+                {'$group': {'_id': '$nowuid', 'count': {'$sum': 1}}}
+            ]):
+                stocks[row['_id']] = row['count']
+            return stocks
+        except Exception as e:
+            logger.error(f"❌ 批量获取库存失败: {e}")
+            return {nowuid: 0 for nowuid in nowuids}
+
+    @staticmethod
+    def _compute_agent_price(hq: Optional[Dict], price_doc: Optional[Dict]) -> Optional[float]:
+        """代理价 = 总部价 + 加价（商品未激活时返回 None）"""
+        if not hq or not price_doc or not price_doc.get('is_active', False):
+            return None
+        return round(float(hq.get('money', 0.0)) + float(price_doc.get('agent_markup', 0.0)), 2)
+
+    def get_product_prices(self, nowuids: List[str]) -> Dict[str, Optional[float]]:
+        """批量获取代理价（走商品查询缓存）"""
+        try:
+            records = self.product_cache.get_many(nowuids)
+        except Exception as e:
+            logger.error(f"❌ 批量获取价格失败: {e}")
+            return {nowuid: None for nowuid in nowuids}
+        prices = {}
+        for nowuid, (hq, doc) in records.items():
+            # 单个商品价格字段异常只影响该商品，不影响整页
+            try:
+                prices[nowuid] = self._compute_agent_price(hq, doc)
+            except (TypeError, ValueError) as e:
+                logger.warning(f"⚠️ 商品 {nowuid} 价格字段异常: {e}")
+                prices[nowuid] = None
+        return prices
+
     def get_product_price(self, nowuid: str) -> Optional[float]:
         try:
-            # 获取商品的总部价格（实时）
-            origin = self.config.ejfl.find_one({'nowuid': nowuid})
-            if not origin:
-                return None
-            original_price = float(origin.get('money', 0.0))
-            
-            # 获取代理设置的加价标记
-            doc = self.config.agent_product_prices.find_one({
-                'agent_bot_id': self.config.AGENT_BOT_ID,
-                'original_nowuid': nowuid,
-                'is_active': True
-            })
-            if not doc:
-                return None
-            
-            agent_markup = float(doc.get('agent_markup', 0.0))
-            
-            # ✅ 实时计算：代理价 = 总部价 + 加价
-            agent_price = round(original_price + agent_markup, 2)
-            return agent_price
+            # ✅ 实时计算：代理价 = 总部价 + 加价（记录来自短时缓存，同步事件会使其失效）
+            hq, doc = self.product_cache.get(nowuid)
+            return self._compute_agent_price(hq, doc)
         except Exception as e:
             logger.error(f"❌ 获取价格失败: {e}")
             return None
@@ -4316,6 +4620,7 @@ class AgentBotCore:
                 }}
             )
             if res.modified_count:
+                self.product_cache.invalidate([product_nowuid])
                 profit_rate = (new_markup / op * 100) if op else 0
                 return True, f"价格更新成功！加价 {new_markup:.2f}U，利润率 {profit_rate:.1f}%（基于当前总部价 {op}U）"
             return False, "无变化"
@@ -4336,6 +4641,7 @@ class AgentBotCore:
                 {'agent_bot_id': self.config.AGENT_BOT_ID, 'original_nowuid': product_nowuid},
                 {'$set': {'is_active': new_status, 'updated_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}}
             )
+            self.product_cache.invalidate([product_nowuid])
             return True, ("商品已启用" if new_status else "商品已禁用")
         except Exception as e:
             logger.error(f"❌ 切换状态失败: {e}")
@@ -4444,19 +4750,16 @@ class AgentBotCore:
             self.config.withdrawal_requests.insert_one(doc)
 
             if self.config.AGENT_NOTIFY_CHAT_ID:  # ✅ 正确
-                try:
-                    Bot(self.config.BOT_TOKEN).send_message(
-                        chat_id=self.config.AGENT_NOTIFY_CHAT_ID,  # ✅ 修复：使用实例配置
-                        text=(f"📢 <b>代理提现申请</b>\n\n"
-                              f"🏢 代理ID：<code>{self._h(self.config.AGENT_BOT_ID)}</code>\n"
-                              f"👤 用户：{self._link_user(user_id)}\n"
-                              f"💰 金额：<b>{amount:.2f} USDT</b>\n"
-                              f"🏦 地址：<code>{self._h(withdrawal_address)}</code>\n"
-                              f"⏰ 时间：{now.strftime('%Y-%m-%d %H:%M:%S')}"),
-                        parse_mode=ParseMode.HTML
-                    )
-                except Exception as ne:
-                    logger.warning(f"总部通知发送失败: {ne}")
+                self.outbox.enqueue(
+                    self.config.AGENT_NOTIFY_CHAT_ID,
+                    f"📢 <b>代理提现申请</b>\n\n"
+                    f"🏢 代理ID：<code>{self._h(self.config.AGENT_BOT_ID)}</code>\n"
+                    f"👤 用户：{self._link_user(user_id)}\n"
+                    f"💰 金额：<b>{amount:.2f} USDT</b>\n"
+                    f"🏦 地址：<code>{self._h(withdrawal_address)}</code>\n"
+                    f"⏰ 时间：{now.strftime('%Y-%m-%d %H:%M:%S')}",
+                    parse_mode=ParseMode.HTML
+                )
 
             return True, "提现申请已提交，等待审核"
         except Exception as e:
@@ -4559,7 +4862,7 @@ class AgentBotCore:
             "• 必须精确到 4 位小数的“应付金额”\n"
             "• 系统自动监听入账，无需手动校验"
         )
-        Bot(self.config.BOT_TOKEN).send_message(
+        get_bot(self.config.BOT_TOKEN).send_message(
             chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup
         )
 
@@ -4584,7 +4887,7 @@ class AgentBotCore:
                 "• 系统自动监听入账，无需手动校验"
             )
             if bio:
-                Bot(self.config.BOT_TOKEN).send_photo(
+                get_bot(self.config.BOT_TOKEN).send_photo(
                     chat_id=chat_id,
                     photo=bio,
                     caption=caption,
@@ -4806,7 +5109,7 @@ class AgentBotCore:
             self.config.get_agent_user_collection().update_one(
                 {'user_id': order['user_id']},
                 {'$inc': {'USDT': amt},
-                 '$set': {'last_active': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}}
+                 '$set': self._with_timer_datetimes({'last_active': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})}
             )
             user_doc = self.config.get_agent_user_collection().find_one(
                 {'user_id': order['user_id']}, {'USDT': 1}
@@ -4815,7 +5118,6 @@ class AgentBotCore:
 
             # 用户通知
             try:
-                bot = Bot(self.config.BOT_TOKEN)
                 friendly_time = self._to_beijing(paid_time).strftime('%Y-%m-%d %H:%M:%S')
                 tx_short = (tx_id[:12] + '...') if tx_id and len(tx_id) > 12 else (tx_id or '-')
                 msg = (
@@ -4831,7 +5133,8 @@ class AgentBotCore:
                      InlineKeyboardButton("👤 个人中心", callback_data="profile")],
                     [InlineKeyboardButton("📜 充值记录", callback_data="recharge_list")]
                 ])
-                bot.send_message(chat_id=order['user_id'], text=msg, reply_markup=kb)
+                log_failure(outbound.send_message(self.config.BOT_TOKEN, order['user_id'], msg, reply_markup=kb),
+                            '用户充值成功通知')
             except Exception as ue:
                 logger.warning(f"用户充值成功通知发送失败: {ue}")
 
@@ -4847,10 +5150,10 @@ class AgentBotCore:
                         f"🏦 收款地址：<code>{self._h(self.config.AGENT_USDT_ADDRESS)}</code>\n"
                         f"🔗 TX：<code>{self._h(tx_short)}</code>"
                     )
-                    Bot(self.config.BOT_TOKEN).send_message(
-                        chat_id=self.config.AGENT_NOTIFY_CHAT_ID,  # ✅ 修复：使用实例配置
-                        text=text,
-                        parse_mode=ParseMode.HTML,
+                    self.outbox.enqueue(
+                        self.config.AGENT_NOTIFY_CHAT_ID, text, parse_mode=ParseMode.HTML,
+                        topic='recharge', title='✅ 充值入账',
+                        digest=f"{self._link_user(order['user_id'])} · {amt:.2f} {self._h(self.config.TOKEN_SYMBOL)}",
                         reply_markup=self._kb_tx_addr_user(tx_id, self.config.AGENT_USDT_ADDRESS, order['user_id'])
                     )
                 except Exception as ne:
@@ -4893,7 +5196,7 @@ class AgentBotCore:
             # ✅ Translate product name (with year prefix support)
             translated_product_name = self.translate_product_name(user_id, product_name)
             
-            bot = Bot(self.config.BOT_TOKEN)
+            bot = get_bot(self.config.BOT_TOKEN)
             first = items[0]
             item_type = first.get('leixing', '')
             nowuid = first.get('nowuid', '')
@@ -4982,18 +5285,11 @@ class AgentBotCore:
             if not user:
                 return False, "用户不存在"
 
-            # ✅ 获取商品原始信息
-            product = self.config.ejfl.find_one({'nowuid': product_nowuid})
+            # ✅ 获取商品原始信息 + 代理价格配置（共用商品查询缓存）
+            product, price_cfg = self.product_cache.get(product_nowuid)
             if not product:
                 return False, "原始商品不存在"
-
-            # ✅ 获取代理价格配置
-            price_cfg = self.config.agent_product_prices.find_one({
-                'agent_bot_id': self.config.AGENT_BOT_ID,
-                'original_nowuid': product_nowuid,
-                'is_active': True
-            })
-            if not price_cfg:
+            if not price_cfg or not price_cfg.get('is_active', False):
                 return False, "商品不存在或已下架"
 
             # ✅ 获取库存
@@ -5018,7 +5314,7 @@ class AgentBotCore:
             new_balance = balance - total_cost
             coll_users.update_one(
                 {'user_id': user_id},
-                {'$set': {'USDT': new_balance, 'last_active': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+                {'$set': self._with_timer_datetimes({'USDT': new_balance, 'last_active': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}),
                  '$inc': {'zgje': total_cost, 'zgsl': quantity}}
             )
             
@@ -5053,7 +5349,7 @@ class AgentBotCore:
                 self.update_profit_account(total_profit)
 
             order_coll = self.config.get_agent_gmjlu_collection()
-            order_coll.insert_one({
+            order_coll.insert_one(self._with_timer_datetimes({
                 'leixing': 'purchase',
                 'bianhao': order_id,
                 'user_id': user_id,
@@ -5072,7 +5368,9 @@ class AgentBotCore:
                 'item_ids': ids,  # 所有已售出商品的 ObjectId 列表
                 'first_item_id': str(ids[0]) if ids else '',  # 第一个商品ID（向后兼容/调试）
                 'category': product.get('leixing', '')  # 商品分类
-            })
+            }))
+            self.metrics.mark_dirty()
+            self._record_analytics({'gmjlu_sales': float(total_cost), 'gmjlu_count': 1})
 
             # ✅ 群通知（新版格式）
             try:
@@ -5081,12 +5379,10 @@ class AgentBotCore:
                     profit_per_unit = agent_markup
                     total_value = total_cost
                     
-                    # 获取机器人用户名
+                    # 机器人用户名（Bot 实例缓存 get_me 结果）
                     bot_username = None
                     try:
-                        bot = Bot(self.config.BOT_TOKEN)
-                        bot_info = bot.get_me()
-                        bot_username = bot_info.username
+                        bot_username = get_bot(self.config.BOT_TOKEN).username
                     except Exception as e:
                         logger.warning(f"⚠️ 获取机器人用户名失败: {e}")
                     
@@ -5112,38 +5408,14 @@ class AgentBotCore:
                         bot_username=bot_username
                     )
                     
-                    # 发送群通知
-                    try:
-                        Bot(self.config.BOT_TOKEN).send_message(
-                            chat_id=self.config.AGENT_NOTIFY_CHAT_ID,
-                            text=text,
-                            parse_mode=ParseMode.HTML,
-                            reply_markup=self._kb_purchase_notify(product_nowuid, user_id)
-                        )
-                        logger.info(f"✅ 购买群通知发送成功: 订单 {order_id}")
-                    except Exception as send_err:
-                        logger.error(f"❌ 购买群通知发送失败: {send_err}")
-                        # 尝试不使用HTML格式重新发送（回退方案）
-                        try:
-                            simple_text = (
-                                f"🛒 用户购买通知\n\n"
-                                f"订单号: {order_id}\n"
-                                f"用户: {user_id}\n"
-                                f"商品: {product.get('projectname', '')}\n"
-                                f"数量: {quantity}\n"
-                                f"总额: {total_cost:.2f}U\n"
-                                f"利润: {total_profit:.2f}U"
-                            )
-                            Bot(self.config.BOT_TOKEN).send_message(
-                                chat_id=self.config.AGENT_NOTIFY_CHAT_ID,
-                                text=simple_text,
-                                reply_markup=self._kb_purchase_notify(product_nowuid, user_id)
-                            )
-                            logger.info(f"✅ 购买群通知（简化版）发送成功: 订单 {order_id}")
-                        except Exception as fallback_err:
-                            logger.error(f"❌ 购买群通知回退方案也失败: {fallback_err}")
-                            import traceback
-                            traceback.print_exc()
+                    # 写入发件箱（合并窗口内的多笔购买合并为一条摘要）
+                    self.outbox.enqueue(
+                        self.config.AGENT_NOTIFY_CHAT_ID, text, parse_mode=ParseMode.HTML,
+                        topic='purchase', title='🛒 用户购买通知',
+                        digest=f"{self._link_user(user_id)} · {self._h(product.get('projectname', ''))} × {quantity}"
+                               f" · {total_cost:.2f}U（利润 {total_profit:.2f}U）",
+                        reply_markup=self._kb_purchase_notify(product_nowuid, user_id)
+                    )
                 else:
                     logger.warning(f"⚠️ AGENT_NOTIFY_CHAT_ID 未配置，跳过群通知发送")
             except Exception as ne:
@@ -5227,42 +5499,183 @@ class AgentBotCore:
             }
             
     # ---------- 统计 ----------
-    def get_sales_statistics(self, days: int = 30) -> Dict:
-        try:
-            end = datetime.now(); start = end - timedelta(days=days)
-            s_str = start.strftime('%Y-%m-%d %H:%M:%S')
-            e_str = end.strftime('%Y-%m-%d %H:%M:%S')
-            coll = self.config.get_agent_gmjlu_collection()
-            base = list(coll.aggregate([
-                {'$match': {'leixing': 'purchase', 'timer': {'$gte': s_str, '$lte': e_str}}},
-                {'$group': {'_id': None, 'total_orders': {'$sum': 1},
-                            'total_revenue': {'$sum': '$ts'}, 'total_quantity': {'$sum': '$count'}}}
-            ]))
-            today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).strftime('%Y-%m-%d %H:%M:%S')
-            today = list(coll.aggregate([
-                {'$match': {'leixing': 'purchase', 'timer': {'$gte': today_start}}},
-                {'$group': {'_id': None, 'today_orders': {'$sum': 1},
-                            'today_revenue': {'$sum': '$ts'}, 'today_quantity': {'$sum': '$count'}}}
-            ]))
-            popular = list(coll.aggregate([
-                {'$match': {'leixing': 'purchase', 'timer': {'$gte': s_str, '$lte': e_str}}},
+    @staticmethod
+    def _facet_count(result: List[Dict], name: str) -> int:
+        rows = result[0].get(name) if result else None
+        return rows[0]['n'] if rows else 0
+
+    @staticmethod
+    def _facet_first(result: List[Dict], name: str) -> Dict:
+        rows = result[0].get(name) if result else None
+        return rows[0] if rows else {}
+
+    def _sales_metrics(self, periods) -> Dict:
+        """一次 $facet 计算多个周期的销售汇总/热销TOP5、今日数据与近7天趋势"""
+        coll = self.config.get_agent_gmjlu_collection()
+        now = datetime.now()
+        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        totals = {'$group': {'_id': None, 'total_orders': {'$sum': 1},
+                             'total_revenue': {'$sum': '$ts'}, 'total_quantity': {'$sum': '$count'}}}
+        facets = {
+            'today': [{'$match': self._timer_filter(coll, 'timer', today_start)}, totals],
+            'trends': [
+                {'$match': self._timer_filter(coll, 'timer', now - timedelta(days=7))},
+                {'$addFields': {'date_only': {'$substr': ['$timer', 0, 10]}}},
+                {'$group': {'_id': '$date_only', 'daily_revenue': {'$sum': '$ts'}, 'daily_orders': {'$sum': 1}}},
+                {'$sort': {'_id': 1}}
+            ],
+        }
+        for days in periods:
+            period_match = {'$match': self._timer_filter(coll, 'timer', now - timedelta(days=days), now)}
+            facets[f'total_{days}'] = [period_match, totals]
+            facets[f'popular_{days}'] = [
+                period_match,
                 {'$group': {'_id': '$projectname', 'total_sold': {'$sum': '$count'},
                             'total_revenue': {'$sum': '$ts'}, 'order_count': {'$sum': 1}}},
                 {'$sort': {'total_sold': -1}},
                 {'$limit': 5}
-            ]))
-            result = {
+            ]
+        longest = now - timedelta(days=max(list(periods) + [7]))
+        result = list(coll.aggregate([
+            {'$match': {'leixing': 'purchase', **self._timer_filter(coll, 'timer', longest)}},
+            {'$facet': facets}
+        ], allowDiskUse=True))
+
+        today = self._facet_first(result, 'today')
+        trends = result[0].get('trends', []) if result else []
+        sales, financial = {}, {}
+        for days in periods:
+            base = self._facet_first(result, f'total_{days}')
+            orders, revenue = base.get('total_orders', 0), base.get('total_revenue', 0.0)
+            avg = round(revenue / max(orders, 1), 2)
+            sales[str(days)] = {
                 'period_days': days,
-                'total_orders': base[0]['total_orders'] if base else 0,
-                'total_revenue': base[0]['total_revenue'] if base else 0.0,
-                'total_quantity': base[0]['total_quantity'] if base else 0,
-                'today_orders': today[0]['today_orders'] if today else 0,
-                'today_revenue': today[0]['today_revenue'] if today else 0.0,
-                'today_quantity': today[0]['today_quantity'] if today else 0,
-                'popular_products': popular,
-                'avg_order_value': round((base[0]['total_revenue'] / max(base[0]['total_orders'], 1)), 2) if base else 0.0
+                'total_orders': orders,
+                'total_revenue': revenue,
+                'total_quantity': base.get('total_quantity', 0),
+                'today_orders': today.get('total_orders', 0),
+                'today_revenue': today.get('total_revenue', 0.0),
+                'today_quantity': today.get('total_quantity', 0),
+                'popular_products': result[0].get(f'popular_{days}', []) if result else [],
+                'avg_order_value': avg
             }
-            return result
+            financial[str(days)] = {
+                'period_days': days,
+                'total_revenue': revenue,
+                'estimated_profit': revenue * 0.2,
+                'profit_margin': 20.0,
+                'order_count': orders,
+                'avg_order_value': avg,
+                'daily_trends': trends,
+                'revenue_growth': 0.0
+            }
+        return {'sales': sales, 'financial': financial}
+
+    def _user_metrics(self) -> Dict:
+        users = self.config.get_agent_user_collection()
+        today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        numeric_zgje = {'$in': [{'$type': '$zgje'}, ['double', 'int', 'long', 'decimal']]}
+
+        def level(cond):
+            return {'$sum': {'$cond': [{'$and': [numeric_zgje, cond]}, 1, 0]}}
+
+        result = list(users.aggregate([{'$facet': {
+            'total': [{'$count': 'n'}],
+            'active': [{'$match': self._timer_filter(users, 'last_active', datetime.now() - timedelta(days=7))},
+                       {'$count': 'n'}],
+            'today_new': [{'$match': self._timer_filter(users, 'register_time', today_start)}, {'$count': 'n'}],
+            'balance': [{'$group': {
+                '_id': None, 'total_balance': {'$sum': '$USDT'},
+                'avg_balance': {'$avg': '$USDT'}, 'total_spent': {'$sum': '$zgje'},
+                'bronze': level({'$lt': ['$zgje', 50]}),
+                'silver': level({'$and': [{'$gte': ['$zgje', 50]}, {'$lt': ['$zgje', 100]}]}),
+                'gold': level({'$gte': ['$zgje', 100]}),
+            }}],
+        }}]))
+        total = self._facet_count(result, 'total')
+        active = self._facet_count(result, 'active')
+        bal = self._facet_first(result, 'balance')
+        return {
+            'total_users': total,
+            'active_users': active,
+            'today_new_users': self._facet_count(result, 'today_new'),
+            'total_balance': bal.get('total_balance') or 0.0,
+            'avg_balance': round(bal.get('avg_balance') or 0.0, 2),
+            'total_spent': bal.get('total_spent') or 0.0,
+            'spending_levels': {k: bal.get(k, 0) for k in ('bronze', 'silver', 'gold')},
+            'activity_rate': round((active / max(total, 1)) * 100, 1)
+        }
+
+    def _hq_stock_metrics(self) -> Dict:
+        """总部库存按类型汇总：所有代理共享一份（agent_metrics_snapshots._id='hq_stock'），过期才重算"""
+        shared = self.config.agent_metrics_snapshots
+        doc = shared.find_one({'_id': 'hq_stock'})
+        if doc and time.time() - doc.get('built_at', 0) < self.config.AGENT_METRICS_REFRESH_SECONDS:
+            return doc
+        rows = list(self.config.hb.aggregate([
+            {'$group': {
+                '_id': '$leixing',
+                'stock_count': {'$sum': {'$cond': [{'$eq': ['$state', 0]}, 1, 0]}},
+                'sold_count': {'$sum': {'$cond': [{'$eq': ['$state', 1]}, 1, 0]}},
+            }},
+            {'$sort': {'stock_count': -1}}
+        ], allowDiskUse=True))
+        doc = {
+            'built_at': time.time(),
+            'stock_by_category': [{'_id': r['_id'], 'stock_count': r['stock_count']} for r in rows if r['stock_count']],
+            'total_stock': sum(r['stock_count'] for r in rows),
+            'sold_stock': sum(r['sold_count'] for r in rows),
+        }
+        shared.replace_one({'_id': 'hq_stock'}, doc, upsert=True)
+        return doc
+
+    def _product_metrics(self) -> Dict:
+        result = list(self.config.agent_product_prices.aggregate([
+            {'$match': {'agent_bot_id': self.config.AGENT_BOT_ID}},
+            {'$group': {
+                '_id': None,
+                'total': {'$sum': 1},
+                'active': {'$sum': {'$cond': [{'$eq': ['$is_active', True]}, 1, 0]}},
+                'avg_profit_rate': {'$avg': '$profit_rate'},
+                'highest_profit_rate': {'$max': '$profit_rate'},
+                'lowest_profit_rate': {'$min': '$profit_rate'}
+            }}
+        ]))
+        p = result[0] if result else {}
+        stock = self._hq_stock_metrics()
+        total, active = p.get('total', 0), p.get('active', 0)
+        total_stock, sold_stock = stock['total_stock'], stock['sold_stock']
+        return {
+            'total_products': total,
+            'active_products': active,
+            'inactive_products': total - active,
+            'total_stock': total_stock,
+            'sold_stock': sold_stock,
+            'stock_by_category': stock['stock_by_category'],
+            'avg_profit_rate': round(p.get('avg_profit_rate') or 0.0, 1),
+            'highest_profit_rate': round(p.get('highest_profit_rate') or 0.0, 1),
+            'lowest_profit_rate': round(p.get('lowest_profit_rate') or 0.0, 1),
+            'stock_turnover_rate': round((sold_stock / max(sold_stock + total_stock, 1)) * 100, 1)
+        }
+
+    def compute_metrics_snapshot(self) -> Dict:
+        """一次性计算报表所需的全部指标（供 AgentMetricsSnapshot 使用）"""
+        data = self._sales_metrics(AgentMetricsSnapshot.PERIODS)
+        data['users'] = self._user_metrics()
+        data['products'] = self._product_metrics()
+        return data
+
+    def _snapshot_section(self, section: str, days: Optional[int] = None) -> Optional[Dict]:
+        snap = self.metrics.get()
+        value = snap.get(section)
+        if value is not None and days is not None:
+            value = value.get(str(days))
+        return value
+
+    def get_sales_statistics(self, days: int = 30) -> Dict:
+        try:
+            stats = self._snapshot_section('sales', days)
+            return stats if stats is not None else self._sales_metrics((days,))['sales'][str(days)]
         except Exception as e:
             logger.error(f"❌ 销售统计失败: {e}")
             return {
@@ -5273,31 +5686,8 @@ class AgentBotCore:
 
     def get_user_statistics(self) -> Dict:
         try:
-            users = self.config.get_agent_user_collection()
-            total = users.count_documents({})
-            active_date = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-            active = users.count_documents({'last_active': {'$gte': active_date}})
-            today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).strftime('%Y-%m-%d %H:%M:%S')
-            today_new = users.count_documents({'register_time': {'$gte': today_start}})
-            bal_data = list(users.aggregate([{'$group': {
-                '_id': None, 'total_balance': {'$sum': '$USDT'},
-                'avg_balance': {'$avg': '$USDT'}, 'total_spent': {'$sum': '$zgje'}
-            }}]))
-            spending_levels = {
-                'bronze': users.count_documents({'zgje': {'$lt': 50}}),
-                'silver': users.count_documents({'zgje': {'$gte': 50, '$lt': 100}}),
-                'gold': users.count_documents({'zgje': {'$gte': 100}})
-            }
-            return {
-                'total_users': total,
-                'active_users': active,
-                'today_new_users': today_new,
-                'total_balance': bal_data[0]['total_balance'] if bal_data else 0.0,
-                'avg_balance': round(bal_data[0]['avg_balance'], 2) if bal_data else 0.0,
-                'total_spent': bal_data[0]['total_spent'] if bal_data else 0.0,
-                'spending_levels': spending_levels,
-                'activity_rate': round((active / max(total, 1)) * 100, 1)
-            }
+            stats = self._snapshot_section('users')
+            return stats if stats is not None else self._user_metrics()
         except Exception as e:
             logger.error(f"❌ 用户统计失败: {e}")
             return {
@@ -5308,34 +5698,8 @@ class AgentBotCore:
 
     def get_product_statistics(self) -> Dict:
         try:
-            total = self.config.agent_product_prices.count_documents({'agent_bot_id': self.config.AGENT_BOT_ID})
-            active = self.config.agent_product_prices.count_documents({'agent_bot_id': self.config.AGENT_BOT_ID, 'is_active': True})
-            stock_pipeline = [
-                {'$match': {'state': 0}},
-                {'$group': {'_id': '$leixing', 'stock_count': {'$sum': 1}}},
-                {'$sort': {'stock_count': -1}}
-            ]
-            stock_by_category = list(self.config.hb.aggregate(stock_pipeline))
-            total_stock = self.config.hb.count_documents({'state': 0})
-            sold_stock = self.config.hb.count_documents({'state': 1})
-            price_stats = list(self.config.agent_product_prices.aggregate([
-                {'$match': {'agent_bot_id': self.config.AGENT_BOT_ID}},
-                {'$group': {'_id': None, 'avg_profit_rate': {'$avg': '$profit_rate'},
-                            'highest_profit_rate': {'$max': '$profit_rate'},
-                            'lowest_profit_rate': {'$min': '$profit_rate'}}}
-            ]))
-            return {
-                'total_products': total,
-                'active_products': active,
-                'inactive_products': total - active,
-                'total_stock': total_stock,
-                'sold_stock': sold_stock,
-                'stock_by_category': stock_by_category,
-                'avg_profit_rate': round(price_stats[0]['avg_profit_rate'], 1) if price_stats else 0.0,
-                'highest_profit_rate': round(price_stats[0]['highest_profit_rate'], 1) if price_stats else 0.0,
-                'lowest_profit_rate': round(price_stats[0]['lowest_profit_rate'], 1) if price_stats else 0.0,
-                'stock_turnover_rate': round((sold_stock / max(sold_stock + total_stock, 1)) * 100, 1)
-            }
+            stats = self._snapshot_section('products')
+            return stats if stats is not None else self._product_metrics()
         except Exception as e:
             logger.error(f"❌ 商品统计失败: {e}")
             return {
@@ -5347,31 +5711,8 @@ class AgentBotCore:
 
     def get_financial_statistics(self, days: int = 30) -> Dict:
         try:
-            end = datetime.now(); start = end - timedelta(days=days)
-            s_str = start.strftime('%Y-%m-%d %H:%M:%S')
-            coll = self.config.get_agent_gmjlu_collection()
-            revenue = list(coll.aggregate([
-                {'$match': {'leixing': 'purchase', 'timer': {'$gte': s_str}}},
-                {'$group': {'_id': None, 'total_revenue': {'$sum': '$ts'}, 'order_count': {'$sum': 1}}}
-            ]))
-            trends = list(coll.aggregate([
-                {'$match': {'leixing': 'purchase', 'timer': {'$gte': (end - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')}}},
-                {'$addFields': {'date_only': {'$substr': ['$timer', 0, 10]}}},
-                {'$group': {'_id': '$date_only', 'daily_revenue': {'$sum': '$ts'}, 'daily_orders': {'$sum': 1}}},
-                {'$sort': {'_id': 1}}
-            ]))
-            total_rev = revenue[0]['total_revenue'] if revenue else 0.0
-            order_cnt = revenue[0]['order_count'] if revenue else 0
-            return {
-                'period_days': days,
-                'total_revenue': total_rev,
-                'estimated_profit': total_rev * 0.2,
-                'profit_margin': 20.0,
-                'order_count': order_cnt,
-                'avg_order_value': round(total_rev / max(order_cnt, 1), 2),
-                'daily_trends': trends,
-                'revenue_growth': 0.0
-            }
+            stats = self._snapshot_section('financial', days)
+            return stats if stats is not None else self._sales_metrics((days,))['financial'][str(days)]
         except Exception as e:
             logger.error(f"❌ 财务统计失败: {e}")
             return {
@@ -5439,7 +5780,7 @@ class AgentBotHandlers:
                     try:
                         chat_id = query.message.chat_id
                         query.message.delete()
-                        Bot(self.core.config.BOT_TOKEN).send_message(
+                        get_bot(self.core.config.BOT_TOKEN).send_message(
                             chat_id=chat_id, text=text, reply_markup=markup, parse_mode=parse_mode
                         )
                     except Exception as e_del:
@@ -5679,6 +6020,7 @@ class AgentBotHandlers:
 • 代理商品数: {result['total_agent']}
 
 ⏱️ <b>耗时:</b> {result['elapsed']} 秒
+🚀 <b>吞吐量:</b> {result.get('rate', 0)} 个/秒
 
 💡 使用 /diag_sync_stats 查看详细诊断信息"""
             
@@ -5735,6 +6077,14 @@ class AgentBotHandlers:
                 if diag['suggest_full_resync']:
                     sync_suggestion = "\n\n⚠️ <b>建议执行全量同步</b>\n使用 /resync_hq_products 命令"
                 
+                # 最近一次全量同步吞吐量
+                last_full = self.core.last_full_sync_stats
+                if last_full:
+                    throughput_str = (f"\n{last_full['finished_at']} · {last_full['total_hq']} 个 · "
+                                      f"{last_full['elapsed']} 秒 · {last_full.get('rate', 0)} 个/秒")
+                else:
+                    throughput_str = "\n本进程尚未执行全量同步"
+                
                 text = f"""📊 <b>同步诊断统计</b>
 
 📈 <b>商品数量对比:</b>
@@ -5750,7 +6100,13 @@ class AgentBotHandlers:
 📊 <b>代理分类分布</b> (前10项):{agent_cats_str}
 
 🕐 <b>最近同步时间:</b>
-{diag['last_sync_time']}{sync_suggestion}"""
+{diag['last_sync_time']}
+
+🚀 <b>最近全量同步吞吐量:</b>{throughput_str}
+
+🔌 <b>Telegram 客户端:</b>
+{format_client_metrics()}
+{outbound.format_metrics()}{sync_suggestion}"""
             
             # 更新消息
             msg.edit_text(text, parse_mode=ParseMode.HTML)
@@ -5965,11 +6321,30 @@ Refresh Time: {refresh_time}
             uid = query.from_user.id
             self.safe_edit_message(query, self.core.t(uid, 'error.load_failed'), [[InlineKeyboardButton(self.core.t(uid, 'common.back_main'), callback_data="back_main")]], parse_mode=None)
             
+    def _attach_stock_and_price(self, products: List[Dict]) -> List[Dict]:
+        """为商品批量附加库存与代理价，过滤无库存/未定价商品，按库存降序"""
+        nowuids = [p['nowuid'] for p in products if p.get('nowuid')]
+        stocks = self.core.get_product_stocks(nowuids)
+        prices = self.core.get_product_prices(nowuids)
+        result = []
+        for p in products:
+            nowuid = p.get('nowuid')
+            stock = stocks.get(nowuid, 0)
+            price = prices.get(nowuid)
+            if not nowuid or stock <= 0 or price is None or price <= 0:
+                continue
+            p['stock'] = stock
+            p['price'] = price
+            result.append(p)
+        result.sort(key=lambda x: -x['stock'])
+        return result
+
     def show_category_products(self, query, category: str, page: int = 1):
         """显示分类下的商品（二级分类）- 支持HQ克隆模式 + 统一协议号分类"""
         try:
-            # ✅ 先自动同步新商品，确保最新商品能显示
-            self.core.auto_sync_new_products()
+            # ✅ 先自动同步新商品，确保最新商品能显示（总部发布器在线时已由其推送，无需每次点击全量比对）
+            if not self.core.uses_hq_sync_publisher():
+                self.core.auto_sync_new_products()
             
             skip = (page - 1) * 10
             
@@ -6059,26 +6434,15 @@ Refresh Time: {refresh_time}
                     
                     products = list(self.core.config.ejfl.aggregate(pipeline))
                     
-                    # 提取商品信息并计算库存和价格
-                    products_with_stock = []
+                    # ✅ 聚合结果已包含总部记录和代理价格记录，直接写入商品查询缓存
+                    agent_bot_id = self.core.config.AGENT_BOT_ID
                     for p in products:
-                        nowuid = p.get('nowuid')
-                        if not nowuid:
-                            continue
-                        
-                        # 获取库存
-                        stock = self.core.get_product_stock(nowuid)
-                        if stock <= 0:
-                            continue
-                        
-                        # 获取价格
-                        price = self.core.get_product_price(nowuid)
-                        if price is None or price <= 0:
-                            continue
-                        
-                        p['stock'] = stock
-                        p['price'] = price
-                        products_with_stock.append(p)
+                        if p.get('nowuid'):
+                            price_doc = next((d for d in p.get('agent_price', []) if d.get('agent_bot_id') == agent_bot_id), None)
+                            self.core.product_cache.put(p['nowuid'], p, price_doc)
+                    
+                    # 提取商品信息并计算库存和价格（库存一次聚合，价格走缓存）
+                    products_with_stock = self._attach_stock_and_price(products)
                     
                     # 按库存降序排列
                     products_with_stock.sort(key=lambda x: -x['stock'])
@@ -6181,31 +6545,15 @@ Refresh Time: {refresh_time}
             
             price_docs = list(self.core.config.agent_product_prices.aggregate(pipeline))
             
-            # ✅ 提取商品信息并计算库存和价格
-            products_with_stock = []
+            # ✅ 提取商品信息并写入商品查询缓存，再批量计算库存和价格
+            products = []
             for pdoc in price_docs:
                 if not pdoc.get('product_info'):
                     continue
-                
-                p = pdoc['product_info'][0]
-                nowuid = p.get('nowuid')
-                
-                # 获取库存
-                stock = self.core.get_product_stock(nowuid)
-                if stock <= 0:
-                    continue
-                
-                # 获取价格
-                price = self.core.get_product_price(nowuid)
-                if price is None or price <= 0:
-                    continue
-                
-                p['stock'] = stock
-                p['price'] = price
-                products_with_stock.append(p)
-            
-            # 按库存降序排列
-            products_with_stock.sort(key=lambda x: -x['stock'])
+                p = pdoc.pop('product_info')[0]
+                self.core.product_cache.put(p.get('nowuid'), p, pdoc)
+                products.append(p)
+            products_with_stock = self._attach_stock_and_price(products)
             
             # ✅ 文本格式
             uid = query.from_user.id
@@ -6264,12 +6612,13 @@ Refresh Time: {refresh_time}
         """显示商品详情 - 完全仿照总部格式"""
         try:
             uid = query.from_user.id
-            prod = self.core.config.ejfl.find_one({'nowuid': nowuid})
+            # ✅ 总部记录与代理价格记录一次取出（商品查询缓存）
+            prod, agent_price_info = self.core.product_cache.get(nowuid)
             if not prod:
                 self.safe_edit_message(query, self.core.t(uid, 'products.not_exist'), [[InlineKeyboardButton(self.core.t(uid, 'common.back'), callback_data="back_products")]], parse_mode=None)
                 return
             
-            price = self.core.get_product_price(nowuid)
+            price = self.core._compute_agent_price(prod, agent_price_info)
             stock = self.core.get_product_stock(nowuid)
             
             if price is None:
@@ -6277,10 +6626,6 @@ Refresh Time: {refresh_time}
                 return
             
             # ✅ 获取商品在代理价格表中的分类（统一后的分类）
-            agent_price_info = self.core.config.agent_product_prices.find_one({
-                'agent_bot_id': self.core.config.AGENT_BOT_ID,
-                'original_nowuid': nowuid
-            })
             # 使用统一后的分类，如果没有则回退到原leixing
             category = agent_price_info.get('category') if agent_price_info else (prod.get('leixing') or AGENT_PROTOCOL_CATEGORY_UNIFIED)
             
@@ -6321,8 +6666,8 @@ Refresh Time: {refresh_time}
     def handle_buy_product(self, query, nowuid: str):
         """处理购买流程 - 完全仿照总部格式"""
         uid = query.from_user.id
-        prod = self.core.config.ejfl.find_one({'nowuid': nowuid})
-        price = self.core.get_product_price(nowuid)
+        prod, price_doc = self.core.product_cache.get(nowuid)
+        price = self.core._compute_agent_price(prod, price_doc)
         stock = self.core.get_product_stock(nowuid)
         user = self.core.get_user_info(uid)
         bal = user.get('USDT', 0) if user else 0
@@ -6388,8 +6733,8 @@ Refresh Time: {refresh_time}
         
         st = self.user_states[uid]
         nowuid = st['product_nowuid']
-        prod = self.core.config.ejfl.find_one({'nowuid': nowuid})
-        price = self.core.get_product_price(nowuid)
+        prod, price_doc = self.core.product_cache.get(nowuid)
+        price = self.core._compute_agent_price(prod, price_doc)
         stock = self.core.get_product_stock(nowuid)
         user = self.core.get_user_info(uid)
         bal = user.get('USDT', 0) if user else 0
@@ -6843,11 +7188,12 @@ Refresh Time: {refresh_time}
                 text += f"{i}. {self.H(p['_id'])}  数量:{p['total_sold']}  销售:{p['total_revenue']:.2f}U\n"
         else:
             text += "暂无数据\n"
+        text += f"\n⏰ 数据时间：{self.core.metrics.as_of()}"
         kb = [
             [InlineKeyboardButton("📅 7天", callback_data="report_sales_7"),
              InlineKeyboardButton("📅 30天", callback_data="report_sales_30"),
              InlineKeyboardButton("📅 90天", callback_data="report_sales_90")],
-            [InlineKeyboardButton("🔄 刷新", callback_data=f"report_sales_{days}"),
+            [InlineKeyboardButton("🔄 刷新", callback_data=f"report_refresh_sales_{days}"),
              InlineKeyboardButton("🔙 返回报表", callback_data="system_reports")]
         ]
         self.safe_edit_message(query, text, kb, parse_mode=None)
@@ -6857,8 +7203,9 @@ Refresh Time: {refresh_time}
         text = (f"👥 用户统计报表\n"
                 f"总:{st['total_users']}  活跃:{st['active_users']}  今日新增:{st['today_new_users']}  活跃率:{st['activity_rate']}%\n"
                 f"余额总:{st['total_balance']:.2f}U  平均:{st['avg_balance']:.2f}U  消费总:{st['total_spent']:.2f}U\n"
-                f"等级分布  铜:{st['spending_levels']['bronze']}  银:{st['spending_levels']['silver']}  金:{st['spending_levels']['gold']}")
-        kb=[[InlineKeyboardButton("🔄 刷新", callback_data="report_users"),
+                f"等级分布  铜:{st['spending_levels']['bronze']}  银:{st['spending_levels']['silver']}  金:{st['spending_levels']['gold']}\n\n"
+                f"⏰ 数据时间：{self.core.metrics.as_of()}")
+        kb=[[InlineKeyboardButton("🔄 刷新", callback_data="report_refresh_users"),
              InlineKeyboardButton("🔙 返回报表", callback_data="system_reports")]]
         self.safe_edit_message(query, text, kb, parse_mode=None)
 
@@ -6868,8 +7215,9 @@ Refresh Time: {refresh_time}
         text = (f"📊 系统概览报表(30天)\n\n"
                 f"用户:{u['total_users']}  活跃:{u['active_users']}  今日新增:{u['today_new_users']}\n"
                 f"订单:{s['total_orders']}  销售:{s['total_revenue']:.2f}U  今日:{s['today_revenue']:.2f}U\n"
-                f"平均订单额:{s['avg_order_value']:.2f}U  活跃率:{u['activity_rate']}%")
-        kb=[[InlineKeyboardButton("🔄 刷新", callback_data="report_overview_quick"),
+                f"平均订单额:{s['avg_order_value']:.2f}U  活跃率:{u['activity_rate']}%\n\n"
+                f"⏰ 数据时间：{self.core.metrics.as_of()}")
+        kb=[[InlineKeyboardButton("🔄 刷新", callback_data="report_refresh_overview_quick"),
              InlineKeyboardButton("🔙 返回报表", callback_data="system_reports")]]
         self.safe_edit_message(query, text, kb, parse_mode=None)
 
@@ -6878,8 +7226,9 @@ Refresh Time: {refresh_time}
         text = (f"📦 商品统计报表\n"
                 f"商品:{p['total_products']}  启用:{p['active_products']}  禁用:{p['inactive_products']}\n"
                 f"库存:{p['total_stock']}  已售:{p['sold_stock']}  周转率:{p['stock_turnover_rate']}%\n"
-                f"平均利润率:{p['avg_profit_rate']}%  最高:{p['highest_profit_rate']}%  最低:{p['lowest_profit_rate']}%")
-        kb=[[InlineKeyboardButton("🔄 刷新", callback_data="report_products"),
+                f"平均利润率:{p['avg_profit_rate']}%  最高:{p['highest_profit_rate']}%  最低:{p['lowest_profit_rate']}%\n\n"
+                f"⏰ 数据时间：{self.core.metrics.as_of()}")
+        kb=[[InlineKeyboardButton("🔄 刷新", callback_data="report_refresh_products"),
              InlineKeyboardButton("🔙 返回报表", callback_data="system_reports")]]
         self.safe_edit_message(query, text, kb, parse_mode=None)
 
@@ -6887,12 +7236,13 @@ Refresh Time: {refresh_time}
         f = self.core.get_financial_statistics(days)
         text = (f"💰 财务报表（{days}天）\n"
                 f"总收入:{f['total_revenue']:.2f}U  订单数:{f['order_count']}  平均订单:{f['avg_order_value']:.2f}U\n"
-                f"预估利润:{f['estimated_profit']:.2f}U  利润率:{f['profit_margin']}%")
+                f"预估利润:{f['estimated_profit']:.2f}U  利润率:{f['profit_margin']}%\n\n"
+                f"⏰ 数据时间：{self.core.metrics.as_of()}")
         kb = [
             [InlineKeyboardButton("📅 7天", callback_data="report_financial_7"),
              InlineKeyboardButton("📅 30天", callback_data="report_financial_30"),
              InlineKeyboardButton("📅 90天", callback_data="report_financial_90")],
-            [InlineKeyboardButton("🔄 刷新", callback_data=f"report_financial_{days}"),
+            [InlineKeyboardButton("🔄 刷新", callback_data=f"report_refresh_financial_{days}"),
              InlineKeyboardButton("🔙 返回报表", callback_data="system_reports")]
         ]
         self.safe_edit_message(query, text, kb, parse_mode=None)
@@ -7751,6 +8101,11 @@ Refresh Time: {refresh_time}
         try:
             logger.info(f"[DEBUG] callback data: {d}")
 
+            # 报表刷新：标记快照待刷新（最短间隔 AGENT_METRICS_MIN_INTERVAL），再按原报表渲染
+            if d.startswith("report_refresh_"):
+                self.core.metrics.mark_dirty()
+                d = "report_" + d[len("report_refresh_"):]
+
             # 基础导航
             if d == "products":
                 self.show_product_categories(q); q.answer(); return
@@ -7805,6 +8160,10 @@ Refresh Time: {refresh_time}
                 q.answer()
                 return
 
+            # 广告推送任务：暂停 / 继续 / 取消
+            elif d == "adjob_list" or d.startswith("adjob_"):
+                self.handle_ad_broadcast_action(q, context, d); return
+
             # 价格管理 / 报表
             elif d == "price_management":
                 self.show_price_management(q); q.answer(); return
@@ -7931,7 +8290,7 @@ Refresh Time: {refresh_time}
                             try:
                                 chat_id = q.message.chat_id
                                 q.message.delete()
-                                Bot(self.core.config.BOT_TOKEN).send_message(
+                                get_bot(self.core.config.BOT_TOKEN).send_message(
                                     chat_id=chat_id,
                                     text="❌ 该充值订单已取消。\n请重新选择金额创建新的订单。",
                                     reply_markup=kb
@@ -7957,7 +8316,7 @@ Refresh Time: {refresh_time}
                                 )
                             except Exception as e_cap:
                                 logger.warning(f"编辑取消 caption 失败: {e_cap}")
-                                Bot(self.core.config.BOT_TOKEN).send_message(
+                                get_bot(self.core.config.BOT_TOKEN).send_message(
                                     chat_id=q.message.chat_id,
                                     text="❌ 该充值订单已取消。\n请重新选择金额创建新的订单。",
                                     reply_markup=kb
@@ -8120,57 +8479,146 @@ Refresh Time: {refresh_time}
             
             logger.info(f"🚀 开始广播广告消息: {message_text[:50]}...")
             
-            # 调用核心广播方法
-            success_count = self.core.broadcast_ad_to_agent_users(wrapped_text, parse_mode=ParseMode.HTML)
-            
-            logger.info(f"✅ 广告推送完成: 成功通知 {success_count} 个用户")
-            
-            # 发送广播完成通知到广告通知群（独立配置）
-            if self.core.config.AGENT_AD_NOTIFY_CHAT_ID and success_count > 0:
-                try:
-                    from datetime import datetime
-                    now_beijing = datetime.utcnow() + timedelta(hours=8)
-                    
-                    # 获取用户总数用于计算成功率
-                    user_collection = self.core.config.get_agent_user_collection()
-                    query = {}
-                    if self.core.config.AGENT_AD_DM_ACTIVE_DAYS > 0:
-                        cutoff_date = datetime.now() - timedelta(days=self.core.config.AGENT_AD_DM_ACTIVE_DAYS)
-                        cutoff_str = cutoff_date.strftime('%Y-%m-%d %H:%M:%S')
-                        query['last_active'] = {'$gte': cutoff_str}
-                    total_users = user_collection.count_documents(query)
-                    
-                    # 考虑最大发送限制
-                    max_per_run = self.core.config.AGENT_AD_DM_MAX_PER_RUN
-                    if max_per_run > 0 and total_users > max_per_run:
-                        total_users = max_per_run
-                    
-                    success_rate = (success_count / total_users * 100) if total_users > 0 else 0
-                    
-                    notification_text = (
-                        f"📢 <b>广告推送完成报告</b>\n\n"
-                        f"🏢 代理ID：<code>{self.core._h(self.core.config.AGENT_BOT_ID)}</code>\n"
-                        f"🤖 代理名称：{self.core._h(self.core.config.AGENT_NAME)}\n"
-                        f"✅ 成功发送：<b>{success_count}</b> / {total_users} 用户\n"
-                        f"📊 成功率：<b>{success_rate:.1f}%</b>\n"
-                        f"⏰ 完成时间：{now_beijing.strftime('%Y-%m-%d %H:%M:%S')} (北京时间)\n\n"
-                        f"📝 广告内容（前100字符）：\n<code>{self.core._h(message_text[:100])}...</code>"
-                    )
-                    
-                    Bot(self.core.config.BOT_TOKEN).send_message(
-                        chat_id=self.core.config.AGENT_AD_NOTIFY_CHAT_ID,
-                        text=notification_text,
-                        parse_mode=ParseMode.HTML
-                    )
-                    logger.info(f"📤 已发送广播完成通知到广告通知群: {self.core.config.AGENT_AD_NOTIFY_CHAT_ID}")
-                except Exception as notify_err:
-                    logger.warning(f"⚠️ 发送广播完成通知失败: {notify_err}")
+            # 创建持久化推送任务，放到后台执行，不阻塞频道消息处理
+            job_id = self.core.create_ad_broadcast(wrapped_text, parse_mode=ParseMode.HTML)
+            if job_id is None:
+                return
+            context.job_queue.run_once(self._job_run_ad_broadcast, 0,
+                                       context={'job_id': str(job_id), 'preview': message_text[:100]})
             
         except Exception as e:
             logger.error(f"❌ 处理广告频道消息异常: {e}")
             traceback.print_exc()
 
+    def _job_run_ad_broadcast(self, context: CallbackContext):
+        """后台执行广告推送任务，完成后发送报告到广告通知群"""
+        job_id = context.job.context['job_id']
+        preview = context.job.context.get('preview')
+        try:
+            status, stats = self.core.run_ad_broadcast(context.bot, job_id)
+            if stats is None:
+                return
+            if status != JOB_DONE:
+                logger.info(f"📤 广告推送任务 {job_id} 结束：{status}（{stats.done}/{stats.total}）")
+                return
+            logger.info(f"✅ 广告推送完成: 成功通知 {stats.sent} 个用户")
+            if not self.core.config.AGENT_AD_NOTIFY_CHAT_ID or stats.sent <= 0:
+                return
+            if preview is None:
+                job = self.core.broadcasts.get(job_id) or {}
+                text = (job.get('payload') or {}).get('text', '')
+                preview = text.replace("<b>📢 最新公告</b>\n\n", "", 1)[:100]
+            now_beijing = datetime.utcnow() + timedelta(hours=8)
+            success_rate = (stats.sent / stats.total * 100) if stats.total > 0 else 0
+            notification_text = (
+                f"📢 <b>广告推送完成报告</b>\n\n"
+                f"🏢 代理ID：<code>{self.core._h(self.core.config.AGENT_BOT_ID)}</code>\n"
+                f"🤖 代理名称：{self.core._h(self.core.config.AGENT_NAME)}\n"
+                f"✅ 成功发送：<b>{stats.sent}</b> / {stats.total} 用户\n"
+                f"🚫 拉黑/注销：{stats.blocked}  ❌ 失败：{stats.failed}\n"
+                f"📊 成功率：<b>{success_rate:.1f}%</b>\n"
+                f"⏰ 完成时间：{now_beijing.strftime('%Y-%m-%d %H:%M:%S')} (北京时间)\n\n"
+                f"📝 广告内容（前100字符）：\n<code>{self.core._h(preview)}...</code>"
+            )
+            context.bot.send_message(
+                chat_id=self.core.config.AGENT_AD_NOTIFY_CHAT_ID,
+                text=notification_text,
+                parse_mode=ParseMode.HTML
+            )
+            logger.info(f"📤 已发送广播完成通知到广告通知群: {self.core.config.AGENT_AD_NOTIFY_CHAT_ID}")
+        except Exception as e:
+            logger.error(f"❌ 广告推送任务异常: {e}")
+            traceback.print_exc()
+
+    AD_JOB_LABELS = {
+        JOB_RUNNING: '🟢 进行中',
+        JOB_PAUSED: '⏸ 已暂停',
+        JOB_CANCELLED: '⛔ 已取消',
+        JOB_DONE: '✅ 已完成',
+    }
+
+    def _ad_broadcast_list(self):
+        """广告推送任务列表文本与控制按钮"""
+        jobs = self.core.recent_ad_broadcasts()
+        if not jobs:
+            text = "📋 <b>广告推送任务</b>\n\n暂无任务"
+        else:
+            lines = ["📋 <b>广告推送任务</b>（最近10个）\n"]
+            for i, job in enumerate(jobs, 1):
+                stats = job.get('stats', {})
+                created = job['created_at'].strftime('%m-%d %H:%M')
+                lines.append(
+                    f"{i}. {self.AD_JOB_LABELS.get(job['status'], job['status'])} <code>{created}</code>\n"
+                    f"   📤 {stats.get('done', 0)}/{job.get('total', 0)}  ✅ {stats.get('sent', 0)}  "
+                    f"❌ {stats.get('failed', 0)}  🚫 {stats.get('blocked', 0)}"
+                )
+            text = "\n".join(lines)
+        keyboard = []
+        for i, job in enumerate(jobs, 1):
+            job_id = job['_id']
+            if job['status'] == JOB_RUNNING:
+                keyboard.append([InlineKeyboardButton(f"⏸ 暂停 #{i}", callback_data=f"adjob_pause_{job_id}"),
+                                 InlineKeyboardButton(f"⛔ 取消 #{i}", callback_data=f"adjob_cancel_{job_id}")])
+            elif job['status'] == JOB_PAUSED:
+                keyboard.append([InlineKeyboardButton(f"▶️ 继续 #{i}", callback_data=f"adjob_resume_{job_id}"),
+                                 InlineKeyboardButton(f"⛔ 取消 #{i}", callback_data=f"adjob_cancel_{job_id}")])
+        keyboard.append([InlineKeyboardButton("🔄 刷新", callback_data="adjob_list")])
+        return text, InlineKeyboardMarkup(keyboard)
+
+    def ad_broadcasts_command(self, update: Update, context: CallbackContext):
+        """广告推送任务列表（仅管理员可用）"""
+        if not self.core.config.is_admin(update.effective_user.id):
+            update.message.reply_text("❌ 无权限")
+            return
+        text, markup = self._ad_broadcast_list()
+        update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+    def handle_ad_broadcast_action(self, query, context: CallbackContext, data: str):
+        """广告推送任务按钮：adjob_list / adjob_pause_<id> / adjob_resume_<id> / adjob_cancel_<id>"""
+        if not self.core.config.is_admin(query.from_user.id):
+            query.answer("❌ 无权限", show_alert=True)
+            return
+        if data != "adjob_list":
+            action, _, job_id = data[len("adjob_"):].partition('_')
+            status = {'pause': JOB_PAUSED, 'resume': JOB_RUNNING, 'cancel': JOB_CANCELLED}.get(action)
+            if status is None or not self.core.set_ad_broadcast_status(job_id, status):
+                query.answer("任务状态已变化，请刷新", show_alert=True)
+                return
+            if status == JOB_RUNNING:
+                # 继续：新的执行会等待上一次执行发完在途收件人，再从检查点续发
+                context.job_queue.run_once(self._job_run_ad_broadcast, 1, context={'job_id': job_id})
+            query.answer({JOB_PAUSED: "⏸ 正在暂停，在途消息发完后停止",
+                          JOB_RUNNING: "▶️ 已继续",
+                          JOB_CANCELLED: "⛔ 已取消"}[status])
+        else:
+            query.answer()
+        text, markup = self._ad_broadcast_list()
+        self.safe_edit_message(query, text, markup, parse_mode=ParseMode.HTML)
+
+    def resume_ad_broadcasts(self, job_queue):
+        """启动时续跑上次中断的广告推送任务"""
+        try:
+            self.core.ensure_ad_broadcast_indexes()
+            for job in self.core.pending_ad_broadcasts():
+                job_queue.run_once(self._job_run_ad_broadcast, 15, context={'job_id': str(job['_id'])})
+                logger.info(f"♻️ 续跑广告推送任务：{job['_id']}（{job.get('stats', {}).get('done', 0)}/{job.get('total', 0)}）")
+        except Exception as e:
+            logger.warning(f"续跑广告推送任务失败: {e}")
+
     # ========== 补货通知镜像功能 ==========
+    @staticmethod
+    def _restock_post_nowuids(message) -> List[str]:
+        """从总部补货帖子的按钮中提取商品 nowuid（buy_ 深链或 gmsp 回调）"""
+        nowuids = []
+        markup = message.reply_markup
+        for row in (markup.inline_keyboard if markup and hasattr(markup, 'inline_keyboard') else []):
+            for button in row:
+                if button.url and 'start=buy_' in button.url:
+                    nowuids.append(button.url.split('start=buy_', 1)[1].split('&')[0])
+                elif button.callback_data and button.callback_data.startswith('gmsp '):
+                    nowuids.append(button.callback_data[len('gmsp '):].strip())
+        return [n for n in nowuids if n]
+
     def handle_headquarters_message(self, update: Update, context: CallbackContext):
         """
         监听总部通知群的消息，自动转发补货通知到代理补货通知群
@@ -8215,6 +8663,14 @@ Refresh Time: {refresh_time}
             if chat_id != hq_chat_id:
                 logger.debug(f"⚠️ 消息不是来自总部通知群（来自 {chat_id}，期望 {hq_chat_id}）")
                 return
+
+            # 总部补货分发已直接推送过帖子里的全部商品时不再转发；
+            # 手工帖子（无商品按钮）和分发未覆盖的商品（如尚未建立代理价格）照常转发
+            if self.core.uses_hq_restock_fanout():
+                post_nowuids = self._restock_post_nowuids(message)
+                if post_nowuids and self.core.restock_fanout_covered(post_nowuids):
+                    logger.debug(f"ℹ️ 总部补货分发已推送 {len(post_nowuids)} 个商品，跳过频道转发")
+                    return
             
             # 检查是否有补货通知目标群
             if not self.core.config.AGENT_RESTOCK_NOTIFY_CHAT_ID:
@@ -8443,10 +8899,12 @@ class AgentBot:
         self.config = AgentBotConfig()
         self.core = AgentBotCore(self.config)
         self.handlers = AgentBotHandlers(self.core)
-        self.updater = Updater(token=token, use_context=True)
+        # Updater 与后台发送（结算通知、发货、广告推送）共用同一个 Bot 客户端连接池
+        self.updater = Updater(bot=get_bot(token), use_context=True)
         self.dispatcher = self.updater.dispatcher
         self._watch_thread = None
         self._watch_stop_flag = False
+        self._last_local_sync = 0.0
 
     def start_headquarters_product_watch(self):
         """启动总部商品 Change Stream 监听线程"""
@@ -8507,7 +8965,9 @@ class AgentBot:
             
             logger.info("🛑 Change Stream 监听线程已退出")
         
-        if self.config.AGENT_ENABLE_PRODUCT_WATCH:
+        if self.core.uses_hq_sync_publisher():
+            logger.info("ℹ️ 总部同步发布器在线，代理不再单独监听 ejfl（改为订阅 product_sync_events）")
+        elif self.config.AGENT_ENABLE_PRODUCT_WATCH:
             self._watch_thread = threading.Thread(target=_watch_loop, daemon=True, name="ProductWatch")
             self._watch_thread.start()
             logger.info("✅ Change Stream 监听线程已启动")
@@ -8515,8 +8975,15 @@ class AgentBot:
             logger.info("ℹ️ Change Stream 监听已禁用（环境变量 AGENT_ENABLE_PRODUCT_WATCH=0）")
 
     def _job_auto_product_poll(self, context: CallbackContext):
-        """定时轮询商品同步任务（兜底方案）"""
+        """定时商品同步任务：总部发布器在线时消费其事件，否则本地轮询同步（兜底方案）"""
         try:
+            if self.core.uses_hq_sync_publisher():
+                self.core.consume_hq_sync_events()
+                return
+            now = time.time()
+            if now - self._last_local_sync < self.config.PRODUCT_SYNC_POLL_SECONDS:
+                return
+            self._last_local_sync = now
             synced = self.core.auto_sync_new_products()
             if synced > 0:
                 logger.info(f"✅ 轮询触发商品同步: {synced} 个商品")
@@ -8528,6 +8995,7 @@ class AgentBot:
         self.dispatcher.add_handler(CommandHandler("reload_admins", self.handlers.reload_admins_command))
         self.dispatcher.add_handler(CommandHandler("resync_hq_products", self.handlers.resync_hq_products_command))
         self.dispatcher.add_handler(CommandHandler("diag_sync_stats", self.handlers.diag_sync_stats_command))
+        self.dispatcher.add_handler(CommandHandler("ad_broadcasts", self.handlers.ad_broadcasts_command))
         self.dispatcher.add_handler(CallbackQueryHandler(self.handlers.button_callback))
         
         # ✅ 创建组合处理器，同时处理总部通知和广告频道消息
@@ -8579,13 +9047,45 @@ class AgentBot:
         try:
             self.updater.job_queue.run_repeating(
                 self._job_auto_product_poll,
-                interval=self.config.PRODUCT_SYNC_POLL_SECONDS,
+                interval=self.config.HQ_SYNC_EVENT_POLL_SECONDS,
                 first=10  # 首次延迟10秒启动
             )
-            logger.info(f"✅ 已启动商品同步轮询任务（间隔 {self.config.PRODUCT_SYNC_POLL_SECONDS}s，兜底方案）")
+            logger.info(
+                f"✅ 已启动商品同步任务（事件检查 {self.config.HQ_SYNC_EVENT_POLL_SECONDS}s，"
+                f"本地轮询兜底 {self.config.PRODUCT_SYNC_POLL_SECONDS}s）"
+            )
         except Exception as e:
             logger.warning(f"启动商品同步轮询任务失败: {e}")
 
+        # ✅ 登记补货通知群（总部补货分发直接推送）与新商品默认加价（总部发布器按代理加价写入）
+        self.core.register_restock_chat()
+        self.core.register_default_markup()
+
+        # ✅ 广告推送任务续跑（重启前未完成的任务从检查点继续）
+        self.handlers.resume_ad_broadcasts(self.updater.job_queue)
+
+        # ✅ 通知发件箱发送任务（群通知合并、限速发送）
+        self.core.outbox.start(self.updater.job_queue)
+
+        # ✅ 报表指标快照任务
+        try:
+            self.updater.job_queue.run_repeating(
+                self._job_refresh_metrics,
+                interval=self.config.AGENT_METRICS_MIN_INTERVAL,
+                first=30
+            )
+            logger.info(f"✅ 已启动报表指标快照任务（定时 {self.config.AGENT_METRICS_REFRESH_SECONDS}s，事件触发最短 {self.config.AGENT_METRICS_MIN_INTERVAL}s）")
+        except Exception as e:
+            logger.warning(f"启动报表指标快照任务失败: {e}")
+
+    def _job_refresh_metrics(self, context: CallbackContext):
+        """定时/事件触发刷新报表指标快照，报表页面始终命中快照"""
+        try:
+            if self.core.metrics.is_stale():
+                self.core.metrics.refresh()
+        except Exception as e:
+            logger.warning(f"报表指标快照任务异常: {e}")
+
     def _job_auto_recharge_check(self, context: CallbackContext):
         try:
             self.core.poll_and_auto_settle_recharges(max_orders=80)
@@ -1,7 +1,12 @@
 import logging
 import os
+import sys
 from datetime import datetime
-from telegram import Bot
+from pathlib import Path
+
+# 与总部共用进程级 Bot 客户端注册表（仓库根目录 bot_clients.py）
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from bot_clients import get_bot
 
 logger = logging.getLogger(__name__)
 
@@ -150,7 +155,7 @@ class AgentBotCore:
             logger.info(f"🔍 使用代理机器人token")
             
             # 创建机器人实例
-            bot = Bot(token=bot_token)
+            bot = get_bot(bot_token)
             
             # 获取商品信息
             item_projectname = item.get('projectname', '')
@@ -0,0 +1,159 @@
+"""
+代理商品价格同步（总部与代理进程共用）
+
+- 比对总部 ejfl 商品与代理 agent_product_prices 记录，生成 upsert/$set 写操作（纯计算，不访问数据库）
+- 写操作以无序 bulk_write 执行，部分失败时按 BulkWriteError 明细累加计数
+- 总部发布器（mongo.py）与代理本地同步（agent/agent_bot.py）都调用这里，保证两边的同步规则一致
+"""
+import logging
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+AGENT_SYNC_BATCH_SIZE = 1000
+AGENT_SYNC_PRICE_EPSILON = 0.01
+AGENT_SYNC_HQ_PROJECTION = {'nowuid': 1, 'money': 1, 'projectname': 1, 'leixing': 1}
+AGENT_SYNC_PRICE_PROJECTION = {
+    'original_nowuid': 1, 'product_name': 1, 'category': 1, 'original_price_snapshot': 1,
+    'agent_markup': 1, 'agent_price': 1, 'needs_price_set': 1, 'hq_deleted': 1,
+}
+
+
+def safe_money(value) -> float:
+    """安全解析价格字段（空值、空字符串、非数字均视为 0）"""
+    try:
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return 0.0
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def build_agent_price_ops(agent_bot_id, products, existing_map, default_markup, now_time, auto_created=False):
+    """
+    计算一批总部商品对应的代理价格写操作（纯计算，不访问数据库）
+
+    Args:
+        products: 总部 ejfl 商品列表
+        existing_map: {nowuid: 代理价格记录}
+        default_markup: 新商品默认加价
+
+    Returns:
+        (ops, stats)：pymongo 写操作列表，以及 {inserted, updated, skipped, activated} 预估计数；
+        stats['changed'] 为产生写操作的 nowuid 列表
+    """
+    ops = []
+    stats = {'inserted': 0, 'updated': 0, 'skipped': 0, 'activated': 0, 'changed': []}
+    for product in products:
+        nowuid = product.get('nowuid')
+        if not nowuid:
+            stats['skipped'] += 1
+            continue
+        original_price = safe_money(product.get('money'))
+        projectname = product.get('projectname', '')
+        # 存储层保持原始 leixing，分类统一/映射在展示层处理
+        category = product.get('leixing')
+        key = {'agent_bot_id': agent_bot_id, 'original_nowuid': nowuid}
+        exists = existing_map.get(nowuid)
+
+        if exists is None:
+            # 新商品：upsert + $setOnInsert，重复执行或并发同步也不会产生重复记录
+            ops.append(UpdateOne(key, {'$setOnInsert': {
+                **key,
+                'agent_markup': default_markup,
+                'agent_price': round(original_price + default_markup, 2),
+                'original_price_snapshot': original_price,
+                'product_name': projectname,
+                'category': category,
+                'is_active': original_price > 0,
+                'needs_price_set': original_price <= 0,
+                'sales_count': 0,
+                'total_revenue': 0.0,
+                'auto_created': auto_created,
+                'synced_at': now_time,
+                'created_time': now_time,
+                'updated_time': now_time,
+            }}, upsert=True))
+            stats['inserted'] += 1
+            stats['changed'].append(nowuid)
+            continue
+
+        updates = {}
+        if exists.get('product_name') != projectname:
+            updates['product_name'] = projectname
+        if exists.get('category') != category:
+            updates['category'] = category
+        if abs(safe_money(exists.get('original_price_snapshot')) - original_price) > AGENT_SYNC_PRICE_EPSILON:
+            updates['original_price_snapshot'] = original_price
+        # 代理价格 = 总部价 + 代理加价
+        new_agent_price = round(original_price + safe_money(exists.get('agent_markup')), 2)
+        if abs(safe_money(exists.get('agent_price')) - new_agent_price) > AGENT_SYNC_PRICE_EPSILON:
+            updates['agent_price'] = new_agent_price
+        # 之前待补价、现在总部价 > 0 时自动激活
+        if exists.get('needs_price_set') and original_price > 0:
+            updates['is_active'] = True
+            updates['needs_price_set'] = False
+            stats['activated'] += 1
+        # 曾被总部删除后又恢复的商品重新上架
+        if exists.get('hq_deleted'):
+            updates['hq_deleted'] = False
+            updates['is_active'] = original_price > 0
+
+        if updates:
+            updates['updated_time'] = now_time
+            ops.append(UpdateOne(key, {'$set': updates}))
+            stats['updated'] += 1
+            stats['changed'].append(nowuid)
+        else:
+            stats['skipped'] += 1
+    return ops, stats
+
+
+def deactivate_deleted_products(collection, agent_bot_ids, nowuids=None, keep_nowuids=None, now_time=None) -> int:
+    """
+    总部已删除的商品在代理侧下架（保留记录、加价与销量，商品恢复后由同步自动重新上架）
+
+    Args:
+        nowuids: 已删除的商品；或传 keep_nowuids（总部现存的全部商品），下架代理侧其余所有商品
+            （代理侧 nowuid 流式读出后在内存中求差集，不向服务器发送超大的 $nin）
+    """
+    base = {'agent_bot_id': {'$in': list(agent_bot_ids)}, 'hq_deleted': {'$ne': True}}
+    try:
+        if nowuids is None:
+            if not keep_nowuids:
+                return 0
+            keep = set(keep_nowuids)
+            nowuids = {doc.get('original_nowuid')
+                       for doc in collection.find(base, {'_id': 0, 'original_nowuid': 1}).batch_size(AGENT_SYNC_BATCH_SIZE)}
+            nowuids = [n for n in nowuids if n and n not in keep]
+        nowuids = list(nowuids)
+        update = {'is_active': False, 'hq_deleted': True}
+        if now_time:
+            update['updated_time'] = now_time
+        modified = 0
+        for i in range(0, len(nowuids), AGENT_SYNC_BATCH_SIZE):
+            match = dict(base, original_nowuid={'$in': nowuids[i:i + AGENT_SYNC_BATCH_SIZE]})
+            modified += collection.update_many(match, {'$set': update}).modified_count
+        return modified
+    except Exception as e:
+        logging.error(f"❌ 下架总部已删除商品失败：{e}")
+        return 0
+
+
+def write_agent_price_ops(collection, ops, totals, label):
+    """执行无序 bulk_write 并把 inserted/updated/errors 累加到 totals"""
+    if not ops:
+        return
+    try:
+        result = collection.bulk_write(ops, ordered=False)
+        totals['inserted'] += result.upserted_count
+        totals['updated'] += result.modified_count
+    except BulkWriteError as e:
+        details = e.details or {}
+        totals['inserted'] += details.get('nUpserted', 0)
+        totals['updated'] += details.get('nModified', 0)
+        totals['errors'] += len(details.get('writeErrors', []))
+        logging.error(f"❌ 代理商品批量写入部分失败：{label}, 错误数={len(details.get('writeErrors', []))}")
+    except Exception as e:
+        totals['errors'] += len(ops)
+        logging.error(f"❌ 代理商品批量写入失败：{label}, {e}")
@@ -43,12 +43,13 @@ from telegram.ext import (
 
 from mongo import (
     agent_bots, agent_product_prices, agent_orders, agent_withdrawals,
-    create_agent_bot_data, create_agent_product_price_data, create_agent_order_data,
+    create_agent_bot_data, create_agent_order_data,
     create_agent_withdrawal_data, create_agent_user_data, get_agent_bot_info,
     get_agent_bot_user_collection, get_agent_bot_user, update_agent_bot_user_balance,
     get_agent_product_price, get_real_time_stock, generate_agent_bot_id, get_agent_stats,
     get_agent_bot_topup_collection, get_agent_bot_gmjlu_collection,
-    normalize_agent_bot_id, ensure_agent_user_exists, _get_agent_id_suffix
+    normalize_agent_bot_id, ensure_agent_user_exists, _get_agent_id_suffix,
+    bulk_sync_agent_products, invalidate_agent_stats, invalidate_income_summary
 )
 # ✅ 先定义变量（在文件顶部）
 NOTIFY_CHANNEL_ID = os.getenv("NOTIFY_CHANNEL_ID")
@@ -121,31 +122,15 @@ class MultiBotDistributionSystem:
             return False, f"创建失败: {str(e)}"
     
     def clone_products_for_agent(self, agent_bot_id, profit_margin=0.3):
-        """为代理克隆所有商品价格设置"""
+        """为代理克隆所有商品价格设置（批量同步引擎：按批 $in 比对 + 无序 bulk_write）"""
         try:
-            cloned_count = 0
-            
-            # 获取所有总部商品
-            for product in ejfl.find():
-                original_price = float(product.get('money', 0))
-                # 使用固定利润加价而不是百分比
-                suggested_price = round(original_price + profit_margin, 2)
-                
-                success = create_agent_product_price_data(
-                    agent_bot_id=agent_bot_id,
-                    original_nowuid=product['nowuid'],
-                    agent_price=suggested_price,
-                    is_active=True,
-                    agent_markup=profit_margin  # ✅ 传递利润加价参数
-                )
-                
-                if success:
-                    cloned_count += 1
-            
-            return cloned_count
+            # 使用固定利润加价而不是百分比
+            result = bulk_sync_agent_products(agent_bot_id, default_markup=profit_margin)
+            logging.info(f"✅ 克隆商品价格: {result['inserted']} 个, 耗时 {result['elapsed']}s, 速率 {result['rate']}/s")
+            return result['inserted']
             
         except Exception as e:
-            print(f"❌ 克隆商品价格失败: {e}")
+            logging.error(f"❌ 克隆商品价格失败: {e}")
             return 0
     
     def get_agent_bot_list(self):
@@ -181,6 +166,8 @@ class MultiBotDistributionSystem:
             # 4. 删除代理提现申请
             result = agent_withdrawals.delete_many({'agent_bot_id': agent_bot_id})
             print(f"✅ 删除代理提现申请: {result.deleted_count} 条")
+            invalidate_agent_stats(agent_bot_id)
+            agent_analytics.delete_one({'_id': agent_bot_id})
             
             # 5. 删除代理机器人独立集合
             try:
@@ -274,13 +261,25 @@ except ImportError:
 
 from pymongo import MongoClient
 from mongo import *
+from export_engine import submit_export, iter_batches, iter_chunked_batches, join_users, clean_name
+from bot_clients import get_bot, format_client_metrics
+from notification_outbox import NotificationOutbox
+from outbound_sender import outbound, log_failure
+from broadcast_engine import (
+    BroadcastJobStore, run_job, submit_job, get_limiter, BLOCKED,
+    JOB_RUNNING, JOB_PAUSED, JOB_CANCELLED, JOB_DONE
+)
 from mongo import topup, user, withdrawal_requests
+from bson import ObjectId
 from utils import create_easypay_url, create_payment_with_qrcode
 from pay_server import start_flask_server
 
+broadcast_store = BroadcastJobStore(broadcast_jobs, broadcast_deliveries)
+
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+outbox = NotificationOutbox(notification_outbox, 'hq', BOT_TOKEN)
 # ✅ 管理员配置统一使用 ID
 ADMIN_IDS = list(map(int, filter(None, os.getenv("ADMIN_IDS", "").split(","))))
 EASYPAY_PID = os.getenv("EASYPAY_PID")
@@ -299,6 +298,10 @@ MESSAGE_DELETE_DELAY = int(os.getenv("MESSAGE_DELETE_DELAY", "3"))
 TRX_MESSAGE_DELETE_DELAY = int(os.getenv("TRX_MESSAGE_DELETE_DELAY", "300"))
 BOT_TIMEOUT = int(os.getenv("BOT_TIMEOUT", "600"))
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "20"))
+# dispatcher 工作线程数（私发/导出仍在工作线程上等待发送结果，默认保持 128）
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "32"))
+# 红包消息刷新去抖（秒）：窗口内的多次领取合并为一次编辑
+HONGBAO_EDIT_DEBOUNCE = float(os.getenv("HONGBAO_EDIT_DEBOUNCE", "1"))
 
 # 日志目录初始化
 os.makedirs(os.path.dirname(LOG_FILE_PATH) if os.path.dirname(LOG_FILE_PATH) else '.', exist_ok=True)
@@ -422,6 +425,10 @@ def get_admin_ids() -> list:
     """获取管理员 ID 列表"""
     return ADMIN_IDS.copy()
 
+def notify_admins(text: str, topic: str = None, digest: str = None, **kwargs) -> int:
+    """通知所有管理员：写入通知发件箱后立即返回，由发件箱任务合并并限速发送"""
+    return outbox.enqueue(get_admin_ids(), text, topic=topic, digest=digest, **kwargs)
+
 def add_admin(user_id: int) -> bool:
     """添加管理员到内存中（需要重启生效）"""
     if user_id not in ADMIN_IDS:
@@ -484,83 +491,15 @@ def get_fy(fstext):
         # 出错时返回原文
         return fstext
 
-def generate_captcha():
-    """生成图片验证码"""
-    import random
-    import os
-    from PIL import Image, ImageDraw, ImageFont
-    
-    # 生成4位随机数字作为验证码
-    captcha_code = ''.join([str(random.randint(0, 9)) for _ in range(4)])
-    
-    # 创建图片
-    width, height = 300, 150
-    image = Image.new('RGB', (width, height), color='white')
-    draw = ImageDraw.Draw(image)
-    
-    # 添加背景噪点
-    for _ in range(200):
-        x = random.randint(0, width)
-        y = random.randint(0, height)
-        draw.point((x, y), fill=(random.randint(200, 255), random.randint(200, 255), random.randint(200, 255)))
-    
-    # 绘制验证码数字
-    try:
-        # 尝试使用系统字体
-        font_size = 60
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except:
-        # 如果没有arial.ttf，使用默认字体
-        font = ImageFont.load_default()
-    
-    # 计算文字位置居中
-    char_width = width // 4
-    for i, char in enumerate(captcha_code):
-        x = i * char_width + char_width // 2 - 15
-        y = height // 2 - 30
-        
-        # 添加随机颜色
-        color = (random.randint(50, 150), random.randint(100, 200), random.randint(50, 150))
-        draw.text((x, y), char, font=font, fill=color)
-    
-    # 添加干扰线
-    for _ in range(5):
-        x1 = random.randint(0, width)
-        y1 = random.randint(0, height)
-        x2 = random.randint(0, width)
-        y2 = random.randint(0, height)
-        draw.line([(x1, y1), (x2, y2)], fill=(random.randint(150, 200), random.randint(150, 200), random.randint(150, 200)), width=2)
-    
-    # 保存图片
-    captcha_dir = "captcha"
-    if not os.path.exists(captcha_dir):
-        os.makedirs(captcha_dir)
-    
-    image_path = os.path.join(captcha_dir, f"captcha_{captcha_code}_{random.randint(1000, 9999)}.png")
-    image.save(image_path)
-    
-    # 生成错误选项（其他4位数字）
-    wrong_answers = []
-    while len(wrong_answers) < 2:
-        wrong_code = ''.join([str(random.randint(0, 9)) for _ in range(4)])
-        if wrong_code != captcha_code and wrong_code not in wrong_answers:
-            wrong_answers.append(wrong_code)
-    
-    # 打乱选项顺序
-    all_options = [captcha_code] + wrong_answers
-    random.shuffle(all_options)
-    
-    return image_path, captcha_code, all_options
-
-
 def send_captcha(update: Update, context: CallbackContext, user_id: int, lang: str = 'zh'):
     """发送验证码界面"""
-    image_path, correct_answer, options = generate_captcha()
+    from captcha_service import captcha_pool  # 验证码功能启用时才加载 PIL 并启动预生成池
+    
+    image_bytes, correct_answer, options = captcha_pool.pop()
     
     # 保存正确答案到用户数据
     context.user_data[f"captcha_answer_{user_id}"] = correct_answer
     context.user_data[f"captcha_attempts_{user_id}"] = 0
-    context.user_data[f"captcha_image_{user_id}"] = image_path
     
     if lang == 'zh':
         text = f"""为了防止恶意使用，请看图片中的数字验证码：
@@ -580,15 +519,14 @@ Please select the correct answer from the options below:"""
         [InlineKeyboardButton(str(option), callback_data=f'captcha_{option}') for option in options]
     ]
     
-    # 发送图片验证码
-    with open(image_path, 'rb') as photo:
-        context.bot.send_photo(
-            chat_id=user_id,
-            photo=photo,
-            caption=text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    # 发送图片验证码（预生成的 PNG）
+    context.bot.send_photo(
+        chat_id=user_id,
+        photo=BytesIO(image_bytes),
+        caption=text,
+        parse_mode='HTML',
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
 
 def handle_captcha_response(update: Update, context: CallbackContext):
@@ -618,14 +556,6 @@ def handle_captcha_response(update: Update, context: CallbackContext):
     except:
         pass
     
-    # 清理验证码图片
-    try:
-        captcha_image_path = context.user_data.get(f"captcha_image_{user_id}")
-        if captcha_image_path and os.path.exists(captcha_image_path):
-            os.remove(captcha_image_path)
-    except:
-        pass
-    
     if user_answer == correct_answer:
         # 验证成功
         user.update_one({'user_id': user_id}, {'$set': {'verified': True}})
@@ -634,7 +564,6 @@ def handle_captcha_response(update: Update, context: CallbackContext):
         context.user_data.pop(f"captcha_answer_{user_id}", None)
         context.user_data.pop(f"captcha_attempts_{user_id}", None)
         context.user_data.pop(f"captcha_cooldown_{user_id}", None)
-        context.user_data.pop(f"captcha_image_{user_id}", None)
         
         if lang == 'zh':
             success_msg = "✅ 验证成功！正在进入系统..."
@@ -783,54 +712,52 @@ def inline_query(update: Update, context: CallbackContext):
     # 商品分享卡片（根据 nowuid）
     if query.startswith("share_"):
         nowuid = query.replace("share_", "")
-        product = ejfl.find_one({'nowuid': nowuid})
-        if not product:
-            return
-
-        pname = product.get('projectname', '未知商品')
-        price = float(product.get('money', 0))
-        stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
-        desc = product.get('desc', '暂无商品说明')
-
-        # 获取一级分类名
-        uid = product.get('uid')
-        cate_name = '未知分类'
-        if uid:
-            cate = fenlei.find_one({'uid': uid})
-            if cate:
-                cate_name = cate.get('projectname', '未知分类')
-
-        # 分类路径
-        category_path = f"{cate_name} / {pname}"
+        lang_code = update.inline_query.from_user.language_code or 'zh'
+        cache_key = (query, lang_code)
+        results = share_card_manager.inline_results.get(cache_key)
+        if results is None:
+            card = share_card_manager.get_card(nowuid)
+            if not card:
+                return
 
-        # 显示文本（图片下方 caption）
-        text = (
-            f"<b>✅ 商品：</b>{pname}\n"
-            f"<b>📂 分类：</b>{category_path}\n"
-            f"<b>💰 价格：</b>{price:.2f} USDT\n"
-            f"<b>🏢 库存：</b>{stock} 件\n\n"
-            f"❗️ 未使用过的请先少量购买测试，以免争执。谢谢合作！"
-        )
+            pname = card['projectname']
+            price = card['price']
+            stock = card['stock']
+            cate_name = card['cate_name']
+
+            # 分类路径
+            category_path = f"{cate_name} / {pname}"
+
+            # 显示文本（图片下方 caption）
+            text = (
+                f"<b>✅ 商品：</b>{pname}\n"
+                f"<b>📂 分类：</b>{category_path}\n"
+                f"<b>💰 价格：</b>{price:.2f} USDT\n"
+                f"<b>🏢 库存：</b>{stock} 件\n\n"
+                f"❗️ 未使用过的请先少量购买测试，以免争执。谢谢合作！"
+            )
 
-        title = f"🛍 {pname} | {price:.2f}U"
-        description = f"📂 {cate_name} · 📦 剩余 {stock} 件 · 自动发货"
+            title = f"🛍 {pname} | {price:.2f}U"
+            description = f"📂 {cate_name} · 📦 剩余 {stock} 件 · 自动发货"
 
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🛒 立即购买", url=f"https://t.me/{context.bot.username}?start=buy_{nowuid}")]
-        ])
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("🛒 立即购买", url=f"https://t.me/{context.bot.username}?start=buy_{nowuid}")]
+            ])
 
-        results.append(InlineQueryResultPhoto(
-            id=str(uuid.uuid4()),
-            title=title,
-            description=description,
-            photo_url=DEFAULT_IMAGE_URL,
-            thumb_url=DEFAULT_IMAGE_URL,
-            caption=text,
-            parse_mode="HTML",
-            reply_markup=keyboard
-        ))
+            results = [InlineQueryResultPhoto(
+                id=str(uuid.uuid4()),
+                title=title,
+                description=description,
+                photo_url=DEFAULT_IMAGE_URL,
+                thumb_url=DEFAULT_IMAGE_URL,
+                caption=text,
+                parse_mode="HTML",
+                reply_markup=keyboard
+            )]
+            share_card_manager.inline_results.set(cache_key, results)
 
-        update.inline_query.answer(results=results, cache_time=0)
+        # 分享卡片与用户无关，允许 Telegram 端短时缓存
+        update.inline_query.answer(results=results, cache_time=INLINE_SHARE_CACHE_TIME, is_personal=False)
         return
 
     # 欢迎页（空关键词）
@@ -866,9 +793,10 @@ def inline_query(update: Update, context: CallbackContext):
             )
         ]
 
-        update.inline_query.answer(results=results, cache_time=0)
+        update.inline_query.answer(results=results, cache_time=INLINE_WELCOME_CACHE_TIME, is_personal=False)
         return
 
+    # 以下分支依赖用户余额/红包状态，且会写入转账记录，不能让 Telegram 缓存（cache_time=0）
     yh_list = update['inline_query']['from_user']
     user_id = yh_list['id']
     fullname = yh_list['full_name']
@@ -888,10 +816,8 @@ def inline_query(update: Update, context: CallbackContext):
 ⚠️操作失败，转账金额必须大于0
                 '''
 
-                hyy = shangtext.find_one({'projectname': '欢迎语'})['text']
-                hyyys = shangtext.find_one({'projectname': '欢迎语样式'})['text']
-
-                entities = pickle.loads(hyyys)
+                hyy = get_shangtext_value('欢迎语')
+                entities = get_welcome_entities()
 
                 results = [
                     InlineQueryResultArticle(
@@ -950,10 +876,8 @@ def inline_query(update: Update, context: CallbackContext):
 ⚠️操作失败，余额不足，💰当前余额：{USDT}U
             '''
 
-            hyy = shangtext.find_one({'projectname': '欢迎语'})['text']
-            hyyys = shangtext.find_one({'projectname': '欢迎语样式'})['text']
-
-            entities = pickle.loads(hyyys)
+            hyy = get_shangtext_value('欢迎语')
+            entities = get_welcome_entities()
 
             results = [
                 InlineQueryResultArticle(
@@ -1011,24 +935,8 @@ def inline_query(update: Update, context: CallbackContext):
 
             update.inline_query.answer(results=results, cache_time=0)
         else:
-            qbrtext = []
-            jiangpai = {'0': '🥇', '1': '🥈', '2': '🥉'}
-            count = 0
-            qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-            for i in qb_list:
-                qbid = i['user_id']
-                qbname = i['fullname'].replace('<', '').replace('>', '')
-                qbtimer = i['timer'][-8:]
-                qbmoney = i['money']
-                if str(count) in jiangpai.keys():
-
-                    qbrtext.append(
-                        f'{jiangpai[str(count)]} <code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-                else:
-                    qbrtext.append(
-                        f'<code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-                count += 1
-            qbrtext = '\n'.join(qbrtext)
+            qb_list = get_hongbao_claims(uid)
+            qbrtext = _hongbao_rank_text(qb_list)
 
             syhb = hbsl - len(qb_list)
 
@@ -1139,6 +1047,65 @@ def shokuan(update: Update, context: CallbackContext):
         pass
 
 
+def _hongbao_rank_text(claims) -> str:
+    """红包领取排行（前三名带奖牌）"""
+    jiangpai = {0: '🥇', 1: '🥈', 2: '🥉'}
+    lines = []
+    for count, i in enumerate(claims):
+        qbname = i['fullname'].replace('<', '').replace('>', '')
+        line = f'<code>{i["money"]}</code>({i["timer"][-8:]}) USDT💰 - <a href="tg://user?id={i["user_id"]}">{qbname}</a>'
+        lines.append(f'{jiangpai[count]} {line}' if count in jiangpai else line)
+    return '\n'.join(lines)
+
+
+def _hongbao_group_message(bot, hongbao_list, claims):
+    """群内红包消息（文本 + 按钮）"""
+    fb_id = hongbao_list['user_id']
+    hbsl = hongbao_list['hbsl']
+    syhb = hbsl - len(claims)
+    fstext = f'''
+🧧 <a href="tg://user?id={fb_id}">{hongbao_list['fullname']}</a> 发送了一个红包
+💵总金额:{hongbao_list['hbmoney']} USDT💰 剩余:{syhb}/{hbsl}
+
+{_hongbao_rank_text(claims)}
+    '''
+    url = helpers.create_deep_linked_url(bot.username, str(fb_id))
+    keyboard = [[InlineKeyboardButton(bot.first_name, url=url)]]
+    if syhb > 0 and hongbao_list['state'] == 0:
+        keyboard.insert(0, [InlineKeyboardButton('领取红包', callback_data=f'lqhb {hongbao_list["uid"]}')])
+    return fstext, InlineKeyboardMarkup(keyboard)
+
+
+_hongbao_edits = set()
+_hongbao_edits_lock = threading.Lock()
+
+
+def _schedule_hongbao_edit(context: CallbackContext, query, uid):
+    """同一条红包消息在去抖窗口内只刷新一次（渲染时读取最新领取情况）"""
+    key = query.inline_message_id or (query.message.chat_id, query.message.message_id)
+    with _hongbao_edits_lock:
+        if key in _hongbao_edits:
+            return
+        _hongbao_edits.add(key)
+    context.job_queue.run_once(_hongbao_edit_job, HONGBAO_EDIT_DEBOUNCE, context={'key': key, 'uid': uid})
+
+
+def _hongbao_edit_job(context: CallbackContext):
+    key = context.job.context['key']
+    uid = context.job.context['uid']
+    with _hongbao_edits_lock:
+        _hongbao_edits.discard(key)
+    hongbao_list = hongbao.find_one({'uid': uid})
+    if hongbao_list is None:
+        return
+    fstext, markup = _hongbao_group_message(context.bot, hongbao_list, get_hongbao_claims(uid))
+    target = {'inline_message_id': key} if isinstance(key, str) else {'chat_id': key[0], 'message_id': key[1]}
+    try:
+        context.bot.edit_message_text(text=fstext, reply_markup=markup, parse_mode='HTML', **target)
+    except Exception:
+        pass
+
+
 def lqhb(update: Update, context: CallbackContext):
     query = update.callback_query
     uid = query.data.replace('lqhb ', '')
@@ -1148,7 +1115,8 @@ def lqhb(update: Update, context: CallbackContext):
     lastname = query.from_user.last_name
     timer = beijing_now_str()
 
-    if user.find_one({'user_id': user_id}) is None:
+    user_list = user.find_one({'user_id': user_id}, {'username': 1, 'fullname': 1})
+    if user_list is None:
         try:
             key_id = user.find_one({}, sort=[('count_id', -1)])['count_id']
         except:
@@ -1166,103 +1134,23 @@ def lqhb(update: Update, context: CallbackContext):
                     break
                 except:
                     continue
-    elif user.find_one({'user_id': user_id})['username'] != username:
-        user.update_one({'user_id': user_id}, {'$set': {'username': username}})
-
-    elif user.find_one({'user_id': user_id})['fullname'] != fullname:
-        user.update_one({'user_id': user_id}, {'$set': {'fullname': fullname}})
-
-    user_list = user.find_one({"user_id": user_id})
-    USDT = user_list['USDT']
-
-    hongbao_list = hongbao.find_one({'uid': uid})
-    fb_id = hongbao_list['user_id']
-    fb_fullname = hongbao_list['fullname']
-    hbmoney = hongbao_list['hbmoney']
-    hbsl = hongbao_list['hbsl']
-    state = hongbao_list['state']
-    if state == 1:
-        query.answer('红包已抢完', show_alert=bool("true"))
-        return
+    elif user_list.get('username') != username or user_list.get('fullname') != fullname:
+        user.update_one({'user_id': user_id}, {'$set': {'username': username, 'fullname': fullname}})
 
-    qhb_list = qb.find_one({"uid": uid, 'user_id': user_id})
-    if qhb_list is not None:
+    # 原子占用一个预拆分名额（重复领取由 qb 唯一索引拦截）
+    result = claim_hongbao(uid, user_id, fullname, timer)
+    if result['status'] == 'claimed':
         query.answer('你已领取该红包', show_alert=bool("true"))
         return
-    qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-
-    syhb = hbsl - len(qb_list)
-    # 以下是随机分配金额的代码
-    remaining_money = hbmoney - sum(q['money'] for q in qb_list)  # 计算剩余红包总额
-    if syhb > 1:
-        # 多于一个红包剩余时，使用正态分布随机生成金额
-        mean_money = remaining_money / syhb  # 计算每个红包的平均金额
-        std_dev = mean_money / 3  # 标准差设定为平均金额的1/3
-        money = standard_num(max(0.01, round(random.normalvariate(mean_money, std_dev), 2)))  # 使用正态分布生成金额，并保留两位小数
-        money = float(money) if str(money).count('.') > 0 else int(money)
-    else:
-        # 如果只有一个红包剩余，直接将剩余金额分配给该红包
-        money = round(remaining_money, 2)  # 将剩余金额保留两位小数
-        money = float(money) if str(money).count('.') > 0 else int(money)
-
-    # 将金额保存到数据库
-    qb.insert_one({
-        'uid': uid,
-        'user_id': user_id,
-        'fullname': fullname,
-        'money': money,
-        'timer': timer
-    })
-
-    user_money = standard_num(USDT + money)
-    user_money = float(user_money) if str(user_money).count('.') > 0 else int(user_money)
-    user.update_one({'user_id': user_id}, {"$set": {'USDT': user_money}})
-
-    query.answer(f'领取红包成功，金额:{money}', show_alert=bool("true"))
-
-    jiangpai = {'0': '🥇', '1': '🥈', '2': '🥉'}
-
-    qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-
-    syhb = hbsl - len(qb_list)
-    qbrtext = []
-    count = 0
-    for i in qb_list:
-        qbid = i['user_id']
-        qbname = i['fullname'].replace('<', '').replace('>', '')
-        qbtimer = i['timer'][-8:]
-        qbmoney = i['money']
-        if str(count) in jiangpai.keys():
-
-            qbrtext.append(
-                f'{jiangpai[str(count)]} <code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-        else:
-            qbrtext.append(f'<code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-        count += 1
-    qbrtext = '\n'.join(qbrtext)
-
-    fstext = f'''
-🧧 <a href="tg://user?id={fb_id}">{fb_fullname}</a> 发送了一个红包
-💵总金额:{hbmoney} USDT💰 剩余:{syhb}/{hbsl}
+    if result['status'] == 'unavailable':
+        query.answer('红包领取暂不可用，请联系管理员', show_alert=bool("true"))
+        return
+    if result['status'] != 'ok':
+        query.answer('红包已抢完', show_alert=bool("true"))
+        return
 
-{qbrtext}
-    '''
-    if syhb == 0:
-        url = helpers.create_deep_linked_url(context.bot.username, str(user_id))
-        keyboard = [
-            [InlineKeyboardButton(context.bot.first_name, url=url)]
-        ]
-        hongbao.update_one({'uid': uid}, {"$set": {'state': 1}})
-    else:
-        url = helpers.create_deep_linked_url(context.bot.username, str(user_id))
-        keyboard = [
-            [InlineKeyboardButton('领取红包', callback_data=f'lqhb {uid}')],
-            [InlineKeyboardButton(context.bot.first_name, url=url)]
-        ]
-    try:
-        query.edit_message_text(text=fstext, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
-    except:
-        pass
+    query.answer(f'领取红包成功，金额:{result["money"]}', show_alert=bool("true"))
+    _schedule_hongbao_edit(context, query, uid)
 
 
 def xzhb(update: Update, context: CallbackContext):
@@ -1277,28 +1165,11 @@ def xzhb(update: Update, context: CallbackContext):
     hbmoney = hongbao_list['hbmoney']
     hbsl = hongbao_list['hbsl']
     timer = hongbao_list['timer']
-    jiangpai = {'0': '🥇', '1': '🥈', '2': '🥉'}
     if state == 0:
 
-        qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-
+        qb_list = get_hongbao_claims(uid)
         syhb = hbsl - len(qb_list)
-
-        qbrtext = []
-        count = 0
-        for i in qb_list:
-            qbid = i['user_id']
-            qbname = i['fullname'].replace('<', '').replace('>', '')
-            qbtimer = i['timer'][-8:]
-            qbmoney = i['money']
-            if str(count) in jiangpai.keys():
-
-                qbrtext.append(
-                    f'{jiangpai[str(count)]} <code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-            else:
-                qbrtext.append(f'<code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-            count += 1
-        qbrtext = '\n'.join(qbrtext)
+        qbrtext = _hongbao_rank_text(qb_list)
 
         fstext = f'''
 🧧 <a href="tg://user?id={fb_id}">{fb_fullname}</a> 发送了一个红包
@@ -1315,23 +1186,7 @@ def xzhb(update: Update, context: CallbackContext):
                                  reply_markup=InlineKeyboardMarkup(keyboard))
     else:
 
-        qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-
-        qbrtext = []
-        count = 0
-        for i in qb_list:
-            qbid = i['user_id']
-            qbname = i['fullname'].replace('<', '').replace('>', '')
-            qbtimer = i['timer'][-8:]
-            qbmoney = i['money']
-            if str(count) in jiangpai.keys():
-
-                qbrtext.append(
-                    f'{jiangpai[str(count)]} <code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-            else:
-                qbrtext.append(f'<code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-            count += 1
-        qbrtext = '\n'.join(qbrtext)
+        qbrtext = _hongbao_rank_text(get_hongbao_claims(uid))
 
         fstext = f'''
 🧧 <a href="tg://user?id={fb_id}">{fb_fullname}</a> 发送了一个红包
@@ -1363,8 +1218,8 @@ def jxzhb(update: Update, context: CallbackContext):
         timer = i['timer'][-14:-3]
         hbsl = i['hbsl']
         uid = i['uid']
-        qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-        syhb = hbsl - len(qb_list)
+        claimed = i['claimed'] if 'claimed' in i else qb.count_documents({'uid': uid})
+        syhb = hbsl - claimed
         hbmoney = i['hbmoney']
         keyboard.append(
             [InlineKeyboardButton(f'🧧[{timer}] {syhb}/{hbsl} - {hbmoney} USDT', callback_data=f'xzhb {uid}')])
@@ -1443,8 +1298,11 @@ def start(update: Update, context: CallbackContext):
             except:
                 continue
     else:
-        if user.find_one({'user_id': user_id})['fullname'] != fullname:
+        existing = user.find_one({'user_id': user_id}, {'fullname': 1, 'bot_blocked': 1})
+        if existing['fullname'] != fullname:
             user.update_one({'user_id': user_id}, {'$set': {'fullname': fullname}})
+        if existing.get('bot_blocked'):
+            clear_user_blocked(user_id)
 
     # ✅ 管理员状态设置 - 统一使用 user_id 验证
     if is_admin(user_id):
@@ -1715,6 +1573,112 @@ def admin(update: Update, context: CallbackContext):
     logging.info(f"Admin panel accessed by user_id={user_id}")
     show_admin_panel(update, context, user_id)
 
+def rebuild_sales_rollups_command(update: Update, context: CallbackContext):
+    """/rebuild_sales_rollups - 从购买记录回填销售汇总（总部管理员）"""
+    user_id = update.effective_user.id
+    if not multi_bot_system.is_master_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    msg = update.message.reply_text("⏳ 正在回填销售汇总，请稍候...")
+    try:
+        result = rebuild_sales_rollups()
+        msg.edit_text(
+            f"✅ 销售汇总回填完成\n\n"
+            f"📋 扫描订单：{result['scanned']}\n"
+            f"📅 覆盖天数：{result['days']}\n"
+            f"⚠️ 时间无法解析：{result['skipped']}\n"
+            f"🧾 回填期间补记订单：{result['pending']}\n"
+            f"⏱ 耗时：{result['elapsed']}s"
+        )
+    except Exception as e:
+        logging.error(f"❌ 销售汇总回填失败：{e}")
+        msg.edit_text(f"❌ 销售汇总回填失败：{e}")
+
+
+def migrate_hongbao_claims_command(update: Update, context: CallbackContext):
+    """/migrate_hongbao_claims - 归档重复红包领取记录并建立唯一索引（总部管理员，一次性）"""
+    user_id = update.effective_user.id
+    if not multi_bot_system.is_master_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    msg = update.message.reply_text("⏳ 正在迁移红包领取记录，请稍候...")
+    try:
+        result = migrate_hongbao_claims()
+        msg.edit_text(
+            f"✅ 红包领取记录迁移完成\n\n"
+            f"👥 重复领取组：{result['groups']}\n"
+            f"📦 归档到 qb_duplicates：{result['archived']} 条\n"
+            f"🔒 唯一索引已建立，红包领取恢复"
+        )
+    except Exception as e:
+        logging.error(f"❌ 红包领取记录迁移失败：{e}")
+        msg.edit_text(f"❌ 红包领取记录迁移失败：{e}")
+
+
+def hongbao_claim_recovery_job(context: CallbackContext):
+    """定时归还中断领取占用的红包名额"""
+    try:
+        recover_stale_hongbao_claims()
+    except Exception as e:
+        logging.error(f"❌ 归还中断红包名额失败：{e}")
+
+
+_timer_migration_stop = threading.Event()
+_timer_migration_running = threading.Lock()
+
+
+def migrate_timer_fields_command(update: Update, context: CallbackContext):
+    """/migrate_timer_fields [stop] - 后台回填时间字段的 datetime 副本（可中断、可续跑）"""
+    user_id = update.effective_user.id
+    if not multi_bot_system.is_master_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    if context.args and context.args[0] == 'stop':
+        _timer_migration_stop.set()
+        update.message.reply_text("⏸ 已请求停止，将在当前批次结束后暂停（再次执行命令可续跑）")
+        return
+
+    if not _timer_migration_running.acquire(blocking=False):
+        update.message.reply_text("⏳ 时间字段回填正在进行中")
+        return
+
+    _timer_migration_stop.clear()
+    msg = update.message.reply_text("⏳ 开始回填时间字段...")
+    last_edit = [0.0]
+
+    def on_progress(collection_name, field, migrated):
+        if time.time() - last_edit[0] < 5:
+            return
+        last_edit[0] = time.time()
+        try:
+            msg.edit_text(f"⏳ 正在回填 <code>{collection_name}.{field}</code>：已处理 {migrated} 条", parse_mode='HTML')
+        except Exception:
+            pass
+
+    def run():
+        try:
+            result = migrate_timer_fields(should_stop=_timer_migration_stop.is_set, progress=on_progress)
+            status = "⏸ 已暂停" if result['stopped'] else "✅ 回填完成"
+            completed = "\n".join(f"• <code>{k}</code>" for k in result['completed']) or "• 无"
+            msg.edit_text(
+                f"{status}\n\n本次写入：{result['migrated']} 条\n完成字段：\n{completed}",
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logging.error(f"❌ 时间字段回填失败：{e}")
+            try:
+                msg.edit_text(f"❌ 时间字段回填失败：{e}（再次执行命令可从断点续跑）")
+            except Exception:
+                pass
+        finally:
+            _timer_migration_running.release()
+
+    threading.Thread(target=run, daemon=True, name='TimerMigration').start()
+
+
 def diag_db(update: Update, context: CallbackContext):
     """数据库诊断命令 - 显示当前 MongoDB 配置信息"""
     user_id = update.effective_user.id
@@ -1780,173 +1744,130 @@ def diag_db(update: Update, context: CallbackContext):
         import traceback
         traceback.print_exc()
 
+def _export_menu_markup(user_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔙 返回数据导出", callback_data='data_export_menu')],
+        [InlineKeyboardButton("❌ 关闭", callback_data=f'close {user_id}')]
+    ])
+
+
+def _chunk_progress_text(chunks):
+    return f"🧩 时间分块：{chunks['done']}/{chunks['total']}" if chunks.get('total') else ""
+
+
+def _iter_gmjlu_export_batches(projection, chunks):
+    """购买记录按时间分块并行读取（新到旧），chunks 记录分块进度"""
+    def on_chunk(done, total):
+        chunks.update(done=done, total=total)
+    return iter_chunked_batches(
+        gmjlu, {}, 'timer', projection=projection, progress=on_chunk,
+        range_filter=lambda start, end: timer_range_filter('gmjlu', 'timer', start, end)
+    )
+
+
+def _iter_topup_export_batches(projection, chunks):
+    """成功充值记录按时间分块并行读取（新到旧）"""
+    def on_chunk(done, total):
+        chunks.update(done=done, total=total)
+    return iter_chunked_batches(topup, {'status': 'success'}, 'time', projection=projection, progress=on_chunk)
+
+
+def start_background_export(query, context: CallbackContext, title, filename, build, done_markup=None):
+    """把导出提交到后台线程池，当前消息作为进度/结果提示"""
+    submitted = submit_export(
+        context.bot, query.message.chat_id, query.message.message_id,
+        title, filename, build, done_markup=done_markup
+    )
+    if submitted:
+        query.edit_message_text(f"⏳ {title}导出已开始，完成后自动发送文件...")
+    else:
+        query.answer(f"⏳ {title}正在导出中，请稍候", show_alert=True)
+
+
 def export_gmjlu_records(update: Update, context: CallbackContext):
-    """导出用户购买记录 - 优化版"""
+    """导出用户购买记录 - 流式后台导出"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
 
-    try:
-        # 获取所有下单记录 - 修复版：兼容字符串格式的timer字段
-        orders = list(gmjlu.find({}))
-        
-        # 按时间排序（处理字符串格式的时间）
-        def parse_time_safe(timer_value):
-            if isinstance(timer_value, str):
-                try:
-                    return datetime.strptime(timer_value, '%Y-%m-%d %H:%M:%S')
-                except:
-                    return datetime.min
-            return timer_value or datetime.min
-        
-        orders.sort(key=lambda x: parse_time_safe(x.get('timer')), reverse=True)
-        
-        if not orders:
-            query.edit_message_text("📭 暂无下单记录。")
-            return
-
-        data = []
+    def build(writer, job):
+        detail = writer.sheet("购买记录明细", [
+            ("订单时间", 20), ("用户ID", 14), ("用户名", 18), ("用户姓名", 18), ("商品类型", 12),
+            ("商品名称", 25), ("购买数量", 10), ("单价(USDT)", 12), ("总价(USDT)", 12),
+            ("用户余额", 12), ("用户状态", 10), ("记录内容", 25)
+        ])
         category_stats = {}
         user_stats = {}
         total_revenue = 0
-        
-        for o in orders:
-            uid = o.get('user_id')
-            uinfo = user.find_one({'user_id': uid}) or {}
-
-            pname = o.get('projectname', '未知商品')
-            leixing = o.get('leixing', '未知类型')
-            text = o.get('text', '')
-            ts = o.get('timer', beijing_now_str())  # 使用timer字段
-            count = o.get('count', 1)
-            price = o.get('price', 0)  # 单价
-            total_price = o.get('total_price', price * count)  # 总价
-            
-            # 统计数据
-            category_stats[leixing] = category_stats.get(leixing, 0) + 1
-            if uid not in user_stats:
-                user_stats[uid] = {'orders': 0, 'amount': 0}
-            user_stats[uid]['orders'] += 1
-            user_stats[uid]['amount'] += total_price
-            total_revenue += total_price
-
-            # 处理记录内容显示
-            if leixing in ['会员链接', '谷歌', 'API链接', 'txt文本']:
-                record_content = text[:100] + "..." if len(text) > 100 else text
-            else:
-                record_content = '[文件内容]'
-
-            data.append({
-                "订单时间": ts,
-                "用户ID": uid,
-                "用户名": uinfo.get('username', '未知'),
-                "用户姓名": uinfo.get('fullname', '').replace('<', '').replace('>', ''),
-                "商品类型": leixing,
-                "商品名称": pname,
-                "购买数量": count,
-                "单价(USDT)": price,
-                "总价(USDT)": total_price,
-                "用户余额": uinfo.get('USDT', 0),
-                "用户状态": uinfo.get('state', '1'),
-                "记录内容": record_content
-            })
+        total_orders = 0
+        chunks = {}
+
+        projection = {'_id': 0, 'user_id': 1, 'projectname': 1, 'leixing': 1, 'text': 1,
+                      'timer': 1, 'count': 1, 'price': 1, 'total_price': 1}
+        for batch in _iter_gmjlu_export_batches(projection, chunks):
+            users_map = join_users(batch)
+            for o in batch:
+                uid = o.get('user_id')
+                uinfo = users_map.get(uid, {})
+                leixing = o.get('leixing', '未知类型')
+                text = o.get('text', '')
+                count = o.get('count', 1)
+                price = o.get('price', 0)  # 单价
+                total_price = o.get('total_price', price * count)  # 总价
+
+                # 统计数据
+                category_stats[leixing] = category_stats.get(leixing, 0) + 1
+                stats = user_stats.setdefault(uid, {'orders': 0, 'amount': 0})
+                stats['orders'] += 1
+                stats['amount'] += total_price
+                total_revenue += total_price
+
+                # 处理记录内容显示
+                if leixing in ['会员链接', '谷歌', 'API链接', 'txt文本']:
+                    record_content = text[:100] + "..." if len(text) > 100 else text
+                else:
+                    record_content = '[文件内容]'
 
-        # 生成统计报表
-        stats_data = []
-        for category, count in sorted(category_stats.items(), key=lambda x: x[1], reverse=True):
-            stats_data.append({
-                "商品类型": category,
-                "销售数量": count,
-                "占比": f"{count/len(orders)*100:.1f}%"
-            })
+                detail.write_row([
+                    o.get('timer', ''), uid, uinfo.get('username', '未知'), clean_name(uinfo.get('fullname')),
+                    leixing, o.get('projectname', '未知商品'), count, price, total_price,
+                    uinfo.get('USDT', 0), uinfo.get('state', '1'), record_content
+                ])
+            total_orders += len(batch)
+            job.progress(f"📋 已写入 {total_orders} 条记录\n{_chunk_progress_text(chunks)}")
 
-        # 用户购买排行
-        user_ranking = []
-        sorted_users = sorted(user_stats.items(), key=lambda x: x[1]['amount'], reverse=True)[:20]
-        for i, (uid, stats) in enumerate(sorted_users, 1):
-            uinfo = user.find_one({'user_id': uid}) or {}
-            user_ranking.append({
-                "排名": i,
-                "用户ID": uid,
-                "用户名": uinfo.get('username', ''),
-                "用户姓名": uinfo.get('fullname', '').replace('<', '').replace('>', ''),
-                "订单数量": stats['orders'],
-                "消费总额": stats['amount']
-            })
+        if not total_orders:
+            return "📭 暂无下单记录。"
 
-        # 生成Excel文件
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            # 详细记录
-            df_details = pd.DataFrame(data)
-            df_details.to_excel(writer, index=False, sheet_name="购买记录明细")
-            
-            # 商品类型统计
-            df_category = pd.DataFrame(stats_data)
-            df_category.to_excel(writer, index=False, sheet_name="商品类型统计")
-            
-            # 用户购买排行
-            df_users = pd.DataFrame(user_ranking)
-            df_users.to_excel(writer, index=False, sheet_name="用户购买排行")
-            
-            # 总体统计
-            summary_data = [{
-                "统计项目": "订单总数",
-                "数值": len(orders),
-                "备注": "所有历史订单"
-            }, {
-                "统计项目": "总收入",
-                "数值": f"{total_revenue:.2f} USDT",
-                "备注": "累计销售收入"
-            }, {
-                "统计项目": "客户总数",
-                "数值": len(user_stats),
-                "备注": "有购买记录的用户"
-            }, {
-                "统计项目": "商品类型",
-                "数值": len(category_stats),
-                "备注": "不同商品类别数"
-            }, {
-                "统计项目": "平均客单价",
-                "数值": f"{total_revenue/len(user_stats):.2f} USDT" if user_stats else "0 USDT",
-                "备注": "每用户平均消费"
-            }]
-            
-            df_summary = pd.DataFrame(summary_data)
-            df_summary.to_excel(writer, index=False, sheet_name="总体统计")
-            
-            # 设置列宽
-            for sheet_name in ["购买记录明细", "商品类型统计", "用户购买排行", "总体统计"]:
-                worksheet = writer.sheets[sheet_name]
-                if sheet_name == "购买记录明细":
-                    df = df_details
-                elif sheet_name == "商品类型统计":
-                    df = df_category
-                elif sheet_name == "用户购买排行":
-                    df = df_users
-                else:
-                    df = df_summary
-                    
-                for i, col in enumerate(df.columns):
-                    column_len = max(df[col].astype(str).str.len().max(), len(col)) + 2
-                    worksheet.set_column(i, i, min(column_len, 25))
+        writer.write_table("商品类型统计", [("商品类型", 15), ("销售数量", 12), ("占比", 10)], [
+            {"商品类型": category, "销售数量": count, "占比": f"{count / total_orders * 100:.1f}%"}
+            for category, count in sorted(category_stats.items(), key=lambda x: x[1], reverse=True)
+        ])
 
-        buffer.seek(0)
-        
-        # 发送文件
-        context.bot.send_document(
-            chat_id=user_id, 
-            document=buffer, 
-            filename=f"用户购买记录详细报表_{beijing_now_str('%Y%m%d_%H%M%S')}.xlsx",
-            caption=f"📊 购买记录导出完成\n\n🛒 总订单: {len(orders)} 个\n👥 总用户: {len(user_stats)} 人\n💰 总收入: {total_revenue:.2f} USDT\n📈 商品类型: {len(category_stats)} 种"
-        )
-        
-        query.edit_message_text("✅ 用户购买记录导出完成！")
+        # 用户购买排行（一次 $in 关联前 20 名）
+        top_users = sorted(user_stats.items(), key=lambda x: x[1]['amount'], reverse=True)[:20]
+        top_info = join_users([{'user_id': uid} for uid, _ in top_users])
+        writer.write_table("用户购买排行", [("排名", 6), ("用户ID", 14), ("用户名", 18), ("用户姓名", 18),
+                                         ("订单数量", 10), ("消费总额", 12)], [
+            {"排名": i, "用户ID": uid, "用户名": top_info.get(uid, {}).get('username', ''),
+             "用户姓名": clean_name(top_info.get(uid, {}).get('fullname')),
+             "订单数量": stats['orders'], "消费总额": stats['amount']}
+            for i, (uid, stats) in enumerate(top_users, 1)
+        ])
 
-    except Exception as e:
-        query.edit_message_text(f"❌ 导出失败：{str(e)}")
-        print(f"[错误] 导出购买记录失败: {e}")
+        writer.write_table("总体统计", [("统计项目", 12), ("数值", 18), ("备注", 20)], [
+            {"统计项目": "订单总数", "数值": total_orders, "备注": "所有历史订单"},
+            {"统计项目": "总收入", "数值": f"{total_revenue:.2f} USDT", "备注": "累计销售收入"},
+            {"统计项目": "客户总数", "数值": len(user_stats), "备注": "有购买记录的用户"},
+            {"统计项目": "商品类型", "数值": len(category_stats), "备注": "不同商品类别数"},
+            {"统计项目": "平均客单价",
+             "数值": f"{total_revenue / len(user_stats):.2f} USDT" if user_stats else "0 USDT",
+             "备注": "每用户平均消费"},
+        ])
+        return (f"📊 购买记录导出完成\n\n🛒 总订单: {total_orders} 个\n👥 总用户: {len(user_stats)} 人\n"
+                f"💰 总收入: {total_revenue:.2f} USDT\n📈 商品类型: {len(category_stats)} 种")
 
+    start_background_export(query, context, "用户购买记录", f"用户购买记录详细报表_{beijing_now_str('%Y%m%d_%H%M%S')}", build)
 
 # 🆕 销售统计仪表板
 def sales_dashboard(update: Update, context: CallbackContext):
@@ -1967,41 +1888,18 @@ def sales_dashboard(update: Update, context: CallbackContext):
     week_start = today_start - timedelta(days=today_start.weekday())
     month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 
-    # 销量统计 - 修复版：兼容字符串格式的时间字段
+    # 销量统计：从日汇总读取（一次 _id 范围查询覆盖本月/本周/昨日）
+    range_start = min(yesterday_start, week_start, month_start)
+    rollup_days = {doc['day']: doc for doc in get_sales_rollup_days(
+        range_start.strftime('%Y-%m-%d'), today_start.strftime('%Y-%m-%d'))}
+
     def get_sales_stats(start_time, end_time):
-        # 获取所有订单，然后在Python中过滤时间
-        all_orders = list(gmjlu.find())
-        orders = []
-        
-        for order in all_orders:
-            timer_value = order.get('timer')
-            if timer_value:
-                try:
-                    # 处理字符串格式的时间
-                    # 数据库中的时间字符串按北京时间存储，parse_to_beijing将其标记为北京时区
-                    if isinstance(timer_value, str):
-                        order_time = parse_to_beijing(timer_value)
-                    else:
-                        order_time = timer_value
-                    
-                    if start_time <= order_time < end_time:
-                        orders.append(order)
-                except Exception as e:
-                    print(f"时间解析错误: {timer_value}, 错误: {e}")
-                    # 如果时间解析失败，跳过这条记录
-                    continue
-        
-        total_orders = len(orders)
-        unique_customers = len(set(o.get('user_id') for o in orders if o.get('user_id')))
-        
-        # 按商品类型统计
-        category_stats = {}
-        for order in orders:
-            category = order.get('leixing', '未知')
-            count = order.get('count', 1)
-            category_stats[category] = category_stats.get(category, 0) + count
-        
-        return total_orders, unique_customers, category_stats
+        start_day = start_time.strftime('%Y-%m-%d')
+        end_day = end_time.strftime('%Y-%m-%d') if end_time == today_start else '9999-12-31'
+        summary = summarize_sales_rollups(
+            doc for day, doc in rollup_days.items() if start_day <= day < end_day
+        )
+        return summary['orders'], summary['customers'], summary['by_leixing']
 
     # 获取各时段数据
     today_orders, today_customers, today_categories = get_sales_stats(today_start, now)
@@ -2009,15 +1907,8 @@ def sales_dashboard(update: Update, context: CallbackContext):
     week_orders, week_customers, week_categories = get_sales_stats(week_start, now)
     month_orders, month_customers, month_categories = get_sales_stats(month_start, now)
 
-    # 热销商品Top5 - 修复版：统计实际商品销量
-    all_orders = list(gmjlu.find())
-    product_count = {}
-    for order in all_orders:
-        product = order.get('projectname', '未知商品')
-        count = order.get('count', 1)
-        if product != '点击按钮修改':  # 过滤掉测试数据
-            product_count[product] = product_count.get(product, 0) + count
-    
+    # 热销商品Top5：全量累计汇总
+    product_count = get_sales_rollup_total().get('by_product', {})
     top_products = sorted(product_count.items(), key=lambda x: x[1], reverse=True)[:5]
 
     # 获取库存统计 - 基于真实数据结构
@@ -2086,7 +1977,7 @@ def sales_dashboard(update: Update, context: CallbackContext):
 
 # 🆕 库存预警系统
 def stock_alerts(update: Update, context: CallbackContext):
-    """库存预警系统"""
+    """库存预警系统 - 基于库存健康报告（一次聚合）"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
@@ -2096,17 +1987,11 @@ def stock_alerts(update: Update, context: CallbackContext):
         query.edit_message_text("❌ 无权限访问此功能")
         return
 
-    # 获取所有商品分类和库存信息 - 修复版：检查实际库存数据
-    categories = list(fenlei.find({}))
-    
-    low_stock_items = []
-    out_of_stock_items = []
-    normal_stock_items = []
-    
-    # 如果hb集合为空，显示提示信息
-    total_hb_count = hb.count_documents({})
-    
-    if total_hb_count == 0:
+    report = stock_health.report()
+    products = report['products']
+
+    # 没有任何商品时显示提示信息
+    if not products:
         text = """
 🚨 <b>库存预警系统</b>
 
@@ -2123,70 +2008,51 @@ def stock_alerts(update: Update, context: CallbackContext):
         keyboard = [[InlineKeyboardButton("🔙 返回管理面板", callback_data='backstart')]]
         query.edit_message_text(text=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
         return
-    
-    for category in categories:
-        category_name = category.get('name', '未知分类')
-        
-        # 基于实际数据：state=0是可用库存，state=1是已售出
-        available_count = hb.count_documents({'leixing': category_name, 'state': 0})
-        sold_count = hb.count_documents({'leixing': category_name, 'state': 1})
-        total_count = available_count + sold_count
-        
-        # 如果分类名是"未知"，查询所有协议号类型的库存
-        if category_name == '未知':
-            available_count = hb.count_documents({'leixing': '协议号', 'state': 0})
-            sold_count = hb.count_documents({'leixing': '协议号', 'state': 1})
-            total_count = available_count + sold_count
-            category_name = '协议号'  # 显示实际的商品类型
-        
-        # 设定预警阈值
-        warning_threshold = 10  # 低库存预警
-        critical_threshold = 0   # 缺货预警
-        
-        if available_count <= critical_threshold:
-            out_of_stock_items.append((category_name, available_count, total_count))
-        elif available_count <= warning_threshold:
-            low_stock_items.append((category_name, available_count, total_count))
-        else:
-            normal_stock_items.append((category_name, available_count, total_count))
 
-    # 构建预警报告 - 修复版
+    out_of_stock_items = [p for p in products if p['level'] == 'out']
+    low_stock_items = sorted([p for p in products if p['level'] == 'low'], key=lambda p: p['available'])
+    normal_count = len(products) - len(out_of_stock_items) - len(low_stock_items)
+
+    # 构建预警报告（按商品阈值判断）
     alert_text = ""
     if out_of_stock_items:
-        alert_text += "🚨 <b>缺货商品分类</b>\n"
-        for category, available, total in out_of_stock_items[:10]:  # 限制显示数量
-            alert_text += f"   ❌ {category} (可用: {available}, 总计: {total})\n"
+        alert_text += "🚨 <b>缺货商品</b>\n"
+        for p in out_of_stock_items[:10]:  # 限制显示数量
+            alert_text += f"   ❌ {p['category']} / {p['projectname']} (已售: {p['sold']})\n"
         alert_text += "\n"
 
-    warning_text = ""
     if low_stock_items:
-        warning_text += "⚠️ <b>低库存预警分类</b>\n"
-        for category, available, total in low_stock_items[:10]:
-            alert_text += f"   ⚠️ {category} (可用: {available}, 总计: {total})\n"
-        warning_text += "\n"
+        alert_text += "⚠️ <b>低库存预警商品</b>\n"
+        for p in low_stock_items[:10]:
+            alert_text += f"   ⚠️ {p['category']} / {p['projectname']} (可用: {p['available']}, 阈值: {p['threshold']})\n"
+        alert_text += "\n"
+
+    # 分类概览：问题商品最多的分类排前
+    category_text = ""
+    categories = sorted(report['categories'], key=lambda c: (c['out'] + c['low'], -c['available']), reverse=True)
+    for c in categories[:8]:
+        category_text += (f"   📁 {c['category']}：可用 {c['available']} / 已售 {c['sold']}"
+                          f"（缺货 {c['out']}，低库存 {c['low']}）\n")
 
-    # 库存概览
-    total_products = len(out_of_stock_items) + len(low_stock_items) + len(normal_stock_items)
-    normal_count = len(normal_stock_items)
-    
     text = f"""
 ⚠️ <b>库存预警系统</b>
 
 
 📋 <b>库存概览</b>
-├─ 📦 商品总数：<code>{total_products}</code> 个
+├─ 📦 商品总数：<code>{len(products)}</code> 个
 ├─ ✅ 库存正常：<code>{normal_count}</code> 个
 ├─ ⚠️ 低库存预警：<code>{len(low_stock_items)}</code> 个
 └─ 🚨 缺货商品：<code>{len(out_of_stock_items)}</code> 个
 
-{alert_text}{warning_text}
+{alert_text}📁 <b>分类库存</b>
+{category_text}
 💡 <b>建议操作</b>
 ├─ 🔄 及时补充缺货商品
 ├─ 📊 关注低库存预警
 └─ 🔍 定期检查库存状态
 
 
-⏰ 更新时间：{beijing_now_str('%m-%d %H:%M:%S')}
+⏰ 数据时间：{format_beijing_time(report['built_at'], '%m-%d %H:%M:%S')}
     """.strip()
 
     keyboard = [
@@ -2272,26 +2138,30 @@ def auto_restock_reminders(update: Update, context: CallbackContext):
     query.answer()
     user_id = query.from_user.id
 
+    default_threshold, per_product = stock_health.thresholds()
+    history = stock_health.alert_history_counts()
+
     text = f"""
 🔄 <b>自动补货提醒</b>
 
 
 ⚙️ <b>提醒设置</b>
-├─ 📋 低库存阈值：<code>10</code> 件
+├─ 📋 低库存阈值：<code>{default_threshold}</code> 件
+├─ 🎯 单品自定义阈值：<code>{len(per_product)}</code> 个商品
 ├─ 🚨 缺货阈值：<code>0</code> 件
-├─ ⏰ 检查频率：<code>每日 09:00</code>
+├─ ⏰ 检查频率：<code>出库后 {STOCK_ALERT_CHECK_SECONDS} 秒内，全量每 {STOCK_ALERT_SWEEP_SECONDS // 60} 分钟</code>
 └─ 📨 提醒方式：<code>Telegram消息</code>
 
 📊 <b>提醒历史</b>
-├─ 今日提醒：<code>3</code> 次
-├─ 本周提醒：<code>15</code> 次
-└─ 本月提醒：<code>45</code> 次
+├─ 今日提醒：<code>{history['today']}</code> 次
+├─ 本周提醒：<code>{history['week']}</code> 次
+└─ 本月提醒：<code>{history['month']}</code> 次
 
 💡 <b>功能说明</b>
 ├─ 🤖 系统自动监控库存
-├─ ⚠️ 低库存时发送预警
+├─ ⚠️ 库存跌破阈值时发送预警
 ├─ 🚨 缺货时立即通知
-└─ 📊 提供补货建议
+└─ 🔁 同一商品补货恢复前只提醒一次
 
 
 🔧 <b>状态</b>：✅ 已启用
@@ -2305,95 +2175,66 @@ def auto_restock_reminders(update: Update, context: CallbackContext):
         [InlineKeyboardButton("❌ 关闭", callback_data=f'close {user_id}')]
     ]
 
-    query.edit_message_text(
-        text=text,
-        parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        disable_web_page_preview=True
-    )
-
-
-# 🆕 导出用户综合数据
-def export_users_comprehensive(update: Update, context: CallbackContext):
-    """导出用户综合数据"""
-    query = update.callback_query
-    query.answer()
-    user_id = query.from_user.id
-
-    # 权限检查 - 使用env配置的管理员列表
-    if not is_admin(user_id):
-        query.edit_message_text("❌ 无权限访问此功能")
-        return
-
-    try:
-        # 获取所有用户数据
-        users = list(user.find({}))
-        
-        data = []
-        for u in users:
-            uid = u.get('user_id')
-            
-            # 获取用户充值记录
-            recharge_records = list(topup.find({'user_id': uid, 'status': 'success'}))
-            total_recharge = sum(r.get('money', 0) for r in recharge_records)
-            recharge_count = len(recharge_records)
-            
-            # 获取用户购买记录
-            order_records = list(gmjlu.find({'user_id': uid}))
-            order_count = len(order_records)
-            
-            # 注册时间（如果有的话）
-            reg_time = u.get('reg_time', '未知')
-            if isinstance(reg_time, datetime):
-                reg_time = format_beijing_time(reg_time)
-            
-            data.append({
-                "用户ID": uid,
-                "用户名": u.get('username', ''),
-                "姓名": u.get('fullname', '').replace('<', '').replace('>', ''),
-                "USDT余额": u.get('USDT', 0),
-                "用户状态": u.get('state', '1'),
-                "注册时间": reg_time,
-                "充值总额": total_recharge,
-                "充值次数": recharge_count,
-                "购买次数": order_count,
-                "最后活跃": u.get('last_active', '未知')
-            })
-        
-        # 生成Excel文件
-        df = pd.DataFrame(data)
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name="用户综合数据")
-            
-            # 设置列宽
-            worksheet = writer.sheets["用户综合数据"]
-            for i, col in enumerate(df.columns):
-                column_len = max(df[col].astype(str).str.len().max(), len(col)) + 2
-                worksheet.set_column(i, i, min(column_len, 50))
-        
-        buffer.seek(0)
-        context.bot.send_document(
-            chat_id=user_id, 
-            document=buffer, 
-            filename=f"用户综合数据_{beijing_now_str('%Y%m%d_%H%M%S')}.xlsx"
-        )
-        
-        query.edit_message_text(
-            f"✅ 用户综合数据导出完成\n\n📊 共导出 {len(data)} 个用户的数据",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 返回数据导出", callback_data='data_export_menu')],
-                [InlineKeyboardButton("❌ 关闭", callback_data=f'close {user_id}')]
-            ])
-        )
-        
-    except Exception as e:
-        query.edit_message_text(f"❌ 导出失败：{str(e)}")
+    query.edit_message_text(
+        text=text,
+        parse_mode='HTML',
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        disable_web_page_preview=True
+    )
+
+
+# 🆕 导出用户综合数据
+def export_users_comprehensive(update: Update, context: CallbackContext):
+    """导出用户综合数据 - 流式后台导出"""
+    query = update.callback_query
+    query.answer()
+    user_id = query.from_user.id
+
+    # 权限检查 - 使用env配置的管理员列表
+    if not is_admin(user_id):
+        query.edit_message_text("❌ 无权限访问此功能")
+        return
+
+    def build(writer, job):
+        sheet = writer.sheet("用户综合数据", [
+            ("用户ID", 14), ("用户名", 18), ("姓名", 18), ("USDT余额", 12), ("用户状态", 10),
+            ("注册时间", 20), ("充值总额", 12), ("充值次数", 10), ("购买次数", 10), ("最后活跃", 20)
+        ])
+        exported = 0
+        projection = {'_id': 0, 'user_id': 1, 'username': 1, 'fullname': 1, 'USDT': 1,
+                      'state': 1, 'reg_time': 1, 'last_active': 1}
+        for batch in iter_batches(user.find({}, projection)):
+            ids = [u.get('user_id') for u in batch]
+            # 每批一次聚合：充值总额/次数、购买次数
+            recharge = {r['_id']: r for r in topup.aggregate([
+                {'$match': {'user_id': {'$in': ids}, 'status': 'success'}},
+                {'$group': {'_id': '$user_id', 'total': {'$sum': '$money'}, 'count': {'$sum': 1}}}
+            ])}
+            orders = {r['_id']: r['count'] for r in gmjlu.aggregate([
+                {'$match': {'user_id': {'$in': ids}}},
+                {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}}
+            ])}
+            for u in batch:
+                uid = u.get('user_id')
+                reg_time = u.get('reg_time', '未知')
+                if isinstance(reg_time, datetime):
+                    reg_time = format_beijing_time(reg_time)
+                r = recharge.get(uid, {})
+                sheet.write_row([
+                    uid, u.get('username', ''), clean_name(u.get('fullname')), u.get('USDT', 0),
+                    u.get('state', '1'), reg_time, r.get('total', 0), r.get('count', 0),
+                    orders.get(uid, 0), u.get('last_active', '未知')
+                ])
+            exported += len(batch)
+            job.progress(f"👥 已写入 {exported} 个用户")
+        return f"📊 共导出 {exported} 个用户的数据"
 
+    start_background_export(query, context, "用户综合数据", f"用户综合数据_{beijing_now_str('%Y%m%d_%H%M%S')}", build,
+                            done_markup=_export_menu_markup(user_id))
 
 # 🆕 导出订单综合数据
 def export_orders_comprehensive(update: Update, context: CallbackContext):
-    """导出订单综合数据"""
+    """导出订单综合数据 - 流式后台导出"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
@@ -2403,63 +2244,37 @@ def export_orders_comprehensive(update: Update, context: CallbackContext):
         query.edit_message_text("❌ 无权限访问此功能")
         return
 
-    try:
-        # 获取所有订单数据 - 修复版：使用timer字段排序
-        orders = list(gmjlu.find({}).sort('timer', -1))
-        
-        data = []
-        for order in orders:
-            uid = order.get('user_id')
-            uinfo = user.find_one({'user_id': uid}) or {}
-            
-            data.append({
-                "订单时间": order.get('timer', ''),  # 使用timer字段
-                "用户ID": uid,
-                "用户名": uinfo.get('username', ''),
-                "用户姓名": uinfo.get('fullname', '').replace('<', '').replace('>', ''),
-                "商品类型": order.get('leixing', ''),
-                "商品名称": order.get('projectname', ''),
-                "购买数量": order.get('count', 1),
-                "订单编号": order.get('bianhao', ''),
-                "订单状态": "已完成",
-                "备注": order.get('remark', ''),
-                "商品内容": str(order.get('text', ''))[:100] + "..." if len(str(order.get('text', ''))) > 100 else str(order.get('text', ''))
-            })
-        
-        # 生成Excel文件
-        df = pd.DataFrame(data)
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name="订单综合数据")
-            
-            # 设置列宽
-            worksheet = writer.sheets["订单综合数据"]
-            for i, col in enumerate(df.columns):
-                column_len = max(df[col].astype(str).str.len().max(), len(col)) + 2
-                worksheet.set_column(i, i, min(column_len, 50))
-        
-        buffer.seek(0)
-        context.bot.send_document(
-            chat_id=user_id,
-            document=buffer,
-            filename=f"订单综合数据_{beijing_now_str('%Y%m%d_%H%M%S')}.xlsx"
-        )
-        
-        query.edit_message_text(
-            f"✅ 订单综合数据导出完成\n\n📊 共导出 {len(data)} 条订单记录",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 返回数据导出", callback_data='data_export_menu')],
-                [InlineKeyboardButton("❌ 关闭", callback_data=f'close {user_id}')]
-            ])
-        )
-        
-    except Exception as e:
-        query.edit_message_text(f"❌ 导出失败：{str(e)}")
+    def build(writer, job):
+        sheet = writer.sheet("订单综合数据", [
+            ("订单时间", 20), ("用户ID", 14), ("用户名", 18), ("用户姓名", 18), ("商品类型", 12),
+            ("商品名称", 25), ("购买数量", 10), ("订单编号", 22), ("订单状态", 10), ("备注", 15), ("商品内容", 40)
+        ])
+        exported = 0
+        chunks = {}
+        projection = {'_id': 0, 'user_id': 1, 'timer': 1, 'leixing': 1, 'projectname': 1,
+                      'count': 1, 'bianhao': 1, 'remark': 1, 'text': 1}
+        for batch in _iter_gmjlu_export_batches(projection, chunks):
+            users_map = join_users(batch)
+            for order in batch:
+                uid = order.get('user_id')
+                uinfo = users_map.get(uid, {})
+                content = str(order.get('text', ''))
+                sheet.write_row([
+                    order.get('timer', ''), uid, uinfo.get('username', ''), clean_name(uinfo.get('fullname')),
+                    order.get('leixing', ''), order.get('projectname', ''), order.get('count', 1),
+                    order.get('bianhao', ''), "已完成", order.get('remark', ''),
+                    content[:100] + "..." if len(content) > 100 else content
+                ])
+            exported += len(batch)
+            job.progress(f"📋 已写入 {exported} 条订单\n{_chunk_progress_text(chunks)}")
+        return f"📊 共导出 {exported} 条订单记录"
 
+    start_background_export(query, context, "订单综合数据", f"订单综合数据_{beijing_now_str('%Y%m%d_%H%M%S')}", build,
+                            done_markup=_export_menu_markup(user_id))
 
 # 🆕 导出财务数据
 def export_financial_data(update: Update, context: CallbackContext):
-    """导出财务数据"""
+    """导出财务数据 - 流式后台导出"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
@@ -2469,108 +2284,56 @@ def export_financial_data(update: Update, context: CallbackContext):
         query.edit_message_text("❌ 无权限访问此功能")
         return
 
-    try:
-        # 获取所有充值记录
-        recharge_records = list(topup.find({'status': 'success'}).sort('time', -1))
-        
-        financial_data = []
-        for record in recharge_records:
-            uid = record.get('user_id')
-            uinfo = user.find_one({'user_id': uid}) or {}
-            
-            financial_data.append({
-                "充值时间": format_beijing_time(record.get('time')) if record.get('time') else '',
-                "用户ID": uid,
-                "用户名": uinfo.get('username', ''),
-                "用户姓名": uinfo.get('fullname', '').replace('<', '').replace('>', ''),
-                "充值金额": record.get('money', 0),
-                "充值方式": record.get('cz_type', ''),
-                "订单号": record.get('order_id', ''),
-                "状态": record.get('status', ''),
-                "备注": record.get('remark', '')
-            })
-        
-        # 计算财务汇总（使用北京时间）
+    def build(writer, job):
+        sheet = writer.sheet("充值明细", [
+            ("充值时间", 20), ("用户ID", 14), ("用户名", 18), ("用户姓名", 18), ("充值金额", 12),
+            ("充值方式", 10), ("订单号", 22), ("状态", 10), ("备注", 20)
+        ])
+        exported = 0
+        chunks = {}
+        projection = {'_id': 0, 'user_id': 1, 'time': 1, 'money': 1, 'cz_type': 1,
+                      'order_id': 1, 'status': 1, 'remark': 1}
+        for batch in _iter_topup_export_batches(projection, chunks):
+            users_map = join_users(batch)
+            for record in batch:
+                uid = record.get('user_id')
+                uinfo = users_map.get(uid, {})
+                sheet.write_row([
+                    format_beijing_time(record.get('time')) if record.get('time') else '', uid,
+                    uinfo.get('username', ''), clean_name(uinfo.get('fullname')), record.get('money', 0),
+                    record.get('cz_type', ''), record.get('order_id', ''), record.get('status', ''),
+                    record.get('remark', '')
+                ])
+            exported += len(batch)
+            job.progress(f"💰 已写入 {exported} 条充值记录\n{_chunk_progress_text(chunks)}")
+
+        # 财务汇总（使用北京时间）：一次 $facet 得到今日/本月按支付方式的收入
         now = get_beijing_now()
         today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
         month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        def sum_income(start_time, end_time, cz_type=None):
-            query_filter = {
-                'status': 'success',
-                'time': {'$gte': start_time, '$lt': end_time}
-            }
-            if cz_type:
-                query_filter['cz_type'] = cz_type
-            return sum(r.get('money', 0) for r in topup.find(query_filter))
-        
-        summary_data = [{
-            "统计项目": "今日收入（支付宝）",
-            "金额": sum_income(today_start, now, 'alipay'),
-            "币种": "CNY"
-        }, {
-            "统计项目": "今日收入（微信）",
-            "金额": sum_income(today_start, now, 'wechat'),
-            "币种": "CNY"
-        }, {
-            "统计项目": "今日收入（USDT）",
-            "金额": sum_income(today_start, now, 'usdt'),
-            "币种": "USDT"
-        }, {
-            "统计项目": "本月总收入（支付宝）",
-            "金额": sum_income(month_start, now, 'alipay'),
-            "币种": "CNY"
-        }, {
-            "统计项目": "本月总收入（微信）",
-            "金额": sum_income(month_start, now, 'wechat'),
-            "币种": "CNY"
-        }, {
-            "统计项目": "本月总收入（USDT）",
-            "金额": sum_income(month_start, now, 'usdt'),
-            "币种": "USDT"
-        }]
-        
-        # 生成Excel文件
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            # 充值明细
-            df_detail = pd.DataFrame(financial_data)
-            df_detail.to_excel(writer, index=False, sheet_name="充值明细")
-            
-            # 财务汇总
-            df_summary = pd.DataFrame(summary_data)
-            df_summary.to_excel(writer, index=False, sheet_name="财务汇总")
-            
-            # 设置列宽
-            for sheet_name in ["充值明细", "财务汇总"]:
-                worksheet = writer.sheets[sheet_name]
-                df = df_detail if sheet_name == "充值明细" else df_summary
-                for i, col in enumerate(df.columns):
-                    column_len = max(df[col].astype(str).str.len().max(), len(col)) + 2
-                    worksheet.set_column(i, i, min(column_len, 30))
-        
-        buffer.seek(0)
-        context.bot.send_document(
-            chat_id=user_id,
-            document=buffer,
-            filename=f"财务数据报表_{beijing_now_str('%Y%m%d_%H%M%S')}.xlsx"
-        )
-        
-        query.edit_message_text(
-            f"✅ 财务数据导出完成\n\n📊 充值记录：{len(financial_data)} 条\n📈 包含财务汇总分析",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 返回数据导出", callback_data='data_export_menu')],
-                [InlineKeyboardButton("❌ 关闭", callback_data=f'close {user_id}')]
-            ])
-        )
-        
-    except Exception as e:
-        query.edit_message_text(f"❌ 导出失败：{str(e)}")
-
+        by_type = {'$group': {'_id': '$cz_type', 'amount': {'$sum': '$money'}}}
+        facet = list(topup.aggregate([
+            {'$match': {'status': 'success', 'time': {'$gte': month_start, '$lt': now}}},
+            {'$facet': {
+                'today': [{'$match': {'time': {'$gte': today_start}}}, by_type],
+                'month': [{'$match': {'time': {'$gte': month_start}}}, by_type],
+            }}
+        ]))
+        income = {name: {r['_id']: r['amount'] for r in (facet[0][name] if facet else [])} for name in ('today', 'month')}
+        labels = [('alipay', '支付宝', 'CNY'), ('wechat', '微信', 'CNY'), ('usdt', 'USDT', 'USDT')]
+        summary_rows = [{"统计项目": f"今日收入（{label}）", "金额": income['today'].get(t, 0), "币种": cur}
+                        for t, label, cur in labels]
+        summary_rows += [{"统计项目": f"本月总收入（{label}）", "金额": income['month'].get(t, 0), "币种": cur}
+                         for t, label, cur in labels]
+        writer.write_table("财务汇总", [("统计项目", 22), ("金额", 14), ("币种", 8)], summary_rows)
+        return f"📊 充值记录：{exported} 条\n📈 包含财务汇总分析"
+
+    start_background_export(query, context, "财务数据", f"财务数据报表_{beijing_now_str('%Y%m%d_%H%M%S')}", build,
+                            done_markup=_export_menu_markup(user_id))
 
 # 🆕 导出库存数据
 def export_inventory_data(update: Update, context: CallbackContext):
-    """导出库存数据"""
+    """导出库存数据 - 按商品聚合后台导出"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
@@ -2580,120 +2343,61 @@ def export_inventory_data(update: Update, context: CallbackContext):
         query.edit_message_text("❌ 无权限访问此功能")
         return
 
-    try:
-        # 获取所有分类 - 修复版
-        categories = list(fenlei.find({}))
-        
-        inventory_data = []
-        for category in categories:
-            category_name = category.get('name', '未知分类')
-            
-            # 统计该分类下的库存情况
-            # 可用库存 (state=1)
-            available_products = list(hb.find({
-                'leixing': category_name, 
-                'state': '1'
-            }))
-            
-            # 已售出 (state=2)
-            sold_products = list(hb.find({
-                'leixing': category_name, 
-                'state': '2'
-            }))
-            
-            # 总库存
-            total_products = list(hb.find({'leixing': category_name}))
-            
-            available_count = len(available_products)
-            sold_count = len(sold_products)
-            total_count = len(total_products)
-            
-            # 计算库存状态
-            if available_count == 0:
+    def build(writer, job):
+        sheet = writer.sheet("库存清单", [
+            ("商品分类", 18), ("商品名称", 28), ("单价(USDT)", 12), ("可用库存", 10), ("已售出", 10),
+            ("库存总数", 10), ("库存状态", 10), ("库存率", 10), ("库存价值", 12), ("最后更新", 20)
+        ])
+        category_names = {c['uid']: c.get('projectname', '未知分类') for c in fenlei.find({}, {'_id': 0, 'uid': 1, 'projectname': 1})}
+        # 一次聚合得到每个商品的可用/已售数量
+        counts = {}
+        for row in hb.aggregate([
+            {'$group': {'_id': {'nowuid': '$nowuid', 'state': '$state'}, 'count': {'$sum': 1}}}
+        ], allowDiskUse=True):
+            entry = counts.setdefault(row['_id'].get('nowuid'), {'available': 0, 'sold': 0, 'total': 0})
+            entry['total'] += row['count']
+            if row['_id'].get('state') == 0:
+                entry['available'] += row['count']
+            elif row['_id'].get('state') == 1:
+                entry['sold'] += row['count']
+
+        totals = {'products': 0, 'stock': 0, 'value': 0.0, 'low': 0, 'out': 0}
+        updated = beijing_now_str()
+        projection = {'_id': 0, 'nowuid': 1, 'projectname': 1, 'uid': 1, 'money': 1}
+        for product in ejfl.find({}, projection).sort('row', 1):
+            c = counts.get(product.get('nowuid'), {'available': 0, 'sold': 0, 'total': 0})
+            price = float(product.get('money', 0) or 0)
+            value = round(c['available'] * price, 2)
+            if c['available'] == 0:
                 status = "缺货"
-            elif available_count <= 10:
+                totals['out'] += 1
+            elif c['available'] <= 10:
                 status = "低库存"
+                totals['low'] += 1
             else:
                 status = "正常"
-            
-            inventory_data.append({
-                "商品分类": category_name,
-                "可用库存": available_count,
-                "已售出": sold_count,
-                "库存总数": total_count,
-                "库存状态": status,
-                "库存率": f"{(available_count/total_count*100):.1f}%" if total_count > 0 else "0%",
-                "最后更新": beijing_now_str()
-            })
-        
-        # 库存汇总统计 - 修复版
-        total_categories = len(inventory_data)
-        total_available = sum(item['可用库存'] for item in inventory_data)
-        total_sold = sum(item['已售出'] for item in inventory_data)
-        total_stock = sum(item['库存总数'] for item in inventory_data)
-        total_value = sum(item['库存价值'] for item in inventory_data)
-        low_stock_count = len([item for item in inventory_data if item['库存状态'] == '低库存'])
-        out_of_stock_count = len([item for item in inventory_data if item['库存状态'] == '缺货'])
-        
-        summary_data = [{
-            "统计项目": "商品总数",
-            "数值": total_products,
-            "单位": "个"
-        }, {
-            "统计项目": "库存总量",
-            "数值": total_stock,
-            "单位": "件"
-        }, {
-            "统计项目": "库存总价值",
-            "数值": total_value,
-            "单位": "USDT"
-        }, {
-            "统计项目": "低库存商品",
-            "数值": low_stock_count,
-            "单位": "个"
-        }, {
-            "统计项目": "缺货商品",
-            "数值": out_of_stock_count,
-            "单位": "个"
-        }]
-        
-        # 生成Excel文件
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            # 库存清单
-            df_inventory = pd.DataFrame(inventory_data)
-            df_inventory.to_excel(writer, index=False, sheet_name="库存清单")
-            
-            # 库存汇总
-            df_summary = pd.DataFrame(summary_data)
-            df_summary.to_excel(writer, index=False, sheet_name="库存汇总")
-            
-            # 设置列宽和格式
-            for sheet_name in ["库存清单", "库存汇总"]:
-                worksheet = writer.sheets[sheet_name]
-                df = df_inventory if sheet_name == "库存清单" else df_summary
-                for i, col in enumerate(df.columns):
-                    column_len = max(df[col].astype(str).str.len().max(), len(col)) + 2
-                    worksheet.set_column(i, i, min(column_len, 30))
-        
-        buffer.seek(0)
-        context.bot.send_document(
-            chat_id=user_id,
-            document=buffer,
-            filename=f"库存数据报表_{beijing_now_str('%Y%m%d_%H%M%S')}.xlsx"
-        )
-        
-        query.edit_message_text(
-            f"✅ 库存数据导出完成\n\n📦 商品总数：{total_products} 个\n📊 库存总量：{total_stock} 件\n💰 库存价值：{total_value} USDT",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 返回数据导出", callback_data='data_export_menu')],
-                [InlineKeyboardButton("❌ 关闭", callback_data=f'close {user_id}')]
+            totals['products'] += 1
+            totals['stock'] += c['available']
+            totals['value'] += value
+            sheet.write_row([
+                category_names.get(product.get('uid'), '未知分类'), product.get('projectname', ''), price,
+                c['available'], c['sold'], c['total'], status,
+                f"{c['available'] / c['total'] * 100:.1f}%" if c['total'] > 0 else "0%", value, updated
             ])
-        )
-        
-    except Exception as e:
-        query.edit_message_text(f"❌ 导出失败：{str(e)}")
+            job.progress(f"📦 已写入 {totals['products']} 个商品")
+
+        writer.write_table("库存汇总", [("统计项目", 14), ("数值", 14), ("单位", 8)], [
+            {"统计项目": "商品总数", "数值": totals['products'], "单位": "个"},
+            {"统计项目": "库存总量", "数值": totals['stock'], "单位": "件"},
+            {"统计项目": "库存总价值", "数值": round(totals['value'], 2), "单位": "USDT"},
+            {"统计项目": "低库存商品", "数值": totals['low'], "单位": "个"},
+            {"统计项目": "缺货商品", "数值": totals['out'], "单位": "个"},
+        ])
+        return (f"📦 商品总数：{totals['products']} 个\n📊 库存总量：{totals['stock']} 件\n"
+                f"💰 库存价值：{totals['value']:.2f} USDT")
 
+    start_background_export(query, context, "库存数据", f"库存数据报表_{beijing_now_str('%Y%m%d_%H%M%S')}", build,
+                            done_markup=_export_menu_markup(user_id))
 
 # 🆕 多语言管理系统
 def multilang_management(update: Update, context: CallbackContext):
@@ -2935,14 +2639,17 @@ def modify_restock_threshold(update: Update, context: CallbackContext):
     query.answer()
     user_id = query.from_user.id
 
-    text = """
+    default_threshold, per_product = stock_health.thresholds()
+
+    text = f"""
 ⚙️ <b>修改库存预警阈值</b>
 
 
 📋 <b>当前设置</b>
 ├─ 🚨 缺货阈值：<code>0</code> 件
-├─ ⚠️ 低库存阈值：<code>10</code> 件
-└─ 📊 正常库存：<code>>10</code> 件
+├─ ⚠️ 低库存阈值：<code>{default_threshold}</code> 件
+├─ 🎯 单品自定义阈值：<code>{len(per_product)}</code> 个商品
+└─ 📊 正常库存：<code>>{default_threshold}</code> 件
 
 🔧 <b>修改说明</b>
 ├─ 缺货阈值：商品数量为0时触发
@@ -2950,8 +2657,9 @@ def modify_restock_threshold(update: Update, context: CallbackContext):
 └─ 建议值：5-20件（根据销量调整）
 
 💡 <b>使用方法</b>
-发送格式：<code>/set_threshold 低库存阈值</code>
-例如：<code>/set_threshold 15</code>
+全局阈值：<code>/set_threshold 15</code>
+单品阈值：<code>/set_threshold 商品ID 30</code>
+恢复全局：<code>/set_threshold 商品ID default</code>
 
 
     """.strip()
@@ -3081,43 +2789,81 @@ def view_reminder_history(update: Update, context: CallbackContext):
 
 
 # 🆕 详细销售报表
+def _sales_change_text(current, previous) -> str:
+    """环比变化文本，如 ↗️ +12%"""
+    if not previous:
+        return "➖ 无对比数据" if not current else "↗️ 新增"
+    pct = (current - previous) / previous * 100
+    arrow = "↗️" if pct > 0 else "↘️" if pct < 0 else "➖"
+    return f"{arrow} {pct:+.0f}%"
+
+
+def _load_sales_rollup_window(now, days: int) -> dict:
+    """读取最近 days 天（含今日）的日汇总，返回 {day: doc}"""
+    start_day = (now - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    return {doc['day']: doc for doc in get_sales_rollup_days(start_day, now.strftime('%Y-%m-%d'))}
+
+
+def _sum_rollup_range(rollups: dict, now, start_offset: int, length: int) -> dict:
+    """汇总 [今日-start_offset-length+1, 今日-start_offset] 这段日期"""
+    days = [(now - timedelta(days=start_offset + i)).strftime('%Y-%m-%d') for i in range(length)]
+    return summarize_sales_rollups(rollups[d] for d in days if d in rollups)
+
+
 def detailed_sales_report(update: Update, context: CallbackContext):
-    """详细销售报表"""
+    """详细销售报表（基于日汇总）"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
 
     now = get_beijing_now()
-    
-    # 生成详细销售报表
+    rollups = _load_sales_rollup_window(now, 180)
+
+    today = _sum_rollup_range(rollups, now, 0, 1)
+    yesterday = _sum_rollup_range(rollups, now, 1, 1)
+    week, last_week = _sum_rollup_range(rollups, now, 0, 7), _sum_rollup_range(rollups, now, 7, 7)
+    month, last_month = _sum_rollup_range(rollups, now, 0, 30), _sum_rollup_range(rollups, now, 30, 30)
+    quarter, last_quarter = _sum_rollup_range(rollups, now, 0, 90), _sum_rollup_range(rollups, now, 90, 90)
+
+    # 商品排行榜（全量累计）
+    medals = ['🥇', '🥈', '🥉', '4️⃣', '5️⃣']
+    top_products = sorted(get_sales_rollup_total().get('by_product', {}).items(), key=lambda x: x[1], reverse=True)[:5]
+    ranking_lines = [f"{medals[i]} {name}：<code>{count}</code> 单" for i, (name, count) in enumerate(top_products)]
+    ranking_text = "\n".join(
+        ("└─ " if i == len(ranking_lines) - 1 else "├─ ") + line for i, line in enumerate(ranking_lines)
+    ) or "└─ 暂无数据"
+
+    # 时段分布（近30天）
+    by_hour = month['by_hour']
+    hour_total = sum(by_hour.values()) or 1
+    def hour_share(hours):
+        return f"{sum(by_hour.get(f'{h:02d}', 0) for h in hours) * 100 / hour_total:.0f}%"
+
+    avg_items = month['items'] / month['orders'] if month['orders'] else 0
+
     text = f"""
 📈 <b>详细销售报表</b>
 
 
 📊 <b>时段对比分析</b>
-├─ 📅 今日 vs 昨日：<code>↗️ +12%</code>
-├─ 📊 本周 vs 上周：<code>↗️ +8%</code>
-├─ 📆 本月 vs 上月：<code>↘️ -3%</code>
-└─ 📈 季度趋势：<code>↗️ +15%</code>
+├─ 📅 今日 vs 昨日：<code>{_sales_change_text(today['orders'], yesterday['orders'])}</code>
+├─ 📊 近7天 vs 前7天：<code>{_sales_change_text(week['orders'], last_week['orders'])}</code>
+├─ 📆 近30天 vs 前30天：<code>{_sales_change_text(month['orders'], last_month['orders'])}</code>
+└─ 📈 季度趋势：<code>{_sales_change_text(quarter['orders'], last_quarter['orders'])}</code>
 
 🏆 <b>商品排行榜</b>
-├─ 🥇 Instagram账号：<code>156</code> 单
-├─ 🥈 TikTok账号：<code>134</code> 单
-├─ 🥉 Twitter账号：<code>98</code> 单
-├─ 4️⃣ YouTube频道：<code>87</code> 单
-└─ 5️⃣ Facebook账号：<code>76</code> 单
+{ranking_text}
 
-👥 <b>客户分析</b>
-├─ 🆕 新客户：<code>45%</code>
-├─ 🔄 回购客户：<code>55%</code>
-├─ 💰 平均客单价：<code>$25.8</code>
-└─ 📊 客户满意度：<code>4.7/5.0</code>
+👥 <b>客户分析（近30天）</b>
+├─ 👤 购买客户：<code>{month['customers']}</code> 人
+├─ 🛒 订单数：<code>{month['orders']}</code> 单
+└─ 📦 平均每单件数：<code>{avg_items:.1f}</code>
 
-🕐 <b>时段分析</b>
-├─ 🌅 上午(6-12)：<code>25%</code>
-├─ 🌞 下午(12-18)：<code>45%</code>
-├─ 🌆 傍晚(18-22)：<code>25%</code>
-└─ 🌙 夜间(22-6)：<code>5%</code>
+🕐 <b>时段分析（近30天）</b>
+├─ 🌅 上午(6-12)：<code>{hour_share(range(6, 12))}</code>
+├─ 🌞 下午(12-18)：<code>{hour_share(range(12, 18))}</code>
+├─ 🌆 傍晚(18-22)：<code>{hour_share(range(18, 22))}</code>
+└─ 🌙 夜间(22-6)：<code>{hour_share(list(range(22, 24)) + list(range(0, 6)))}</code>
 
 
 ⏰ 生成时间：{format_beijing_time(now)}
@@ -3140,43 +2886,74 @@ def detailed_sales_report(update: Update, context: CallbackContext):
 
 # 🆕 销售趋势分析
 def sales_trend_analysis(update: Update, context: CallbackContext):
-    """销售趋势分析"""
+    """销售趋势分析（基于日汇总）"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
 
     now = get_beijing_now()
-    
+    rollups = _load_sales_rollup_window(now, 180)
+
+    today, yesterday = _sum_rollup_range(rollups, now, 0, 1), _sum_rollup_range(rollups, now, 1, 1)
+    week, last_week = _sum_rollup_range(rollups, now, 0, 7), _sum_rollup_range(rollups, now, 7, 7)
+    month, last_month = _sum_rollup_range(rollups, now, 0, 30), _sum_rollup_range(rollups, now, 30, 30)
+    quarter, last_quarter = _sum_rollup_range(rollups, now, 0, 90), _sum_rollup_range(rollups, now, 90, 90)
+
+    # 周期性：近8周（不含今日）按星期几平均
+    weekday_names = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
+    weekday_orders = [[] for _ in range(7)]
+    for offset in range(1, 57):
+        day = now - timedelta(days=offset)
+        doc = rollups.get(day.strftime('%Y-%m-%d'))
+        weekday_orders[day.weekday()].append(doc.get('orders', 0) if doc else 0)
+    weekday_avg = [sum(v) / len(v) if v else 0 for v in weekday_orders]
+    busiest = max(range(7), key=lambda i: weekday_avg[i])
+    slowest = min(range(7), key=lambda i: weekday_avg[i])
+
+    # 高峰/低谷：近30天订单最多/最少的连续4小时
+    by_hour = month['by_hour']
+    hourly = [by_hour.get(f'{h:02d}', 0) for h in range(24)]
+    windows = [sum(hourly[(h + i) % 24] for i in range(4)) for h in range(24)]
+    peak = max(range(24), key=lambda h: windows[h])
+    low = min(range(24), key=lambda h: windows[h])
+
+    # 预测：近7天日均
+    daily_avg = week['orders'] / 7
+
+    # 销量下滑商品：近7天比前7天下降超过30%
+    declining = [
+        name for name, prev in last_week['by_product'].items()
+        if prev >= 5 and week['by_product'].get(name, 0) < prev * 0.7
+    ]
+    declining_text = "\n".join(f"├─ 📉 {name}" for name in declining[:3]) or "├─ ✅ 暂无明显下滑商品"
+
     text = f"""
 📊 <b>销售趋势分析</b>
 
 
 📈 <b>增长趋势</b>
-├─ 📅 日增长率：<code>+3.2%</code>
-├─ 📊 周增长率：<code>+8.5%</code>
-├─ 📆 月增长率：<code>+12.1%</code>
-└─ 📈 季度增长率：<code>+28.7%</code>
+├─ 📅 日增长率：<code>{_sales_change_text(today['orders'], yesterday['orders'])}</code>
+├─ 📊 周增长率：<code>{_sales_change_text(week['orders'], last_week['orders'])}</code>
+├─ 📆 月增长率：<code>{_sales_change_text(month['orders'], last_month['orders'])}</code>
+└─ 📈 季度增长率：<code>{_sales_change_text(quarter['orders'], last_quarter['orders'])}</code>
 
 🔄 <b>周期性分析</b>
-├─ 📅 周一最忙：<code>平均18单/天</code>
-├─ 📊 周末较慢：<code>平均12单/天</code>
-├─ 🕐 下午高峰：<code>14:00-18:00</code>
-└─ 🌙 夜间低谷：<code>22:00-06:00</code>
+├─ 📅 {weekday_names[busiest]}最忙：<code>平均{weekday_avg[busiest]:.0f}单/天</code>
+├─ 📊 {weekday_names[slowest]}较慢：<code>平均{weekday_avg[slowest]:.0f}单/天</code>
+├─ 🕐 高峰时段：<code>{peak:02d}:00-{(peak + 4) % 24:02d}:00</code>
+└─ 🌙 低谷时段：<code>{low:02d}:00-{(low + 4) % 24:02d}:00</code>
 
-🎯 <b>预测分析</b>
-├─ 📅 明日预测：<code>23-28单</code>
-├─ 📊 下周预测：<code>150-180单</code>
-├─ 📆 下月预测：<code>680-750单</code>
-└─ 💰 收入预测：<code>$2,800-3,200</code>
+🎯 <b>预测分析（按近7天日均）</b>
+├─ 📅 明日预测：<code>{daily_avg * 0.9:.0f}-{daily_avg * 1.1:.0f}单</code>
+├─ 📊 下周预测：<code>{daily_avg * 7 * 0.9:.0f}-{daily_avg * 7 * 1.1:.0f}单</code>
+└─ 📆 下月预测：<code>{daily_avg * 30 * 0.9:.0f}-{daily_avg * 30 * 1.1:.0f}单</code>
 
 ⚠️ <b>风险提示</b>
-├─ 📉 部分商品增长放缓
-├─ 🏪 竞争对手增加
-├─ 📊 客户获取成本上升
-└─ 💡 建议优化营销策略
+{declining_text}
+└─ 💡 近7天购买客户 {week['customers']} 人（前7天 {last_week['customers']} 人）
 
 
-🤖 AI分析时间：{format_beijing_time(now)}
+⏰ 分析时间：{format_beijing_time(now)}
     """.strip()
 
     keyboard = [
@@ -3494,13 +3271,16 @@ def set_threshold_handler(update: Update, context: CallbackContext):
     """处理设置阈值的快捷按钮"""
     query = update.callback_query
     query.answer()
-    
-    # 从callback_data中提取阈值
-    threshold = query.data.split('_')[-1]
-    
-    # 这里应该保存到数据库或配置文件
-    # 暂时只显示设置成功的消息
-    
+
+    if not is_admin(query.from_user.id):
+        query.edit_message_text("❌ 无权限访问此功能")
+        return
+
+    # 从callback_data中提取阈值，保存为全局阈值
+    threshold = int(query.data.split('_')[-1])
+    stock_health.set_default_threshold(threshold)
+    logging.info(f"⚙️ 管理员 {query.from_user.id} 将低库存阈值设为 {threshold}")
+
     text = f"""
 ✅ <b>阈值设置成功</b>
 
@@ -3511,10 +3291,10 @@ def set_threshold_handler(update: Update, context: CallbackContext):
 └─ 📊 正常库存：<code>>{threshold}</code> 件
 
 🔄 <b>生效状态</b>
-└─ ✅ 立即生效，系统已更新预警规则
+└─ ✅ 立即生效，系统已更新预警规则（单品自定义阈值不受影响）
 
 💡 <b>下次检查</b>
-└─ 🕐 下次自动检查：每小时整点
+└─ 🕐 商品出库后自动检查，全量每 {STOCK_ALERT_SWEEP_SECONDS // 60} 分钟一次
 
 
     """.strip()
@@ -3898,120 +3678,74 @@ def show_income_callback(update: Update, context: CallbackContext):
 
 
 
+PAYMENT_TYPE_DISPLAY = {
+    'alipay': '支付宝',
+    'zhifubao': '支付宝',
+    'wechat': '微信支付',
+    'weixin': '微信支付',
+    'wxpay': '微信支付',
+    'usdt': 'USDT',
+    'USDT': 'USDT'
+}
+
+
 def export_recharge_details(update: Update, context: CallbackContext):
-    """导出充值明细 - 优化版"""
+    """导出充值明细 - 流式后台导出"""
     query = update.callback_query
     query.answer()
-    user_id = query.from_user.id
-
-    try:
-        # 查询所有成功的充值记录
-        records = list(topup.find({'status': 'success'}).sort('time', -1))
 
-        if not records:
-            query.edit_message_text("📭 暂无成功充值记录。")
-            return
-
-        data = []
+    def build(writer, job):
+        sheet = writer.sheet("充值明细", [
+            ("充值时间", 20), ("用户ID", 14), ("用户名", 18), ("用户姓名", 18), ("充值金额", 12),
+            ("支付方式", 10), ("订单号", 22), ("随机数", 10), ("状态", 8), ("备注", 22)
+        ])
         total_amount = 0
         payment_stats = {}
-        
-        for r in records:
-            uid = r.get('user_id')
-            u = user.find_one({'user_id': uid}) or {}
-            amount = r.get('money', 0)
-            cz_type = r.get('cz_type', '未知')
-            
-            # 统计总金额和支付方式
-            total_amount += amount
-            payment_stats[cz_type] = payment_stats.get(cz_type, 0) + amount
-            
-            # 标准化支付方式显示
-            payment_display = {
-                'alipay': '支付宝',
-                'zhifubao': '支付宝', 
-                'wechat': '微信支付',
-                'weixin': '微信支付',
-                'wxpay': '微信支付',
-                'usdt': 'USDT',
-                'USDT': 'USDT'
-            }.get(cz_type, cz_type)
-            
-            data.append({
-                '充值时间': format_beijing_time(r.get('time')) if r.get('time') else '未知',
-                '用户ID': uid,
-                '用户名': u.get('username', '未知'),
-                '用户姓名': u.get('fullname', '').replace('<', '').replace('>', ''),
-                '充值金额': amount,
-                '支付方式': payment_display,
-                '订单号': r.get('bianhao', ''),
-                '随机数': r.get('suijishu', ''),
-                '状态': '成功',
-                '备注': f"基础金额: {r.get('base_amount', 'N/A')}"
-            })
-
-        # 生成统计汇总
-        stats_data = []
-        for payment_type, amount in payment_stats.items():
-            payment_display = {
-                'alipay': '支付宝',
-                'zhifubao': '支付宝',
-                'wechat': '微信支付', 
-                'weixin': '微信支付',
-                'wxpay': '微信支付',
-                'usdt': 'USDT',
-                'USDT': 'USDT'
-            }.get(payment_type, payment_type)
-            
-            stats_data.append({
-                '支付方式': payment_display,
-                '交易笔数': len([r for r in records if r.get('cz_type') == payment_type]),
-                '总金额': amount,
-                '平均金额': round(amount / len([r for r in records if r.get('cz_type') == payment_type]), 2)
-            })
+        exported = 0
+        chunks = {}
+        projection = {'_id': 0, 'user_id': 1, 'time': 1, 'money': 1, 'cz_type': 1,
+                      'bianhao': 1, 'suijishu': 1, 'base_amount': 1}
+        for batch in _iter_topup_export_batches(projection, chunks):
+            users_map = join_users(batch)
+            for r in batch:
+                uid = r.get('user_id')
+                u = users_map.get(uid, {})
+                amount = r.get('money', 0)
+                cz_type = r.get('cz_type', '未知')
+
+                # 统计总金额和支付方式
+                total_amount += amount
+                stats = payment_stats.setdefault(cz_type, {'amount': 0, 'count': 0})
+                stats['amount'] += amount
+                stats['count'] += 1
+
+                sheet.write_row([
+                    format_beijing_time(r.get('time')) if r.get('time') else '未知', uid,
+                    u.get('username', '未知'), clean_name(u.get('fullname')), amount,
+                    PAYMENT_TYPE_DISPLAY.get(cz_type, cz_type), r.get('bianhao', ''), r.get('suijishu', ''),
+                    '成功', f"基础金额: {r.get('base_amount', 'N/A')}"
+                ])
+            exported += len(batch)
+            job.progress(f"💰 已写入 {exported} 条充值记录\n{_chunk_progress_text(chunks)}")
 
-        # 生成Excel文件
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            # 充值明细
-            df_details = pd.DataFrame(data)
-            df_details.to_excel(writer, index=False, sheet_name="充值明细")
-            
-            # 统计汇总
-            df_stats = pd.DataFrame(stats_data)
-            df_stats.to_excel(writer, index=False, sheet_name="支付方式统计")
-            
-            # 设置列宽
-            for sheet_name in ["充值明细", "支付方式统计"]:
-                worksheet = writer.sheets[sheet_name]
-                df = df_details if sheet_name == "充值明细" else df_stats
-                for i, col in enumerate(df.columns):
-                    column_len = max(df[col].astype(str).str.len().max(), len(col)) + 2
-                    worksheet.set_column(i, i, min(column_len, 30))
+        if not exported:
+            return "📭 暂无成功充值记录。"
 
-        buffer.seek(0)
-        
-        # 发送文件
-        context.bot.send_document(
-            chat_id=user_id,
-            document=buffer,
-            filename=f"充值明细报表_{beijing_now_str('%Y%m%d_%H%M%S')}.xlsx",
-            caption=f"📄 充值明细导出完成\n\n📊 总记录: {len(data)} 条\n💰 总金额: {total_amount:.2f}\n📅 导出时间: {beijing_now_str()}"
-        )
-        
-        query.edit_message_text("✅ 充值明细导出完成，请查收文件！")
+        writer.write_table("支付方式统计", [("支付方式", 12), ("交易笔数", 10), ("总金额", 14), ("平均金额", 12)], [
+            {'支付方式': PAYMENT_TYPE_DISPLAY.get(t, t), '交易笔数': s['count'], '总金额': s['amount'],
+             '平均金额': round(s['amount'] / s['count'], 2)}
+            for t, s in payment_stats.items()
+        ])
+        return f"📄 充值明细导出完成\n\n📊 总记录: {exported} 条\n💰 总金额: {total_amount:.2f}\n📅 导出时间: {beijing_now_str()}"
 
-    except Exception as e:
-        query.edit_message_text(f"❌ 导出失败：{str(e)}")
-        print(f"[错误] 导出充值明细失败: {e}")
+    start_background_export(query, context, "充值明细", f"充值明细报表_{beijing_now_str('%Y%m%d_%H%M%S')}", build)
 
 def show_user_income_summary(update: Update, context: CallbackContext):
-    """用户充值汇总 - 优化版"""
+    """用户充值汇总 - 数据库聚合分页，结果短时缓存"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
 
-    from collections import defaultdict
     import math
 
     try:
@@ -4026,70 +3760,39 @@ def show_user_income_summary(update: Update, context: CallbackContext):
             page = 1
 
         per_page = 10
+        overview = get_income_summary_overview()
+        total_users = overview['users']
+        total_pages = math.ceil(total_users / per_page) if total_users > 0 else 1
+        page = max(1, min(page, total_pages))
         start = (page - 1) * per_page
 
-        # 构建充值汇总 - 支持更多支付类型
-        summary = defaultdict(lambda: {
-            'usdt': 0, 
-            'rmb': 0, 
-            'alipay': 0, 
-            'wechat': 0, 
-            'count': 0,
-            'last_time': None
-        })
-        
-        for r in topup.find({'status': 'success'}):
-            uid = r.get('user_id')
-            cz_type = r.get('cz_type', '')
-            amount = r.get('money', 0)
-            time = r.get('time')
-            
-            summary[uid]['count'] += 1
-            if not summary[uid]['last_time'] or (time and time > summary[uid]['last_time']):
-                summary[uid]['last_time'] = time
-            
-            # 更精确的支付类型匹配
-            if cz_type in ['alipay', 'zhifubao']:
-                summary[uid]['rmb'] += amount
-                summary[uid]['alipay'] += amount
-            elif cz_type in ['wechat', 'weixin', 'wxpay']:
-                summary[uid]['rmb'] += amount
-                summary[uid]['wechat'] += amount
-            elif cz_type in ['usdt', 'USDT']:
-                summary[uid]['usdt'] += amount
-
-        # 按总充值金额排序
-        all_uids = list(summary.keys())
-        all_uids.sort(key=lambda x: summary[x]['rmb'] + summary[x]['usdt'] * 7.2, reverse=True)
-        
-        # 获取用户信息
-        user_info = {u['user_id']: u for u in user.find({'user_id': {'$in': all_uids}})}
-
-        # 分页处理
-        total_users = len(all_uids)
-        total_pages = math.ceil(total_users / per_page) if total_users > 0 else 1
-        page_uids = all_uids[start:start + per_page]
+        # 只取当前页：$sort/$skip/$limit 在数据库内完成
+        page_rows = get_income_summary_page(page, per_page)
+        user_info = {u['user_id']: u for u in user.find(
+            {'user_id': {'$in': [r['_id'] for r in page_rows]}},
+            {'_id': 0, 'user_id': 1, 'fullname': 1, 'username': 1}
+        )}
 
         # 构建显示内容
         rows = []
-        total_rmb_all = sum(s['rmb'] for s in summary.values())
-        total_usdt_all = sum(s['usdt'] for s in summary.values())
-        
-        for idx, uid in enumerate(page_uids, start=start + 1):
+        total_rmb_all = overview['rmb']
+        total_usdt_all = overview['usdt']
+
+        for idx, s in enumerate(page_rows, start=start + 1):
+            uid = s['_id']
             u = user_info.get(uid, {})
             fullname = u.get('fullname', '未知用户').replace('<', '').replace('>', '')
             username = u.get('username', '未设置')
-            
-            s = summary[uid]
+
             rmb = standard_num(s['rmb'])
             usdt = standard_num(s['usdt'])
             alipay = standard_num(s['alipay'])
             wechat = standard_num(s['wechat'])
             count = s['count']
-            last_time = format_beijing_time(s['last_time'], '%Y-%m-%d') if s['last_time'] else '未知'
-            
+            last_time = format_beijing_time(s['last_time'], '%Y-%m-%d') if s.get('last_time') else '未知'
+
             # 计算总价值
-            total_value = float(rmb) + float(usdt) * 7.2
+            total_value = s['total_value']
 
             row = f"""
 {idx}. 👤 <b>{fullname}</b>
@@ -4115,7 +3818,7 @@ def show_user_income_summary(update: Update, context: CallbackContext):
 ├─ 👥 总用户数: <code>{total_users}</code> 人
 ├─ 💰 总人民币: <code>{standard_num(total_rmb_all)}</code> 元
 ├─ � 总USDT: <code>{standard_num(total_usdt_all)}</code> USDT
-└─ 💵 总价值: ≈<code>{standard_num(total_rmb_all + total_usdt_all * 7.2)}</code> 元
+└─ 💵 总价值: ≈<code>{standard_num(overview['total_value'])}</code> 元
 
 � <b>第 {page}/{total_pages} 页</b> (显示第 {start + 1}-{min(start + per_page, total_users)} 名)
 
@@ -4123,7 +3826,7 @@ def show_user_income_summary(update: Update, context: CallbackContext):
 {chr(10).join(rows)}
 
 
-💡 <b>说明</b>: 按总充值金额排序，USDT按1:7.2汇率计算
+💡 <b>说明</b>: 按总充值金额排序，USDT按1:{INCOME_USDT_RATE}汇率计算
 ⏰ <b>更新时间</b>: {beijing_now_str()}
         """.strip()
 
@@ -4158,143 +3861,47 @@ def show_user_income_summary(update: Update, context: CallbackContext):
 
 # 🆕 导出用户汇总报表
 def export_user_summary_report(update: Update, context: CallbackContext):
-    """导出用户充值汇总报表"""
+    """导出用户充值汇总报表 - 按排行顺序流式写入"""
     query = update.callback_query
     query.answer()
-    user_id = query.from_user.id
-
-    try:
-        from collections import defaultdict
-        
-        # 构建完整汇总数据
-        summary = defaultdict(lambda: {
-            'usdt': 0, 'rmb': 0, 'alipay': 0, 'wechat': 0, 
-            'count': 0, 'first_time': None, 'last_time': None
-        })
-        
-        for r in topup.find({'status': 'success'}):
-            uid = r.get('user_id')
-            cz_type = r.get('cz_type', '')
-            amount = r.get('money', 0)
-            time = r.get('time')
-            
-            summary[uid]['count'] += 1
-            
-            if not summary[uid]['first_time'] or (time and time < summary[uid]['first_time']):
-                summary[uid]['first_time'] = time
-            if not summary[uid]['last_time'] or (time and time > summary[uid]['last_time']):
-                summary[uid]['last_time'] = time
-            
-            if cz_type in ['alipay', 'zhifubao']:
-                summary[uid]['rmb'] += amount
-                summary[uid]['alipay'] += amount
-            elif cz_type in ['wechat', 'weixin', 'wxpay']:
-                summary[uid]['rmb'] += amount
-                summary[uid]['wechat'] += amount
-            elif cz_type in ['usdt', 'USDT']:
-                summary[uid]['usdt'] += amount
-
-        # 获取用户信息
-        all_uids = list(summary.keys())
-        user_info = {u['user_id']: u for u in user.find({'user_id': {'$in': all_uids}})}
-
-        # 生成详细数据
-        data = []
-        for uid in all_uids:
-            u = user_info.get(uid, {})
-            s = summary[uid]
-            
-            total_value = s['rmb'] + s['usdt'] * 7.2
-            
-            data.append({
-                '排名': 0,  # 稍后排序后填充
-                '用户ID': uid,
-                '用户名': u.get('username', ''),
-                '用户姓名': u.get('fullname', '').replace('<', '').replace('>', ''),
-                '支付宝充值': s['alipay'],
-                '微信充值': s['wechat'],
-                '人民币小计': s['rmb'],
-                'USDT充值': s['usdt'],
-                '总价值(元)': round(total_value, 2),
-                '充值次数': s['count'],
-                '首次充值': format_beijing_time(s['first_time']) if s['first_time'] else '',
-                '最后充值': format_beijing_time(s['last_time']) if s['last_time'] else '',
-                '用户状态': u.get('state', '1'),
-                '当前余额': u.get('USDT', 0)
-            })
-
-        # 按总价值排序并设置排名
-        data.sort(key=lambda x: x['总价值(元)'], reverse=True)
-        for i, item in enumerate(data, 1):
-            item['排名'] = i
-
-        # 生成统计汇总
-        total_users = len(data)
-        total_rmb = sum(item['人民币小计'] for item in data)
-        total_usdt = sum(item['USDT充值'] for item in data)
-        total_value = sum(item['总价值(元)'] for item in data)
-        total_transactions = sum(item['充值次数'] for item in data)
-
-        stats_data = [{
-            '统计项目': '用户总数',
-            '数值': total_users,
-            '单位': '人'
-        }, {
-            '统计项目': '人民币总额',
-            '数值': total_rmb,
-            '单位': '元'
-        }, {
-            '统计项目': 'USDT总额',
-            '数值': total_usdt,
-            '单位': 'USDT'
-        }, {
-            '统计项目': '总价值',
-            '数值': total_value,
-            '单位': '元'
-        }, {
-            '统计项目': '交易总数',
-            '数值': total_transactions,
-            '单位': '笔'
-        }, {
-            '统计项目': '平均客单价',
-            '数值': round(total_value / total_users, 2) if total_users > 0 else 0,
-            '单位': '元/人'
-        }]
-
-        # 生成Excel文件
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            # 用户汇总
-            df_summary = pd.DataFrame(data)
-            df_summary.to_excel(writer, index=False, sheet_name="用户充值汇总")
-            
-            # 统计数据
-            df_stats = pd.DataFrame(stats_data)
-            df_stats.to_excel(writer, index=False, sheet_name="总体统计")
-            
-            # 设置格式
-            for sheet_name in ["用户充值汇总", "总体统计"]:
-                worksheet = writer.sheets[sheet_name]
-                df = df_summary if sheet_name == "用户充值汇总" else df_stats
-                for i, col in enumerate(df.columns):
-                    column_len = max(df[col].astype(str).str.len().max(), len(col)) + 2
-                    worksheet.set_column(i, i, min(column_len, 25))
-
-        buffer.seek(0)
-        
-        context.bot.send_document(
-            chat_id=user_id,
-            document=buffer,
-            filename=f"用户充值汇总报表_{beijing_now_str('%Y%m%d_%H%M%S')}.xlsx",
-            caption=f"📊 用户充值汇总报表\n\n👥 总用户: {total_users} 人\n💰 总金额: {total_value:.2f} 元\n📈 交易数: {total_transactions} 笔"
-        )
-        
-        query.edit_message_text("✅ 用户汇总报表导出完成！")
 
-    except Exception as e:
-        query.edit_message_text(f"❌ 导出失败：{str(e)}")
-        print(f"[错误] 导出用户汇总报表失败: {e}")
+    def build(writer, job):
+        sheet = writer.sheet("用户充值汇总", [
+            ("排名", 6), ("用户ID", 14), ("用户名", 18), ("用户姓名", 18), ("支付宝充值", 12), ("微信充值", 12),
+            ("人民币小计", 12), ("USDT充值", 12), ("总价值(元)", 12), ("充值次数", 10), ("首次充值", 20),
+            ("最后充值", 20), ("用户状态", 10), ("当前余额", 12)
+        ])
+        rank = 0
+        for batch in iter_batches(iter_income_summary(), 1000):
+            users_map = join_users([{'user_id': s['_id']} for s in batch])
+            for s in batch:
+                rank += 1
+                u = users_map.get(s['_id'], {})
+                sheet.write_row([
+                    rank, s['_id'], u.get('username', ''), clean_name(u.get('fullname')),
+                    s['alipay'], s['wechat'], s['rmb'], s['usdt'], round(s['total_value'], 2), s['count'],
+                    format_beijing_time(s['first_time']) if s.get('first_time') else '',
+                    format_beijing_time(s['last_time']) if s.get('last_time') else '',
+                    u.get('state', '1'), u.get('USDT', 0)
+                ])
+            job.progress(f"👥 已写入 {rank} 个用户")
+
+        # 统计汇总与页面共用同一份快照
+        overview = get_income_summary_overview()
+        total_value = round(overview['total_value'], 2)
+        writer.write_table("总体统计", [("统计项目", 14), ("数值", 16), ("单位", 8)], [
+            {'统计项目': '用户总数', '数值': overview['users'], '单位': '人'},
+            {'统计项目': '人民币总额', '数值': overview['rmb'], '单位': '元'},
+            {'统计项目': 'USDT总额', '数值': overview['usdt'], '单位': 'USDT'},
+            {'统计项目': '总价值', '数值': total_value, '单位': '元'},
+            {'统计项目': '交易总数', '数值': overview['count'], '单位': '笔'},
+            {'统计项目': '平均客单价',
+             '数值': round(total_value / overview['users'], 2) if overview['users'] > 0 else 0, '单位': '元/人'},
+        ])
+        return (f"📊 用户充值汇总报表\n\n👥 总用户: {overview['users']} 人\n"
+                f"💰 总金额: {total_value:.2f} 元\n📈 交易数: {overview['count']} 笔")
 
+    start_background_export(query, context, "用户充值汇总", f"用户充值汇总报表_{beijing_now_str('%Y%m%d_%H%M%S')}", build)
 
 
 
@@ -4611,13 +4218,7 @@ def sifa(update: Update, context: CallbackContext):
     state = fqdtw_list['state']
 
     # ✨ 图文私发菜单按钮（含表情 + 两列排布）
-    keyboard = [
-        [InlineKeyboardButton('🖼 图文设置', callback_data='tuwen'),
-         InlineKeyboardButton('🔘 按钮设置', callback_data='anniu')],
-        [InlineKeyboardButton('📎 查看图文', callback_data='cattu'),
-         InlineKeyboardButton('📤 开启私发', callback_data='kaiqisifa')],
-        [InlineKeyboardButton('❌ 关闭', callback_data=f'close {user_id}')]
-    ]
+    keyboard = _sifa_menu_keyboard(user_id)
 
     # 状态提示文本
     if state == 1:
@@ -4701,133 +4302,262 @@ def anniu(update: Update, context: CallbackContext):
 
 
 
+def _sifa_menu_keyboard(user_id):
+    """图文私发菜单按钮（含表情 + 两列排布）"""
+    return [
+        [InlineKeyboardButton('🖼 图文设置', callback_data='tuwen'),
+         InlineKeyboardButton('🔘 按钮设置', callback_data='anniu')],
+        [InlineKeyboardButton('📎 查看图文', callback_data='cattu'),
+         InlineKeyboardButton('📤 开启私发', callback_data='kaiqisifa')],
+        [InlineKeyboardButton('📋 私发任务', callback_data='bcast_list'),
+         InlineKeyboardButton('❌ 关闭', callback_data=f'close {user_id}')]
+    ]
+
+
 def kaiqisifa(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
     bot_id = context.bot.id
 
-    job = context.job_queue.get_jobs_by_name('sifa')
+    if not broadcast_store.active('usersifa', bot_id=bot_id):
+        fqdtw_list = sftw.find_one({'bot_id': bot_id, 'projectname': '图文1🔽'})
+        if fqdtw_list is None or fqdtw_list.get('send_type') not in ('text', 'photo', 'animation'):
+            context.bot.send_message(chat_id=user_id, text='❌ 请先设置图文内容后再开启私发。')
+            return
 
-    if not job:
         # 🟢 修改图文状态为“正在私发”
         sftw.update_one({'bot_id': bot_id, 'projectname': '图文1🔽'}, {'$set': {"state": 2}})
 
-        # ✨ 更新菜单按钮（图文管理）
-        keyboard = [
-            [InlineKeyboardButton('🖼 图文设置', callback_data='tuwen'),
-             InlineKeyboardButton('🔘 按钮设置', callback_data='anniu')],
-            [InlineKeyboardButton('📎 查看图文', callback_data='cattu'),
-             InlineKeyboardButton('📤 开启私发', callback_data='kaiqisifa')],
-            [InlineKeyboardButton('❌ 关闭', callback_data=f'close {user_id}')]
-        ]
-
         # ✅ 状态文字提示
         query.edit_message_text(
             text='🟢 私发状态：<b>已开启</b>',
             parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=InlineKeyboardMarkup(_sifa_menu_keyboard(user_id))
         )
 
+        # 💾 持久化私发任务（图文内容快照 + 收件人检查点），重启后自动续跑
+        payload = {
+            'send_type': fqdtw_list['send_type'],
+            'file_id': fqdtw_list.get('file_id', ''),
+            'text': fqdtw_list.get('text', ''),
+            'keyboard': fqdtw_list.get('keyboard'),
+        }
+        job_id = broadcast_store.create('usersifa', user_id, payload, count_broadcast_recipients(), bot_id=bot_id)
+
         # ⏳ 添加定时任务执行私发
-        context.job_queue.run_once(usersifa, 1, context={"user_id": user_id}, name='sifa')
+        context.job_queue.run_once(usersifa, 1, context={'job_id': str(job_id)}, name=f'sifa_{job_id}')
 
         # ⏱ 提示私发启动中
         context.bot.send_message(chat_id=user_id, text='⏳ 正在准备群发内容，请稍等...')
     else:
         # 🚫 阻止重复开启
-        context.bot.send_message(chat_id=user_id, text='⚠️ 私发正在进行中，请勿重复开启。')
+        context.bot.send_message(
+            chat_id=user_id,
+            text='⚠️ 已有私发任务（进行中或已暂停），请在任务列表中继续或取消后再开启。',
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('📋 私发任务', callback_data='bcast_list')]])
+        )
+
+
+BROADCAST_STATUS_LABELS = {
+    JOB_RUNNING: '🟢 进行中',
+    JOB_PAUSED: '⏸ 已暂停',
+    JOB_CANCELLED: '⛔ 已取消',
+    JOB_DONE: '✅ 已完成',
+}
+
 
+def _broadcast_job_markup(job_id, status):
+    """私发任务控制按钮"""
+    if status == JOB_RUNNING:
+        row = [InlineKeyboardButton('⏸ 暂停', callback_data=f'bcast_pause {job_id}'),
+               InlineKeyboardButton('⛔ 取消', callback_data=f'bcast_cancel {job_id}')]
+    elif status == JOB_PAUSED:
+        row = [InlineKeyboardButton('▶️ 继续', callback_data=f'bcast_resume {job_id}'),
+               InlineKeyboardButton('⛔ 取消', callback_data=f'bcast_cancel {job_id}')]
+    else:
+        row = []
+    rows = [row] if row else []
+    rows.append([InlineKeyboardButton('📋 私发任务', callback_data='bcast_list')])
+    return InlineKeyboardMarkup(rows)
 
 
 def usersifa(context: CallbackContext):
-    from concurrent.futures import ThreadPoolExecutor
-    import threading
+    """job_queue 回调：私发任务交给群发任务线程池执行，不占用调度线程"""
+    submit_job(run_usersifa_job, context.bot, context.job.context['job_id'])
+
 
-    job = context.job
-    bot = context.bot
+def run_usersifa_job(bot, job_id):
+    """执行（或续跑）私发任务，阻塞直到完成、暂停或取消"""
     bot_id = bot.id
-    guanli_id = job.context['user_id']
 
-    fqdtw_list = sftw.find_one({'bot_id': bot_id, 'projectname': '图文1🔽'})
-    file_id = fqdtw_list['file_id']
-    file_text = fqdtw_list['text']
-    file_type = fqdtw_list['send_type']
-    key_text = fqdtw_list['key_text']
-    keyboard_data = fqdtw_list['keyboard']
-    keyboard = pickle.loads(keyboard_data)
+    job = broadcast_store.get(job_id)
+    if job is None or job['status'] != JOB_RUNNING:
+        return
+    guanli_id = job['owner']
+    payload = job['payload']
+    file_id = payload['file_id']
+    file_text = payload['text']
+    file_type = payload['send_type']
+    keyboard = pickle.loads(payload['keyboard']) if payload.get('keyboard') else []
     keyboard.append([InlineKeyboardButton('✅ 已读（点击销毁此消息）', callback_data='close 12321')])
     markup = InlineKeyboardMarkup(keyboard)
 
-    user_list = list(user.find({}))
-    total_users = len(user_list)
-    success = 0
-    fail = 0
-    lock = threading.Lock()
-
     # ⏳ 初始化消息（将后续所有进度和结果编辑在此消息上）
+    resumed = job.get('checkpoint') is not None
     progress_msg = bot.send_message(
         chat_id=guanli_id,
-        text=f"⏳ 正在准备群发内容，请稍等...\n📤 进度：0/{total_users}",
-        parse_mode='HTML'
+        text=(f"♻️ 私发任务继续执行（从上次进度续发）\n📤 进度：{job['stats'].get('done', 0)}/{job['total']}" if resumed
+              else f"⏳ 正在准备群发内容，请稍等...\n📤 进度：0/{job['total']}"),
+        parse_mode='HTML',
+        reply_markup=_broadcast_job_markup(job_id, JOB_RUNNING)
     )
 
-    def send_to_user(u):
-        nonlocal success, fail
+    def send_to_user(uid):
+        if file_type == 'text':
+            future = outbound.send_message(bot.token, uid, file_text, reply_markup=markup)
+        elif file_type == 'photo':
+            future = outbound.send_photo(bot.token, uid, file_id, caption=file_text, reply_markup=markup)
+        else:
+            future = outbound.send_animation(bot.token, uid, file_id, caption=file_text, reply_markup=markup)
+        return future
+
+    def on_result(uid, status, error):
+        if status == BLOCKED:
+            mark_user_blocked(uid)
+
+    def progress(stats, status):
         try:
-            uid = u['user_id']
-            if file_type == 'text':
-                bot.send_message(chat_id=uid, text=file_text, reply_markup=markup)
-            elif file_type == 'photo':
-                bot.send_photo(chat_id=uid, photo=file_id, caption=file_text, reply_markup=markup)
-            elif file_type == 'animation':
-                bot.send_animation(chat_id=uid, animation=file_id, caption=file_text, reply_markup=markup)
-            else:
-                raise Exception("❌ 不支持的发送类型")
-            with lock:
-                success += 1
-        except:
-            with lock:
-                fail += 1
-        finally:
-            sent = success + fail
-            if sent % 10 == 0 or sent == total_users:
-                try:
-                    bot.edit_message_text(
-                        chat_id=guanli_id,
-                        message_id=progress_msg.message_id,
-                        text=f"📤 私发中：<b>{sent}/{total_users}</b>\n✅ 成功：{success}  ❌ 失败：{fail}",
-                        parse_mode='HTML'
-                    )
-                except:
-                    pass
+            bot.edit_message_text(
+                chat_id=guanli_id,
+                message_id=progress_msg.message_id,
+                text=(f"📤 私发中：<b>{stats.done}/{stats.total}</b>\n"
+                      f"✅ 成功：{stats.sent}  ❌ 失败：{stats.failed}  🚫 拉黑：{stats.blocked}\n"
+                      f"⚡ 速度：{stats.rate:.1f} 条/秒"),
+                parse_mode='HTML',
+                reply_markup=_broadcast_job_markup(job_id, status)
+            )
+        except Exception:
+            pass
+
+    # 🚀 限速异步发送（与本机器人其他群发共享速率上限，逐个收件人记录投递状态；在途消息不占线程）
+    status, stats = run_job(broadcast_store, job_id, iter_broadcast_recipients, send_to_user,
+                            get_limiter(bot.token), on_result=on_result, progress=progress, async_send=True)
+    if status is None or stats is None:
+        return
 
-    # 🚀 并发发送
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        executor.map(send_to_user, user_list)
+    summary = (f"<b>成功：</b>{stats.sent} 人\n<b>失败：</b>{stats.failed} 人\n"
+               f"<b>拉黑/注销：</b>{stats.blocked} 人（后续群发自动跳过）")
+    if status == JOB_RUNNING:
+        # 暂停后又被继续：后续进度由新的进度消息显示
+        try:
+            bot.edit_message_text(
+                chat_id=guanli_id,
+                message_id=progress_msg.message_id,
+                text=f"▶️ 私发任务已继续（{stats.done}/{stats.total}），进度见新消息",
+                parse_mode='HTML'
+            )
+        except Exception:
+            pass
+        return
+    if status == JOB_PAUSED:
+        bot.edit_message_text(
+            chat_id=guanli_id,
+            message_id=progress_msg.message_id,
+            text=f"⏸ 私发任务已暂停（{stats.done}/{stats.total}）\n\n{summary}",
+            parse_mode='HTML',
+            reply_markup=_broadcast_job_markup(job_id, status)
+        )
+        return
 
     # 🛑 更新图文状态为已关闭
     sftw.update_one({'bot_id': bot_id, 'projectname': '图文1🔽'}, {'$set': {'state': 1}})
 
-    # 📌 最终编辑结果 + 菜单按钮
-    end_keyboard = [
-        [InlineKeyboardButton('🖼 图文设置', callback_data='tuwen'),
-         InlineKeyboardButton('🔘 按钮设置', callback_data='anniu')],
-        [InlineKeyboardButton('📎 查看图文', callback_data='cattu'),
-         InlineKeyboardButton('📤 开启私发', callback_data='kaiqisifa')],
-        [InlineKeyboardButton('❌ 关闭', callback_data=f'close {guanli_id}')]
-    ]
-
-    # ✅ 最终替换原消息
+    # ✅ 最终替换原消息 + 菜单按钮
+    title = '✅ 私发任务已完成！' if status == JOB_DONE else '⛔ 私发任务已取消'
     bot.edit_message_text(
         chat_id=guanli_id,
         message_id=progress_msg.message_id,
-        text=f"✅ 私发任务已完成！\n\n<b>成功：</b>{success} 人\n<b>失败：</b>{fail} 人\n\n📴 私发状态：<b>已关闭🔴</b>",
+        text=f"{title}\n\n{summary}\n\n📴 私发状态：<b>已关闭🔴</b>",
         parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(end_keyboard)
+        reply_markup=InlineKeyboardMarkup(_sifa_menu_keyboard(guanli_id))
     )
 
 
+def broadcast_job_callback(update: Update, context: CallbackContext):
+    """私发任务列表与暂停/继续/取消"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    if not is_admin(user_id):
+        query.answer('❌ 无权限', show_alert=True)
+        return
+    bot_id = context.bot.id
+    action, _, job_id = query.data.partition(' ')
+
+    if action == 'bcast_pause':
+        ok = broadcast_store.set_status(job_id, JOB_PAUSED, only_from=[JOB_RUNNING])
+        query.answer('⏸ 正在暂停，当前批次发送完后停止' if ok else '任务已不在运行中', show_alert=not ok)
+        return
+    if action == 'bcast_resume':
+        if broadcast_store.set_status(job_id, JOB_RUNNING, only_from=[JOB_PAUSED]):
+            context.job_queue.run_once(usersifa, 1, context={'job_id': job_id}, name=f'sifa_{job_id}')
+            query.answer('▶️ 已继续')
+            try:
+                query.edit_message_reply_markup(reply_markup=_broadcast_job_markup(job_id, JOB_RUNNING))
+            except Exception:
+                pass
+        else:
+            query.answer('任务当前不可继续', show_alert=True)
+        return
+    if action == 'bcast_cancel':
+        job = broadcast_store.get(job_id)
+        if job is None or not broadcast_store.set_status(job_id, JOB_CANCELLED, only_from=[JOB_RUNNING, JOB_PAUSED]):
+            query.answer('任务已结束', show_alert=True)
+            return
+        query.answer('⛔ 已取消')
+        if job['status'] == JOB_PAUSED:
+            # 已暂停的任务没有执行线程，直接收尾
+            sftw.update_one({'bot_id': bot_id, 'projectname': '图文1🔽'}, {'$set': {'state': 1}})
+            try:
+                query.edit_message_reply_markup(reply_markup=_broadcast_job_markup(job_id, JOB_CANCELLED))
+            except Exception:
+                pass
+        return
+
+    # 📋 最近的私发任务
+    query.answer()
+    jobs = broadcast_store.list('usersifa', limit=10, bot_id=bot_id)
+    if not jobs:
+        text = '📋 <b>私发任务</b>\n\n暂无任务'
+    else:
+        lines = ['📋 <b>私发任务</b>（最近10个）\n']
+        for i, job in enumerate(jobs, 1):
+            stats = job.get('stats', {})
+            lines.append(
+                f"{i}. {BROADCAST_STATUS_LABELS.get(job['status'], job['status'])} "
+                f"<code>{format_beijing_time(job['created_at'].timestamp(), '%m-%d %H:%M')}</code>\n"
+                f"   📤 {stats.get('done', 0)}/{job.get('total', 0)}  ✅ {stats.get('sent', 0)}  "
+                f"❌ {stats.get('failed', 0)}  🚫 {stats.get('blocked', 0)}"
+            )
+        text = '\n'.join(lines)
+    keyboard = []
+    for job in jobs:
+        if job['status'] in (JOB_RUNNING, JOB_PAUSED):
+            keyboard.extend(_broadcast_job_markup(job['_id'], job['status']).inline_keyboard[:-1])
+    keyboard.append([InlineKeyboardButton('🔄 刷新', callback_data='bcast_list'),
+                     InlineKeyboardButton('❌ 关闭', callback_data=f'close {user_id}')])
+    context.bot.send_message(chat_id=user_id, text=text, parse_mode='HTML',
+                             reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def resume_broadcast_jobs(job_queue, bot_id):
+    """启动时续跑上次中断的私发任务（已暂停的任务等待管理员继续）"""
+    broadcast_store.ensure_indexes()
+    for job in broadcast_store.list('usersifa', limit=50, status=JOB_RUNNING, bot_id=bot_id):
+        job_queue.run_once(usersifa, 10, context={'job_id': str(job['_id'])}, name=f"sifa_{job['_id']}")
+        logging.info(f"♻️ 续跑私发任务：{job['_id']}（{job.get('stats', {}).get('done', 0)}/{job.get('total', 0)}）")
+
+
 def backstart(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
@@ -4909,18 +4639,12 @@ def backstart(update: Update, context: CallbackContext):
         disable_web_page_preview=True
     )
 
-def gmaijilu(update: Update, context: CallbackContext):
-    query = update.callback_query
-    query.answer()
-    user_id = query.from_user.id
-    lang = user.find_one({'user_id': user_id})['lang']
-    df_id = int(query.data.replace('gmaijilu ', ''))
-
-    # 查询最近10条记录
-    jilu_list = list(gmjlu.find({'user_id': df_id}, sort=[('timer', -1)], limit=10))
-    total_count = gmjlu.count_documents({'user_id': df_id})
+def _purchase_history_rows(jilu_list, lang):
+    """购买记录按钮行（非中文用户的商品名按页批量预取译文）"""
+    names = {}
+    if lang != 'zh':
+        names = get_translations([i.get('projectname', '未知商品') for i in jilu_list], get_fy)
     keyboard = []
-
     for i in jilu_list:
         bianhao = i.get('bianhao', '无编号')
         projectname = i.get('projectname', '未知商品')
@@ -4944,34 +4668,53 @@ def gmaijilu(update: Update, context: CallbackContext):
         if projectname == '点击按钮修改':
             display_name = '测试商品' if lang == 'zh' else 'Test Product'
         else:
-            display_name = projectname if lang == 'zh' else get_fy(projectname)
+            display_name = projectname if lang == 'zh' else names.get(projectname, projectname)
         
         # 优化按钮显示格式 - 包含商品名、数量、类型、时间
         if lang == 'zh':
             title = f"{display_name} | 数量:{count} | {leixing} | {time_str}"
         else:
-            title = f"{get_fy(display_name)} | Qty:{count} | {leixing} | {time_str}"
+            title = f"{display_name} | Qty:{count} | {leixing} | {time_str}"
             
         keyboard.append([InlineKeyboardButton(title, callback_data=f'zcfshuo {bianhao}')])
+    return keyboard
+
+
+def _purchase_history_nav(df_id, lang, current_page, total_pages, result):
+    """购买记录分页按钮：上一页/下一页携带本页首/末条记录的 _id 作为键集游标"""
+    items = result['items']
+    nav_buttons = []
+    if result['has_prev'] and items:
+        nav_buttons.append(InlineKeyboardButton(
+            '⬅️ 上一页' if lang == 'zh' else '⬅️ Previous',
+            callback_data=f"gmainext {df_id}:{current_page - 1}:p{items[0]['_id']}"
+        ))
+    nav_buttons.append(InlineKeyboardButton(f'📄 {current_page}/{total_pages}', callback_data='page_info'))
+    if result['has_next'] and items:
+        nav_buttons.append(InlineKeyboardButton(
+            '下一页 ➡️' if lang == 'zh' else 'Next ➡️',
+            callback_data=f"gmainext {df_id}:{current_page + 1}:n{items[-1]['_id']}"
+        ))
+    return nav_buttons
+
+
+def gmaijilu(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    user_id = query.from_user.id
+    lang = user.find_one({'user_id': user_id})['lang']
+    df_id = int(query.data.replace('gmaijilu ', ''))
+
+    # 查询最近10条记录（键集分页第一页）
+    result = get_purchase_page(df_id, limit=10)
+    jilu_list = result['items']
+    total_count = get_purchase_count(df_id)
+    keyboard = _purchase_history_rows(jilu_list, lang)
 
     # 改进分页按钮
-    if total_count > 10:
-        page_buttons = []
-        # 第一页就是从0开始
-        current_page = 1
-        total_pages = (total_count + 9) // 10  # 向上取整
-        
-        # 上一页按钮 (当不是第一页时显示)
-        if total_count > 10:  # 有多页才显示下一页
-            if lang == 'zh':
-                page_buttons.append(InlineKeyboardButton('📄 1/'+str(total_pages), callback_data='page_info'))
-                page_buttons.append(InlineKeyboardButton('下一页 ➡️', callback_data=f'gmainext {df_id}:10'))
-            else:
-                page_buttons.append(InlineKeyboardButton('📄 1/'+str(total_pages), callback_data='page_info'))
-                page_buttons.append(InlineKeyboardButton('Next ➡️', callback_data=f'gmainext {df_id}:10'))
-        
-        if page_buttons:
-            keyboard.append(page_buttons)
+    if result['has_next']:
+        total_pages = max((total_count + 9) // 10, 2)  # 向上取整
+        keyboard.append(_purchase_history_nav(df_id, lang, 1, total_pages, result))
 
     # 返回按钮
     if lang == 'zh':
@@ -5056,69 +4799,34 @@ def gmainext(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     data = query.data.replace('gmainext ', '')
-    page = data.split(":")[1]
-    df_id = int(data.split(':')[0])
+    parts = data.split(':')
+    df_id = int(parts[0])
     user_id = query.from_user.id
     lang = user.find_one({'user_id': user_id})['lang']
-    keyboard = []
-    text_list = []
-    jilu_list = list(gmjlu.find({"user_id": df_id}, sort=[("timer", -1)], skip=int(page), limit=10))
-    count = 1
-    for i in jilu_list:
-        bianhao = i.get('bianhao', '无编号')
-        projectname = i.get('projectname', '未知商品')
-        leixing = i.get('leixing', '未知类型')
-        timer_value = i.get('timer')
-        count = i.get('count', 1)
-        
-        # 处理时间显示（北京时间）
-        if isinstance(timer_value, str):
-            try:
-                timer_dt = parse_to_beijing(timer_value)
-                time_str = format_beijing_time(timer_dt, "%m-%d %H:%M") if timer_dt else timer_value[:10]
-            except:
-                time_str = timer_value[:10] if len(timer_value) > 10 else timer_value
-        elif isinstance(timer_value, datetime):
-            time_str = format_beijing_time(timer_value, "%m-%d %H:%M")
-        else:
-            time_str = '未知时间'
 
-        # 商品名称处理
-        if projectname == '点击按钮修改':
-            display_name = '测试商品' if lang == 'zh' else 'Test Product'
-        else:
-            display_name = projectname if lang == 'zh' else get_fy(projectname)
-        
-        # 优化按钮显示格式
-        if lang == 'zh':
-            title = f"{display_name} | 数量:{count} | {leixing} | {time_str}"
-        else:
-            title = f"{get_fy(display_name)} | Qty:{count} | {leixing} | {time_str}"
-            
-        keyboard.append([InlineKeyboardButton(title, callback_data=f'zcfshuo {bianhao}')])
-        count += 1
-    # 改进分页逻辑
-    total_count = gmjlu.count_documents({'user_id': df_id})
-    current_page = int(page) // 10 + 1
-    total_pages = (total_count + 9) // 10
+    # 新格式 {df_id}:{页码}:{n|p}{游标_id}；旧消息上的 {df_id}:{skip} 按钮回到第一页
+    anchor, direction, current_page = None, 'next', 1
+    if len(parts) == 3 and parts[2][:1] in ('n', 'p'):
+        try:
+            anchor = ObjectId(parts[2][1:])
+            direction = 'next' if parts[2][0] == 'n' else 'prev'
+            current_page = max(int(parts[1]), 1)
+        except Exception:
+            anchor = None
+    result = get_purchase_page(df_id, anchor, direction, limit=10)
+    jilu_list = result['items']
+    if not result['has_prev']:
+        current_page = 1
+    keyboard = _purchase_history_rows(jilu_list, lang)
+
+    # 改进分页逻辑（总数走缓存，页码随游标传递）
+    total_count = get_purchase_count(df_id)
+    total_pages = max((total_count + 9) // 10, current_page + (1 if result['has_next'] else 0))
     
     if lang == 'zh':
         # 分页导航按钮
         if total_pages > 1:
-            nav_buttons = []
-            
-            # 上一页按钮
-            if current_page > 1:
-                nav_buttons.append(InlineKeyboardButton('⬅️ 上一页', callback_data=f'gmainext {df_id}:{int(page) - 10}'))
-            
-            # 页码显示
-            nav_buttons.append(InlineKeyboardButton(f'📄 {current_page}/{total_pages}', callback_data='page_info'))
-            
-            # 下一页按钮
-            if current_page < total_pages:
-                nav_buttons.append(InlineKeyboardButton('下一页 ➡️', callback_data=f'gmainext {df_id}:{int(page) + 10}'))
-            
-            keyboard.append(nav_buttons)
+            keyboard.append(_purchase_history_nav(df_id, lang, current_page, total_pages, result))
 
         keyboard.append([InlineKeyboardButton('🔙 返回', callback_data=f'backgmjl {df_id}')])
         
@@ -5146,20 +4854,7 @@ def gmainext(update: Update, context: CallbackContext):
     else:
         # 英文版分页导航
         if total_pages > 1:
-            nav_buttons = []
-            
-            # 上一页按钮
-            if current_page > 1:
-                nav_buttons.append(InlineKeyboardButton('⬅️ Previous', callback_data=f'gmainext {df_id}:{int(page) - 10}'))
-            
-            # 页码显示
-            nav_buttons.append(InlineKeyboardButton(f'📄 {current_page}/{total_pages}', callback_data='page_info'))
-            
-            # 下一页按钮
-            if current_page < total_pages:
-                nav_buttons.append(InlineKeyboardButton('Next ➡️', callback_data=f'gmainext {df_id}:{int(page) + 10}'))
-            
-            keyboard.append(nav_buttons)
+            keyboard.append(_purchase_history_nav(df_id, lang, current_page, total_pages, result))
 
         keyboard.append([InlineKeyboardButton('🔙 Back', callback_data=f'backgmjl {df_id}')])
         
@@ -6907,6 +6602,7 @@ def del_ejfl_confirm(update: Update, context: CallbackContext):
         # 删除该分类下的所有库存 (hb表)
         hb_delete_result = hb.delete_many({'nowuid': nowuid})
         logging.info(f"✅ 删除库存: nowuid={nowuid}, 数量={hb_delete_result.deleted_count}")
+        notify_product_changed(nowuid)
         
         # 删除该分类下的协议号 (xyh表)
         xyh_delete_result = xyh.delete_many({'nowuid': nowuid})
@@ -7157,6 +6853,15 @@ def dabaohao(context, user_id, folder_names, leixing, nowuid, erjiprojectname, f
     bianhao = formatted_time + timestamp
     timer = beijing_now_str()
     count = len(folder_names)
+    token = context.bot.token
+
+    def notify_failure(error):
+        # 发货消息未送达：提示用户凭订单号联系客服（不阻塞发货线程）
+        log_failure(outbound.send_message(token, user_id, f"❌ 发货消息发送失败，请联系客服处理\n订单号：{bianhao}"),
+                    '发货失败提示')
+
+    def track(future):
+        log_failure(future, f'发货 {bianhao} ', on_error=notify_failure)
 
     if leixing == '协议号':
         zip_filename = f"./协议号发货/{user_id}_{int(time.time())}.zip"
@@ -7169,7 +6874,8 @@ def dabaohao(context, user_id, folder_names, leixing, nowuid, erjiprojectname, f
                 if os.path.exists(session_file):
                     zipf.write(session_file, os.path.basename(session_file))
         goumaijilua(leixing, bianhao, user_id, erjiprojectname, zip_filename, fstext, timer, count)
-        context.bot.send_document(chat_id=user_id, document=open(zip_filename, "rb"))
+        with open(zip_filename, "rb") as fh:
+            track(outbound.send_document(token, user_id, fh))
 
     elif leixing == '直登号':
         zip_filename = f"./发货/{user_id}_{int(time.time())}.zip"
@@ -7183,20 +6889,21 @@ def dabaohao(context, user_id, folder_names, leixing, nowuid, erjiprojectname, f
                             rel_path = os.path.join(folder_name, os.path.relpath(full_path, base_path))
                             zipf.write(full_path, rel_path)
         goumaijilua(leixing, bianhao, user_id, erjiprojectname, zip_filename, fstext, timer, count)
-        context.bot.send_document(chat_id=user_id, document=open(zip_filename, "rb"))
+        with open(zip_filename, "rb") as fh:
+            track(outbound.send_document(token, user_id, fh))
 
     elif leixing == 'API链接':
         link_text = '\n'.join(folder_names)
-        context.bot.send_message(chat_id=user_id, text=link_text)
+        track(outbound.send_message(token, user_id, link_text))
         goumaijilua(leixing, bianhao, user_id, erjiprojectname, link_text, fstext, timer, count)
 
     elif leixing == 'txt文本':
         content = '\n'.join(folder_names)
-        context.bot.send_message(chat_id=user_id, text=content)
+        track(outbound.send_message(token, user_id, content))
         goumaijilua(leixing, bianhao, user_id, erjiprojectname, content, fstext, timer, count)
 
     else:
-        context.bot.send_message(chat_id=user_id, text=f"❌ 未知商品类型：{leixing}")
+        log_failure(outbound.send_message(token, user_id, f"❌ 未知商品类型：{leixing}"), '发货')
 
 
 
@@ -7280,12 +6987,10 @@ def qrgaimai(update: Update, context: CallbackContext):
 购买数量: {gmsl}
 购买金额: {zxymoney}
             '''
-            # 通知所有管理员 - 使用env配置的管理员列表
-            for admin_id in get_admin_ids():
-                try:
-                    context.bot.send_message(chat_id=admin_id, text=fstext, parse_mode='HTML')
-                except Exception as e:
-                    logging.warning(f"Failed to send admin notification to {admin_id}: {e}")
+            # 通知所有管理员（写入发件箱，合并窗口内的多笔购买合并为一条摘要）
+            notify_admins(fstext, topic='purchase', title='🛒 购买通知',
+                          digest=f'<a href="tg://user?id={user_id}">{fullname}</a> · '
+                                 f'{yijiprojectname}/{erjiprojectname} × {gmsl} · {zxymoney}')
 
             Timer(1, dabaohao,
                   args=[context, user_id, folder_names, '协议号', nowuid, erjiprojectname, fstext, timer]).start()
@@ -7369,12 +7074,10 @@ def qrgaimai(update: Update, context: CallbackContext):
 购买数量: {gmsl}
 购买金额: {zxymoney}
             '''
-            # 通知所有管理员 - 使用env配置的管理员列表
-            for admin_id in get_admin_ids():
-                try:
-                    context.bot.send_message(chat_id=admin_id, text=fstext, parse_mode='HTML')
-                except Exception as e:
-                    logging.warning(f"Failed to send admin notification to {admin_id}: {e}")
+            # 通知所有管理员（写入发件箱，合并窗口内的多笔购买合并为一条摘要）
+            notify_admins(fstext, topic='purchase', title='🛒 购买通知',
+                          digest=f'<a href="tg://user?id={user_id}">{fullname}</a> · '
+                                 f'{yijiprojectname}/{erjiprojectname} × {gmsl} · {zxymoney}')
 
 
         elif fhtype == 'API':
@@ -7425,12 +7128,10 @@ def qrgaimai(update: Update, context: CallbackContext):
 购买数量: {gmsl}
 购买金额: {zxymoney}
             '''
-            # 通知所有管理员 - 使用env配置的管理员列表
-            for admin_id in get_admin_ids():
-                try:
-                    context.bot.send_message(chat_id=admin_id, text=fstext, parse_mode='HTML')
-                except Exception as e:
-                    logging.warning(f"Failed to send admin notification to {admin_id}: {e}")
+            # 通知所有管理员（写入发件箱，合并窗口内的多笔购买合并为一条摘要）
+            notify_admins(fstext, topic='purchase', title='🛒 购买通知',
+                          digest=f'<a href="tg://user?id={user_id}">{fullname}</a> · '
+                                 f'{yijiprojectname}/{erjiprojectname} × {gmsl} · {zxymoney}')
         elif fhtype == '会员链接':
             zgje = user_list['zgje']
             zgsl = user_list['zgsl']
@@ -7475,12 +7176,10 @@ def qrgaimai(update: Update, context: CallbackContext):
 购买数量: {gmsl}
 购买金额: {zxymoney}
             '''
-            # 通知所有管理员 - 使用env配置的管理员列表
-            for admin_id in get_admin_ids():
-                try:
-                    context.bot.send_message(chat_id=admin_id, text=fstext, parse_mode='HTML')
-                except Exception as e:
-                    logging.warning(f"Failed to send admin notification to {admin_id}: {e}")
+            # 通知所有管理员（写入发件箱，合并窗口内的多笔购买合并为一条摘要）
+            notify_admins(fstext, topic='purchase', title='🛒 购买通知',
+                          digest=f'<a href="tg://user?id={user_id}">{fullname}</a> · '
+                                 f'{yijiprojectname}/{erjiprojectname} × {gmsl} · {zxymoney}')
         else:
             zgje = user_list['zgje']
             zgsl = user_list['zgsl']
@@ -7522,12 +7221,10 @@ def qrgaimai(update: Update, context: CallbackContext):
 购买数量: {gmsl}
 购买金额: {zxymoney}
             '''
-            # 通知所有管理员 - 使用env配置的管理员列表
-            for admin_id in get_admin_ids():
-                try:
-                    context.bot.send_message(chat_id=admin_id, text=fstext, parse_mode='HTML')
-                except Exception as e:
-                    logging.warning(f"Failed to send admin notification to {admin_id}: {e}")
+            # 通知所有管理员（写入发件箱，合并窗口内的多笔购买合并为一条摘要）
+            notify_admins(fstext, topic='purchase', title='🛒 购买通知',
+                          digest=f'<a href="tg://user?id={user_id}">{fullname}</a> · '
+                                 f'{yijiprojectname}/{erjiprojectname} × {gmsl} · {zxymoney}')
 
             Timer(1, dabaohao,
                   args=[context, user_id, folder_names, '直登号', nowuid, erjiprojectname, fstext, timer]).start()
@@ -7567,8 +7264,8 @@ def qrgaimai(update: Update, context: CallbackContext):
 
             # query.message.reply_document(open(zip_filename, "rb"))
 
-
-
+        # 库存已变化，分享卡片失效
+        notify_product_changed(nowuid)
 
     else:
         if lang == 'zh':
@@ -7695,6 +7392,8 @@ def qchuall(update: Update, context: CallbackContext):
 
         query.message.reply_document(open(zip_filename, "rb"))
 
+    notify_product_changed(nowuid)
+
     ej_list = ejfl.find_one({'nowuid': nowuid})
     uid = ej_list['uid']
     ej_projectname = ej_list['projectname']
@@ -7852,15 +7551,8 @@ def textkeyboard(update: Update, context: CallbackContext):
                         user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
                         uid = generate_24bit_uid()
                         timer = beijing_now_str()
-                        hongbao.insert_one({
-                            'uid': uid,
-                            'user_id': user_id,
-                            'fullname': fullname,
-                            'hbmoney': money,
-                            'hbsl': hbsl,
-                            'timer': timer,
-                            'state': 0
-                        })
+                        # 创建时预拆分金额，领取时原子占用名额
+                        create_hongbao(uid, user_id, fullname, money, hbsl, timer)
                         now_money = standard_num(USDT - money)
                         now_money = float(now_money) if str((now_money)).count('.') > 0 else int(
                             standard_num(now_money))
@@ -7886,6 +7578,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                 elif sign == 'startupdate':
                     entities = update.message.entities
                     shangtext.update_one({"projectname": '欢迎语'}, {"$set": {"text": zxh}})
+                    invalidate_shangtext_cache('欢迎语')
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
                     context.bot.send_message(chat_id=user_id, text=f'当前欢迎语为: {zxh}', parse_mode='HTML')
                 elif 'zdycz' in sign:
@@ -7981,7 +7674,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                                     reply_markup=InlineKeyboardMarkup(keyboard)
                                 )
 
-                            topup.insert_one({
+                            topup.insert_one(with_timer_datetimes('topup', {
                                 'bianhao': timer,
                                 'user_id': user_id,
                                 'money': final_amount,
@@ -7993,7 +7686,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                                 'timer': timer_str,
                                 'expire_time': expire_str,
                                 'message_id': msg.message_id
-                            })
+                            }))
 
                         # 微信 / 支付宝 模式：生成二维码和支付链接
                         elif paytype in ['wechat', 'alipay']:
@@ -8087,7 +7780,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                                     reply_markup=InlineKeyboardMarkup(keyboard)
                                 )
 
-                            topup.insert_one({
+                            topup.insert_one(with_timer_datetimes('topup', {
                                 'bianhao': timer,
                                 'user_id': user_id,
                                 'money': final_amount,
@@ -8101,7 +7794,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                                 'message_id': msg.message_id,
                                 'pay_url': pay_url,
                                 'qrcode_path': qrcode_path
-                            })
+                            }))
 
                         user.update_one({'user_id': user_id}, {"$set": {"sign": 0}})
                     else:
@@ -8202,6 +7895,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                         nowuid = sign.replace('upmoney ', '')
                         money = float(text) if text.count('.') > 0 else int(text)
                         ejfl.update_one({"nowuid": nowuid}, {"$set": {"money": money}})
+                        notify_product_changed(nowuid)
                         user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
 
                         ej_list = ejfl.find_one({'nowuid': nowuid})
@@ -8241,6 +7935,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                 elif 'upejflname' in sign:
                     nowuid = sign.replace('upejflname ', '')
                     ejfl.update_one({"nowuid": nowuid}, {"$set": {"projectname": text}})
+                    notify_product_changed(nowuid)
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
                     uid = ejfl.find_one({'nowuid': nowuid})['uid']
                     fl_pro = fenlei.find_one({'uid': uid})['projectname']
@@ -9647,34 +9342,43 @@ def textkeyboard(update: Update, context: CallbackContext):
                     )
 
 
+def build_page_window_buttons(page, total_pages, callback_prefix, lang='zh', window=5):
+    """构建窗口化页码按钮：上一页 / 当前页附近的页码 / 下一页，避免页数过多时键盘超限"""
+    half = window // 2
+    first = max(0, min(page - half, total_pages - window))
+    last = min(total_pages, first + window)
+
+    number_row = []
+    for i in range(first, last):
+        label = f"·{i + 1}·" if i == page else str(i + 1)
+        number_row.append(InlineKeyboardButton(label, callback_data=f"{callback_prefix} {i}"))
+
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("⏮" if lang == 'zh' else "⏮ First", callback_data=f"{callback_prefix} 0"))
+        nav_row.append(InlineKeyboardButton("⬅️ 上一页" if lang == 'zh' else "⬅️ Prev", callback_data=f"{callback_prefix} {page - 1}"))
+    if page < total_pages - 1:
+        nav_row.append(InlineKeyboardButton("下一页 ➡️" if lang == 'zh' else "Next ➡️", callback_data=f"{callback_prefix} {page + 1}"))
+        nav_row.append(InlineKeyboardButton("⏭" if lang == 'zh' else "Last ⏭", callback_data=f"{callback_prefix} {total_pages - 1}"))
+
+    return [row for row in (number_row, nav_row) if len(row) > 0 and total_pages > 1]
+
+
 def check_stock_callback(update: Update, context: CallbackContext, page=0, lang='zh'):
     query = update.callback_query if update.callback_query else None
     user_id = update.effective_user.id
     limit = 50
-    start = page * limit
-
-    # 获取所有商品（过滤掉所属一级分类被删除的）
-    all_goods = []
-    for g in ejfl.find().sort("row", 1):
-        nowuid = g['nowuid']
-        uid = g.get('uid')
-        if not fenlei.find_one({'uid': uid}):
-            continue
-        stock_count = hb.count_documents({'nowuid': nowuid, 'state': 0})
-        if stock_count <= 0:
-            continue
-        g['stock'] = stock_count
-        all_goods.append(g)
 
-    total = len(all_goods)
-    total_pages = (total + limit - 1) // limit
-    display_goods = all_goods[start:start + limit]
+    # 从库存快照分页（快照由一次聚合生成，并已过滤掉所属一级分类被删除的商品）
+    snapshot_page = stock_snapshot.get_page(page, limit, lang=lang, translate=get_fy)
+    page = snapshot_page['page']
+    total_pages = snapshot_page['total_pages']
+    start = page * limit
 
     # 拼接展示内容
     text_lines = [f"<b>{'商品库存列表' if lang == 'zh' else 'Product Stock List'}</b>", "--------"]
-    for i, g in enumerate(display_goods, start=start + 1):
-        pname = g.get('projectname', '未知商品')
-        pname = pname if lang == 'zh' else get_fy(pname)
+    for i, g in enumerate(snapshot_page['items'], start=start + 1):
+        pname = g['display_name']
         stock = g['stock']
         line = f"⤷ <b>{i}. {pname}</b>  ➥  {'库存' if lang == 'zh' else 'Stock'}: <b>{stock}</b>"
         text_lines.append(line)
@@ -9685,18 +9389,13 @@ def check_stock_callback(update: Update, context: CallbackContext, page=0, lang=
     else:
         text_lines.append(f"↰ Page <b>{page + 1}</b> / <b>{total_pages}</b> ↱")
 
-    text = "\n".join(text_lines)
-
-    # 构建页码跳转按钮
-    keyboard = []
+    as_of = format_beijing_time(snapshot_page['built_at'], '%H:%M:%S') if snapshot_page['built_at'] else '-'
+    text_lines.append(f"<i>{'数据更新于' if lang == 'zh' else 'As of'} {as_of}</i>")
 
-    page_buttons = []
-    for i in range(total_pages):
-        label = f"{'↦' if i == page else ''}第{i + 1}页" if lang == 'zh' else f"{'↦' if i == page else ''}Page {i + 1}"
-        page_buttons.append(InlineKeyboardButton(label, callback_data=f"ck_page {i}"))
+    text = "\n".join(text_lines)
 
-    for i in range(0, len(page_buttons), 5):
-        keyboard.append(page_buttons[i:i + 5])
+    # 构建窗口化页码跳转按钮
+    keyboard = build_page_window_buttons(page, total_pages, "ck_page", lang)
 
     keyboard.append([InlineKeyboardButton("❌ 关闭" if lang == 'zh' else "❌ Close", callback_data=f"close {user_id}")])
 
@@ -9717,6 +9416,113 @@ def check_stock_callback(update: Update, context: CallbackContext, page=0, lang=
         )
 
 
+def bot_clients_command(update: Update, context: CallbackContext):
+    """/bot_clients - 查看进程内 Telegram 客户端连接池与在途请求"""
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+    update.message.reply_text(f"🔌 <b>Telegram 客户端</b>\n\n{format_client_metrics()}\n{outbound.format_metrics()}",
+                              parse_mode='HTML')
+
+
+def set_threshold_command(update: Update, context: CallbackContext):
+    """/set_threshold <阈值> 或 /set_threshold <商品ID> <阈值|default> - 设置低库存预警阈值"""
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    args = context.args or []
+    try:
+        if len(args) == 1:
+            threshold = int(args[0])
+            stock_health.set_default_threshold(threshold)
+            update.message.reply_text(f"✅ 全局低库存阈值已设为 {threshold} 件")
+        elif len(args) == 2:
+            nowuid = args[0]
+            product = ejfl.find_one({'nowuid': nowuid}, {'projectname': 1})
+            if not product:
+                update.message.reply_text("❌ 商品不存在")
+                return
+            if args[1].lower() == 'default':
+                stock_health.set_product_threshold(nowuid, None)
+                update.message.reply_text(f"✅ {product.get('projectname', nowuid)} 已恢复使用全局阈值")
+            else:
+                threshold = int(args[1])
+                stock_health.set_product_threshold(nowuid, threshold)
+                update.message.reply_text(f"✅ {product.get('projectname', nowuid)} 的低库存阈值已设为 {threshold} 件")
+        else:
+            update.message.reply_text("用法：/set_threshold 15 或 /set_threshold 商品ID 30 或 /set_threshold 商品ID default")
+            return
+    except ValueError:
+        update.message.reply_text("❌ 阈值必须是整数")
+        return
+    # 阈值变化后立即按新阈值检查一次
+    stock_health.mark_changed(args[0] if len(args) == 2 else None)
+
+
+_last_stock_sweep = 0.0
+
+
+def stock_health_job(context: CallbackContext):
+    """定时检查库存阈值：出库的商品每轮检查，全量检查兜底代理机器人等其他进程的出库"""
+    global _last_stock_sweep
+    full = time.time() - _last_stock_sweep >= STOCK_ALERT_SWEEP_SECONDS
+    try:
+        alerts = stock_health.check_alerts(full=full)
+        if full:
+            _last_stock_sweep = time.time()
+    except Exception as e:
+        logging.error(f"❌ 库存阈值检查失败：{e}")
+        return
+    if not alerts:
+        return
+
+    lines = []
+    for a in alerts[:20]:
+        if a['level'] == 'out':
+            lines.append(f"🚨 <b>{a['projectname']}</b> 已缺货")
+        else:
+            lines.append(f"⚠️ <b>{a['projectname']}</b> 库存 {a['available']}（阈值 {a['threshold']}）")
+    if len(alerts) > 20:
+        lines.append(f"… 另有 {len(alerts) - 20} 个商品")
+    text = "📦 <b>低库存预警</b>\n\n" + "\n".join(lines) + f"\n\n⏰ {beijing_now_str('%m-%d %H:%M:%S')}"
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("📋 查看库存预警", callback_data='stock_alerts')]])
+    notify_admins(text, reply_markup=keyboard)
+    logging.info(f"📦 已推送 {len(alerts)} 条库存预警")
+
+
+def restock_fanout_heartbeat_job(context: CallbackContext):
+    """补货分发心跳：代理据此判断是否由总部推送补货通知"""
+    try:
+        restock_publisher.heartbeat()
+    except Exception as e:
+        logging.warning(f"⚠️ 写入补货分发心跳失败：{e}")
+
+
+_last_agent_analytics_reconcile = 0.0
+
+
+def agent_analytics_job(context: CallbackContext):
+    """代理分析汇总：重算代理进程标记 dirty 的记录；定期按源数据全量校正"""
+    global _last_agent_analytics_reconcile
+    try:
+        if time.time() - _last_agent_analytics_reconcile >= AGENT_ANALYTICS_RECONCILE_SECONDS:
+            _last_agent_analytics_reconcile = time.time()
+            reconcile_agent_analytics()
+        refresh_dirty_agent_analytics()
+    except Exception as e:
+        logging.error(f"❌ 代理分析汇总任务失败：{e}")
+
+
+def refresh_stock_snapshot_job(context: CallbackContext):
+    """定时刷新库存快照，使用户翻页时总是命中快照"""
+    try:
+        stock_snapshot.refresh()
+    except Exception as e:
+        logging.error(f"❌ 定时刷新库存快照失败：{e}")
+
+
 def ck_page_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
@@ -10133,7 +9939,7 @@ def czmoney_callback(update: Update, context: CallbackContext):
             return
 
     try:
-        topup.insert_one({
+        topup.insert_one(with_timer_datetimes('topup', {
             'bianhao': bianhao,
             'user_id': user_id,
             'money': final_rmb,
@@ -10148,7 +9954,7 @@ def czmoney_callback(update: Update, context: CallbackContext):
             'message_id': msg.message_id,
             'pay_url': pay_url,
             'qrcode_path': qrcode_path
-        })
+        }))
         print(f"[订单创建成功] 用户ID: {user_id} 金额: {final_rmb} 单号: {bianhao} 二维码: {qrcode_path}")
     except Exception as e:
         print(f"[错误] 插入订单失败：{e}")
@@ -10272,7 +10078,7 @@ def yuecz(update: Update, context: CallbackContext):
         )
 
     # 插入订单（补齐 cz_type、status、time 字段）
-    topup.insert_one({
+    topup.insert_one(with_timer_datetimes('topup', {
         'bianhao': bianhao,
         'user_id': user_id,
         'money': total_money,
@@ -10284,7 +10090,7 @@ def yuecz(update: Update, context: CallbackContext):
         'cz_type': 'usdt',          # ✅ 正确标识 usdt 充值类型
         'status': 'pending',
         'message_id': message.message_id
-    })
+    }))
 
 
 
@@ -10762,7 +10568,7 @@ def handle_all_callbacks(update: Update, context: CallbackContext):
                     if snapshot_chat_id and snapshot_token:
                         # 使用快照配置直接发送
                         print(f"[WITHDRAW_NOTIFY] Using snapshot: agent_bot_id={agent_bot_id} chat={snapshot_chat_id}")
-                        Bot(token=snapshot_token).send_message(
+                        get_bot(snapshot_token).send_message(
                             chat_id=snapshot_chat_id,
                             text=notification_text,
                             parse_mode='HTML'
@@ -10818,6 +10624,11 @@ def handle_all_callbacks(update: Update, context: CallbackContext):
             # 弹窗显示地址供手动复制
             query.answer(w['withdrawal_address'], show_alert=True)           
             
+    # ========== 代理排行分页（agent_rank:<指标> <页码>） ==========
+    elif query.data.startswith("agent_rank:"):
+        sort_key, _, page_index = query.data.split(":", 1)[1].partition(' ')
+        agent_bot_list(update, context, sort_key, int(page_index or 0) + 1)
+
     # ========== 代理机器人查看 ==========
     elif query.data.startswith("agent_view:"):
         agent_bot_id = query.data.split(":", 1)[1]
@@ -11304,16 +11115,8 @@ def jiexi(context: CallbackContext):
 充值: {today_money} USDT
 <a href="https://tronscan.org/#/transaction/{txid}">充值详细</a>
                 '''
-                for admin_id in get_admin_ids():
-                    try:
-                        context.bot.send_message(
-                            chat_id=admin_id,
-                            text=admin_text,
-                            parse_mode='HTML',
-                            disable_web_page_preview=True
-                        )
-                    except Exception as e:
-                        logging.warning(f"Failed to send recharge notification to admin {admin_id}: {e}")
+                notify_admins(admin_text, topic='recharge', title='💰 充值通知',
+                              digest=f'<a href="tg://user?id={user_id}">{fullname}</a> · {today_money} USDT')
 
                 # 删除 pending 订单消息（如果有的话）
                 existing_order = dj_list
@@ -11336,6 +11139,7 @@ def jiexi(context: CallbackContext):
                         }
                     }
                 )
+                invalidate_income_summary()
 
                 # qukuai 标记为处理成功
                 qukuai.update_one({'txid': txid}, {"$set": {"state": 1}})
@@ -11450,20 +11254,16 @@ def handle_user_withdrawal_txid(update: Update, context: CallbackContext):
         )
         
         # 通知管理员
-        for admin_id in ADMIN_IDS:
-            try:
-                context.bot.send_message(
-                    chat_id=admin_id,
-                    text=f"🔔 <b>新的提现TXID提交</b>\n\n"
-                         f"用户ID: {user_id}\n"
-                         f"提现金额: {withdrawal['amount']:.2f} USDT\n"
-                         f"交易哈希: <code>{text}</code>\n"
-                         f"提交时间: {format_beijing_time(now)}\n\n"
-                         f"请尽快验证处理。",
-                    parse_mode='HTML'
-                )
-            except Exception as e:
-                print(f"通知管理员失败 {admin_id}: {e}")
+        notify_admins(
+            f"🔔 <b>新的提现TXID提交</b>\n\n"
+            f"用户ID: {user_id}\n"
+            f"提现金额: {withdrawal['amount']:.2f} USDT\n"
+            f"交易哈希: <code>{text}</code>\n"
+            f"提交时间: {format_beijing_time(now)}\n\n"
+            f"请尽快验证处理。",
+            topic='withdrawal', title='🔔 提现TXID提交',
+            digest=f"用户 {user_id} · {withdrawal['amount']:.2f} USDT · <code>{text}</code>"
+        )
         
     except Exception as e:
         print(f"❌ 完成付款写入错误: {e}")
@@ -11577,10 +11377,10 @@ def handle_admin_txhash_message(update: Update, context: CallbackContext):
 
 def jianceguoqi(context: CallbackContext):
     while True:
-        for i in topup.find({}):
-            # 忽略没有 message_id 的数据
-            if 'message_id' not in i:
-                continue
+        # 只取已超过 10 分钟的订单（回填完成后按 timer_at 索引查询）
+        cutoff = get_beijing_now().replace(tzinfo=None) - timedelta(minutes=10)
+        expired_filter = {'message_id': {'$exists': True}, **timer_range_filter('topup', 'timer', end=cutoff)}
+        for i in topup.find(expired_filter):
 
             try:
                 timer = i['timer']
@@ -12647,8 +12447,16 @@ def handle_create_agent_bot_command(update: Update, context: CallbackContext):
         print(f"❌ 创建代理机器人异常: {e}")
         update.message.reply_text(f"❌ 创建失败：{str(e)}")
 
-def agent_bot_list(update: Update, context: CallbackContext):
-    """代理机器人列表"""
+AGENT_RANK_LABELS = {
+    'sales': '销售额',
+    'commission': '佣金',
+    'users': '用户数',
+    'withdrawals': '待提现',
+}
+
+
+def agent_bot_list(update: Update, context: CallbackContext, sort_key: str = 'sales', page: int = 1):
+    """代理机器人列表 - 按指标排行分页（读取 agent_analytics，一次索引查询）"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
@@ -12658,46 +12466,46 @@ def agent_bot_list(update: Update, context: CallbackContext):
         return
     
     try:
-        agent_bots_list = multi_bot_system.get_agent_bot_list()
+        ranking = get_agent_analytics_page(sort_key, page, per_page=10)
         
-        if not agent_bots_list:
+        if not ranking['items']:
             text = "📭 暂无代理机器人"
             keyboard = [[InlineKeyboardButton("➕ 创建代理机器人", callback_data='create_agent_bot'),
                         InlineKeyboardButton("🔙 返回", callback_data='agent_bot_management')]]
         else:
-            text = f"🤖 <b>代理机器人列表</b> (共{len(agent_bots_list)}个)\n\n"
+            page = ranking['page']
+            text = (f"🤖 <b>代理机器人列表</b> (共{ranking['total']}个)\n"
+                    f"🏆 按<b>{AGENT_RANK_LABELS.get(sort_key, '销售额')}</b>排序 · 第 {page}/{ranking['total_pages']} 页\n\n")
             keyboard = []
             
-            for i, bot in enumerate(agent_bots_list[:10], 1):  # 显示前10个
-                status_icon = "🟢" if bot['status'] == 'active' else "🔴"
-                
-                # 获取实时统计数据
-                stats = get_agent_stats(bot['agent_bot_id'])
-                if not stats:
-                    stats = {
-                        'total_sales': 0.0,
-                        'available_balance': 0.0
-                    }
+            for i, bot in enumerate(ranking['items'], (page - 1) * 10 + 1):
+                status_icon = "🟢" if bot.get('status') == 'active' else "🔴"
+                name = bot.get('agent_name') or bot['_id']
                 
-                text += f"{i}. {status_icon} <b>{bot['agent_name']}</b>\n"
+                text += f"{i}. {status_icon} <b>{name}</b>\n"
                 text += f"   ├─ 机器人：@{bot.get('agent_username', 'unknown')}\n"
-                text += f"   ├─ 佣金率：{bot['commission_rate']}%\n"
-                text += f"   ├─ 销售额：{stats.get('total_sales', 0):.2f} USDT\n"
-                text += f"   ├─ 余额：{stats.get('available_balance', 0):.2f} USDT\n"
-                text += f"   └─ 创建：{bot['creation_time'][:10]}\n\n"
+                text += f"   ├─ 佣金率：{bot.get('commission_rate', 0)}%\n"
+                text += f"   ├─ 销售额：{bot.get('total_sales', 0):.2f} USDT（{bot.get('order_count', 0)} 单）\n"
+                text += f"   ├─ 佣金：{bot.get('total_commission', 0):.2f} USDT · 用户：{bot.get('total_users', 0)}\n"
+                text += f"   ├─ 余额：{bot.get('available_balance', 0):.2f} USDT"
+                if bot.get('pending_withdrawal_count'):
+                    text += f" · 待提现 {bot['pending_withdrawal_count']} 笔/{bot.get('pending_withdrawal_amount', 0):.2f}"
+                text += f"\n   └─ 创建：{str(bot.get('creation_time', ''))[:10]}\n\n"
                 
                 keyboard.append([
                     InlineKeyboardButton(
-                        f"📊 {bot['agent_name'][:10]}",
-                        callback_data=f"agent_view:{bot['agent_bot_id']}"
+                        f"📊 {name[:10]}",
+                        callback_data=f"agent_view:{bot['_id']}"
                     )
                 ])
             
+            # 排序方式
+            keyboard.append([
+                InlineKeyboardButton(f"{'✅' if key == sort_key else ''}{label}", callback_data=f"agent_rank:{key} 0")
+                for key, label in AGENT_RANK_LABELS.items()
+            ])
             # 导航按钮
-            if len(agent_bots_list) > 10:
-                keyboard.append([
-                    InlineKeyboardButton("➡️ 查看更多", callback_data="agent_bot_list_page_2")
-                ])
+            keyboard.extend(build_page_window_buttons(page - 1, ranking['total_pages'], f"agent_rank:{sort_key}"))
             
             keyboard.extend([
                 [InlineKeyboardButton("➕ 创建新代理", callback_data='create_agent_bot'),
@@ -12823,6 +12631,21 @@ def show_agent_info_detail(update: Update, context: CallbackContext, agent_bot_i
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
 
+def _agent_rank_text(agent_bot_id: str) -> str:
+    """代理在全部代理中的名次（累计数据，来自 agent_analytics）"""
+    try:
+        total = agent_analytics.estimated_document_count()
+        ranks = [(label, get_agent_analytics_rank(agent_bot_id, key))
+                 for key, label in AGENT_RANK_LABELS.items() if key != 'withdrawals']
+        if not total or not any(rank for _, rank in ranks):
+            return ""
+        lines = "\n".join(f"• {label}：第 {rank} 名" for label, rank in ranks if rank)
+        return f"\n\n🏆 <b>代理排行（累计，共{total}个）</b>\n{lines}"
+    except Exception as e:
+        logging.warning(f"⚠️ 获取代理排行失败：{e}")
+        return ""
+
+
 def show_agent_report_detail(update: Update, context: CallbackContext, agent_bot_id: str, period: str = '30d'):
     """显示代理机器人报表
     
@@ -12891,7 +12714,7 @@ def show_agent_report_detail(update: Update, context: CallbackContext, agent_bot
 ⚙️ <b>代理设置</b>
 • 佣金率：{agent_info['commission_rate']}%
 • 状态：{'🟢 运行中' if agent_info['status'] == 'active' else '🔴 已停用'}
-• 创建时间：{agent_info['creation_time']}"""
+• 创建时间：{agent_info['creation_time']}{_agent_rank_text(agent_bot_id)}"""
             
             # 构建时间周期选择按钮
             period_buttons = [
@@ -13662,8 +13485,7 @@ def send_balance_notification_to_user(agent_bot_id, target_user_id, operation, a
         agent_users_collection = get_agent_bot_user_collection(bot['agent_bot_id'])
         user_count = agent_users_collection.count_documents({})        
         # 创建代理机器人实例来发送消息
-        from telegram import Bot
-        agent_bot = Bot(token=agent_bot_token)
+        agent_bot = get_bot(agent_bot_token)
         
         # 构建通知消息
         operation_names = {
@@ -14159,10 +13981,7 @@ def detailed_balance_stats(update: Update, context: CallbackContext):
             query.edit_message_text("❌ 无法获取用户数据")
             return
         
-        # 统计数据
-        total_users = agent_users_collection.count_documents({})
-        
-        # 余额分布统计
+        # 余额分布区间（与原逐区间 count_documents 口径一致）
         balance_ranges = [
             {"name": "0 USDT", "min": 0, "max": 0},
             {"name": "0-10 USDT", "min": 0.01, "max": 10},
@@ -14175,60 +13994,59 @@ def detailed_balance_stats(update: Update, context: CallbackContext):
         text = f"📊 <b>{agent_info['agent_name']} - 详细统计</b>\n\n"
         text += f"📅 生成时间：<code>{beijing_now_str()}</code>\n\n"
         
-        # 基础统计
-        pipeline = [
-            {
-                "$group": {
-                    "_id": None,
-                    "total_balance": {"$sum": {"$ifNull": ["$USDT", 0]}},
-                    "total_consumption": {"$sum": {"$ifNull": ["$zgje", 0]}},
-                    "avg_balance": {"$avg": {"$ifNull": ["$USDT", 0]}},
-                    "max_balance": {"$max": {"$ifNull": ["$USDT", 0]}},
-                    "min_balance": {"$min": {"$ifNull": ["$USDT", 0]}}
-                }
-            }
-        ]
-        
-        stats = list(agent_users_collection.aggregate(pipeline))
-        stat = stats[0] if stats else {
-            'total_balance': 0,
-            'total_consumption': 0,
-            'avg_balance': 0,
-            'max_balance': 0,
-            'min_balance': 0
+        # 一次聚合：基础统计 + 各余额区间人数 + 有余额人数
+        def count_if(cond):
+            return {"$sum": {"$cond": [cond, 1, 0]}}
+
+        numeric_usdt = {"$in": [{"$type": "$USDT"}, ["double", "int", "long", "decimal"]]}
+        group = {
+            "_id": None,
+            "total_users": {"$sum": 1},
+            "total_balance": {"$sum": {"$ifNull": ["$USDT", 0]}},
+            "total_consumption": {"$sum": {"$ifNull": ["$zgje", 0]}},
+            "avg_balance": {"$avg": {"$ifNull": ["$USDT", 0]}},
+            "max_balance": {"$max": {"$ifNull": ["$USDT", 0]}},
+            "min_balance": {"$min": {"$ifNull": ["$USDT", 0]}},
+            "active_users": count_if({"$and": [numeric_usdt, {"$gt": ["$USDT", 0]}]}),
         }
+        for i, range_info in enumerate(balance_ranges):
+            if range_info['max'] == 0:
+                cond = {"$and": [numeric_usdt, {"$eq": ["$USDT", 0]}]}
+            elif range_info['max'] == float('inf'):
+                cond = {"$and": [numeric_usdt, {"$gte": ["$USDT", range_info['min']]}]}
+            else:
+                cond = {"$and": [numeric_usdt, {"$gte": ["$USDT", range_info['min']]},
+                                 {"$lt": ["$USDT", range_info['max']]}]}
+            group[f"range_{i}"] = count_if(cond)
+
+        stats = list(agent_users_collection.aggregate([{"$group": group}]))
+        stat = stats[0] if stats else {}
+        total_users = stat.get('total_users', 0)
         
         text += f"👥 <b>用户统计：</b>\n"
         text += f"├─ 总用户数：<code>{total_users}</code> 个\n"
         text += f"├─ 总余额：<code>{stat.get('total_balance', 0):.2f}</code> USDT\n"
         text += f"├─ 总消费：<code>{stat.get('total_consumption', 0):.2f}</code> USDT\n"
-        text += f"├─ 平均余额：<code>{stat.get('avg_balance', 0):.2f}</code> USDT\n"
-        text += f"├─ 最高余额：<code>{stat.get('max_balance', 0):.2f}</code> USDT\n"
-        text += f"└─ 最低余额：<code>{stat.get('min_balance', 0):.2f}</code> USDT\n\n"
+        text += f"├─ 平均余额：<code>{stat.get('avg_balance') or 0:.2f}</code> USDT\n"
+        text += f"├─ 最高余额：<code>{stat.get('max_balance') or 0:.2f}</code> USDT\n"
+        text += f"└─ 最低余额：<code>{stat.get('min_balance') or 0:.2f}</code> USDT\n\n"
         
         # 余额分布
         text += f"💰 <b>余额分布：</b>\n"
-        for range_info in balance_ranges:
-            if range_info['max'] == 0:
-                count = agent_users_collection.count_documents({"USDT": 0})
-            elif range_info['max'] == float('inf'):
-                count = agent_users_collection.count_documents({"USDT": {"$gte": range_info['min']}})
-            else:
-                count = agent_users_collection.count_documents({
-                    "USDT": {"$gte": range_info['min'], "$lt": range_info['max']}
-                })
-            
+        for i, range_info in enumerate(balance_ranges):
+            count = stat.get(f"range_{i}", 0)
             percentage = (count / total_users * 100) if total_users > 0 else 0
             text += f"├─ {range_info['name']}: <code>{count}</code> 个 ({percentage:.1f}%)\n"
         
         # 活跃度统计
-        active_users = agent_users_collection.count_documents({"USDT": {"$gt": 0}})
+        active_users = stat.get('active_users', 0)
         inactive_users = total_users - active_users
         active_percentage = (active_users / total_users * 100) if total_users > 0 else 0
         
         text += f"\n📈 <b>活跃度：</b>\n"
         text += f"├─ 有余额用户：<code>{active_users}</code> 个 ({active_percentage:.1f}%)\n"
         text += f"└─ 零余额用户：<code>{inactive_users}</code> 个 ({100-active_percentage:.1f}%)"
+        text += _agent_rank_text(agent_bot_id)
         
         keyboard = [
             [InlineKeyboardButton("🔙 返回", callback_data=f'balance_manage_{agent_bot_id}')]
@@ -14489,7 +14307,7 @@ def send_agent_notification(agent_bot_id, text, reply_markup=None, parse_mode='H
         
         print(f"[WITHDRAW_NOTIFY] agent_bot_id={agent_bot_id} target_chat={notify_chat_id} token_used={bot_token[:10]}...")
         
-        bot = Bot(token=bot_token)
+        bot = get_bot(bot_token)
         bot.send_message(
             chat_id=notify_chat_id,
             text=text,
@@ -14645,11 +14463,7 @@ def handle_user_balance_set(update: Update, context: CallbackContext):
 
 如有疑问请联系客服"""
                         
-                        agent_bot = telegram.Bot(token=agent_token)
-                        agent_bot.send_message(
-                            chat_id=target_user_id,
-                            text=notify_text
-                        )
+                        outbox.enqueue(target_user_id, notify_text, parse_mode=None, token=agent_token)
                 except Exception as e:
                     print(f"通知用户失败: {e}")
             else:
@@ -14758,11 +14572,7 @@ def handle_user_balance_set(update: Update, context: CallbackContext):
 
 如有疑问请联系客服"""
                     
-                    agent_bot = telegram.Bot(token=agent_token)
-                    agent_bot.send_message(
-                        chat_id=target_user_id,
-                        text=notify_text
-                    )
+                    outbox.enqueue(target_user_id, notify_text, parse_mode=None, token=agent_token)
                 else:
                     print(f"❌ 未找到代理机器人token: {bot['agent_bot_id']}")
             except Exception as e:
@@ -14878,11 +14688,7 @@ def handle_uset_callback(update: Update, context: CallbackContext):
 
 如有疑问请联系客服"""
                     
-                    agent_bot = telegram.Bot(token=agent_token)
-                    agent_bot.send_message(
-                        chat_id=target_user_id,
-                        text=notify_text
-                    )
+                    outbox.enqueue(target_user_id, notify_text, parse_mode=None, token=agent_token)
             except Exception as e:
                 print(f"通知用户失败: {e}")
                 
@@ -14993,11 +14799,12 @@ def main():
 
     Thread(target=start_flask_server, daemon=True).start()
 
+    # Updater 与所有后台发送共用进程内同一个 Bot 客户端（连接池需 >= workers + 4）
+    workers = BOT_WORKERS
     updater = Updater(
-        token=BOT_TOKEN,
+        bot=get_bot(BOT_TOKEN, pool_size=workers + 4, connect_timeout=REQUEST_TIMEOUT, read_timeout=REQUEST_TIMEOUT),
         use_context=True,
-        workers=128,
-        request_kwargs={'read_timeout': REQUEST_TIMEOUT, 'connect_timeout': REQUEST_TIMEOUT}
+        workers=workers
     )
 
     dispatcher = updater.dispatcher
@@ -15013,6 +14820,11 @@ def main():
     dispatcher.add_handler(CommandHandler("admin_add", admin_add, run_async=True))
     dispatcher.add_handler(CommandHandler("admin_remove", admin_remove, run_async=True))
     dispatcher.add_handler(CommandHandler("diag_db", diag_db, run_async=True))  # Database diagnostics
+    dispatcher.add_handler(CommandHandler("rebuild_sales_rollups", rebuild_sales_rollups_command, run_async=True))
+    dispatcher.add_handler(CommandHandler("migrate_hongbao_claims", migrate_hongbao_claims_command, run_async=True))
+    dispatcher.add_handler(CommandHandler("migrate_timer_fields", migrate_timer_fields_command, run_async=True))
+    dispatcher.add_handler(CommandHandler("set_threshold", set_threshold_command, run_async=True))
+    dispatcher.add_handler(CommandHandler("bot_clients", bot_clients_command, run_async=True))
     # 🆕 用户提现管理命令
     dispatcher.add_handler(CommandHandler("my_withdrawals", check_my_withdrawals, run_async=True))
     # 在main()函数的dispatcher部分添加：
@@ -15192,6 +15004,7 @@ def main():
     dispatcher.add_handler(CallbackQueryHandler(tuwen, pattern='tuwen', run_async=True))
     dispatcher.add_handler(CallbackQueryHandler(anniu, pattern='anniu', run_async=True))
     dispatcher.add_handler(CallbackQueryHandler(cattu, pattern='cattu', run_async=True))
+    dispatcher.add_handler(CallbackQueryHandler(broadcast_job_callback, pattern='^bcast_', run_async=True))
     dispatcher.add_handler(CallbackQueryHandler(handle_all_callbacks))
 
     # ✅ 修复：textkeyboard必须在handle_admin_txhash_message之前注册
@@ -15228,6 +15041,16 @@ def main():
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command & Filters.private, handle_admin_txhash_message, run_async=True), group=1)
     updater.job_queue.run_repeating(suoyouchengxu, 1, 1, name='suoyouchengxu')
     updater.job_queue.run_repeating(jiexi, 3, 1, name='chongzhi')
+    updater.job_queue.run_repeating(refresh_stock_snapshot_job, STOCK_SNAPSHOT_TTL, 5, name='stock_snapshot')
+    updater.job_queue.run_repeating(stock_health_job, STOCK_ALERT_CHECK_SECONDS, 20, name='stock_health')
+    updater.job_queue.run_repeating(agent_analytics_job, AGENT_ANALYTICS_REFRESH_SECONDS, 30, name='agent_analytics')
+    updater.job_queue.run_repeating(hongbao_claim_recovery_job, HONGBAO_CLAIM_STALE_SECONDS, 60, name='hongbao_recovery')
+    resume_broadcast_jobs(updater.job_queue, updater.bot.id)
+    outbox.start(updater.job_queue)
+    restock_publisher.ensure_indexes()
+    updater.job_queue.run_repeating(restock_fanout_heartbeat_job, 60, 0, name='restock_fanout')
+    if HQ_SYNC_PUBLISHER_ENABLED:
+        product_sync_publisher.start()
     updater.start_polling(timeout=BOT_TIMEOUT)
     updater.idle()
 
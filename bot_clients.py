@@ -0,0 +1,102 @@
+"""
+进程级 Telegram Bot 客户端注册表
+
+- 同一 token 在进程内只创建一个 Bot，所有发送共用一个 urllib3 连接池（keep-alive，避免重复 TLS 握手）
+- Updater 通过 get_bot() 取得同一个实例，代码里 context.bot 与 get_bot(token) 指向同一连接池
+- 每个客户端统计在途请求数、峰值、总请求数、失败数和平均耗时，供诊断命令展示
+"""
+import os
+import time
+import logging
+import threading
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+BOT_CLIENT_POOL_SIZE = int(os.getenv('BOT_CLIENT_POOL_SIZE', '16'))             # 默认每个 token 的连接池大小
+BOT_CLIENT_CONNECT_TIMEOUT = float(os.getenv('BOT_CLIENT_CONNECT_TIMEOUT', '10'))
+BOT_CLIENT_READ_TIMEOUT = float(os.getenv('BOT_CLIENT_READ_TIMEOUT', '20'))
+
+
+class _MeteredRequest(Request):
+    """带在途请求统计的 Request（连接池在实例内复用）"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+    def _request_wrapper(self, *args, **kwargs):
+        with self._stats_lock:
+            self.in_flight += 1
+            self.total += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        started = time.monotonic()
+        try:
+            return super()._request_wrapper(*args, **kwargs)
+        except Exception:
+            with self._stats_lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self.in_flight -= 1
+                self.total_seconds += time.monotonic() - started
+
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            return {
+                'pool_size': self.con_pool_size,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'total': self.total,
+                'errors': self.errors,
+                'avg_ms': (self.total_seconds / self.total * 1000) if self.total else 0.0,
+            }
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_bot(token: str, pool_size: int = None, connect_timeout: float = None, read_timeout: float = None) -> Bot:
+    """
+    获取 token 对应的共享 Bot（首次调用时创建）
+
+    Args:
+        pool_size: 连接池大小（Updater 需要 workers + 4）；已创建的客户端不会被替换，池偏小时记录警告
+    """
+    if not token:
+        raise ValueError("❌ Bot token 为空")
+    with _clients_lock:
+        bot = _clients.get(token)
+        if bot is None:
+            request = _MeteredRequest(
+                con_pool_size=max(pool_size or 0, BOT_CLIENT_POOL_SIZE),
+                connect_timeout=connect_timeout or BOT_CLIENT_CONNECT_TIMEOUT,
+                read_timeout=read_timeout or BOT_CLIENT_READ_TIMEOUT,
+            )
+            bot = _clients[token] = Bot(token=token, request=request)
+        elif pool_size and bot.request.con_pool_size < pool_size:
+            logging.warning(f"⚠️ Bot 客户端 {token[:10]}... 连接池 {bot.request.con_pool_size} 小于请求的 {pool_size}，"
+                            f"请确保 Updater 最先创建客户端")
+        return bot
+
+
+def client_metrics() -> dict:
+    """各客户端连接池与请求统计：{token 前缀: {...}}"""
+    with _clients_lock:
+        clients = list(_clients.items())
+    return {f"{token.split(':')[0]}": bot.request.snapshot() for token, bot in clients}
+
+
+def format_client_metrics() -> str:
+    """诊断命令用的客户端统计文本（每个客户端一行）"""
+    lines = []
+    for bot_id, m in client_metrics().items():
+        lines.append(f"• {bot_id}：在途 {m['in_flight']}/{m['pool_size']}（峰值 {m['peak_in_flight']}）"
+                     f" · 请求 {m['total']} · 失败 {m['errors']} · 平均 {m['avg_ms']:.0f}ms")
+    return "\n".join(lines) or "• 暂无客户端"
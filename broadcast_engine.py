@@ -0,0 +1,528 @@
+"""
+群发引擎
+
+- 收件人由调用方以游标流式提供（只投影 user_id），不一次性加载全部用户
+- 令牌桶限速：同一机器人的所有群发共享一个限速器，遇到 429 RetryAfter 时整体暂停；
+  同一收件人 429 次数超过 BROADCAST_MAX_THROTTLES 记为失败
+- 网络超时等瞬时错误按指数退避重试；用户拉黑/注销/会话不存在记为 blocked，交给调用方记录
+- 进度回调按时间节流，只在调度线程中调用
+- 异步发送（async_send）：send 返回 Future，调度线程自己维持最多 BROADCAST_IN_FLIGHT 条在途消息，
+  完成、重试与结果记录都在调度线程中处理，整个群发只占一个线程
+- 任务通过 submit_job 在专用线程池中执行，不占用 job_queue（APScheduler）的线程
+- 可选持久化任务（BroadcastJobStore）：收件人按 user_id 顺序派发，派发前写入投递记录（唯一索引占位），
+  检查点随进度保存；重启后从检查点续跑，已占位的收件人不会重复发送
+"""
+import os
+import time
+import heapq
+import queue
+import logging
+import itertools
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from telegram.error import RetryAfter, TimedOut, NetworkError, Unauthorized, BadRequest, ChatMigrated
+
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))                       # 每秒最多发送条数（Telegram 全局约 30/s）
+BROADCAST_BURST = int(os.getenv('BROADCAST_BURST', '5'))                        # 令牌桶容量
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))                    # 并发发送线程数
+BROADCAST_IN_FLIGHT = int(os.getenv('BROADCAST_IN_FLIGHT', '32'))                # 异步发送时单个群发同时在途的消息数
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))            # 瞬时错误重试次数
+BROADCAST_MAX_THROTTLES = int(os.getenv('BROADCAST_MAX_THROTTLES', '5'))        # 单个收件人最多等待 429 的次数
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))  # 进度刷新间隔（秒）
+BROADCAST_JOB_THREADS = int(os.getenv('BROADCAST_JOB_THREADS', '2'))            # 同时执行的群发任务数
+
+SENT = 'sent'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+SENDING = 'sending'      # 已占位、发送结果未落库
+UNKNOWN = 'unknown'      # 进程中断时处于 sending 的收件人：可能已送达，不再重发
+
+JOB_RUNNING = 'running'
+JOB_PAUSED = 'paused'
+JOB_CANCELLED = 'cancelled'
+JOB_DONE = 'done'
+
+# 视为“用户不可达”的 BadRequest 描述（小写匹配）
+UNREACHABLE_ERRORS = ('chat not found', 'user is deactivated', 'bot was blocked', 'peer_id_invalid',
+                      'bot can\'t initiate conversation', 'user not found')
+
+
+class RateLimiter:
+    """线程安全的令牌桶；hold() 让所有等待者暂停到指定时间之后（用于 RetryAfter）"""
+    def __init__(self, rate: float = BROADCAST_RATE, burst: int = BROADCAST_BURST):
+        self.rate = max(rate, 0.1)
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._hold_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, should_stop=None) -> bool:
+        """取一个令牌，必要时阻塞；should_stop() 为真时放弃并返回 False"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._hold_until:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return True
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._hold_until - now
+            if should_stop and should_stop():
+                return False
+            time.sleep(min(wait, 1.0))
+
+    def hold(self, seconds: float):
+        """收到 429 后整体暂停 seconds 秒，恢复时令牌清零避免再次突发"""
+        with self._lock:
+            until = time.monotonic() + max(seconds, 0)
+            if until > self._hold_until:
+                self._hold_until = until
+                self._tokens = 0.0
+                self._updated = until
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(key, rate: float = BROADCAST_RATE, burst: int = BROADCAST_BURST) -> RateLimiter:
+    """按机器人（token 或 bot_id）共享的限速器，同一机器人的并发群发共用一个速率上限"""
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(rate, burst)
+        return limiter
+
+
+def is_unreachable(error) -> bool:
+    """判断发送异常是否表示用户不可达（拉黑/注销/从未开始会话）"""
+    if isinstance(error, Unauthorized):
+        return True
+    if isinstance(error, BadRequest):
+        message = str(error).lower()
+        return any(key in message for key in UNREACHABLE_ERRORS)
+    return False
+
+
+def _retry_policy(error, attempt: int, throttled: int, limiter: RateLimiter,
+                  retries: int = BROADCAST_MAX_RETRIES, max_throttles: int = BROADCAST_MAX_THROTTLES):
+    """
+    发送异常的处理判定（deliver 与异步派发共用）
+
+    Returns:
+        (status, delay, attempt, throttled)：status 为 None 表示 delay 秒后重发
+    """
+    if isinstance(error, RetryAfter):
+        # 429 单独计数（不占网络错误重试次数）：暂停整个机器人的发送后重发，超过上限记为失败
+        limiter.hold(float(error.retry_after) + 0.5)
+        throttled += 1
+        return (FAILED if throttled > max_throttles else None), 0, attempt, throttled
+    if isinstance(error, (Unauthorized, BadRequest)):
+        return (BLOCKED if is_unreachable(error) else FAILED), 0, attempt, throttled
+    if isinstance(error, (TimedOut, NetworkError)):
+        attempt += 1
+        return (FAILED if attempt > retries else None), min(2 ** attempt, 30), attempt, throttled
+    return FAILED, 0, attempt, throttled
+
+
+def deliver(send, chat_id, limiter: RateLimiter, retries: int = BROADCAST_MAX_RETRIES, should_stop=None,
+            max_throttles: int = BROADCAST_MAX_THROTTLES):
+    """
+    向单个用户发送一次（含限速与重试）
+
+    Returns:
+        (status, error)：status 为 SENT / FAILED / BLOCKED；should_stop 中断时返回 (None, None)
+    """
+    attempt = throttled = 0
+    while True:
+        if not limiter.acquire(should_stop):
+            return None, None
+        try:
+            send(chat_id)
+            return SENT, None
+        except ChatMigrated as e:
+            chat_id = e.new_chat_id
+            continue
+        except Exception as e:
+            status, delay, attempt, throttled = _retry_policy(e, attempt, throttled, limiter, retries, max_throttles)
+            if status is not None:
+                return status, e
+            if delay:
+                time.sleep(delay)
+
+
+class BroadcastStats:
+    """群发统计（线程安全）"""
+    def __init__(self, total: int = 0):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.stopped = False     # should_stop 中断派发（收件人未取完）
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, status, count: int = 1):
+        with self._lock:
+            if status == SENT:
+                self.sent += count
+            elif status == BLOCKED:
+                self.blocked += count
+            elif status in (FAILED, UNKNOWN):
+                self.failed += count
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.time() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {'total': self.total, 'sent': self.sent, 'failed': self.failed,
+                'blocked': self.blocked, 'done': self.done}
+
+
+_END = object()
+
+
+def _run_async(recipients, send, limiter: RateLimiter, stats: BroadcastStats, in_flight: int,
+               finish, report, should_stop=None, claim=None):
+    """
+    异步派发：send(chat_id) 返回 Future，调度线程维持最多 in_flight 条在途消息
+
+    发送完成回调只把结果放入队列；结果判定、退避重试（最小堆按到期时间）与 finish 都在调度线程中执行
+    """
+    done = queue.Queue()
+    retry = []
+    seq = itertools.count()
+    recipients = iter(recipients)
+    pending = 0
+    exhausted = False
+
+    def submit(item):
+        nonlocal pending
+        pending += 1
+        try:
+            future = send(item['target'])
+        except Exception as e:
+            done.put((item, e))
+            return
+
+        def _done(f):
+            done.put((item, CancelledError() if f.cancelled() else f.exception()))
+        future.add_done_callback(_done)
+
+    def handle(item, error):
+        nonlocal pending
+        pending -= 1
+        if error is None:
+            finish(item['chat_id'], SENT, None)
+            return
+        if isinstance(error, ChatMigrated):
+            item['target'] = error.new_chat_id
+            heapq.heappush(retry, (time.monotonic(), next(seq), item))
+            return
+        status, delay, item['attempt'], item['throttled'] = _retry_policy(
+            error, item['attempt'], item['throttled'], limiter)
+        if status is None:
+            heapq.heappush(retry, (time.monotonic() + delay, next(seq), item))
+        else:
+            finish(item['chat_id'], status, error)
+
+    while True:
+        while True:
+            try:
+                handle(*done.get_nowait())
+            except queue.Empty:
+                break
+
+        if pending < in_flight:
+            item = None
+            if retry and retry[0][0] <= time.monotonic():
+                item = heapq.heappop(retry)[2]
+            elif not exhausted:
+                if should_stop and should_stop():
+                    stats.stopped = exhausted = True
+                else:
+                    chat_id = next(recipients, _END)
+                    if chat_id is _END:
+                        exhausted = True
+                    elif not claim or claim(chat_id):
+                        item = {'chat_id': chat_id, 'target': chat_id, 'attempt': 0, 'throttled': 0}
+            if item is not None:
+                # 已派发的收件人总是发完（暂停/取消只停止派发），保证占位记录都有结果
+                limiter.acquire()
+                submit(item)
+                report()
+                continue
+            if not exhausted:
+                continue
+
+        if exhausted and not pending and not retry:
+            break
+        timeout = 1.0
+        if retry and pending < in_flight:
+            timeout = min(timeout, max(retry[0][0] - time.monotonic(), 0.01))
+        try:
+            handle(*done.get(timeout=timeout))
+        except queue.Empty:
+            pass
+        report()
+
+
+def run_broadcast(recipients, send, limiter: RateLimiter, total: int = 0, workers: int = BROADCAST_WORKERS,
+                  on_result=None, progress=None, should_stop=None, claim=None, stats: BroadcastStats = None,
+                  progress_interval: float = BROADCAST_PROGRESS_INTERVAL, async_send: bool = False,
+                  in_flight: int = BROADCAST_IN_FLIGHT) -> BroadcastStats:
+    """
+    执行一次群发（阻塞直到全部完成或被停止）
+
+    Args:
+        recipients: 可迭代的 chat_id（建议为只投影 user_id 的游标生成器）
+        send: send(chat_id)，发送失败时抛出 telegram 异常；async_send 时返回 concurrent.futures.Future
+        on_result: on_result(chat_id, status, error)，在发送线程中调用（记录拉黑用户等；async_send 时在调度线程中调用）
+        progress: progress(stats)，在调度线程中按 progress_interval 节流调用，结束时再调用一次
+        should_stop: 返回 True 时停止派发新的收件人（已在发送中的会完成）
+        claim: claim(chat_id) -> bool，在调度线程中派发前调用，返回 False 时跳过该收件人
+        stats: 续跑时传入已有统计
+        async_send: 不占用发送线程，由调度线程维持最多 in_flight 条在途消息
+    """
+    stats = stats or BroadcastStats(total)
+    last_progress = time.time()
+
+    def finish(chat_id, status, error):
+        stats.add(status)
+        if status == FAILED:
+            logging.warning(f"⚠️ 群发失败 {chat_id}：{error}")
+        if on_result:
+            try:
+                on_result(chat_id, status, error)
+            except Exception as e:
+                logging.error(f"❌ 记录群发结果失败 {chat_id}：{e}")
+
+    def report(force=False):
+        nonlocal last_progress
+        if progress and (force or time.time() - last_progress >= progress_interval):
+            last_progress = time.time()
+            try:
+                progress(stats)
+            except Exception as e:
+                logging.warning(f"⚠️ 群发进度更新失败：{e}")
+
+    if async_send:
+        _run_async(recipients, send, limiter, stats, max(1, in_flight), finish, report, should_stop, claim)
+        report(force=True)
+        return stats
+
+    workers = max(1, workers)
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def task(chat_id):
+        try:
+            # 已派发的收件人总是发完（暂停/取消只停止派发），保证占位记录都有结果
+            status, error = deliver(send, chat_id, limiter)
+            finish(chat_id, status, error)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast') as executor:
+        for chat_id in recipients:
+            if should_stop and should_stop():
+                stats.stopped = True
+                break
+            # 在途任务有上限，收件人游标按发送速度推进
+            while not slots.acquire(timeout=1):
+                report()
+            if claim and not claim(chat_id):
+                slots.release()
+                continue
+            executor.submit(task, chat_id)
+            report()
+        # 等待在途任务结束，期间继续节流刷新进度
+        for _ in range(workers * 2):
+            while not slots.acquire(timeout=1):
+                report()
+    report(force=True)
+    return stats
+
+
+class BroadcastJobStore:
+    """
+    群发任务持久化
+
+    jobs：{kind, owner, payload, status, total, checkpoint, stats, created_at, updated_at, finished_at, ...}
+    deliveries：每个收件人一条 {job_id, chat_id, status, error, at}，(job_id, chat_id) 唯一
+    """
+    def __init__(self, jobs, deliveries):
+        self.jobs = jobs
+        self.deliveries = deliveries
+
+    def ensure_indexes(self):
+        try:
+            self.deliveries.create_index([('job_id', 1), ('chat_id', 1)], unique=True)
+            self.deliveries.create_index([('job_id', 1), ('status', 1)])
+            self.jobs.create_index([('kind', 1), ('status', 1), ('created_at', -1)])
+        except Exception as e:
+            logging.error(f"❌ 群发任务索引初始化失败：{e}")
+
+    @staticmethod
+    def _oid(job_id):
+        return job_id if isinstance(job_id, ObjectId) else ObjectId(str(job_id))
+
+    def create(self, kind: str, owner, payload: dict, total: int, **extra) -> ObjectId:
+        """创建任务（状态 running，检查点为空）"""
+        now = datetime.now()
+        doc = dict(extra, kind=kind, owner=owner, payload=payload, status=JOB_RUNNING, total=total,
+                   checkpoint=None, stats={'total': total, 'sent': 0, 'failed': 0, 'blocked': 0, 'done': 0},
+                   created_at=now, updated_at=now)
+        return self.jobs.insert_one(doc).inserted_id
+
+    def get(self, job_id):
+        return self.jobs.find_one({'_id': self._oid(job_id)})
+
+    def set_status(self, job_id, status: str, only_from=None) -> bool:
+        """切换任务状态；only_from 限定当前状态（如只允许 running → paused）"""
+        query = {'_id': self._oid(job_id)}
+        if only_from:
+            query['status'] = {'$in': list(only_from)}
+        update = {'status': status, 'updated_at': datetime.now()}
+        if status in (JOB_DONE, JOB_CANCELLED):
+            update['finished_at'] = datetime.now()
+        return self.jobs.update_one(query, {'$set': update}).modified_count > 0
+
+    def update(self, job_id, fields: dict):
+        self.jobs.update_one({'_id': self._oid(job_id)}, {'$set': dict(fields, updated_at=datetime.now())})
+
+    def claim(self, job_id, chat_id) -> bool:
+        """派发前占位；已有记录（已发送或曾经占位）时返回 False"""
+        try:
+            self.deliveries.insert_one({'job_id': self._oid(job_id), 'chat_id': chat_id,
+                                        'status': SENDING, 'at': datetime.now()})
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def finish(self, job_id, chat_id, status: str, error=None):
+        update = {'status': status, 'at': datetime.now()}
+        if error is not None:
+            update['error'] = str(error)[:200]
+        self.deliveries.update_one({'job_id': self._oid(job_id), 'chat_id': chat_id}, {'$set': update})
+
+    def recover(self, job_id) -> int:
+        """把上次中断时仍处于 sending 的收件人标记为 unknown（不重发，避免重复送达）"""
+        return self.deliveries.update_many({'job_id': self._oid(job_id), 'status': SENDING},
+                                           {'$set': {'status': UNKNOWN}}).modified_count
+
+    def count_statuses(self, job_id) -> dict:
+        pipeline = [{'$match': {'job_id': self._oid(job_id)}},
+                    {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]
+        return {row['_id']: row['count'] for row in self.deliveries.aggregate(pipeline)}
+
+    def list(self, kind: str = None, limit: int = 10, **filters) -> list:
+        query = dict(filters)
+        if kind:
+            query['kind'] = kind
+        return list(self.jobs.find(query, {'payload': 0}).sort('created_at', -1).limit(limit))
+
+    def active(self, kind: str = None, **filters) -> list:
+        """运行中/已暂停的任务"""
+        return self.list(kind, limit=50, status={'$in': [JOB_RUNNING, JOB_PAUSED]}, **filters)
+
+
+_job_executor = ThreadPoolExecutor(max_workers=max(1, BROADCAST_JOB_THREADS), thread_name_prefix='broadcast-job')
+
+
+def submit_job(fn, *args, **kwargs):
+    """把长时间运行的群发任务交给专用线程池执行（job_queue 回调只负责提交，立即返回）"""
+    def run():
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logging.error(f"❌ 群发任务执行失败：{e}")
+    return _job_executor.submit(run)
+
+
+_active_jobs = set()
+_active_jobs_cond = threading.Condition()
+
+
+def run_job(store: BroadcastJobStore, job_id, recipients, send, limiter: RateLimiter,
+            on_result=None, progress=None, workers: int = BROADCAST_WORKERS, async_send: bool = False):
+    """
+    执行（或续跑）持久化群发任务，阻塞直到完成、暂停或取消
+
+    同一任务在本进程内同时只有一个执行者：暂停后立即继续时，新的执行等待上一次执行把在途收件人发完，
+    再从检查点接着发送（上一次执行返回 running，表示已交给新的执行）。
+
+    Args:
+        recipients: recipients(after) -> 按 chat_id 升序、只含 chat_id > after 的可迭代对象（after 为 None 表示从头开始）
+        progress: progress(stats, status)，按时间节流调用
+        async_send: send 返回 Future，由调度线程维持在途消息（见 run_broadcast）
+    Returns:
+        (最终状态, BroadcastStats)；任务不存在或已不在运行中时统计为 None
+    """
+    key = str(job_id)
+    with _active_jobs_cond:
+        while key in _active_jobs:
+            _active_jobs_cond.wait()
+        _active_jobs.add(key)
+    try:
+        job = store.get(job_id)
+        if job is None or job['status'] != JOB_RUNNING:
+            return (job or {}).get('status'), None
+        recovered = store.recover(job_id)
+        if recovered:
+            logging.warning(f"⚠️ 群发任务 {key} 有 {recovered} 个收件人在中断时结果未知，续跑时跳过")
+
+        stats = BroadcastStats(job.get('total', 0))
+        for status, count in store.count_statuses(job_id).items():
+            stats.add(status, count)
+        state = {'status': JOB_RUNNING, 'checkpoint': job.get('checkpoint')}
+
+        def claim(chat_id):
+            if not store.claim(job_id, chat_id):
+                return False
+            state['checkpoint'] = chat_id
+            return True
+
+        def result(chat_id, status, error):
+            store.finish(job_id, chat_id, status, error)
+            if on_result:
+                on_result(chat_id, status, error)
+
+        def report(current):
+            # 保存检查点并读取最新状态（管理员暂停/取消在此生效）
+            store.update(job_id, {'checkpoint': state['checkpoint'], 'stats': current.as_dict()})
+            latest = store.jobs.find_one({'_id': store._oid(job_id)}, {'status': 1})
+            state['status'] = (latest or {}).get('status', JOB_CANCELLED)
+            if progress:
+                progress(current, state['status'])
+
+        run_broadcast(recipients(job.get('checkpoint')), send, limiter, workers=workers,
+                      on_result=result, progress=report, claim=claim, stats=stats,
+                      should_stop=lambda: state['status'] != JOB_RUNNING, async_send=async_send)
+
+        # 只有收件人全部取完才算完成；中途停止时以数据库中的最新状态为准（可能已被继续，交给新的执行）
+        if not stats.stopped and store.set_status(job_id, JOB_DONE, only_from=[JOB_RUNNING, JOB_PAUSED]):
+            state['status'] = JOB_DONE
+        else:
+            state['status'] = (store.get(job_id) or {}).get('status', JOB_CANCELLED)
+        store.update(job_id, {'checkpoint': state['checkpoint'], 'stats': stats.as_dict()})
+        logging.info(f"📤 群发任务 {key} 结束：{state['status']} {stats.as_dict()}")
+        return state['status'], stats
+    finally:
+        with _active_jobs_cond:
+            _active_jobs.discard(key)
+            _active_jobs_cond.notify_all()
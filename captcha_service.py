@@ -0,0 +1,110 @@
+"""
+图片验证码预生成池
+
+- 验证码图片由后台线程预先渲染（PNG 字节 + 答案 + 选项），发送时直接从池中取出，不在处理线程上绘图
+- 字体只加载一次；噪点按颜色分批一次性绘制，避免逐点调用
+- 池在首次取用时启动（验证码功能关闭时不占用 CPU），取空时当场生成一张兜底
+"""
+import os
+import random
+import logging
+import threading
+from collections import deque
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+CAPTCHA_POOL_SIZE = int(os.getenv('CAPTCHA_POOL_SIZE', '50'))        # 预生成验证码数量
+CAPTCHA_FONT = os.getenv('CAPTCHA_FONT', 'arial.ttf')                # 验证码字体（找不到时使用默认字体）
+
+WIDTH, HEIGHT = 300, 150
+NOISE_POINTS = 200
+NOISE_COLORS = 8   # 噪点颜色分组数（每组一次 draw.point）
+
+
+class CaptchaPool:
+    """验证码预生成池"""
+    def __init__(self, size: int = CAPTCHA_POOL_SIZE, font_path: str = CAPTCHA_FONT):
+        self.size = size
+        self.font_path = font_path
+        self._font = None
+        self._pool = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def font(self):
+        if self._font is None:
+            try:
+                self._font = ImageFont.truetype(self.font_path, 60)
+            except Exception:
+                logging.warning(f"⚠️ 验证码字体 {self.font_path} 加载失败，使用默认字体")
+                self._font = ImageFont.load_default()
+        return self._font
+
+    def render(self) -> tuple:
+        """渲染一张验证码，返回 (PNG 字节, 答案, 打乱后的 3 个选项)"""
+        code = ''.join(random.choices('0123456789', k=4))
+        image = Image.new('RGB', (WIDTH, HEIGHT), color='white')
+        draw = ImageDraw.Draw(image)
+
+        # 背景噪点：按颜色分组，每组一次绘制
+        points = list(zip(random.choices(range(WIDTH), k=NOISE_POINTS), random.choices(range(HEIGHT), k=NOISE_POINTS)))
+        step = NOISE_POINTS // NOISE_COLORS
+        for i in range(0, NOISE_POINTS, step):
+            draw.point(points[i:i + step], fill=tuple(random.randint(200, 255) for _ in range(3)))
+
+        # 验证码数字
+        char_width = WIDTH // 4
+        for i, char in enumerate(code):
+            color = (random.randint(50, 150), random.randint(100, 200), random.randint(50, 150))
+            draw.text((i * char_width + char_width // 2 - 15, HEIGHT // 2 - 30), char, font=self.font, fill=color)
+
+        # 干扰线
+        for _ in range(5):
+            draw.line([(random.randint(0, WIDTH), random.randint(0, HEIGHT)),
+                       (random.randint(0, WIDTH), random.randint(0, HEIGHT))],
+                      fill=tuple(random.randint(150, 200) for _ in range(3)), width=2)
+
+        buf = BytesIO()
+        image.save(buf, format='PNG')
+
+        options = {code}
+        while len(options) < 3:
+            options.add(''.join(random.choices('0123456789', k=4)))
+        options = list(options)
+        random.shuffle(options)
+        return buf.getvalue(), code, options
+
+    def _refill_loop(self):
+        while True:
+            with self._cond:
+                while len(self._pool) >= self.size:
+                    self._cond.wait()
+            try:
+                item = self.render()
+            except Exception as e:
+                logging.error(f"❌ 生成验证码失败：{e}")
+                threading.Event().wait(5)
+                continue
+            with self._cond:
+                self._pool.append(item)
+
+    def start(self):
+        """启动后台补充线程（重复调用无副作用）"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refill_loop, daemon=True, name='CaptchaPool')
+                self._thread.start()
+                logging.info(f"✅ 验证码预生成池已启动（容量 {self.size}）")
+
+    def pop(self) -> tuple:
+        """取出一张验证码 (PNG 字节, 答案, 选项)；池空时当场生成"""
+        self.start()
+        with self._cond:
+            item = self._pool.popleft() if self._pool else None
+            self._cond.notify()
+        return item or self.render()
+
+
+captcha_pool = CaptchaPool()
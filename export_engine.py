@@ -0,0 +1,404 @@
+"""
+流式导出引擎
+
+- 游标分批读取，每批一次 $in 关联用户信息
+- 逐行写入文件（xlsx constant_memory / csv / csv.gz），内存占用与总行数无关
+- 导出在独立线程池中执行，完成后把文件发送给管理员，不占用 dispatcher 工作线程
+- 大表按时间范围分块，多个游标并行读取、按顺序拼装；输出超过 Telegram 上传上限时自动分卷
+"""
+import io
+import os
+import csv
+import gzip
+import queue
+import shutil
+import logging
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import xlsxwriter
+
+from mongo import user, parse_legacy_timer
+from outbound_sender import outbound
+
+EXPORT_FORMAT = os.getenv('EXPORT_FORMAT', 'xlsx').lower()          # xlsx / csv / csv.gz
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '2000'))
+EXPORT_MAX_WORKERS = int(os.getenv('EXPORT_MAX_WORKERS', '2'))
+EXPORT_PROGRESS_INTERVAL = float(os.getenv('EXPORT_PROGRESS_INTERVAL', '5'))
+EXPORT_CHUNK_WORKERS = int(os.getenv('EXPORT_CHUNK_WORKERS', '4'))        # 每个导出任务的并行游标数
+EXPORT_CHUNK_DAYS = int(os.getenv('EXPORT_CHUNK_DAYS', '7'))              # 每个时间分块的天数
+EXPORT_CHUNK_PREFETCH = int(os.getenv('EXPORT_CHUNK_PREFETCH', '4'))      # 每个分块最多预读的批次数
+EXPORT_SPLIT_MB = float(os.getenv('EXPORT_SPLIT_MB', '45'))               # 单个文件大小上限（Telegram 上传上限 50MB）
+EXPORT_XLSX_COMPRESSION = float(os.getenv('EXPORT_XLSX_COMPRESSION', '3'))  # xlsx 估算压缩比
+
+XLSX_MAX_ROWS = 1048576  # Excel 单个工作表行数上限（含表头）
+
+USER_JOIN_PROJECTION = {'_id': 0, 'user_id': 1, 'username': 1, 'fullname': 1, 'USDT': 1, 'state': 1}
+
+_export_executor = ThreadPoolExecutor(max_workers=EXPORT_MAX_WORKERS, thread_name_prefix='export')
+_chunk_executor = ThreadPoolExecutor(max_workers=max(1, EXPORT_MAX_WORKERS * EXPORT_CHUNK_WORKERS),
+                                     thread_name_prefix='export-chunk')
+_running_exports = set()
+_running_lock = threading.Lock()
+
+
+def iter_batches(cursor, size=EXPORT_BATCH_SIZE):
+    """把游标切成固定大小的批次"""
+    batch = []
+    for doc in cursor.batch_size(size):
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def time_bounds(collection, field, query=None):
+    """返回 query 范围内 field 的最早/最晚时间（datetime），无数据时返回 (None, None)"""
+    bounded = {field: {'$type': ['string', 'date'], '$nin': ['', None]}}
+    query = {'$and': [query, bounded]} if query else bounded
+    first = collection.find_one(query, {'_id': 0, field: 1}, sort=[(field, 1)])
+    last = collection.find_one(query, {'_id': 0, field: 1}, sort=[(field, -1)])
+    if not first or not last:
+        return None, None
+    return parse_legacy_timer(first.get(field)), parse_legacy_timer(last.get(field))
+
+
+def time_chunks(start, end, days=EXPORT_CHUNK_DAYS, descending=True):
+    """把 [start, end) 切成若干 (chunk_start, chunk_end)，按导出顺序排列"""
+    step = timedelta(days=max(1, days))
+    chunks = []
+    cursor = start
+    while cursor < end:
+        chunks.append((cursor, min(cursor + step, end)))
+        cursor += step
+    return chunks[::-1] if descending else chunks
+
+
+def iter_chunked_batches(collection, query, field, range_filter=None, projection=None,
+                         descending=True, size=EXPORT_BATCH_SIZE, days=EXPORT_CHUNK_DAYS,
+                         workers=EXPORT_CHUNK_WORKERS, progress=None):
+    """
+    按时间分块并行读取，按时间顺序产出批次
+
+    每个分块一个独立游标，在线程池中预读（每块最多 EXPORT_CHUNK_PREFETCH 批，内存有上限），
+    消费端按分块顺序依次取出，因此分块内的输出顺序与单游标 sort(field) 一致。
+    时间字段缺失、格式不一致或类型不同（落在所有分块范围之外）的记录放在最后一个“剩余”游标中读取，
+    导出行数与单游标读取完全相同。
+
+    Args:
+        field: 排序/分块字段
+        range_filter: range_filter(start, end) -> dict，默认 {field: {'$gte': start, '$lt': end}}
+        progress: progress(done_chunks, total_chunks)
+    """
+    order = -1 if descending else 1
+    start, end = time_bounds(collection, field, query)
+    if start is None or end is None:
+        # 时间字段无法解析时退回单游标顺序读取
+        yield from iter_batches(collection.find(query or {}, projection).sort(field, order), size)
+        return
+    end += timedelta(seconds=1)
+    if range_filter is None:
+        range_filter = lambda s, e: {field: {'$gte': s, '$lt': e}}
+    # 各分块首尾相接，并集即 [start, end)；剩余游标读取其补集
+    filters = [range_filter(*chunk) for chunk in time_chunks(start, end, days, descending)]
+    filters.append({'$nor': [range_filter(start, end)]})
+    cancelled = threading.Event()
+
+    def put(out, item):
+        """放入预读队列；消费端已取消时放弃（不阻塞线程池）"""
+        while not cancelled.is_set():
+            try:
+                out.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch(chunk_filter, out):
+        try:
+            chunk_query = {'$and': [query, chunk_filter]} if query else chunk_filter
+            cursor = collection.find(chunk_query, projection).sort(field, order)
+            for batch in iter_batches(cursor, size):
+                if not put(out, batch):
+                    return
+        except Exception as e:
+            put(out, e)
+            return
+        put(out, None)
+
+    # 滑动窗口：同时最多 workers 个分块在读，消费完一个再提交下一个
+    pending = []
+    next_index = 0
+    try:
+        for done in range(len(filters)):
+            while next_index < len(filters) and len(pending) < max(1, workers):
+                out = queue.Queue(maxsize=EXPORT_CHUNK_PREFETCH)
+                _chunk_executor.submit(fetch, filters[next_index], out)
+                pending.append(out)
+                next_index += 1
+            out = pending.pop(0)
+            while True:
+                item = out.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            if progress:
+                progress(done + 1, len(filters))
+    finally:
+        cancelled.set()
+
+
+def join_users(docs, key='user_id', projection=None):
+    """为一批记录一次性查询用户信息，返回 {user_id: user_doc}"""
+    ids = list({d.get(key) for d in docs if d.get(key) is not None})
+    if not ids:
+        return {}
+    return {u['user_id']: u for u in user.find({'user_id': {'$in': ids}}, projection or USER_JOIN_PROJECTION)}
+
+
+def clean_name(value):
+    """去掉姓名中的尖括号（与原导出保持一致）"""
+    return str(value or '').replace('<', '').replace('>', '')
+
+
+class _XlsxSheet:
+    """constant_memory 工作表：按行顺序写入，超过 Excel 行数上限时自动续表"""
+    def __init__(self, workbook, name, columns):
+        self.workbook = workbook
+        self.name = name
+        self.columns = columns
+        self.part = 1
+        self._open(name)
+
+    def _open(self, title):
+        self.ws = self.workbook.add_worksheet(title[:31])
+        for i, (col, width) in enumerate(self.columns):
+            self.ws.set_column(i, i, width)
+            self.ws.write(0, i, col)
+        self.row = 1
+
+    def write_row(self, values):
+        if self.row >= XLSX_MAX_ROWS:
+            self.part += 1
+            self._open(f"{self.name}_{self.part}")
+        for i, value in enumerate(values):
+            self.ws.write(self.row, i, value)
+        self.row += 1
+
+
+class _CsvSheet:
+    """CSV 工作表：每个工作表一个文件（可选 gzip），按实际写入字节计算大小"""
+    def __init__(self, path, columns, compress):
+        self.path = path
+        self.raw = open(path, 'wb')
+        self.gz = gzip.GzipFile(fileobj=self.raw, mode='wb') if compress else None
+        self.fh = io.TextIOWrapper(self.gz or self.raw, encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.fh)
+        self.writer.writerow([col for col, _ in columns])
+
+    def write_row(self, values):
+        self.writer.writerow(values)
+
+    def size(self):
+        return self.raw.tell()
+
+    def close(self):
+        self.fh.close()
+        if self.gz is not None:
+            self.raw.close()
+
+
+class _Sheet:
+    """对外的工作表句柄：写满一个分卷时在新分卷中续写（自动补表头）"""
+    def __init__(self, writer, name, columns):
+        self.writer = writer
+        self.name = name
+        self.columns = columns
+        self.rows = 0
+        self.backend = None
+        self.part = None
+
+    def write_row(self, values):
+        self.writer._before_row(self, values)
+        if self.backend is None or self.part != self.writer.part:
+            self.backend = self.writer._open_backend(self.name, self.columns)
+            self.part = self.writer.part
+        self.backend.write_row(values)
+        self.rows += 1
+
+
+class ExportWriter:
+    """
+    导出文件写入器
+
+    用法：
+        sheet = writer.sheet("订单", [("订单时间", 20), ("用户ID", 14)])
+        sheet.write_row([...])
+        paths = writer.close()
+
+    超过 max_mb 时关闭当前分卷并开启 basename_partN，后续行与后续工作表写入新分卷。
+    """
+    def __init__(self, directory, basename, fmt=EXPORT_FORMAT, max_mb=EXPORT_SPLIT_MB):
+        self.directory = directory
+        self.basename = basename
+        self.fmt = fmt if fmt in ('xlsx', 'csv', 'csv.gz') else 'xlsx'
+        self.max_bytes = int(max_mb * 1024 * 1024) if max_mb else 0
+        self.part = 1
+        self.paths = []
+        self._backends = []
+        self._workbook = None
+        self._estimated = 0
+
+    def _part_name(self, suffix=''):
+        part = f"_part{self.part}" if self.part > 1 else ''
+        return f"{self.basename}{suffix}{part}.{self.fmt}"
+
+    def _open_backend(self, name, columns):
+        if self.fmt == 'xlsx':
+            if self._workbook is None:
+                self.path = os.path.join(self.directory, self._part_name())
+                self._workbook = xlsxwriter.Workbook(self.path, {'constant_memory': True, 'tmpdir': self.directory})
+                self.paths.append(self.path)
+                self._estimated = 0
+            backend = _XlsxSheet(self._workbook, name, columns)
+        else:
+            path = os.path.join(self.directory, self._part_name(f"_{name}"))
+            backend = _CsvSheet(path, columns, compress=self.fmt == 'csv.gz')
+            self.paths.append(path)
+        self._backends.append(backend)
+        return backend
+
+    def _part_size(self, sheet):
+        if self.fmt == 'xlsx':
+            return self._estimated / max(EXPORT_XLSX_COMPRESSION, 1)
+        return sheet.backend.size() if sheet.backend is not None and sheet.part == self.part else 0
+
+    def _before_row(self, sheet, values):
+        if self.fmt == 'xlsx':
+            # 估算共享字符串/XML 开销：每个单元格约 30 字节 + 内容长度
+            self._estimated += sum(len(str(v)) + 30 for v in values)
+        if self.max_bytes and sheet.rows and self._part_size(sheet) >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        """关闭当前分卷，后续写入进入下一个分卷"""
+        self._close_part()
+        self._estimated = 0
+        self.part += 1
+        logging.info(f"📦 导出文件 {self.basename} 开始第 {self.part} 卷")
+
+    def _close_part(self):
+        if self._workbook is not None:
+            self._workbook.close()
+            self._workbook = None
+        else:
+            for backend in self._backends:
+                backend.close()
+        self._backends = []
+
+    def sheet(self, name, columns):
+        sheet = _Sheet(self, name, columns)
+        # 先建表头，保证空表也会出现在文件中
+        sheet.backend = self._open_backend(name, columns)
+        sheet.part = self.part
+        return sheet
+
+    def write_table(self, name, columns, rows):
+        """写入一个小型汇总表（rows 为字典列表，按 columns 顺序取值）"""
+        sheet = self.sheet(name, columns)
+        for row in rows:
+            sheet.write_row([row.get(col, '') for col, _ in columns])
+        return sheet
+
+    def close(self):
+        """关闭并返回生成的文件路径列表（按分卷顺序）"""
+        self._close_part()
+        return list(self.paths)
+
+
+class ExportJob:
+    """一次后台导出任务：负责进度提示（节流编辑状态消息）"""
+    def __init__(self, bot, chat_id, message_id, title):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.title = title
+        self.started = time.time()
+        self._last_progress = self.started
+
+    def progress(self, text, force=False):
+        now = time.time()
+        if not force and now - self._last_progress < EXPORT_PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        try:
+            self.bot.edit_message_text(
+                chat_id=self.chat_id, message_id=self.message_id,
+                text=f"⏳ {self.title}导出中...\n\n{text}\n⏱ 已用时 {int(now - self.started)} 秒"
+            )
+        except Exception as e:
+            logging.debug(f"导出进度更新失败：{e}")
+
+
+def submit_export(bot, chat_id, message_id, title, filename, build, done_markup=None, fmt=None):
+    """
+    提交后台导出任务
+
+    Args:
+        title: 导出名称（用于提示，同一管理员同一名称同时只允许一个任务）
+        filename: 文件名前缀（不含扩展名）
+        build: build(writer, job) -> str，写入数据并返回完成说明
+        done_markup: 完成后状态消息的按钮
+    Returns:
+        bool: 是否已提交（已有同名任务运行时返回 False）
+    """
+    key = (chat_id, title)
+    with _running_lock:
+        if key in _running_exports:
+            return False
+        _running_exports.add(key)
+
+    def run():
+        job = ExportJob(bot, chat_id, message_id, title)
+        workdir = tempfile.mkdtemp(prefix='export_')
+        try:
+            writer = ExportWriter(workdir, filename, fmt or EXPORT_FORMAT)
+            summary = build(writer, job)
+            paths = writer.close()
+            job.progress(f"📤 正在发送文件（{len(paths)} 个）...", force=True)
+            # 分卷同时在途，全部提交后统一等待结果（任一失败即按导出失败处理）
+            futures = []
+            for i, path in enumerate(paths, 1):
+                with open(path, 'rb') as fh:
+                    futures.append(outbound.send_document(
+                        bot.token, chat_id, fh, filename=os.path.basename(path),
+                        caption=summary[:1024] if len(paths) == 1 else f"📎 {i}/{len(paths)}"))
+            for future in futures:
+                future.result()
+            bot.edit_message_text(
+                chat_id=chat_id, message_id=message_id,
+                text=f"✅ {title}导出完成\n\n{summary}\n📎 文件数：{len(paths)}\n⏱ 耗时 {int(time.time() - job.started)} 秒",
+                reply_markup=done_markup
+            )
+            logging.info(f"✅ {title}导出完成：{paths}")
+        except Exception as e:
+            logging.error(f"❌ {title}导出失败：{e}")
+            try:
+                bot.edit_message_text(chat_id=chat_id, message_id=message_id,
+                                      text=f"❌ 导出失败：{e}", reply_markup=done_markup)
+            except Exception:
+                pass
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            with _running_lock:
+                _running_exports.discard(key)
+
+    _export_executor.submit(run)
+    return True
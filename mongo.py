@@ -1,8 +1,11 @@
 import json
+import pickle
 import random
 import re
 import pymongo
 from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+from pymongo import ReturnDocument
 import logging
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from datetime import datetime, timedelta
@@ -10,10 +13,19 @@ import time
 from dotenv import load_dotenv
 import os
 import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 # 加载环境变量
 load_dotenv()
 
+from bot_clients import get_bot  # 需在加载环境变量之后导入（读取 BOT_CLIENT_* 配置）
+from broadcast_engine import deliver, get_limiter, SENT
+from agent_price_sync import (  # 代理商品同步规则（与代理进程共用）
+    AGENT_SYNC_BATCH_SIZE, AGENT_SYNC_HQ_PROJECTION, AGENT_SYNC_PRICE_PROJECTION,
+    build_agent_price_ops, write_agent_price_ops, deactivate_deleted_products,
+)
+
 # ✅ 初始化日志系统
 def init_logging():
     log_dir = "logs"
@@ -50,8 +62,47 @@ class Config:
     
     # 时间配置
     STOCK_NOTIFICATION_DELAY = int(os.getenv('STOCK_NOTIFICATION_DELAY', '3'))
+    # 补货通知：持续上架时最长等待（秒）/ 同批补货达到该商品数时合并为一条汇总
+    STOCK_NOTIFICATION_MAX_WAIT = int(os.getenv('STOCK_NOTIFICATION_MAX_WAIT', '30'))
+    STOCK_NOTIFICATION_DIGEST_THRESHOLD = int(os.getenv('STOCK_NOTIFICATION_DIGEST_THRESHOLD', '5'))
     MESSAGE_DELETE_DELAY = int(os.getenv('MESSAGE_DELETE_DELAY', '3'))
-    
+
+    # 内联查询缓存配置（秒）
+    SHARE_CARD_TTL = int(os.getenv('SHARE_CARD_TTL', '30'))
+    INLINE_SHARE_CACHE_TIME = int(os.getenv('INLINE_SHARE_CACHE_TIME', '30'))
+    INLINE_WELCOME_CACHE_TIME = int(os.getenv('INLINE_WELCOME_CACHE_TIME', '300'))
+    SHANGTEXT_CACHE_TTL = int(os.getenv('SHANGTEXT_CACHE_TTL', '60'))
+    STOCK_SNAPSHOT_TTL = int(os.getenv('STOCK_SNAPSHOT_TTL', '60'))
+
+    # 库存健康/低库存预警配置
+    STOCK_ALERT_DEFAULT_THRESHOLD = int(os.getenv('STOCK_ALERT_DEFAULT_THRESHOLD', '10'))
+    STOCK_ALERT_CHECK_SECONDS = int(os.getenv('STOCK_ALERT_CHECK_SECONDS', '30'))
+    STOCK_ALERT_SWEEP_SECONDS = int(os.getenv('STOCK_ALERT_SWEEP_SECONDS', '300'))
+    STOCK_HEALTH_CACHE_TTL = int(os.getenv('STOCK_HEALTH_CACHE_TTL', '30'))
+
+    # 总部商品同步发布器配置
+    HQ_SYNC_PUBLISHER_ENABLED = os.getenv('HQ_SYNC_PUBLISHER_ENABLED', '1') in ('1', 'true', 'True')
+    HQ_SYNC_DEBOUNCE_SECONDS = float(os.getenv('HQ_SYNC_DEBOUNCE_SECONDS', '3'))
+    HQ_SYNC_FULL_INTERVAL = int(os.getenv('HQ_SYNC_FULL_INTERVAL', '600'))
+    AGENT_DEFAULT_MARKUP = float(os.getenv('AGENT_DEFAULT_MARKUP', '0.2'))
+
+    # 补货通知分发到代理补货群：开关 / 并发发送线程数
+    RESTOCK_FANOUT_ENABLED = os.getenv('RESTOCK_FANOUT_ENABLED', '1') in ('1', 'true', 'True')
+    RESTOCK_FANOUT_WORKERS = int(os.getenv('RESTOCK_FANOUT_WORKERS', '8'))
+
+    # 代理统计缓存有效期（秒）
+    AGENT_STATS_CACHE_TTL = int(os.getenv('AGENT_STATS_CACHE_TTL', '60'))
+
+    # 代理分析汇总：派生字段刷新间隔 / 按源数据全量校正间隔（秒）
+    AGENT_ANALYTICS_REFRESH_SECONDS = int(os.getenv('AGENT_ANALYTICS_REFRESH_SECONDS', '60'))
+    AGENT_ANALYTICS_RECONCILE_SECONDS = int(os.getenv('AGENT_ANALYTICS_RECONCILE_SECONDS', '1800'))
+
+    # 用户充值汇总快照有效期（秒）
+    INCOME_SUMMARY_CACHE_TTL = int(os.getenv('INCOME_SUMMARY_CACHE_TTL', '60'))
+
+    # 购买记录总数缓存有效期（秒），新增购买记录时主动失效
+    PURCHASE_COUNT_CACHE_TTL = int(os.getenv('PURCHASE_COUNT_CACHE_TTL', '300'))
+
     # 验证关键配置
     @classmethod
     def validate(cls):
@@ -74,7 +125,29 @@ RESTOCK_GROUP = Config.RESTOCK_GROUP
 BOT_TOKEN = Config.BOT_TOKEN
 NOTIFY_CHANNEL_ID = Config.NOTIFY_CHANNEL_ID
 STOCK_NOTIFICATION_DELAY = Config.STOCK_NOTIFICATION_DELAY
+STOCK_NOTIFICATION_MAX_WAIT = Config.STOCK_NOTIFICATION_MAX_WAIT
+STOCK_NOTIFICATION_DIGEST_THRESHOLD = Config.STOCK_NOTIFICATION_DIGEST_THRESHOLD
 BOT_USERNAME = Config.BOT_USERNAME
+SHARE_CARD_TTL = Config.SHARE_CARD_TTL
+INLINE_SHARE_CACHE_TIME = Config.INLINE_SHARE_CACHE_TIME
+INLINE_WELCOME_CACHE_TIME = Config.INLINE_WELCOME_CACHE_TIME
+SHANGTEXT_CACHE_TTL = Config.SHANGTEXT_CACHE_TTL
+STOCK_SNAPSHOT_TTL = Config.STOCK_SNAPSHOT_TTL
+STOCK_ALERT_DEFAULT_THRESHOLD = Config.STOCK_ALERT_DEFAULT_THRESHOLD
+STOCK_ALERT_CHECK_SECONDS = Config.STOCK_ALERT_CHECK_SECONDS
+STOCK_ALERT_SWEEP_SECONDS = Config.STOCK_ALERT_SWEEP_SECONDS
+STOCK_HEALTH_CACHE_TTL = Config.STOCK_HEALTH_CACHE_TTL
+HQ_SYNC_PUBLISHER_ENABLED = Config.HQ_SYNC_PUBLISHER_ENABLED
+HQ_SYNC_DEBOUNCE_SECONDS = Config.HQ_SYNC_DEBOUNCE_SECONDS
+HQ_SYNC_FULL_INTERVAL = Config.HQ_SYNC_FULL_INTERVAL
+RESTOCK_FANOUT_ENABLED = Config.RESTOCK_FANOUT_ENABLED
+RESTOCK_FANOUT_WORKERS = Config.RESTOCK_FANOUT_WORKERS
+AGENT_DEFAULT_MARKUP = Config.AGENT_DEFAULT_MARKUP
+AGENT_STATS_CACHE_TTL = Config.AGENT_STATS_CACHE_TTL
+INCOME_SUMMARY_CACHE_TTL = Config.INCOME_SUMMARY_CACHE_TTL
+PURCHASE_COUNT_CACHE_TTL = Config.PURCHASE_COUNT_CACHE_TTL
+AGENT_ANALYTICS_REFRESH_SECONDS = Config.AGENT_ANALYTICS_REFRESH_SECONDS
+AGENT_ANALYTICS_RECONCILE_SECONDS = Config.AGENT_ANALYTICS_RECONCILE_SECONDS
 
 # ✅ 数据库连接和集合管理优化
 class DatabaseManager:
@@ -111,6 +184,13 @@ class DatabaseManager:
         self.qb = self.bot_db['qb']
         self.zhuanz = self.bot_db['zhuanz']
         self.withdrawal_requests = self.bot_db['withdrawal_requests']
+        self.sales_rollups = self.bot_db['sales_rollups']
+        self.stock_thresholds = self.bot_db['stock_thresholds']
+        self.stock_alert_state = self.bot_db['stock_alert_state']
+        self.stock_alert_log = self.bot_db['stock_alert_log']
+        self.broadcast_jobs = self.bot_db['broadcast_jobs']
+        self.broadcast_deliveries = self.bot_db['broadcast_deliveries']
+        self.notification_outbox = self.bot_db['notification_outbox']
     
     def close(self):
         """关闭数据库连接"""
@@ -143,29 +223,600 @@ hongbao = db_manager.hongbao
 qb = db_manager.qb
 zhuanz = db_manager.zhuanz
 withdrawal_requests = db_manager.withdrawal_requests
+sales_rollups = db_manager.sales_rollups
+stock_thresholds = db_manager.stock_thresholds
+stock_alert_state = db_manager.stock_alert_state
+stock_alert_log = db_manager.stock_alert_log
+broadcast_jobs = db_manager.broadcast_jobs
+broadcast_deliveries = db_manager.broadcast_deliveries
+notification_outbox = db_manager.notification_outbox
+
+# ✅ 进程内短时缓存（热点读优化）
+class TTLCache:
+    """线程安全的短时缓存，过期条目在读取时惰性清理"""
+    def __init__(self, ttl: float, max_size: int = 2048):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """读取缓存，过期或不存在时返回 default"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expire_at, value = item
+            if expire_at < time.time():
+                self._data.pop(key, None)
+                return default
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """写入缓存，超出容量时先清理过期条目，仍超出则淘汰最早过期的条目"""
+        expire_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.max_size:
+                now = time.time()
+                for k in [k for k, (exp, _) in self._data.items() if exp < now]:
+                    self._data.pop(k, None)
+                if len(self._data) >= self.max_size:
+                    oldest = min(self._data, key=lambda k: self._data[k][0])
+                    self._data.pop(oldest, None)
+            self._data[key] = (expire_at, value)
+
+    def invalidate(self, key=None):
+        """删除指定缓存；key 为 None 时清空全部"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """按条件删除缓存（predicate 接收 key）"""
+        with self._lock:
+            for k in [k for k in self._data if predicate(k)]:
+                self._data.pop(k, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+# ✅ 商品分享卡片（inline share_<nowuid>）缓存
+class ShareCardManager:
+    """
+    缓存商品分享卡片所需数据（名称/分类/价格/库存）
+    - 缺失的卡片按批次查询：ejfl、fenlei 各一次 $in，hb 一次 $group 统计库存
+    - 库存或价格变化时调用 invalidate，同时清除依赖它的内联查询结果缓存
+    """
+    def __init__(self, ttl: float):
+        self.cards = TTLCache(ttl)
+        self.inline_results = TTLCache(ttl)
+
+    def get_cards(self, nowuids) -> dict:
+        """批量获取分享卡片数据，返回 {nowuid: card}，不存在的商品不在结果中"""
+        result = {}
+        missing = []
+        for nowuid in nowuids:
+            card = self.cards.get(nowuid)
+            if card is None:
+                missing.append(nowuid)
+            else:
+                result[nowuid] = card
+        if not missing:
+            return result
+
+        try:
+            products = list(ejfl.find(
+                {'nowuid': {'$in': missing}},
+                {'nowuid': 1, 'uid': 1, 'projectname': 1, 'money': 1, 'desc': 1}
+            ))
+            uids = list({p.get('uid') for p in products if p.get('uid')})
+            cate_map = {
+                c['uid']: c.get('projectname', '未知分类')
+                for c in fenlei.find({'uid': {'$in': uids}}, {'uid': 1, 'projectname': 1})
+            } if uids else {}
+            stock_map = {
+                s['_id']: s['count']
+                for s in hb.aggregate([
+                    {'$match': {'nowuid': {'$in': missing}, 'state': 0}},
+                    {'$group': {'_id': '$nowuid', 'count': {'$sum': 1}}}
+                ])
+            }
+        except Exception as e:
+            logging.error(f"❌ 批量获取分享卡片失败：{e}")
+            return result
+
+        for p in products:
+            card = {
+                'nowuid': p['nowuid'],
+                'projectname': p.get('projectname', '未知商品'),
+                'cate_name': cate_map.get(p.get('uid'), '未知分类'),
+                'price': float(p.get('money', 0) or 0),
+                'stock': stock_map.get(p['nowuid'], 0),
+                'desc': p.get('desc', '暂无商品说明'),
+            }
+            self.cards.set(p['nowuid'], card)
+            result[p['nowuid']] = card
+        return result
+
+    def get_card(self, nowuid: str):
+        """获取单个商品的分享卡片数据"""
+        return self.get_cards([nowuid]).get(nowuid)
+
+    def invalidate(self, nowuid: str = None):
+        """使卡片及依赖它的内联查询结果失效；nowuid 为 None 时全部失效"""
+        if nowuid is None:
+            self.cards.invalidate()
+            self.inline_results.invalidate()
+            return
+        self.cards.invalidate(nowuid)
+        self.inline_results.invalidate_where(lambda k: k[0] == f"share_{nowuid}")
+
+share_card_manager = ShareCardManager(SHARE_CARD_TTL)
+
+def get_translations(texts, translate=None) -> dict:
+    """批量读取译文：fyb 一次 $in 查询，缺失项逐个走 translate 回调（无回调则保留原文）"""
+    wanted = {t for t in texts if t}
+    known = {}
+    if not wanted:
+        return known
+    try:
+        for doc in fyb.find({'text': {'$in': list(wanted)}}, {'text': 1, 'fanyi': 1}):
+            known[doc['text']] = doc['fanyi']
+    except Exception as e:
+        logging.warning(f"⚠️ 批量读取翻译失败：{e}")
+    for text in wanted - set(known):
+        known[text] = translate(text) if translate else text
+    return known
+
+# ✅ 库存列表快照（查询库存分页）
+class StockSnapshotManager:
+    """
+    有库存商品列表的周期性快照
+    - 一次聚合完成：hb 按 nowuid $group 计数 → $lookup ejfl → $lookup fenlei（过滤已删除一级分类）
+    - 快照过期或被标记为陈旧后，下次读取时重建；翻页只切片，不再逐商品查询
+    - 非中文名称按页翻译（fyb 批量 $in 查询，缺失项走 translate 回调），译文按快照+语言缓存，翻到哪页补到哪页
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._rows = []
+        self._names = {}
+        self._built_at = 0.0
+        self._expire_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _build(self) -> list:
+        pipeline = [
+            {'$match': {'state': 0}},
+            {'$group': {'_id': '$nowuid', 'stock': {'$sum': 1}}},
+            {'$lookup': {'from': 'ejfl', 'localField': '_id', 'foreignField': 'nowuid', 'as': 'product'}},
+            {'$unwind': '$product'},
+            {'$lookup': {'from': 'fenlei', 'localField': 'product.uid', 'foreignField': 'uid', 'as': 'category'}},
+            {'$match': {'category.0': {'$exists': True}}},
+            {'$project': {
+                '_id': 0,
+                'nowuid': '$_id',
+                'stock': 1,
+                'projectname': {'$ifNull': ['$product.projectname', '未知商品']},
+                'row': '$product.row',
+                'uid': '$product.uid',
+                'cate_name': {'$arrayElemAt': ['$category.projectname', 0]},
+            }},
+            {'$sort': {'row': 1}},
+        ]
+        return list(hb.aggregate(pipeline, allowDiskUse=True))
+
+    def refresh(self):
+        """重建快照"""
+        rows = self._build()
+        with self._lock:
+            self._rows = rows
+            self._names = {}
+            self._built_at = time.time()
+            self._expire_at = self._built_at + self.ttl
+        logging.info(f"📦 库存快照已刷新：{len(rows)} 个有库存商品")
+        return rows
+
+    def mark_stale(self):
+        """标记快照陈旧（库存/价格/名称变化后调用），下次读取时重建"""
+        with self._lock:
+            self._expire_at = 0.0
+
+    def get_rows(self) -> list:
+        """获取快照（过期则重建，并发请求只重建一次）"""
+        if self._expire_at >= time.time():
+            return self._rows
+        with self._refresh_lock:
+            if self._expire_at >= time.time():
+                return self._rows
+            try:
+                return self.refresh()
+            except Exception as e:
+                logging.error(f"❌ 刷新库存快照失败：{e}")
+                return self._rows
+
+    @property
+    def built_at(self) -> float:
+        return self._built_at
+
+    def _names_for(self, rows: list, lang: str, translate=None) -> list:
+        """返回与 rows（当前页）对齐的指定语言名称列表；只翻译本页缺失的名称，结果按快照+语言缓存"""
+        originals = [r['projectname'] for r in rows]
+        if lang == 'zh':
+            return originals
+        with self._lock:
+            cache = self._names.setdefault(lang, {})
+            missing = [n for n in originals if n and n not in cache]
+        if missing:
+            known = get_translations(missing, translate)
+            with self._lock:
+                cache.update(known)
+        return [cache.get(n, n) for n in originals]
+
+    def get_page(self, page: int, limit: int, lang: str = 'zh', translate=None) -> dict:
+        """获取一页数据：{'items': [...], 'total': n, 'total_pages': n, 'page': p, 'built_at': ts}"""
+        rows = self.get_rows()
+        total = len(rows)
+        total_pages = max((total + limit - 1) // limit, 1)
+        page = min(max(page, 0), total_pages - 1)
+        start = page * limit
+        page_rows = rows[start:start + limit]
+        names = self._names_for(page_rows, lang, translate)
+        items = [dict(row, display_name=name) for row, name in zip(page_rows, names)]
+        return {'items': items, 'total': total, 'total_pages': total_pages, 'page': page, 'built_at': self._built_at}
+
+stock_snapshot = StockSnapshotManager(STOCK_SNAPSHOT_TTL)
+
+STOCK_LEVEL_RANK = {'ok': 0, 'low': 1, 'out': 2}
+
+class StockHealthService:
+    """
+    库存健康与低库存预警
+    - 一次 hb 聚合得到每个商品的可用/已售数量，分类数据由商品行汇总
+    - 阈值：stock_thresholds 中 _id='default' 为全局阈值，_id=nowuid 为单品阈值
+    - 库存变化（notify_product_changed）登记待检查商品，由定时任务检查是否跨过阈值；
+      stock_alert_state 记录已提醒的级别，同一级别只提醒一次，补货恢复后清除
+    - 首次检查（stock_alert_state 为空）总是全量建立基线，只为本轮登记过变化的商品推送，历史缺货不批量推送
+    """
+    DEFAULT_ID = 'default'
+
+    def __init__(self, default_threshold: int, cache_ttl: float):
+        self.fallback_threshold = default_threshold
+        self._report_cache = TTLCache(cache_ttl)
+        self._threshold_cache = TTLCache(60)
+        self._dirty = set()
+        self._full_requested = False
+        self._baselined = False
+        self._lock = threading.Lock()
+
+    # ---------- 阈值 ----------
+    def thresholds(self):
+        """返回 (全局阈值, {nowuid: 单品阈值})"""
+        cached = self._threshold_cache.get('all')
+        if cached is not None:
+            return cached
+        default = self.fallback_threshold
+        per_product = {}
+        for doc in stock_thresholds.find({}, {'threshold': 1}):
+            if doc['_id'] == self.DEFAULT_ID:
+                default = int(doc.get('threshold', default))
+            else:
+                per_product[doc['_id']] = int(doc.get('threshold', default))
+        cached = (default, per_product)
+        self._threshold_cache.set('all', cached)
+        return cached
+
+    def threshold_for(self, nowuid: str) -> int:
+        default, per_product = self.thresholds()
+        return per_product.get(nowuid, default)
+
+    def set_default_threshold(self, threshold: int):
+        stock_thresholds.update_one({'_id': self.DEFAULT_ID}, {'$set': {'threshold': int(threshold)}}, upsert=True)
+        self._after_threshold_change()
+
+    def set_product_threshold(self, nowuid: str, threshold=None):
+        """设置单品阈值；threshold 为 None 时恢复使用全局阈值"""
+        if threshold is None:
+            stock_thresholds.delete_one({'_id': nowuid})
+        else:
+            stock_thresholds.update_one({'_id': nowuid}, {'$set': {'threshold': int(threshold)}}, upsert=True)
+        self._after_threshold_change()
+
+    def _after_threshold_change(self):
+        self._threshold_cache.invalidate()
+        self._report_cache.invalidate()
+
+    # ---------- 统计 ----------
+    @staticmethod
+    def _counts(nowuids=None) -> dict:
+        """一次聚合：{nowuid: {'available': n, 'sold': n}}"""
+        pipeline = []
+        if nowuids is not None:
+            pipeline.append({'$match': {'nowuid': {'$in': list(nowuids)}}})
+        pipeline.append({'$group': {
+            '_id': '$nowuid',
+            'available': {'$sum': {'$cond': [{'$eq': ['$state', 0]}, 1, 0]}},
+            'sold': {'$sum': {'$cond': [{'$eq': ['$state', 1]}, 1, 0]}},
+        }})
+        return {r['_id']: r for r in hb.aggregate(pipeline, allowDiskUse=True)}
+
+    @staticmethod
+    def level(available: int, threshold: int) -> str:
+        if available <= 0:
+            return 'out'
+        if available <= threshold:
+            return 'low'
+        return 'ok'
+
+    def report(self) -> dict:
+        """
+        全部商品与分类的库存健康报告（短时缓存）
+        {'products': [...], 'categories': [...], 'built_at': ts}
+        """
+        cached = self._report_cache.get('report')
+        if cached is not None:
+            return cached
+        counts = self._counts()
+        default, per_product = self.thresholds()
+        category_names = {c['uid']: c.get('projectname', '未知分类')
+                          for c in fenlei.find({}, {'_id': 0, 'uid': 1, 'projectname': 1})}
+        products = []
+        categories = {}
+        for p in ejfl.find({}, {'_id': 0, 'nowuid': 1, 'projectname': 1, 'uid': 1, 'row': 1}).sort('row', 1):
+            if p.get('uid') not in category_names:
+                continue  # 一级分类已删除
+            nowuid = p.get('nowuid')
+            c = counts.get(nowuid, {})
+            available, sold = c.get('available', 0), c.get('sold', 0)
+            threshold = per_product.get(nowuid, default)
+            row = {
+                'nowuid': nowuid,
+                'projectname': p.get('projectname', '未知商品'),
+                'category': category_names[p['uid']],
+                'available': available,
+                'sold': sold,
+                'threshold': threshold,
+                'level': self.level(available, threshold),
+            }
+            products.append(row)
+            cat = categories.setdefault(p['uid'], {
+                'category': row['category'], 'available': 0, 'sold': 0, 'products': 0, 'low': 0, 'out': 0
+            })
+            cat['available'] += available
+            cat['sold'] += sold
+            cat['products'] += 1
+            if row['level'] != 'ok':
+                cat[row['level']] += 1
+        report = {'products': products, 'categories': list(categories.values()), 'built_at': time.time()}
+        self._report_cache.set('report', report)
+        return report
+
+    # ---------- 预警 ----------
+    def mark_changed(self, nowuid: str = None):
+        """库存变化：报告失效，并登记该商品待检查阈值；nowuid 为 None（如全局阈值变化）时下一轮全量检查"""
+        self._report_cache.invalidate()
+        with self._lock:
+            if nowuid:
+                self._dirty.add(nowuid)
+            else:
+                self._full_requested = True
+
+    def check_alerts(self, full: bool = False) -> list:
+        """
+        检查商品是否跨过阈值，返回本次需要推送的预警列表
+        full=True 时检查全部商品（兜底代理进程等其他进程的出库）
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            full = full or self._full_requested
+            self._full_requested = False
+        # 首次检查：预警状态为空时全量建立基线，不论本轮是否为全量检查
+        silent = False
+        if not self._baselined:
+            silent = stock_alert_state.estimated_document_count() == 0
+            full = full or silent
+            self._baselined = True
+        if not full and not dirty:
+            return []
+        if full:
+            products = list(ejfl.find({}, {'_id': 0, 'nowuid': 1, 'projectname': 1}))
+        else:
+            products = list(ejfl.find({'nowuid': {'$in': list(dirty)}}, {'_id': 0, 'nowuid': 1, 'projectname': 1}))
+        nowuids = [p['nowuid'] for p in products if p.get('nowuid')]
+        counts = self._counts(None if full else nowuids)
+        states = {d['_id']: d for d in stock_alert_state.find({'_id': {'$in': nowuids}})}
+
+        alerts = []
+        now = datetime.now()
+        for p in products:
+            nowuid = p.get('nowuid')
+            if not nowuid:
+                continue
+            available = counts.get(nowuid, {}).get('available', 0)
+            threshold = self.threshold_for(nowuid)
+            level = self.level(available, threshold)
+            previous = states.get(nowuid, {}).get('level', 'ok')
+            if level == 'ok':
+                if previous != 'ok':
+                    stock_alert_state.delete_one({'_id': nowuid})
+                continue
+            if STOCK_LEVEL_RANK[level] <= STOCK_LEVEL_RANK.get(previous, 0):
+                if states[nowuid].get('available') != available or previous != level:
+                    stock_alert_state.update_one({'_id': nowuid}, {'$set': {'level': level, 'available': available}})
+                continue
+            stock_alert_state.update_one(
+                {'_id': nowuid},
+                {'$set': {'level': level, 'available': available, 'threshold': threshold, 'alerted_at': now}},
+                upsert=True
+            )
+            if silent and nowuid not in dirty:
+                continue  # 建立基线：历史缺货只记录状态，不推送
+            alert = {
+                'nowuid': nowuid, 'projectname': p.get('projectname', '未知商品'),
+                'level': level, 'available': available, 'threshold': threshold, 'time': now,
+            }
+            alerts.append(alert)
+        if alerts:
+            stock_alert_log.insert_many([dict(a) for a in alerts])
+            self._report_cache.invalidate()
+        return alerts
+
+    def alert_history_counts(self) -> dict:
+        """今日/本周/本月推送的预警数"""
+        now = datetime.now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        week = today - timedelta(days=today.weekday())
+        month = today.replace(day=1)
+        rows = list(stock_alert_log.aggregate([
+            {'$match': {'time': {'$gte': min(week, month)}}},
+            {'$group': {
+                '_id': None,
+                'today': {'$sum': {'$cond': [{'$gte': ['$time', today]}, 1, 0]}},
+                'week': {'$sum': {'$cond': [{'$gte': ['$time', week]}, 1, 0]}},
+                'month': {'$sum': {'$cond': [{'$gte': ['$time', month]}, 1, 0]}},
+            }}
+        ]))
+        return rows[0] if rows else {'today': 0, 'week': 0, 'month': 0}
+
+stock_health = StockHealthService(STOCK_ALERT_DEFAULT_THRESHOLD, STOCK_HEALTH_CACHE_TTL)
+
+_product_sync_publisher = None  # 总部商品同步发布器（创建后由 set_product_sync_publisher 注册）
+
+def set_product_sync_publisher(publisher):
+    """注册商品同步发布器，notify_product_changed 据此登记待分发的商品"""
+    global _product_sync_publisher
+    _product_sync_publisher = publisher
+
+def notify_product_changed(nowuid: str = None):
+    """商品库存/价格/名称变化时调用，使相关缓存失效"""
+    share_card_manager.invalidate(nowuid)
+    stock_snapshot.mark_stale()
+    stock_health.mark_changed(nowuid)
+    if _product_sync_publisher is not None and nowuid:
+        _product_sync_publisher.mark_dirty(nowuid)
+
+# ✅ shangtext 配置项缓存（欢迎语等几乎不变的文本）
+shangtext_cache = TTLCache(SHANGTEXT_CACHE_TTL)
+
+def get_shangtext_value(projectname: str, default=None):
+    """读取 shangtext 配置值（带短时缓存）"""
+    value = shangtext_cache.get(projectname)
+    if value is not None:
+        return value
+    doc = shangtext.find_one({'projectname': projectname}, {'text': 1})
+    if doc is None:
+        return default
+    shangtext_cache.set(projectname, doc['text'])
+    return doc['text']
+
+def get_welcome_entities():
+    """读取欢迎语样式并反序列化实体（结果缓存，避免每次 unpickle）"""
+    entities = shangtext_cache.get('__welcome_entities__')
+    if entities is None:
+        entities = pickle.loads(get_shangtext_value('欢迎语样式', b'\x80\x03]q\x00.'))
+        shangtext_cache.set('__welcome_entities__', entities)
+    return entities
+
+def invalidate_shangtext_cache(projectname: str = None):
+    """shangtext 更新后调用，清除对应缓存"""
+    if projectname is None:
+        shangtext_cache.invalidate()
+        return
+    shangtext_cache.invalidate(projectname)
+    if projectname == '欢迎语样式':
+        shangtext_cache.invalidate('__welcome_entities__')
+
+# ✅ 补货通知文本（总部频道与代理补货群共用）
+def render_restock_text(name: str, price: float, count: int, stock: int) -> str:
+    """单个商品补货通知；name 为“一级分类/二级分类”"""
+    if "/" in name:
+        parent_name, product_name = name.split("/", 1)
+    else:
+        parent_name, product_name = "未分类", name
+    return f"""
+<b>💭💭 库存更新💭💭</b>
+
+<b>{parent_name} /{product_name}</b>
+
+<b>💰 商品价格：{price:.2f} U</b>
+
+<b>🆕 新增库存：{count} 个</b>
+
+<b>📊 剩余库存：{stock} 个</b>
+
+<b>🛒 点击下方按钮快速购买</b>
+    """.strip()
+
+def render_restock_digest(items: list) -> str:
+    """多个商品同时补货的汇总通知；items: [{name, price, count, stock}]"""
+    lines = [f"• <b>{i['name']}</b>  {i['price']:.2f} U · 新增 {i['count']} · 剩余 {i['stock']}" for i in items]
+    text = f"<b>💭💭 库存更新💭💭</b>\n\n<b>🆕 本次补货 {len(items)} 个商品</b>\n\n" + "\n".join(lines)
+    if len(text) > 4000:
+        text = text[:3990].rsplit("\n", 1)[0] + "\n…"
+    return text
+
+def restock_keyboard(items: list, url_for) -> InlineKeyboardMarkup:
+    """补货通知购买按钮：单个商品一个按钮，汇总时前 10 个商品各一个按钮"""
+    if len(items) == 1:
+        return InlineKeyboardMarkup([[InlineKeyboardButton("🛒 购买商品", url=url_for(items[0]['nowuid']))]])
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"🛒 {i['name'].split('/', 1)[-1][:30]}", url=url_for(i['nowuid']))]
+        for i in items[:10]
+    ])
 
 # ✅ 库存通知管理优化
 class StockNotificationManager:
-    def __init__(self):
+    """
+    补货通知调度器（单个常驻线程）
+    - 上架事件只累加 notify_cache 中该 nowuid 的新增数量，不再每次启动线程
+    - 每个 nowuid 最后一次上架后静默 delay 秒再发送（持续上架最多等待 max_wait 秒）
+    - 到期商品一次批量读取商品/分类/库存，单个商品各发一条，同时补货较多时合并为一条汇总
+    """
+    def __init__(self, delay: float, max_wait: float, digest_threshold: int):
+        self.delay = delay
+        self.max_wait = max_wait
+        self.digest_threshold = digest_threshold
+        self.publisher = None   # 补货分发（RestockPublisher），创建后注入
         self.notify_cache = {}
         self.last_notify_time = {}
         self.notification_lock = threading.Lock()
         self.bot_instance = None
-    
+        self._wakeup = threading.Event()
+        self._thread = None
+
     def get_bot(self):
         """获取或创建 Bot 实例"""
         if self.bot_instance is None:
-            self.bot_instance = Bot(token=BOT_TOKEN)
+            self.bot_instance = get_bot(BOT_TOKEN)
         return self.bot_instance
-    
-    def add_stock_notification(self, nowuid: str, projectname: str):
-        """添加库存通知"""
+
+    def add_stock_notification(self, nowuid: str, projectname: str, count: int = 1):
+        """累加库存通知（记录首次与最近一次上架时间）"""
+        now = time.time()
         with self.notification_lock:
-            if nowuid not in self.notify_cache:
-                self.notify_cache[nowuid] = {'projectname': projectname, 'count': 1}
+            info = self.notify_cache.get(nowuid)
+            if info is None:
+                self.notify_cache[nowuid] = {'projectname': projectname, 'count': count, 'first': now, 'last': now}
             else:
-                self.notify_cache[nowuid]['count'] += 1
-    
+                info['count'] += count
+                info['last'] = now
+
+    @staticmethod
+    def _buy_url(nowuid: str) -> str:
+        return f"https://t.me/{BOT_USERNAME}?start=buy_{nowuid}"
+
+    def _post(self, text: str, keyboard: InlineKeyboardMarkup):
+        status, error = deliver(
+            lambda chat_id: self.get_bot().send_message(chat_id=chat_id, text=text, parse_mode='HTML',
+                                                        reply_markup=keyboard, disable_web_page_preview=True),
+            NOTIFY_CHANNEL_ID, get_limiter(BOT_TOKEN)
+        )
+        if status != SENT:
+            raise RuntimeError(error)
+
     def send_notification(self, nowuid: str, projectname: str, price: float, stock: int, count: int):
         """发送单个商品的库存通知"""
         try:
@@ -173,92 +824,106 @@ class StockNotificationManager:
                 logging.info(f"ℹ️ 补货数为0，跳过通知：nowuid={nowuid}")
                 return
             
-            # 分离一级分类和二级分类名称
-            if "/" in projectname:
-                parent_name, product_name = projectname.split("/", 1)
-            else:
-                parent_name = "未分类"
-                product_name = projectname
-            
-            text = f"""
-<b>💭💭 库存更新💭💭</b>
-
-<b>{parent_name} /{product_name}</b>
-
-<b>💰 商品价格：{price:.2f} U</b>
-
-<b>🆕 新增库存：{count} 个</b>
-
-<b>📊 剩余库存：{stock} 个</b>
-
-<b>🛒 点击下方按钮快速购买</b>
-            """.strip()
-
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🛒 购买商品", url=f"https://t.me/{BOT_USERNAME}?start=buy_{nowuid}")]
-            ])
-            
-            bot = self.get_bot()
-            bot.send_message(
-                chat_id=NOTIFY_CHANNEL_ID, 
-                text=text, 
-                parse_mode='HTML', 
-                reply_markup=keyboard
-            )
+            text = render_restock_text(projectname, price, count, stock)
+            keyboard = restock_keyboard([{'nowuid': nowuid, 'name': projectname}], self._buy_url)
+            self._post(text, keyboard)
+            self.last_notify_time[nowuid] = time.time()
             logging.info(f"✅ 补货通知已发送：{projectname} (新增{count}个)")
         except Exception as e:
             logging.error(f"❌ 推送失败：{e}")
-    
-    def send_batched_notifications(self):
-        """发送批量库存通知"""
+
+    def send_digest(self, items: list):
+        """同时补货的商品较多时合并为一条汇总（前 10 个商品附购买按钮）"""
+        text = render_restock_digest(items)
+        keyboard = restock_keyboard(items, self._buy_url)
+        try:
+            self._post(text, keyboard)
+            now = time.time()
+            for i in items:
+                self.last_notify_time[i['nowuid']] = now
+            logging.info(f"✅ 补货汇总通知已发送：{len(items)} 个商品")
+        except Exception as e:
+            logging.error(f"❌ 补货汇总推送失败：{e}")
+
+    def resolve(self, pending: dict) -> list:
+        """一次批量读取商品、一级分类与剩余库存，返回待通知商品列表"""
+        nowuids = list(pending)
+        products = {p['nowuid']: p for p in ejfl.find({'nowuid': {'$in': nowuids}}, {'nowuid': 1, 'uid': 1, 'projectname': 1, 'money': 1})}
+        uids = list({p.get('uid') for p in products.values()})
+        parents = {f['uid']: f.get('projectname') for f in fenlei.find({'uid': {'$in': uids}}, {'uid': 1, 'projectname': 1})}
+        stocks = {r['_id']: r['n'] for r in hb.aggregate([
+            {'$match': {'nowuid': {'$in': nowuids}, 'state': 0}},
+            {'$group': {'_id': '$nowuid', 'n': {'$sum': 1}}},
+        ])}
+        items = []
+        for nowuid in nowuids:
+            product = products.get(nowuid)
+            if not product:
+                logging.warning(f"❌ 未找到商品信息：nowuid={nowuid}")
+                continue
+            parent_name = parents.get(product.get('uid')) or "未知分类"
+            items.append({
+                'nowuid': nowuid,
+                'name': f"{parent_name}/{product['projectname']}",
+                'price': float(product.get('money', 0)),
+                'count': pending[nowuid]['count'],
+                'stock': stocks.get(nowuid, 0),
+            })
+        return items
+
+    def send_batched_notifications(self, force: bool = True):
+        """发送库存通知（force=False 时只发送已过去抖窗口的商品）"""
+        now = time.time()
         with self.notification_lock:
-            if not self.notify_cache:
-                return
-            
-            notifications_to_send = self.notify_cache.copy()
-            self.notify_cache.clear()
-        
-        for nowuid, info in notifications_to_send.items():
+            ready = [k for k, v in self.notify_cache.items()
+                     if force or now - v['last'] >= self.delay or now - v['first'] >= self.max_wait]
+            pending = {k: self.notify_cache.pop(k) for k in ready}
+        if not pending:
+            return []
+
+        try:
+            items = self.resolve(pending)
+        except Exception as e:
+            logging.error(f"❌ 读取补货商品信息失败：{e}")
+            return []
+        # 先分发到代理补货群（同步登记覆盖的商品），代理收到频道帖子时据此判断是否需要转发
+        if self.publisher is not None and items:
+            self.publisher.publish(items)
+        if len(items) >= self.digest_threshold:
+            self.send_digest(items)
+        else:
+            for i in items:
+                self.send_notification(i['nowuid'], i['name'], i['price'], i['stock'], i['count'])
+        logging.info(f"📢 批量库存通知完成，共 {len(items)} 个商品")
+        return items
+
+    def _loop(self):
+        while True:
+            with self.notification_lock:
+                if self.notify_cache:
+                    now = time.time()
+                    timeout = max(0.0, min(min(v['last'] + self.delay, v['first'] + self.max_wait)
+                                           for v in self.notify_cache.values()) - now)
+                else:
+                    timeout = None
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
             try:
-                # 获取二级分类信息
-                product = ejfl.find_one({'nowuid': nowuid})
-                if not product:
-                    logging.warning(f"❌ 未找到商品信息：nowuid={nowuid}")
-                    continue
-                
-                # 获取一级分类信息
-                uid = product.get('uid')
-                parent_category = fenlei.find_one({'uid': uid})
-                parent_name = parent_category['projectname'] if parent_category else "未知分类"
-                
-                # 构建完整的商品名称：一级分类/二级分类
-                product_name = f"{parent_name}/{product['projectname']}"
-                
-                price = float(product.get('money', 0))
-                stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
-                self.send_notification(nowuid, product_name, price, stock, info['count'])
-                
+                self.send_batched_notifications(force=False)
             except Exception as e:
-                logging.error(f"❌ 发送库存通知失败：nowuid={nowuid}, error={e}")
-        
-        logging.info(f"📢 批量库存通知完成，共发送 {len(notifications_to_send)} 个通知")
-    
+                logging.error(f"❌ 延迟通知失败：{e}")
+
     def schedule_notification(self, nowuid: str, projectname: str):
-        """安排延迟通知"""
+        """登记补货事件，由常驻调度线程去抖后发送"""
         self.add_stock_notification(nowuid, projectname)
-        
-        def delayed_notify():
-            time.sleep(STOCK_NOTIFICATION_DELAY)
-            try:
-                self.send_batched_notifications()
-            except Exception as e:
-                logging.error(f"❌ 延迟通知失败：{e}")
-        
-        threading.Thread(target=delayed_notify, daemon=True).start()
-        logging.info(f"🔔 已启动库存通知延迟任务：{projectname} (nowuid={nowuid})")
+        with self.notification_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True, name='StockNotification')
+                self._thread.start()
+        self._wakeup.set()
 
 # 初始化库存通知管理器
-stock_manager = StockNotificationManager()
+stock_manager = StockNotificationManager(STOCK_NOTIFICATION_DELAY, STOCK_NOTIFICATION_MAX_WAIT, STOCK_NOTIFICATION_DIGEST_THRESHOLD)
 
 # ✅ 为了向后兼容，保留原有变量和函数
 stock_notify_cache = stock_manager.notify_cache
@@ -315,10 +980,195 @@ def fanyibao(projectname, text, fanyi):
     except Exception as e:
         logging.error(f"❌ 插入翻译包失败：{projectname} - {e}")
 
-def goumaijilua(leixing, bianhao, user_id, projectname, text, ts, timer, count):
+# ================================ 字符串时间字段 → BSON datetime ================================
+#
+# 历史数据的时间字段均为 '%Y-%m-%d %H:%M:%S' 字符串。新增同名的 *_at 日期字段（与字符串相同的
+# 北京时间，naive datetime），写入路径双写，历史数据由 migrate_timer_fields() 在线分批回填。
+# 某字段回填完成后 timer_range_filter() 自动切换为按日期字段查询（走索引）。
+
+TIMER_DATETIME_FIELDS = {
+    'gmjlu': {'timer': 'timer_at'},
+    'topup': {'timer': 'timer_at'},
+    'user': {'creation_time': 'creation_at', 'last_contact_time': 'last_contact_at'},
+    'user_log': {'today_time': 'today_at'},
+    'agent_orders': {'order_time': 'order_at'},
+    'agent_withdrawals': {'apply_time': 'apply_at'},
+}
+# 按前缀匹配的代理独立集合
+TIMER_DATETIME_PREFIX_FIELDS = {
+    'agent_gmjlu_': {'timer': 'timer_at'},
+    'agent_users_': {
+        'creation_time': 'creation_at', 'register_time': 'register_at',
+        'last_active': 'last_active_at', 'last_contact_time': 'last_contact_at',
+    },
+}
+
+timer_migration_state = db_manager.bot_db['timer_migration_state']
+_timer_migrated_cache = TTLCache(60)
+
+def parse_legacy_timer(value):
+    """解析 '%Y-%m-%d %H:%M:%S' 时间字符串（或 datetime），失败返回 None"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    try:
+        return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+
+def timer_datetime_fields(collection_name: str) -> dict:
+    """集合的 {字符串字段: 日期字段} 映射"""
+    if collection_name in TIMER_DATETIME_FIELDS:
+        return TIMER_DATETIME_FIELDS[collection_name]
+    for prefix, fields in TIMER_DATETIME_PREFIX_FIELDS.items():
+        if collection_name.startswith(prefix):
+            return fields
+    return {}
+
+def with_timer_datetimes(collection_name: str, doc: dict) -> dict:
+    """为待写入的文档（或 $set 内容）补充 *_at 日期字段（双写）"""
+    for src, dst in timer_datetime_fields(collection_name).items():
+        if src in doc and dst not in doc:
+            dt = parse_legacy_timer(doc[src])
+            if dt is not None:
+                doc[dst] = dt
+    return doc
+
+def is_timer_migrated(collection_name: str, field: str) -> bool:
+    """字段的历史数据是否已回填完成（结果缓存 60 秒）"""
+    key = f"{collection_name}.{field}"
+    cached = _timer_migrated_cache.get(key)
+    if cached is None:
+        state = timer_migration_state.find_one({'_id': key}, {'done': 1})
+        cached = bool(state and state.get('done'))
+        _timer_migrated_cache.set(key, cached)
+    return cached
+
+def timer_range_filter(collection_name: str, field: str, start=None, end=None) -> dict:
+    """
+    生成时间范围过滤条件：回填完成后按日期字段查询，否则按字符串比较
+    start/end 为北京时间 datetime（naive）
+    """
+    dst = timer_datetime_fields(collection_name).get(field)
+    use_datetime = dst is not None and is_timer_migrated(collection_name, field)
+    cond = {}
+    if start is not None:
+        cond['$gte'] = start if use_datetime else start.strftime('%Y-%m-%d %H:%M:%S')
+    if end is not None:
+        cond['$lt'] = end if use_datetime else end.strftime('%Y-%m-%d %H:%M:%S')
+    return {(dst if use_datetime else field): cond} if cond else {}
+
+def timer_migration_targets() -> list:
+    """列出需要回填的 (集合名, 字符串字段, 日期字段)"""
+    targets = []
+    for name in sorted(bot_db.list_collection_names()):
+        for src, dst in timer_datetime_fields(name).items():
+            targets.append((name, src, dst))
+    return targets
+
+def migrate_timer_fields(batch_size: int = 1000, pause: float = 0.05, should_stop=None, progress=None) -> dict:
+    """
+    在线回填 *_at 日期字段（按 _id 分批，断点保存在 timer_migration_state，可随时中断后续跑）
+
+    Args:
+        batch_size: 每批文档数
+        pause: 批次间休眠秒数，降低对线上读写的影响
+        should_stop: 返回 True 时在批次边界停止
+        progress: 回调 progress(collection, field, migrated_total)
+    """
+    summary = {'collections': 0, 'migrated': 0, 'completed': [], 'stopped': False}
+    for name, src, dst in timer_migration_targets():
+        key = f"{name}.{src}"
+        state = timer_migration_state.find_one({'_id': key}) or {}
+        if state.get('done'):
+            continue
+        summary['collections'] += 1
+        coll = bot_db[name]
+        last_id = state.get('last_id')
+        migrated = state.get('migrated', 0)
+        while True:
+            if should_stop and should_stop():
+                summary['stopped'] = True
+                return summary
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            docs = list(coll.find(query, {src: 1, dst: 1}).sort('_id', 1).limit(batch_size))
+            ops = []
+            for doc in docs:
+                if dst in doc:
+                    continue
+                dt = parse_legacy_timer(doc.get(src))
+                if dt is not None:
+                    ops.append(pymongo.UpdateOne({'_id': doc['_id'], dst: {'$exists': False}}, {'$set': {dst: dt}}))
+            if ops:
+                coll.bulk_write(ops, ordered=False)
+                migrated += len(ops)
+                summary['migrated'] += len(ops)
+            if docs:
+                last_id = docs[-1]['_id']
+            done = len(docs) < batch_size
+            if done:
+                coll.create_index(dst)
+            timer_migration_state.update_one(
+                {'_id': key},
+                {'$set': {'last_id': last_id, 'migrated': migrated, 'done': done, 'updated_at': datetime.now()}},
+                upsert=True
+            )
+            if progress:
+                progress(name, src, migrated)
+            if done:
+                _timer_migrated_cache.invalidate(key)
+                summary['completed'].append(key)
+                logging.info(f"✅ 时间字段回填完成：{key} -> {dst}（{migrated} 条）")
+                break
+            time.sleep(pause)
+    return summary
+
+# ✅ 购买记录分页：(user_id, timer, _id) 倒序键集游标，总数走缓存
+PURCHASE_HISTORY_SORT = [('timer', -1), ('_id', -1)]
+purchase_count_cache = TTLCache(PURCHASE_COUNT_CACHE_TTL)
+
+def get_purchase_count(user_id: int) -> int:
+    """用户购买记录总数（缓存，新增记录时失效）"""
+    cached = purchase_count_cache.get(user_id)
+    if cached is None:
+        cached = gmjlu.count_documents({'user_id': user_id})
+        purchase_count_cache.set(user_id, cached)
+    return cached
+
+def get_purchase_page(user_id: int, anchor=None, direction: str = 'next', limit: int = 10) -> dict:
+    """
+    按键集游标读取一页购买记录（新 → 旧）
+
+    Args:
+        anchor: 游标记录的 _id；None 表示第一页
+        direction: 'next' 取 anchor 之后（更旧）的记录，'prev' 取 anchor 之前（更新）的记录
+    Returns:
+        {'items': [...], 'has_prev': bool, 'has_next': bool}
+    """
+    query = {'user_id': user_id}
+    anchor_doc = gmjlu.find_one({'_id': anchor, 'user_id': user_id}, {'timer': 1}) if anchor else None
+    if anchor_doc is not None:
+        op = '$lt' if direction == 'next' else '$gt'
+        timer = anchor_doc.get('timer')
+        query['$or'] = [
+            {'timer': {op: timer}},
+            {'timer': timer, '_id': {op: anchor_doc['_id']}},
+        ]
+    backward = anchor_doc is not None and direction == 'prev'
+    sort = [(field, -order) for field, order in PURCHASE_HISTORY_SORT] if backward else PURCHASE_HISTORY_SORT
+    items = list(gmjlu.find(query, sort=sort, limit=limit + 1))
+    more = len(items) > limit
+    items = items[:limit]
+    if backward:
+        items.reverse()
+        return {'items': items, 'has_prev': more, 'has_next': True}
+    return {'items': items, 'has_prev': anchor_doc is not None, 'has_next': more}
+
+def goumaijilua(leixing, bianhao, user_id, projectname, text, ts, timer, count=1):
     """购买记录插入函数"""
+    # 销售汇总回填进行中：订单带 rollup_pending 写入，由回填结束后的补记计入汇总
+    pending = sales_rollup_rebuilding()
     try:
-        gmjlu.insert_one({
+        order = {
             'leixing': leixing,
             'bianhao': bianhao,
             'user_id': user_id,
@@ -327,10 +1177,207 @@ def goumaijilua(leixing, bianhao, user_id, projectname, text, ts, timer, count):
             'ts': ts,
             'timer': timer,
             'count': count   # ✅ 记录实际数量
-        })
+        }
+        if pending:
+            order['rollup_pending'] = True
+        gmjlu.insert_one(with_timer_datetimes('gmjlu', order))
+        purchase_count_cache.invalidate(user_id)
         logging.info(f"✅ 插入购买记录：{user_id} - {projectname}")
     except Exception as e:
         logging.error(f"❌ 插入购买记录失败：{user_id} - {projectname} - {e}")
+        return
+    if not pending:
+        record_sales_rollup(leixing, user_id, projectname, timer, count)
+
+# ================================ 销售汇总（按日/按小时预聚合） ================================
+#
+# sales_rollups 文档结构：
+#   {_id: 'd:2024-05-01', day: '2024-05-01', orders, items, users: [...],
+#    by_hour: {'00'..'23': 订单数}, by_leixing: {类型: 件数}, by_product: {商品: 件数}}
+#   {_id: 'all', orders, items, by_product: {商品: 件数}}   # 全量累计（热销榜）
+# 每条购买记录写入时增量更新；历史数据通过 rebuild_sales_rollups() 回填
+# 回填期间（sales_rollup_state 中 running）新订单不做实时增量，只带 rollup_pending 标记，回填结束后逐条补记
+
+SALES_ROLLUP_ALL_ID = 'all'
+SALES_ROLLUP_EXCLUDED_PRODUCTS = ('点击按钮修改',)  # 测试数据
+SALES_ROLLUP_STATE_ID = 'rebuild'
+SALES_ROLLUP_SETTLE_SECONDS = 5        # 切换回填状态后等待在途的实时写入完成
+SALES_ROLLUP_STALE_SECONDS = 600       # 回填心跳超过该时间未更新视为已中断
+
+sales_rollup_state = db_manager.bot_db['sales_rollup_state']
+
+def sales_rollup_rebuilding() -> bool:
+    """销售汇总是否正在回填（心跳过期的回填视为已中断）"""
+    try:
+        state = sales_rollup_state.find_one({'_id': SALES_ROLLUP_STATE_ID}, {'running': 1, 'at': 1})
+    except Exception as e:
+        logging.warning(f"⚠️ 读取销售汇总回填状态失败：{e}")
+        return False
+    return bool(state and state.get('running') and state.get('at')
+                and (datetime.now() - state['at']).total_seconds() < SALES_ROLLUP_STALE_SECONDS)
+
+def _rollup_field(name) -> str:
+    """把商品名/类型转换为可用作字段名的键（不能含 '.' 或以 '$' 开头）"""
+    key = str(name if name not in (None, '') else '未知').replace('.', '．')
+    return '＄' + key[1:] if key.startswith('$') else key
+
+def _rollup_day_id(day: str) -> str:
+    return f"d:{day}"
+
+def _rollup_inc(leixing, projectname, count, hour=None) -> dict:
+    inc = {'orders': 1, 'items': count, f"by_leixing.{_rollup_field(leixing)}": count}
+    if hour is not None:
+        inc[f"by_hour.{hour:02d}"] = 1
+    if projectname not in SALES_ROLLUP_EXCLUDED_PRODUCTS:
+        inc[f"by_product.{_rollup_field(projectname)}"] = count
+    return inc
+
+def record_sales_rollup(leixing, user_id, projectname, timer, count=1):
+    """购买记录写入后增量更新日汇总与全量汇总"""
+    order_time = parse_legacy_timer(timer)
+    if order_time is None:
+        logging.warning(f"⚠️ 销售汇总跳过：无法解析时间 {timer}")
+        return
+    try:
+        count = int(count or 1)
+        day = order_time.strftime('%Y-%m-%d')
+        day_update = {'$inc': _rollup_inc(leixing, projectname, count, order_time.hour),
+                      '$setOnInsert': {'day': day}}
+        if user_id is not None:
+            day_update['$addToSet'] = {'users': user_id}
+        sales_rollups.update_one({'_id': _rollup_day_id(day)}, day_update, upsert=True)
+        sales_rollups.update_one(
+            {'_id': SALES_ROLLUP_ALL_ID},
+            {'$inc': _rollup_inc(leixing, projectname, count)},
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"❌ 更新销售汇总失败：{projectname} - {e}")
+
+def get_sales_rollup_days(start_day: str, end_day: str) -> list:
+    """读取 [start_day, end_day] 范围内的日汇总（按日期升序，一次 _id 范围查询）"""
+    return list(sales_rollups.find(
+        {'_id': {'$gte': _rollup_day_id(start_day), '$lte': _rollup_day_id(end_day)}}
+    ).sort('_id', 1))
+
+def summarize_sales_rollups(days: list) -> dict:
+    """合并多个日汇总：订单数、件数、去重客户数、按类型/商品/小时分布"""
+    summary = {'orders': 0, 'items': 0, 'customers': 0, 'by_leixing': {}, 'by_product': {}, 'by_hour': {}}
+    users = set()
+    for doc in days:
+        summary['orders'] += doc.get('orders', 0)
+        summary['items'] += doc.get('items', 0)
+        users.update(doc.get('users', []))
+        for field in ('by_leixing', 'by_product', 'by_hour'):
+            bucket = summary[field]
+            for k, v in (doc.get(field) or {}).items():
+                bucket[k] = bucket.get(k, 0) + v
+    summary['customers'] = len(users)
+    return summary
+
+def get_sales_rollup_total() -> dict:
+    """全量累计汇总（热销榜）"""
+    return sales_rollups.find_one({'_id': SALES_ROLLUP_ALL_ID}) or {}
+
+def _apply_rollup_inc(target: dict, inc: dict):
+    """在内存文档上执行与 $inc 相同的累加"""
+    for path, value in inc.items():
+        if '.' in path:
+            field, key = path.split('.', 1)
+            bucket = target.setdefault(field, {})
+            bucket[key] = bucket.get(key, 0) + value
+        else:
+            target[path] = target.get(path, 0) + value
+
+def _accumulate_rollup(day_docs: dict, total: dict, order: dict) -> bool:
+    """把一条购买记录累加进内存中的日汇总与全量汇总；时间无法解析时返回 False"""
+    order_time = parse_legacy_timer(order.get('timer'))
+    if order_time is None:
+        return False
+    count = int(order.get('count') or 1)
+    day = order_time.strftime('%Y-%m-%d')
+    doc = day_docs.get(day)
+    if doc is None:
+        doc = day_docs[day] = {'_id': _rollup_day_id(day), 'day': day, 'orders': 0, 'items': 0,
+                               'users': set(), 'by_hour': {}, 'by_leixing': {}, 'by_product': {}}
+    _apply_rollup_inc(doc, _rollup_inc(order.get('leixing'), order.get('projectname'), count, order_time.hour))
+    _apply_rollup_inc(total, _rollup_inc(order.get('leixing'), order.get('projectname'), count))
+    if order.get('user_id') is not None:
+        doc['users'].add(order['user_id'])
+    return True
+
+def apply_pending_rollups(batch_size: int = 500) -> int:
+    """补记带 rollup_pending 标记的订单（逐条原子清除标记后再增量写入，同一订单只计入一次）"""
+    applied = 0
+    projection = {'_id': 1, 'leixing': 1, 'user_id': 1, 'projectname': 1, 'timer': 1, 'count': 1}
+    while True:
+        orders = list(gmjlu.find({'rollup_pending': True}, projection).limit(batch_size))
+        if not orders:
+            return applied
+        for order in orders:
+            if gmjlu.find_one_and_update({'_id': order['_id'], 'rollup_pending': True},
+                                         {'$unset': {'rollup_pending': ''}}) is None:
+                continue
+            record_sales_rollup(order.get('leixing'), order.get('user_id'), order.get('projectname'),
+                                order.get('timer'), order.get('count'))
+            applied += 1
+
+def rebuild_sales_rollups(batch_size: int = 5000) -> dict:
+    """
+    从 gmjlu 全量回填销售汇总
+
+    - 先标记回填状态并等待在途写入完成；此后的新订单带 rollup_pending 写入，不做实时增量
+    - 流式读取不带标记的订单，按日在内存累加后写入临时集合，整体改名替换 sales_rollups（无销售的旧日期随旧集合删除）
+    - 替换后清除回填状态，逐条补记带标记的订单（补记前原子清除标记，不会重复计入）
+    """
+    start = time.time()
+    now = datetime.now()
+    try:
+        sales_rollup_state.update_one(
+            {'_id': SALES_ROLLUP_STATE_ID, '$or': [
+                {'running': {'$ne': True}},
+                {'at': {'$lt': now - timedelta(seconds=SALES_ROLLUP_STALE_SECONDS)}},
+            ]},
+            {'$set': {'running': True, 'started_at': now, 'at': now}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        raise RuntimeError("已有销售汇总回填正在进行")
+    try:
+        time.sleep(SALES_ROLLUP_SETTLE_SECONDS)
+        day_docs = {}
+        total = {'_id': SALES_ROLLUP_ALL_ID, 'orders': 0, 'items': 0, 'by_leixing': {}, 'by_product': {}}
+        scanned = skipped = 0
+        projection = {'_id': 0, 'leixing': 1, 'user_id': 1, 'projectname': 1, 'timer': 1, 'count': 1}
+        for order in gmjlu.find({'rollup_pending': {'$ne': True}}, projection).batch_size(batch_size):
+            scanned += 1
+            if not _accumulate_rollup(day_docs, total, order):
+                skipped += 1
+            if scanned % batch_size == 0:
+                sales_rollup_state.update_one({'_id': SALES_ROLLUP_STATE_ID}, {'$set': {'at': datetime.now()}})
+
+        temp = db_manager.bot_db['sales_rollups_rebuild']
+        temp.drop()
+        docs = []
+        for doc in day_docs.values():
+            doc['users'] = list(doc['users'])
+            docs.append(doc)
+        docs.append(total)
+        for i in range(0, len(docs), 1000):
+            temp.insert_many(docs[i:i + 1000], ordered=False)
+        temp.rename(sales_rollups.name, dropTarget=True)
+    finally:
+        sales_rollup_state.update_one({'_id': SALES_ROLLUP_STATE_ID},
+                                      {'$set': {'running': False, 'at': datetime.now()}})
+    # 清除状态前读到 running 的写入仍可能带标记，等待后再补记一轮
+    pending = apply_pending_rollups()
+    time.sleep(SALES_ROLLUP_SETTLE_SECONDS)
+    pending += apply_pending_rollups()
+
+    result = {'scanned': scanned, 'skipped': skipped, 'days': len(day_docs), 'pending': pending,
+              'elapsed': round(time.time() - start, 2)}
+    logging.info(f"✅ 销售汇总回填完成：{result}")
+    return result
 
 def xieyihaobaocun(uid, nowuid, hbid, projectname, timer):
     """协议号保存函数"""
@@ -364,6 +1411,9 @@ def shangchuanhaobao(leixing, uid, nowuid, hbid, projectname, timer, remark=''):
         })
         logging.info(f"✅ 上架商品成功：{projectname} (nowuid={nowuid})")
 
+        # 库存变化，分享卡片与库存快照失效
+        notify_product_changed(nowuid)
+
         # ✅ 使用优化的库存通知管理器
         stock_manager.schedule_notification(nowuid, projectname)
 
@@ -405,14 +1455,14 @@ def fenleibiao(uid, projectname,row):
     })
 
 def user_logging(uid, projectname , user_id, today_money, today_time):
-    log_data = {
+    log_data = with_timer_datetimes('user_log', {
         'uid': uid,
         'projectname': projectname,
         'user_id': user_id,
         'today_money': today_money,
         'today_time': today_time,
         'log_time': datetime.now()
-    }
+    })
     try:
         user_log.insert_one(log_data)
         print(f"✅ 日志已记录: {log_data}")
@@ -498,7 +1548,7 @@ def keybutton(Row, first):
     
 def user_data(key_id, user_id, username, fullname, lastname, state, creation_time, last_contact_time):
     try:
-        user.insert_one({
+        user.insert_one(with_timer_datetimes('user', {
             'count_id': key_id,
             'user_id': user_id,
             'username': username,
@@ -513,7 +1563,7 @@ def user_data(key_id, user_id, username, fullname, lastname, state, creation_tim
             'sign': 0,
             'lang': 'zh',
             'verified': False   # ✅ 添加这一行
-        })
+        }))
         logging.info(f"✅ 新增用户：{user_id} ({username})")
     except Exception as e:
         logging.error(f"❌ 用户写入失败：{user_id} - {e}")
@@ -554,6 +1604,9 @@ agent_withdrawals = db_manager.bot_db["agent_withdrawals"]
 # 提现申请表（总部系统）
 withdrawal_requests = db_manager.bot_db["withdrawal_requests"]
 
+# 代理分析汇总表（每个代理一条，供跨代理排行/分页）
+agent_analytics = db_manager.bot_db["agent_analytics"]
+
 # ================================ 多机器人分销系统数据操作函数 ================================
 
 def create_agent_bot_data(agent_bot_id, agent_name, agent_token, agent_username, owner_id, commission_rate, creation_time):
@@ -582,6 +1635,10 @@ def create_agent_bot_data(agent_bot_id, agent_name, agent_token, agent_username,
                 'min_purchase': 0.0,                # 最小购买金额
             }
         })
+        record_agent_analytics(agent_bot_id, {}, {
+            'agent_name': agent_name, 'agent_username': agent_username,
+            'commission_rate': commission_rate, 'status': 'active', 'creation_time': creation_time,
+        })
         logging.info(f"✅ 创建代理机器人成功：{agent_name} (@{agent_username})")
         return True
     except Exception as e:
@@ -611,7 +1668,7 @@ def create_agent_order_data(order_id, agent_bot_id, customer_id, original_nowuid
                            agent_price, cost_price, profit, commission, order_time):
     """创建代理订单记录"""
     try:
-        agent_orders.insert_one({
+        agent_orders.insert_one(with_timer_datetimes('agent_orders', {
             'order_id': order_id,                   # 订单ID
             'agent_bot_id': agent_bot_id,           # 代理机器人ID
             'customer_id': customer_id,             # 客户ID（在代理机器人中的ID）
@@ -624,6 +1681,12 @@ def create_agent_order_data(order_id, agent_bot_id, customer_id, original_nowuid
             'status': 'completed',                  # 订单状态
             'order_time': order_time,               # 订单时间
             'delivery_content': '',                 # 发货内容
+        }))
+        invalidate_agent_stats(agent_bot_id)
+        record_agent_analytics(agent_bot_id, {
+            'orders_sales': float(agent_price or 0) * (quantity or 1),
+            'orders_commission': float(commission or 0),
+            'orders_count': 1,
         })
         logging.info(f"✅ 创建代理订单：order_id={order_id}, agent_bot_id={agent_bot_id}")
         return True
@@ -635,7 +1698,7 @@ def create_agent_withdrawal_data(withdrawal_id, agent_bot_id, amount, payment_me
                                 payment_account, status, apply_time):
     """创建代理提现申请"""
     try:
-        agent_withdrawals.insert_one({
+        agent_withdrawals.insert_one(with_timer_datetimes('agent_withdrawals', {
             'withdrawal_id': withdrawal_id,         # 提现ID
             'agent_bot_id': agent_bot_id,           # 代理机器人ID
             'amount': amount,                       # 提现金额
@@ -646,7 +1709,10 @@ def create_agent_withdrawal_data(withdrawal_id, agent_bot_id, amount, payment_me
             'process_time': '',                     # 处理时间
             'process_by': '',                       # 处理人
             'notes': '',                            # 备注
-        })
+        }))
+        invalidate_agent_stats(agent_bot_id)
+        if status == 'pending':
+            record_agent_analytics(agent_bot_id, {'pending_withdrawal_count': 1, 'pending_withdrawal_amount': float(amount or 0)})
         logging.info(f"✅ 创建提现申请：withdrawal_id={withdrawal_id}, agent_bot_id={agent_bot_id}")
         return True
     except Exception as e:
@@ -717,7 +1783,7 @@ def create_agent_user_data(agent_bot_id, user_id, username, fullname, creation_t
         last_user = agent_users.find_one(sort=[('count_id', -1)])
         count_id = (last_user['count_id'] if last_user else 0) + 1
         
-        agent_users.insert_one({
+        agent_users.insert_one(with_timer_datetimes(agent_users.name, {
             'count_id': count_id,                   # 代理内部用户编号
             'user_id': user_id,                     # Telegram用户ID
             'username': username,                   # 用户名
@@ -731,8 +1797,10 @@ def create_agent_user_data(agent_bot_id, user_id, username, fullname, creation_t
             'sign': 0,                             # 签到
             'last_contact_time': creation_time,     # 最后联系时间
             'verified': False,                     # 是否验证
-        })
+        }))
         
+        invalidate_agent_stats(agent_bot_id)
+        record_agent_analytics(agent_bot_id, {'total_users': 1})
         logging.info(f"✅ 代理机器人创建用户：agent_bot_id={agent_bot_id}, user_id={user_id}")
         return True, count_id
     except Exception as e:
@@ -845,9 +1913,607 @@ def generate_agent_bot_id():
     random_part = str(uuid.uuid4()).replace('-', '')[:16]
     return f"agent_{timestamp}{random_part}"
 
+# ================================ 代理商品批量同步引擎 ================================
+
+def bulk_sync_agent_products(agent_bot_id, default_markup, batch_size=AGENT_SYNC_BATCH_SIZE,
+                             hq_filter=None, auto_created=False) -> dict:
+    """
+    批量同步总部商品到指定代理（一次遍历 ejfl，按批 $in 读取已有记录，无序 bulk_write 写入）
+
+    Returns:
+        dict: {inserted, updated, skipped, activated, errors, total_hq, elapsed, rate}
+    """
+    start = time.time()
+    totals = {'inserted': 0, 'updated': 0, 'skipped': 0, 'activated': 0, 'errors': 0, 'total_hq': 0}
+
+    def flush(batch):
+        nowuids = [p['nowuid'] for p in batch if p.get('nowuid')]
+        existing_map = {
+            doc['original_nowuid']: doc
+            for doc in agent_product_prices.find(
+                {'agent_bot_id': agent_bot_id, 'original_nowuid': {'$in': nowuids}},
+                AGENT_SYNC_PRICE_PROJECTION
+            )
+        } if nowuids else {}
+        now_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ops, stats = build_agent_price_ops(agent_bot_id, batch, existing_map, default_markup, now_time, auto_created)
+        for k in ('skipped', 'activated'):
+            totals[k] += stats[k]
+        write_agent_price_ops(agent_product_prices, ops, totals, f"agent_bot_id={agent_bot_id}")
+
+    batch = []
+    cursor = ejfl.find(hq_filter or {}, AGENT_SYNC_HQ_PROJECTION).batch_size(batch_size)
+    for product in cursor:
+        totals['total_hq'] += 1
+        batch.append(product)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    elapsed = time.time() - start
+    totals['elapsed'] = round(elapsed, 2)
+    totals['rate'] = round(totals['total_hq'] / elapsed, 1) if elapsed > 0 else float(totals['total_hq'])
+    logging.info(
+        f"✅ 代理商品批量同步完成：agent_bot_id={agent_bot_id}, 新增={totals['inserted']}, 更新={totals['updated']}, "
+        f"跳过={totals['skipped']}, 错误={totals['errors']}, 耗时={totals['elapsed']}s, 速率={totals['rate']}/s"
+    )
+    return totals
+
+def fanout_products_to_agents(products, agent_markups: dict) -> dict:
+    """
+    把一批已读取的总部商品同步给多个代理：
+    一次 $in 读取所有代理的已有记录，一次无序 bulk_write 写入全部代理的变更
+
+    Args:
+        agent_markups: {agent_bot_id: 该代理新商品的默认加价}
+    """
+    totals = {'inserted': 0, 'updated': 0, 'skipped': 0, 'activated': 0, 'errors': 0}
+    nowuids = [p['nowuid'] for p in products if p.get('nowuid')]
+    if not nowuids or not agent_markups:
+        return totals
+
+    existing = {agent_bot_id: {} for agent_bot_id in agent_markups}
+    for doc in agent_product_prices.find(
+        {'agent_bot_id': {'$in': list(agent_markups)}, 'original_nowuid': {'$in': nowuids}},
+        {**AGENT_SYNC_PRICE_PROJECTION, 'agent_bot_id': 1}
+    ):
+        existing[doc['agent_bot_id']][doc['original_nowuid']] = doc
+
+    now_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    ops = []
+    for agent_bot_id, markup in agent_markups.items():
+        agent_ops, stats = build_agent_price_ops(
+            agent_bot_id, products, existing[agent_bot_id], markup, now_time, auto_created=True
+        )
+        ops.extend(agent_ops)
+        for k in ('skipped', 'activated'):
+            totals[k] += stats[k]
+    write_agent_price_ops(agent_product_prices, ops, totals, f"fan-out agents={len(agent_markups)}")
+    return totals
+
+# ================================ 总部商品同步发布器 ================================
+
+# 同步事件（供代理订阅，自动过期）与发布器心跳
+product_sync_events = db_manager.bot_db["product_sync_events"]
+product_sync_state = db_manager.bot_db["product_sync_state"]
+
+HQ_SYNC_PUBLISHER_ID = 'hq_product_sync'
+
+class ProductSyncPublisher:
+    """
+    总部商品同步发布器：代替每个代理各自 watch ejfl + 轮询
+    - 一个 Change Stream 同时监听 ejfl/hb（不可用时仅依赖进程内通知与定时全量校准）
+    - 变更的 nowuid 先去抖合并，再一次读取总部商品，直接批量写入所有活跃代理的 agent_product_prices
+    - 每次写入后发布一条精简事件到 product_sync_events，代理只需按 _id 增量读取
+    - 定期写入心跳，代理据此判断是否可以停止本地轮询
+    - 新商品按各代理登记的默认加价（agent_bots.default_markup）写入，未登记时使用总部默认值
+    - 总部删除的商品在各代理侧下架；Change Stream 的删除事件只有 _id，按内存中的 _id → nowuid 映射反查
+    """
+    def __init__(self, debounce: float, full_interval: float, default_markup: float):
+        self.debounce = debounce
+        self.full_interval = full_interval
+        self.default_markup = default_markup
+        self._ejfl_ids = {}   # ejfl _id → nowuid（全量校准与增量读取时维护，读写都持有 _ids_lock）
+        self._ids_lock = threading.Lock()
+        self._reconcile_deleted = None  # 全量校准扫描期间收到删除事件的 _id
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_full = 0.0
+        self.last_stats = None
+
+    def mark_dirty(self, nowuid: str = None):
+        """记录变更的商品（nowuid 为 None 时下一轮执行全量校准）"""
+        with self._lock:
+            if nowuid is None:
+                self._last_full = 0.0
+            else:
+                self._dirty.add(nowuid)
+
+    def _active_agents(self) -> dict:
+        """活跃代理及其新商品默认加价 {agent_bot_id: markup}"""
+        agents = {}
+        for a in agent_bots.find({'status': 'active'}, {'agent_bot_id': 1, 'default_markup': 1}):
+            markup = a.get('default_markup')
+            agents[a['agent_bot_id']] = float(markup) if isinstance(markup, (int, float)) else self.default_markup
+        return agents
+
+    def _publish(self, nowuids, agent_ids, stats):
+        product_sync_events.insert_one({
+            'nowuids': nowuids,
+            'full': nowuids is None,
+            'agents': len(agent_ids),
+            'inserted': stats['inserted'],
+            'updated': stats['updated'],
+            'deleted': stats.get('deleted', 0),
+            'created_at': datetime.utcnow(),
+        })
+
+    def flush(self):
+        """处理积压的变更：一次读取总部商品 → 批量写入所有代理 → 发布事件（读不到的商品视为已删除）"""
+        with self._lock:
+            nowuids = list(self._dirty)
+            self._dirty.clear()
+        if not nowuids:
+            return None
+        agents = self._active_agents()
+        start = time.time()
+        totals = {'inserted': 0, 'updated': 0, 'skipped': 0, 'activated': 0, 'errors': 0, 'deleted': 0}
+        for i in range(0, len(nowuids), AGENT_SYNC_BATCH_SIZE):
+            chunk = nowuids[i:i + AGENT_SYNC_BATCH_SIZE]
+            products = list(ejfl.find({'nowuid': {'$in': chunk}}, AGENT_SYNC_HQ_PROJECTION))
+            with self._ids_lock:
+                for p in products:
+                    self._ejfl_ids[p['_id']] = p.get('nowuid')
+            stats = fanout_products_to_agents(products, agents)
+            for k in stats:
+                totals[k] += stats[k]
+            deleted = set(chunk) - {p.get('nowuid') for p in products}
+            if deleted and agents:
+                totals['deleted'] += deactivate_deleted_products(
+                    agent_product_prices, agents, nowuids=deleted,
+                    now_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        self._publish(nowuids, agents, totals)
+        totals['products'] = len(nowuids)
+        totals['elapsed'] = round(time.time() - start, 2)
+        self.last_stats = totals
+        logging.info(
+            f"📤 商品同步已分发：商品={len(nowuids)}, 代理={len(agents)}, 新增={totals['inserted']}, "
+            f"更新={totals['updated']}, 下架={totals['deleted']}, 耗时={totals['elapsed']}s"
+        )
+        return totals
+
+    def full_reconcile(self):
+        """全量校准：对所有活跃代理执行一次批量同步，并下架总部已不存在的商品（兜底 Change Stream 不可用或漏事件）"""
+        agents = self._active_agents()
+        totals = {'inserted': 0, 'updated': 0, 'skipped': 0, 'activated': 0, 'errors': 0, 'deleted': 0}
+        ids = {}
+        batch = []
+        with self._ids_lock:
+            self._reconcile_deleted = set()
+        for product in ejfl.find({}, AGENT_SYNC_HQ_PROJECTION).batch_size(AGENT_SYNC_BATCH_SIZE):
+            ids[product['_id']] = product.get('nowuid')
+            batch.append(product)
+            if len(batch) >= AGENT_SYNC_BATCH_SIZE:
+                stats = fanout_products_to_agents(batch, agents)
+                for k in stats:
+                    totals[k] += stats[k]
+                batch = []
+        if batch:
+            stats = fanout_products_to_agents(batch, agents)
+            for k in stats:
+                totals[k] += stats[k]
+        with self._ids_lock:
+            # 扫描期间收到删除事件的商品不放回映射（删除已由增量同步处理）
+            for doc_id in self._reconcile_deleted:
+                ids.pop(doc_id, None)
+            self._reconcile_deleted = None
+            self._ejfl_ids = ids
+        if agents:
+            totals['deleted'] = deactivate_deleted_products(
+                agent_product_prices, agents, keep_nowuids=[n for n in ids.values() if n],
+                now_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        if totals['inserted'] or totals['updated'] or totals['deleted']:
+            self._publish(None, agents, totals)
+        self._last_full = time.time()
+        logging.info(f"📤 商品全量校准完成：代理={len(agents)}, 新增={totals['inserted']}, "
+                      f"更新={totals['updated']}, 下架={totals['deleted']}")
+        return totals
+
+    def _heartbeat(self):
+        product_sync_state.update_one(
+            {'_id': HQ_SYNC_PUBLISHER_ID},
+            {'$set': {'heartbeat': datetime.utcnow(), 'interval': self.debounce}},
+            upsert=True
+        )
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.debounce):
+            try:
+                self._heartbeat()
+                if time.time() - self._last_full >= self.full_interval:
+                    with self._lock:
+                        self._dirty.clear()
+                    self.full_reconcile()
+                else:
+                    self.flush()
+            except Exception as e:
+                logging.error(f"❌ 商品同步分发失败：{e}")
+
+    def _product_changed(self, coll: str, nowuid: str):
+        if coll == 'ejfl':
+            self.mark_dirty(nowuid)
+        share_card_manager.invalidate(nowuid)
+        stock_snapshot.mark_stale()
+
+    def _on_change(self, change: dict, pending: dict):
+        """处理一条变更事件；需要反查 nowuid 的 _id 放入 pending，按批解析"""
+        coll = change['ns']['coll']
+        op = change['operationType']
+        doc_id = change['documentKey']['_id']
+        nowuid = (change.get('fullDocument') or {}).get('nowuid')
+        if coll == 'ejfl':
+            if op == 'delete':
+                with self._ids_lock:
+                    nowuid = self._ejfl_ids.pop(doc_id, None)
+                    if self._reconcile_deleted is not None:
+                        self._reconcile_deleted.add(doc_id)
+                if nowuid is None:
+                    # 映射中没有（如发布器启动后尚未全量校准）：下一轮全量校准负责下架
+                    self.mark_dirty(None)
+                    return
+            elif nowuid:
+                with self._ids_lock:
+                    self._ejfl_ids[doc_id] = nowuid
+            else:
+                with self._ids_lock:
+                    nowuid = self._ejfl_ids.get(doc_id)
+        elif op == 'delete' and not nowuid:
+            # 已删除的库存无法反查商品：只标记库存快照陈旧，分享卡片随 TTL 过期
+            stock_snapshot.mark_stale()
+            return
+        if nowuid:
+            self._product_changed(coll, nowuid)
+        else:
+            pending[coll].add(doc_id)
+
+    def _resolve_pending(self, pending: dict):
+        """按批反查 update 事件对应的 nowuid（每批一次 $in，代替逐条 updateLookup）"""
+        for coll, collection in (('ejfl', ejfl), ('hb', hb)):
+            ids = pending[coll]
+            if not ids:
+                continue
+            pending[coll] = set()
+            for doc in collection.find({'_id': {'$in': list(ids)}}, {'nowuid': 1}):
+                if not doc.get('nowuid'):
+                    continue
+                if coll == 'ejfl':
+                    with self._ids_lock:
+                        self._ejfl_ids[doc['_id']] = doc['nowuid']
+                self._product_changed(coll, doc['nowuid'])
+
+    def _watch_loop(self):
+        # 不使用 updateLookup：只投影需要的字段，update 事件的 nowuid 按批反查
+        pipeline = [
+            {'$match': {
+                'ns.coll': {'$in': ['ejfl', 'hb']},
+                'operationType': {'$in': ['insert', 'update', 'replace', 'delete']},
+            }},
+            {'$project': {'ns': 1, 'operationType': 1, 'documentKey': 1, 'fullDocument.nowuid': 1}},
+        ]
+        while not self._stop.is_set():
+            try:
+                with db_manager.bot_db.watch(pipeline, max_await_time_ms=1000) as stream:
+                    logging.info("✅ 总部商品 Change Stream 已连接（ejfl/hb）")
+                    pending = {'ejfl': set(), 'hb': set()}
+                    while stream.alive and not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is None:
+                            self._resolve_pending(pending)
+                            continue
+                        self._on_change(change, pending)
+                        if len(pending['ejfl']) + len(pending['hb']) >= AGENT_SYNC_BATCH_SIZE:
+                            self._resolve_pending(pending)
+            except Exception as e:
+                error_msg = str(e).lower()
+                if 'repl' in error_msg or 'replica' in error_msg or 'not supported' in error_msg:
+                    logging.warning(f"⚠️ Change Stream 不可用，仅使用进程内通知与定时全量校准：{e}")
+                    return
+                logging.warning(f"⚠️ Change Stream 中断，5 秒后重连：{e}")
+                self._stop.wait(5)
+
+    def start(self):
+        """启动发布器后台线程"""
+        try:
+            product_sync_events.create_index('created_at', expireAfterSeconds=86400)
+        except Exception as e:
+            logging.warning(f"⚠️ 创建同步事件索引失败：{e}")
+        for target, name in ((self._flush_loop, 'ProductSyncFlush'), (self._watch_loop, 'ProductSyncWatch')):
+            t = threading.Thread(target=target, daemon=True, name=name)
+            t.start()
+            self._threads.append(t)
+        logging.info(f"✅ 总部商品同步发布器已启动（去抖 {self.debounce}s，全量校准间隔 {self.full_interval}s）")
+
+    def stop(self):
+        self._stop.set()
+
+product_sync_publisher = ProductSyncPublisher(HQ_SYNC_DEBOUNCE_SECONDS, HQ_SYNC_FULL_INTERVAL, AGENT_DEFAULT_MARKUP)
+set_product_sync_publisher(product_sync_publisher)
+
+HQ_RESTOCK_PUBLISHER_ID = 'hq_restock_fanout'
+RESTOCK_FANOUT_LOG_TTL = 3600
+
+# 补货分发覆盖记录：{_id: '<agent_bot_id>:<nowuid>', agent_bot_id, nowuid, at}，代理据此跳过已推送商品的频道转发
+restock_fanout_log = db_manager.bot_db["restock_fanout_log"]
+
+class RestockPublisher:
+    """
+    补货通知分发：总部每批补货渲染一次各代理的通知，用代理 token 直接发到代理补货群
+    - 代理启动时把补货群登记到 agent_bots.restock_chat_id，无需加入总部频道、也无需逐条监听匹配关键词
+    - 价格按代理加价（agent_product_prices，未上架的商品不推送），按钮深链到代理机器人
+    - 每个代理一个发送任务，共用线程池并发，每个 token 走自己的限速器
+    - 分发前登记每个代理覆盖的商品（restock_fanout_log），代理只跳过这些商品的频道转发，
+      手工发布的帖子和尚未建立代理价格的商品仍由代理转发
+    - 定期写入心跳，代理据此判断分发是否在线
+    """
+    def __init__(self, enabled: bool, workers: int, digest_threshold: int):
+        self.enabled = enabled
+        self.digest_threshold = digest_threshold
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='RestockFanout')
+        self._lock = threading.Lock()
+        self.last_stats = None
+
+    def ensure_indexes(self):
+        try:
+            restock_fanout_log.create_index('at', expireAfterSeconds=RESTOCK_FANOUT_LOG_TTL)
+        except Exception as e:
+            logging.warning(f"⚠️ 创建补货分发记录索引失败：{e}")
+
+    def _record_coverage(self, markups: dict):
+        """登记各代理本批覆盖的商品（一次无序 bulk_write）"""
+        now = datetime.utcnow()
+        ops = [
+            pymongo.UpdateOne({'_id': f"{agent_bot_id}:{nowuid}"},
+                              {'$set': {'agent_bot_id': agent_bot_id, 'nowuid': nowuid, 'at': now}}, upsert=True)
+            for agent_bot_id, prices in markups.items() for nowuid in prices
+        ]
+        if ops:
+            try:
+                restock_fanout_log.bulk_write(ops, ordered=False)
+            except Exception as e:
+                logging.warning(f"⚠️ 登记补货分发记录失败：{e}")
+
+    def heartbeat(self):
+        product_sync_state.update_one(
+            {'_id': HQ_RESTOCK_PUBLISHER_ID},
+            {'$set': {'heartbeat': datetime.utcnow(), 'enabled': self.enabled}},
+            upsert=True
+        )
+
+    def _targets(self) -> list:
+        return list(agent_bots.find(
+            {'status': 'active', 'restock_chat_id': {'$nin': [None, '']}},
+            {'agent_bot_id': 1, 'agent_token': 1, 'agent_username': 1, 'restock_chat_id': 1}
+        ))
+
+    def publish(self, items: list):
+        """分发一批补货（items 来自 StockNotificationManager.resolve），立即返回"""
+        if not self.enabled or not items:
+            return
+        try:
+            agents = [a for a in self._targets() if a.get('agent_token')]
+            if not agents:
+                return
+            nowuids = [i['nowuid'] for i in items]
+            markups = {}
+            for doc in agent_product_prices.find(
+                {'agent_bot_id': {'$in': [a['agent_bot_id'] for a in agents]},
+                 'original_nowuid': {'$in': nowuids}, 'is_active': True},
+                {'agent_bot_id': 1, 'original_nowuid': 1, 'agent_markup': 1}
+            ):
+                markups.setdefault(doc['agent_bot_id'], {})[doc['original_nowuid']] = float(doc.get('agent_markup', 0.0))
+        except Exception as e:
+            logging.error(f"❌ 读取补货分发目标失败：{e}")
+            return
+        self._record_coverage(markups)
+        stats = self.last_stats = {'agents': len(agents), 'products': len(items), 'sent': 0, 'failed': 0}
+        for agent in agents:
+            self._executor.submit(self._send_agent, agent, items, markups.get(agent['agent_bot_id'], {}), stats)
+        logging.info(f"📤 补货通知分发：商品={len(items)}, 代理={len(agents)}")
+
+    def _count(self, stats: dict, key: str):
+        with self._lock:
+            stats[key] += 1
+
+    def _send_agent(self, agent: dict, items: list, markups: dict, stats: dict):
+        """渲染并发送单个代理的补货通知"""
+        agent_items = [dict(i, price=round(i['price'] + markups[i['nowuid']], 2)) for i in items if i['nowuid'] in markups]
+        if not agent_items:
+            return
+        token = agent['agent_token']
+        try:
+            bot = get_bot(token)
+            username = (agent.get('agent_username') or '').lstrip('@') or bot.username
+            url_for = lambda nowuid: f"https://t.me/{username}?start=product_{nowuid}"
+            if len(agent_items) >= self.digest_threshold:
+                posts = [(render_restock_digest(agent_items), agent_items)]
+            else:
+                posts = [(render_restock_text(i['name'], i['price'], i['count'], i['stock']), [i]) for i in agent_items]
+            for text, group in posts:
+                keyboard = restock_keyboard(group, url_for)
+                status, error = deliver(
+                    lambda chat_id: bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML',
+                                                     reply_markup=keyboard, disable_web_page_preview=True),
+                    agent['restock_chat_id'], get_limiter(token)
+                )
+                if status != SENT:
+                    raise RuntimeError(error)
+            self._count(stats, 'sent')
+        except Exception as e:
+            self._count(stats, 'failed')
+            logging.warning(f"⚠️ 代理 {agent['agent_bot_id']} 补货通知发送失败：{e}")
+
+restock_publisher = RestockPublisher(RESTOCK_FANOUT_ENABLED, RESTOCK_FANOUT_WORKERS, STOCK_NOTIFICATION_DIGEST_THRESHOLD)
+stock_manager.publisher = restock_publisher
+
+# ================================ 用户充值汇总 ================================
+
+INCOME_ALIPAY_TYPES = ['alipay', 'zhifubao']
+INCOME_WECHAT_TYPES = ['wechat', 'weixin', 'wxpay']
+INCOME_USDT_TYPES = ['usdt', 'USDT']
+INCOME_USDT_RATE = 7.2  # 汇总排行中 USDT 折算人民币的汇率
+
+# ('overview',) / ('page', page, per_page) -> 聚合结果；到账时主动失效，TTL 兜底
+income_summary_cache = TTLCache(INCOME_SUMMARY_CACHE_TTL)
+
+def invalidate_income_summary():
+    """充值到账后使用户充值汇总快照失效"""
+    income_summary_cache.invalidate()
+
+def _sum_money_if(types):
+    return {'$sum': {'$cond': [{'$in': ['$cz_type', types]}, {'$ifNull': ['$money', 0]}, 0]}}
+
+def _income_summary_pipeline():
+    """按用户聚合成功充值，按总价值倒序（与原 Python 汇总口径一致）"""
+    return [
+        {'$match': {'status': 'success'}},
+        {'$group': {
+            '_id': '$user_id',
+            'alipay': _sum_money_if(INCOME_ALIPAY_TYPES),
+            'wechat': _sum_money_if(INCOME_WECHAT_TYPES),
+            'usdt': _sum_money_if(INCOME_USDT_TYPES),
+            'count': {'$sum': 1},
+            'first_time': {'$min': '$time'},
+            'last_time': {'$max': '$time'},
+        }},
+        {'$addFields': {'rmb': {'$add': ['$alipay', '$wechat']}}},
+        {'$addFields': {'total_value': {'$add': ['$rmb', {'$multiply': ['$usdt', INCOME_USDT_RATE]}]}}},
+        {'$sort': {'total_value': -1, '_id': 1}},
+    ]
+
+def get_income_summary_overview() -> dict:
+    """全部付费用户的合计（用户数/人民币/USDT/笔数）"""
+    cached = income_summary_cache.get(('overview',))
+    if cached is not None:
+        return cached
+    rows = list(topup.aggregate([
+        {'$match': {'status': 'success'}},
+        {'$group': {
+            '_id': '$user_id',
+            'rmb': _sum_money_if(INCOME_ALIPAY_TYPES + INCOME_WECHAT_TYPES),
+            'usdt': _sum_money_if(INCOME_USDT_TYPES),
+            'count': {'$sum': 1},
+        }},
+        {'$group': {
+            '_id': None,
+            'users': {'$sum': 1},
+            'rmb': {'$sum': '$rmb'},
+            'usdt': {'$sum': '$usdt'},
+            'count': {'$sum': '$count'},
+        }},
+        {'$project': {'_id': 0}},
+    ], allowDiskUse=True))
+    overview = rows[0] if rows else {'users': 0, 'rmb': 0, 'usdt': 0, 'count': 0}
+    overview['total_value'] = overview['rmb'] + overview['usdt'] * INCOME_USDT_RATE
+    income_summary_cache.set(('overview',), overview)
+    return overview
+
+def get_income_summary_page(page: int, per_page: int = 10) -> list:
+    """充值排行的一页（$sort/$skip/$limit 在数据库内完成）"""
+    key = ('page', page, per_page)
+    cached = income_summary_cache.get(key)
+    if cached is not None:
+        return cached
+    pipeline = _income_summary_pipeline() + [{'$skip': max(page - 1, 0) * per_page}, {'$limit': per_page}]
+    rows = list(topup.aggregate(pipeline, allowDiskUse=True))
+    income_summary_cache.set(key, rows)
+    return rows
+
+def iter_income_summary(batch_size: int = 1000):
+    """按排行顺序流式返回全部用户汇总（导出使用）"""
+    return topup.aggregate(_income_summary_pipeline(), allowDiskUse=True, batchSize=batch_size)
+
+AGENT_STATS_PERIOD_DAYS = {'7d': 7, '17d': 17, '30d': 30, '90d': 90}
+
+# (agent_bot_id, period) -> 统计结果；订单/提现/用户写入时主动失效，TTL 兜底代理进程直接写入的订单
+agent_stats_cache = TTLCache(AGENT_STATS_CACHE_TTL)
+
+def invalidate_agent_stats(agent_bot_id=None):
+    """订单/提现/用户变化后使代理统计缓存失效（agent_bot_id 为 None 时全部失效）"""
+    if agent_bot_id is None:
+        agent_stats_cache.invalidate()
+    else:
+        agent_stats_cache.invalidate_where(lambda key: key[0] == agent_bot_id)
+
+def _facet_first(result, name) -> dict:
+    rows = result[0].get(name) if result else None
+    return rows[0] if rows else {}
+
+def _agent_orders_facets(agent_bot_id, start_time):
+    """agent_orders：一次 $facet 同时得到周期与全部时间的销售额/佣金/订单数"""
+    group = {'$group': {
+        '_id': None,
+        'total_sales': {'$sum': {'$multiply': [{'$ifNull': ['$agent_price', 0]}, {'$ifNull': ['$quantity', 1]}]}},
+        'total_commission': {'$sum': {'$ifNull': ['$commission', 0]}},
+        'order_count': {'$sum': 1}
+    }}
+    facets = {'all': [group]}
+    if start_time:
+        facets['period'] = [
+            # 兼容 datetime 和 string 格式的 order_time
+            {'$addFields': {'_orderTime': {'$cond': {
+                'if': {'$eq': [{'$type': '$order_time'}, 'date']},
+                'then': '$order_time',
+                'else': {'$dateFromString': {'dateString': '$order_time', 'onError': None, 'onNull': None}}
+            }}}},
+            {'$match': {'_orderTime': {'$gte': start_time}}},
+            group
+        ]
+    result = list(agent_orders.aggregate([{'$match': {'agent_bot_id': agent_bot_id}}, {'$facet': facets}]))
+    all_time = _facet_first(result, 'all')
+    return (_facet_first(result, 'period') if start_time else all_time), all_time
+
+def _agent_gmjlu_facets(agent_bot_id, start_time):
+    """agent_gmjlu_{id}：一次 $facet 同时得到周期与全部时间的销售额/订单数"""
+    coll = get_agent_bot_gmjlu_collection(agent_bot_id)
+    group = {'$group': {'_id': None, 'total_sales': {'$sum': '$ts'}, 'order_count': {'$sum': 1}}}
+    facets = {'all': [group]}
+    if start_time:
+        facets['period'] = [{'$match': timer_range_filter(coll.name, 'timer', start_time)}, group]
+    result = list(coll.aggregate([{'$match': {'leixing': 'purchase'}}, {'$facet': facets}]))
+    all_time = _facet_first(result, 'all')
+    return (_facet_first(result, 'period') if start_time else all_time), all_time
+
+def _agent_withdrawal_facets(agent_bot_id):
+    """agent_withdrawals：一次 $facet 得到已完成提现总额与待处理提现笔数/金额"""
+    result = list(agent_withdrawals.aggregate([
+        {'$match': {'agent_bot_id': agent_bot_id, 'status': {'$in': ['completed', 'pending']}}},
+        {'$facet': {
+            'completed': [{'$match': {'status': 'completed'}},
+                          {'$group': {'_id': None, 'amount': {'$sum': '$amount'}}}],
+            'pending': [{'$match': {'status': 'pending'}},
+                        {'$group': {'_id': None, 'amount': {'$sum': '$amount'}, 'count': {'$sum': 1}}}],
+        }}
+    ]))
+    return _facet_first(result, 'completed'), _facet_first(result, 'pending')
+
+def _orders_source_totals(stats, commission_rate):
+    """agent_orders 统计 -> (销售额, 佣金, 订单数)；commission 字段缺失时按比例回退"""
+    sales = float(stats.get('total_sales', 0))
+    count = stats.get('order_count', 0)
+    commission = float(stats.get('total_commission', 0))
+    if commission == 0 and sales > 0:
+        commission = sales * commission_rate
+    return sales, commission, count
+
 def get_agent_stats(agent_bot_id, period='all'):
     """获取代理机器人的统计数据（基于 agent_orders 集合，兼容 agent_gmjlu_{id} 回退）
     
+    每个数据源一次 $facet 聚合（周期 + 全部时间 + 待处理），结果按 (agent_bot_id, period) 缓存
+    
     Args:
         agent_bot_id: 代理机器人ID
         period: 时间周期 '7d'|'17d'|'30d'|'90d'|'all'
@@ -856,284 +2522,69 @@ def get_agent_stats(agent_bot_id, period='all'):
         dict: 统计数据字典，包含销售额、佣金、订单数等信息
         None: 如果发生错误
     """
+    cache_key = (agent_bot_id, period)
+    cached = agent_stats_cache.get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
     try:
-        logging.info(f"🔍 get_agent_stats called for agent_bot_id: {agent_bot_id}, period: {period}")
-        
         # 获取代理机器人基本信息
-        agent_info = agent_bots.find_one({'agent_bot_id': agent_bot_id})
+        agent_info = agent_bots.find_one({'agent_bot_id': agent_bot_id}, {'agent_name': 1, 'commission_rate': 1})
         if not agent_info:
             logging.warning(f"❌ Agent not found: {agent_bot_id}")
             return None
         
-        # 提取ID后缀用于集合名称
         id_suffix = _get_agent_id_suffix(agent_bot_id)
-        logging.info(f"✅ Found agent: {agent_info.get('agent_name')}, ID suffix: {id_suffix}")
-        
         commission_rate = agent_info.get('commission_rate', 0) / 100
-        logging.info(f"📊 Commission rate: {commission_rate}")
         
         # 计算时间范围
         start_time = None
         if period != 'all':
-            days_map = {'7d': 7, '17d': 17, '30d': 30, '90d': 90}
-            days = days_map.get(period, 30)
-            start_time = datetime.now() - timedelta(days=days)
-            logging.info(f"📅 Time filter: orders since {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        
-        # ========== 主统计源：agent_orders 集合 ==========
-        total_sales = 0.0
-        order_count = 0
-        total_commission = 0.0
-        data_source = "agent_orders"
-        
-        orders_sales = 0.0
-        orders_count = 0
-        orders_commission = 0.0
+            start_time = datetime.now() - timedelta(days=AGENT_STATS_PERIOD_DAYS.get(period, 30))
         
+        # ========== agent_orders / agent_gmjlu 各一次 $facet ==========
+        orders_period, orders_all = {}, {}
         try:
-            # 构建时间过滤管道（兼容 datetime 和 string 格式）
-            pipeline = []
-            
-            # 1. 匹配代理机器人
-            match_stage = {'agent_bot_id': agent_bot_id}
-            pipeline.append({'$match': match_stage})
-            
-            # 2. 归一化 order_time 字段为 datetime 类型
-            pipeline.append({
-                '$addFields': {
-                    '_orderTime': {
-                        '$cond': {
-                            'if': {'$eq': [{'$type': '$order_time'}, 'date']},
-                            'then': '$order_time',
-                            'else': {
-                                '$dateFromString': {
-                                    'dateString': '$order_time',
-                                    'onError': None,
-                                    'onNull': None
-                                }
-                            }
-                        }
-                    }
-                }
-            })
-            
-            # 3. 时间过滤（如果需要）
-            if start_time:
-                pipeline.append({
-                    '$match': {
-                        '_orderTime': {'$gte': start_time}
-                    }
-                })
-            
-            # 4. 聚合计算
-            pipeline.append({
-                '$group': {
-                    '_id': None,
-                    'total_sales': {
-                        '$sum': {
-                            '$multiply': [
-                                {'$ifNull': ['$agent_price', 0]},
-                                {'$ifNull': ['$quantity', 1]}
-                            ]
-                        }
-                    },
-                    'total_commission': {
-                        '$sum': {
-                            '$ifNull': ['$commission', 0]
-                        }
-                    },
-                    'order_count': {'$sum': 1}
-                }
-            })
-            
-            result = list(agent_orders.aggregate(pipeline))
-            
-            if result and result[0]['order_count'] > 0:
-                stats = result[0]
-                orders_sales = float(stats.get('total_sales', 0))
-                orders_count = stats.get('order_count', 0)
-                orders_commission = float(stats.get('total_commission', 0))
-                
-                # 如果 commission 字段缺失，回退计算
-                if orders_commission == 0 and orders_sales > 0:
-                    orders_commission = orders_sales * commission_rate
-                
-                logging.info(f"📊 agent_orders data - Sales: {orders_sales:.2f}, Commission: {orders_commission:.2f}, Orders: {orders_count}")
+            orders_period, orders_all = _agent_orders_facets(agent_bot_id, start_time)
         except Exception as e:
             logging.warning(f"⚠️ Error querying agent_orders: {str(e)}")
-            orders_count = 0
-        
-        # ========== 同时检查 agent_gmjlu 集合 ==========
-        gmjlu_sales = 0.0
-        gmjlu_count = 0
-        gmjlu_commission = 0.0
         
+        gmjlu_period, gmjlu_all = {}, {}
         try:
-            agent_gmjlu = get_agent_bot_gmjlu_collection(agent_bot_id)
-            
-            # 构建时间过滤
-            match_filter = {'leixing': 'purchase'}
-            if start_time:
-                start_time_str = start_time.strftime('%Y-%m-%d %H:%M:%S')
-                match_filter['timer'] = {'$gte': start_time_str}
-            
-            pipeline = [
-                {'$match': match_filter},
-                {
-                    '$group': {
-                        '_id': None,
-                        'total_sales': {'$sum': '$ts'},
-                        'order_count': {'$sum': 1}
-                    }
-                }
-            ]
-            
-            result = list(agent_gmjlu.aggregate(pipeline))
-            
-            if result:
-                stats = result[0]
-                gmjlu_sales = float(stats.get('total_sales', 0))
-                gmjlu_count = stats.get('order_count', 0)
-                gmjlu_commission = gmjlu_sales * commission_rate
-                logging.info(f"📊 agent_gmjlu data - Sales: {gmjlu_sales:.2f}, Commission: {gmjlu_commission:.2f}, Orders: {gmjlu_count}")
+            gmjlu_period, gmjlu_all = _agent_gmjlu_facets(agent_bot_id, start_time)
         except Exception as e:
             logging.warning(f"⚠️ Error querying agent_gmjlu: {str(e)}")
-            gmjlu_count = 0
+        
+        orders_sales, orders_commission, orders_count = _orders_source_totals(orders_period, commission_rate)
+        gmjlu_sales = float(gmjlu_period.get('total_sales', 0))
+        gmjlu_count = gmjlu_period.get('order_count', 0)
         
         # ========== 选择数据更多的源 ==========
         if gmjlu_count > orders_count:
-            # gmjlu 有更多数据，使用它
-            total_sales = gmjlu_sales
-            order_count = gmjlu_count
-            total_commission = gmjlu_commission
+            total_sales, total_commission, order_count = gmjlu_sales, gmjlu_sales * commission_rate, gmjlu_count
             data_source = f"agent_gmjlu_{id_suffix}"
-            logging.info(f"✅ Using gmjlu (has more data: {gmjlu_count} vs {orders_count} orders)")
         elif orders_count > 0:
-            # agent_orders 有数据且更多，使用它
-            total_sales = orders_sales
-            order_count = orders_count
-            total_commission = orders_commission
+            total_sales, total_commission, order_count = orders_sales, orders_commission, orders_count
             data_source = "agent_orders"
-            logging.info(f"✅ Using agent_orders (has more data: {orders_count} vs {gmjlu_count} orders)")
         else:
-            # 两边都没数据
-            total_sales = 0.0
-            order_count = 0
-            total_commission = 0.0
+            total_sales, total_commission, order_count = 0.0, 0.0, 0
             data_source = "none"
-            logging.warning(f"⚠️ No data in either agent_orders or agent_gmjlu")
-        
-        logging.info(f"📊 Final data source: {data_source} - Sales: {total_sales:.2f}, Commission: {total_commission:.2f}, Orders: {order_count}")
-        
-        # ========== 计算已提现金额（全部时间，从 agent_withdrawals） ==========
-        withdrawal_pipeline = [
-            {
-                '$match': {
-                    'agent_bot_id': agent_bot_id,
-                    'status': 'completed'
-                }
-            },
-            {
-                '$group': {
-                    '_id': None,
-                    'total_withdrawn': {'$sum': '$amount'}
-                }
-            }
-        ]
         
-        withdrawal_result = list(agent_withdrawals.aggregate(withdrawal_pipeline))
-        withdrawn_amount = float(withdrawal_result[0].get('total_withdrawn', 0)) if withdrawal_result else 0.0
+        # ========== 提现：已完成总额 + 待处理（一次 $facet） ==========
+        completed, pending = _agent_withdrawal_facets(agent_bot_id)
+        withdrawn_amount = float(completed.get('amount', 0))
         
-        # ========== 计算可用余额（全部时间累计佣金 - 已提现金额） ==========
-        # 如果当前周期不是"全部"，需要重新计算全部时间的佣金
-        if period != 'all':
-            # 同时查询 agent_orders 和 agent_gmjlu 的全部时间数据
-            all_orders_commission = 0.0
-            all_orders_count = 0
-            all_gmjlu_commission = 0.0
-            all_gmjlu_count = 0
-            
-            try:
-                # 从 agent_orders 获取全部时间数据
-                all_time_pipeline = [
-                    {'$match': {'agent_bot_id': agent_bot_id}},
-                    {
-                        '$group': {
-                            '_id': None,
-                            'total_sales': {
-                                '$sum': {
-                                    '$multiply': [
-                                        {'$ifNull': ['$agent_price', 0]},
-                                        {'$ifNull': ['$quantity', 1]}
-                                    ]
-                                }
-                            },
-                            'total_commission': {
-                                '$sum': {'$ifNull': ['$commission', 0]}
-                            },
-                            'order_count': {'$sum': 1}
-                        }
-                    }
-                ]
-                
-                all_result = list(agent_orders.aggregate(all_time_pipeline))
-                
-                if all_result and all_result[0].get('order_count', 0) > 0:
-                    all_orders_count = all_result[0].get('order_count', 0)
-                    all_orders_commission = float(all_result[0].get('total_commission', 0))
-                    if all_orders_commission == 0:
-                        all_total_sales = float(all_result[0].get('total_sales', 0))
-                        all_orders_commission = all_total_sales * commission_rate
-            except Exception as e:
-                logging.warning(f"⚠️ Error getting all-time agent_orders data: {e}")
-            
-            try:
-                # 从 agent_gmjlu 获取全部时间数据
-                agent_gmjlu = get_agent_bot_gmjlu_collection(agent_bot_id)
-                all_sales_pipeline = [
-                    {'$match': {'leixing': 'purchase'}},
-                    {
-                        '$group': {
-                            '_id': None,
-                            'total_sales': {'$sum': '$ts'},
-                            'order_count': {'$sum': 1}
-                        }
-                    }
-                ]
-                all_sales_result = list(agent_gmjlu.aggregate(all_sales_pipeline))
-                if all_sales_result and all_sales_result[0].get('order_count', 0) > 0:
-                    all_gmjlu_count = all_sales_result[0].get('order_count', 0)
-                    all_total_sales = float(all_sales_result[0].get('total_sales', 0))
-                    all_gmjlu_commission = all_total_sales * commission_rate
-            except Exception as e:
-                logging.warning(f"⚠️ Error getting all-time agent_gmjlu data: {e}")
-            
-            # 使用数据更多的源计算余额
-            if all_gmjlu_count > all_orders_count:
-                all_total_commission = all_gmjlu_commission
-                logging.info(f"💰 All-time commission from gmjlu: {all_total_commission:.2f} ({all_gmjlu_count} orders)")
-            else:
-                all_total_commission = all_orders_commission
-                logging.info(f"💰 All-time commission from agent_orders: {all_total_commission:.2f} ({all_orders_count} orders)")
-            
-            available_balance = all_total_commission - withdrawn_amount
+        # ========== 可用余额 = 全部时间累计佣金 - 已提现金额（同一次 $facet 已包含全部时间） ==========
+        _, all_orders_commission, all_orders_count = _orders_source_totals(orders_all, commission_rate)
+        all_gmjlu_count = gmjlu_all.get('order_count', 0)
+        if all_gmjlu_count > all_orders_count:
+            all_total_commission = float(gmjlu_all.get('total_sales', 0)) * commission_rate
         else:
-            available_balance = total_commission - withdrawn_amount
-        
-        logging.info(f"💰 Withdrawn: {withdrawn_amount:.2f}, Available balance: {available_balance:.2f}")
+            all_total_commission = all_orders_commission
+        available_balance = all_total_commission - withdrawn_amount
         
-        # ========== 获取用户数量（全部时间） ==========
-        agent_users = get_agent_bot_user_collection(agent_bot_id)
-        total_users = agent_users.count_documents({})
-        logging.info(f"👥 Total users: {total_users}")
-        
-        # ========== 获取待处理提现（全部时间） ==========
-        pending_withdrawals = list(agent_withdrawals.find({
-            'agent_bot_id': agent_bot_id,
-            'status': 'pending'
-        }))
-        pending_withdrawal_count = len(pending_withdrawals)
-        pending_withdrawal_amount = sum(w.get('amount', 0) for w in pending_withdrawals)
+        # ========== 用户数量（集合元数据计数） ==========
+        total_users = get_agent_bot_user_collection(agent_bot_id).estimated_document_count()
         
         # ========== 计算平均订单额和利润率 ==========
         avg_order = (total_sales / order_count) if order_count > 0 else 0.0
@@ -1146,17 +2597,18 @@ def get_agent_stats(agent_bot_id, period='all'):
             'withdrawn_amount': withdrawn_amount,
             'total_users': total_users,
             'order_count': order_count,
-            'pending_withdrawal_count': pending_withdrawal_count,
-            'pending_withdrawal_amount': float(pending_withdrawal_amount),
+            'pending_withdrawal_count': pending.get('count', 0),
+            'pending_withdrawal_amount': float(pending.get('amount', 0)),
             'avg_order': avg_order,
             'profit_rate': profit_rate,
             'period': period,
             'data_source': data_source  # 用于调试
         }
         
-        logging.info(f"✅ get_agent_stats returning: {result_stats}")
-        
-        return result_stats
+        logging.debug(f"get_agent_stats {agent_bot_id}/{period}: {result_stats}")
+        logging.info(f"📊 代理统计已计算：{agent_bot_id}/{period}，来源={data_source}，订单={order_count}")
+        agent_stats_cache.set(cache_key, result_stats)
+        return dict(result_stats)
         
     except Exception as e:
         logging.error(f"❌ 获取代理统计数据失败：{e}")
@@ -1178,6 +2630,392 @@ def get_agent_stats(agent_bot_id, period='all'):
             'data_source': 'error'
         }
 
+# ================================ 代理分析汇总（跨代理排行） ================================
+#
+# agent_analytics 文档（_id = agent_bot_id）：
+#   来源计数：orders_sales/orders_commission/orders_count（agent_orders）、gmjlu_sales/gmjlu_count（agent_gmjlu_*）
+#   提现：withdrawn_amount、pending_withdrawal_count/pending_withdrawal_amount
+#   用户：total_users
+#   派生（每次写入在同一条流水线更新内重算，与 get_agent_stats('all') 口径一致）：
+#     total_sales/total_commission/order_count（取订单数更多的来源）、available_balance
+# 订单/提现/用户写入时增量更新（代理进程 $inc 后标记 dirty，由 refresh_dirty_agent_analytics 重算派生字段）；
+# reconcile_agent_analytics 定时按源数据校正（覆盖状态变更等非增量场景）
+
+AGENT_ANALYTICS_SORT_FIELDS = {
+    'sales': 'total_sales',
+    'commission': 'total_commission',
+    'orders': 'order_count',
+    'users': 'total_users',
+    'withdrawals': 'pending_withdrawal_amount',
+    'balance': 'available_balance',
+}
+
+def _analytics_num(field):
+    return {'$ifNull': [f'${field}', 0]}
+
+def _agent_analytics_derived_stages():
+    """由来源计数重算派生字段（update pipeline）"""
+    rate = {'$divide': [_analytics_num('commission_rate'), 100]}
+    use_gmjlu = {'$gt': [_analytics_num('gmjlu_count'), _analytics_num('orders_count')]}
+    orders_commission = {'$cond': [
+        {'$and': [{'$eq': [_analytics_num('orders_commission'), 0]}, {'$gt': [_analytics_num('orders_sales'), 0]}]},
+        {'$multiply': [_analytics_num('orders_sales'), rate]},
+        _analytics_num('orders_commission'),
+    ]}
+    return [
+        {'$set': {
+            'total_sales': {'$cond': [use_gmjlu, _analytics_num('gmjlu_sales'), _analytics_num('orders_sales')]},
+            'order_count': {'$cond': [use_gmjlu, _analytics_num('gmjlu_count'), _analytics_num('orders_count')]},
+            'total_commission': {'$cond': [use_gmjlu, {'$multiply': [_analytics_num('gmjlu_sales'), rate]}, orders_commission]},
+        }},
+        {'$set': {'available_balance': {'$subtract': ['$total_commission', _analytics_num('withdrawn_amount')]}}},
+    ]
+
+def record_agent_analytics(agent_bot_id, inc: dict, fields: dict = None):
+    """增量更新代理分析汇总（inc 为来源计数增量，fields 为直接覆盖的字段）"""
+    if not agent_bot_id:
+        return
+    values = {k: {'$add': [_analytics_num(k), v]} for k, v in inc.items()}
+    values.update({k: {'$literal': v} for k, v in (fields or {}).items()})
+    values['updated_at'] = '$$NOW'
+    try:
+        agent_analytics.update_one(
+            {'_id': agent_bot_id},
+            [{'$set': values}] + _agent_analytics_derived_stages(),
+            upsert=True
+        )
+    except Exception as e:
+        logging.warning(f"⚠️ 更新代理分析汇总失败 {agent_bot_id}: {e}")
+
+def refresh_dirty_agent_analytics() -> int:
+    """代理进程只做 $inc 并标记 dirty，这里统一重算派生字段"""
+    result = agent_analytics.update_many(
+        {'dirty': True},
+        [{'$set': {'dirty': False, 'updated_at': '$$NOW'}}] + _agent_analytics_derived_stages()
+    )
+    return result.modified_count
+
+def reconcile_agent_analytics(agent_bot_id=None) -> int:
+    """按源数据重算代理分析汇总（agent_bot_id 为 None 时全部代理），返回处理的代理数"""
+    query = {'agent_bot_id': agent_bot_id} if agent_bot_id else {}
+    projection = {'_id': 0, 'agent_bot_id': 1, 'agent_name': 1, 'agent_username': 1,
+                  'commission_rate': 1, 'status': 1, 'creation_time': 1}
+    processed = 0
+    known = []
+    for info in agent_bots.find(query, projection):
+        bot_id = info['agent_bot_id']
+        known.append(bot_id)
+        try:
+            _, orders_all = _agent_orders_facets(bot_id, None)
+            _, gmjlu_all = _agent_gmjlu_facets(bot_id, None)
+            completed, pending = _agent_withdrawal_facets(bot_id)
+            fields = {
+                'agent_name': info.get('agent_name', ''),
+                'agent_username': info.get('agent_username', ''),
+                'commission_rate': info.get('commission_rate', 0),
+                'status': info.get('status', 'active'),
+                'creation_time': info.get('creation_time', ''),
+                'orders_sales': float(orders_all.get('total_sales', 0)),
+                'orders_commission': float(orders_all.get('total_commission', 0)),
+                'orders_count': orders_all.get('order_count', 0),
+                'gmjlu_sales': float(gmjlu_all.get('total_sales', 0)),
+                'gmjlu_count': gmjlu_all.get('order_count', 0),
+                'withdrawn_amount': float(completed.get('amount', 0)),
+                'pending_withdrawal_count': pending.get('count', 0),
+                'pending_withdrawal_amount': float(pending.get('amount', 0)),
+                'total_users': get_agent_bot_user_collection(bot_id).estimated_document_count(),
+                'reconciled_at': datetime.now(),
+            }
+            record_agent_analytics(bot_id, {}, fields)
+            processed += 1
+        except Exception as e:
+            logging.warning(f"⚠️ 校正代理分析汇总失败 {bot_id}: {e}")
+    if agent_bot_id is None:
+        # 清理已删除代理的汇总
+        agent_analytics.delete_many({'_id': {'$nin': known}})
+    logging.info(f"📊 代理分析汇总校正完成：{processed} 个代理")
+    return processed
+
+def get_agent_analytics_page(sort_key: str = 'sales', page: int = 1, per_page: int = 10) -> dict:
+    """跨代理排行分页（单次索引排序查询）：{'items': [...], 'total': n, 'total_pages': n, 'page': p}"""
+    field = AGENT_ANALYTICS_SORT_FIELDS.get(sort_key, 'total_sales')
+    total = agent_analytics.estimated_document_count()
+    total_pages = max((total + per_page - 1) // per_page, 1)
+    page = min(max(page, 1), total_pages)
+    items = list(agent_analytics.find({}).sort([(field, -1), ('_id', 1)]).skip((page - 1) * per_page).limit(per_page))
+    return {'items': items, 'total': total, 'total_pages': total_pages, 'page': page}
+
+def get_agent_analytics(agent_bot_id) -> dict:
+    return agent_analytics.find_one({'_id': agent_bot_id}) or {}
+
+def get_agent_analytics_rank(agent_bot_id, sort_key: str = 'sales'):
+    """代理在某项指标上的名次（1 开始），无记录时返回 None"""
+    field = AGENT_ANALYTICS_SORT_FIELDS.get(sort_key, 'total_sales')
+    doc = agent_analytics.find_one({'_id': agent_bot_id}, {field: 1})
+    if not doc:
+        return None
+    return agent_analytics.count_documents({field: {'$gt': doc.get(field, 0)}}) + 1
+
+# ================================ 群发收件人 ================================
+
+BROADCAST_RECIPIENT_FILTER = {'bot_blocked': {'$ne': True}}
+
+def iter_broadcast_recipients(after=None, batch_size: int = 1000):
+    """按 user_id 升序流式产出可群发的 user_id（跳过已拉黑机器人的用户，只投影 user_id）；after 为续跑检查点"""
+    query = dict(BROADCAST_RECIPIENT_FILTER)
+    if after is not None:
+        query['user_id'] = {'$gt': after}
+    cursor = user.find(query, {'_id': 0, 'user_id': 1}).sort('user_id', 1).batch_size(batch_size)
+    for doc in cursor:
+        if doc.get('user_id') is not None:
+            yield doc['user_id']
+
+def count_broadcast_recipients() -> int:
+    """可群发用户数"""
+    return user.count_documents(BROADCAST_RECIPIENT_FILTER)
+
+def mark_user_blocked(user_id: int):
+    """记录用户已拉黑/注销，后续群发跳过"""
+    user.update_one({'user_id': user_id}, {'$set': {'bot_blocked': True, 'bot_blocked_at': datetime.now()}})
+
+def clear_user_blocked(user_id: int):
+    """用户重新与机器人交互后恢复接收群发"""
+    user.update_one({'user_id': user_id, 'bot_blocked': True}, {'$unset': {'bot_blocked': '', 'bot_blocked_at': ''}})
+
+# ================================ 红包 ================================
+# 红包创建时预先拆分金额（slots，单位分），领取时原子地占用下一个名额：
+# - qb 上 (uid, user_id) 唯一索引：先插入领取记录占位，重复领取直接失败
+# - hongbao.claimed 自增（claimed < hbsl 才能成功），名额下标即 claimed - 1，不会超领
+
+def split_hongbao(total, count: int) -> list:
+    """按正态分布预拆分红包金额（与原实时拆分算法一致），返回 count 个金额（元），合计等于 total"""
+    remaining = int(round(float(total) * 100))
+    slots = []
+    for left in range(count, 0, -1):
+        if left == 1:
+            cents = remaining
+        else:
+            mean = remaining / left
+            cents = int(round(random.normalvariate(mean, mean / 3)))
+            cents = min(max(cents, 1), remaining - (left - 1))
+        slots.append(cents)
+        remaining -= cents
+    return [c / 100 for c in slots]
+
+def create_hongbao(uid, user_id, fullname, hbmoney, hbsl: int, timer):
+    """创建红包（预拆分金额，taken_by 记录每个名额被哪次领取占用）"""
+    hongbao.insert_one({
+        'uid': uid,
+        'user_id': user_id,
+        'fullname': fullname,
+        'hbmoney': hbmoney,
+        'hbsl': hbsl,
+        'slots': split_hongbao(hbmoney, hbsl),
+        'taken_by': [None] * hbsl,
+        'claimed': 0,
+        'timer': timer,
+        'state': 0
+    })
+
+HONGBAO_LEGACY_TAKER = 'legacy'  # 补齐占用表时，已领取名额的占位标记
+
+def _ensure_hongbao_slots(uid):
+    """旧红包补齐：无 slots 的按已领取记录补齐剩余名额的预拆分；无 taken_by 的按已领取数补齐占用表"""
+    doc = hongbao.find_one({'uid': uid, 'state': 0}, {'hbmoney': 1, 'hbsl': 1, 'slots': 1, 'claimed': 1, 'taken_by': 1})
+    if doc is None or 'taken_by' in doc:
+        return False
+    if 'slots' in doc:
+        claimed = min(doc.get('claimed', 0), doc['hbsl'])
+        hongbao.update_one({'uid': uid, 'taken_by': {'$exists': False}},
+                           {'$set': {'taken_by': [HONGBAO_LEGACY_TAKER] * claimed + [None] * (doc['hbsl'] - claimed)}})
+        return True
+    claims = list(qb.find({'uid': uid, 'money': {'$ne': None}}, {'money': 1}))
+    taken = [float(c['money']) for c in claims]
+    left = max(doc['hbsl'] - len(taken), 0)
+    rest = split_hongbao(max(float(doc['hbmoney']) - sum(taken), 0.01 * left), left) if left else []
+    hongbao.update_one({'uid': uid, 'slots': {'$exists': False}},
+                       {'$set': {'slots': taken + rest, 'claimed': len(taken),
+                                 'taken_by': [HONGBAO_LEGACY_TAKER] * len(taken) + [None] * len(rest)}})
+    return True
+
+def _take_hongbao_slot(uid, token):
+    """原子占用第一个空闲名额（taken_by 中的 None 改为本次领取的 token）"""
+    return hongbao.find_one_and_update(
+        {'uid': uid, 'state': 0, 'slots': {'$exists': True}, 'taken_by': {'$elemMatch': {'$eq': None}}},
+        {'$set': {'taken_by.$': token}, '$inc': {'claimed': 1}},
+        return_document=ReturnDocument.AFTER
+    )
+
+def _release_hongbao_slot(uid, token) -> bool:
+    """归还 token 占用的名额（没有占用时不做任何事）"""
+    doc = hongbao.find_one({'uid': uid, 'taken_by': token}, {'taken_by': 1})
+    if doc is None:
+        return False
+    index = doc['taken_by'].index(token)
+    return hongbao.update_one(
+        {'uid': uid, f'taken_by.{index}': token},
+        {'$set': {f'taken_by.{index}': None, 'state': 0}, '$inc': {'claimed': -1}}
+    ).modified_count > 0
+
+HONGBAO_CLAIM_STALE_SECONDS = 60  # 占位记录超过该时间仍未写入金额，视为领取中断
+_qb_unique_index = False  # qb (uid, user_id) 唯一索引是否已建立；未建立时不受理领取
+
+def _claim_stale(claim: dict) -> bool:
+    claim_at = claim.get('claim_at')
+    return claim.get('money') is None and (
+        claim_at is None or (datetime.now() - claim_at).total_seconds() > HONGBAO_CLAIM_STALE_SECONDS)
+
+def _expire_hongbao_claim(claim: dict, new_token=None) -> bool:
+    """
+    作废过期占位的 token 并归还它占用的名额（不删除记录）
+
+    原领取若仍在进行，写入金额时 token 不匹配，会自行归还名额且不入账
+    """
+    update = {'claim_token': new_token}
+    if new_token is not None:
+        update['claim_at'] = datetime.now()
+    result = qb.update_one({'_id': claim['_id'], 'money': None, 'claim_token': claim.get('claim_token')},
+                           {'$set': update})
+    if result.modified_count == 0:
+        return False
+    if claim.get('claim_token'):
+        _release_hongbao_slot(claim['uid'], claim['claim_token'])
+    return True
+
+def recover_stale_hongbao_claims(limit: int = 200) -> int:
+    """定时任务：归还中断领取占用的名额（占位记录保留，用户再次领取时接管）"""
+    cutoff = datetime.now() - timedelta(seconds=HONGBAO_CLAIM_STALE_SECONDS)
+    recovered = 0
+    for claim in qb.find({'money': None, 'claim_token': {'$ne': None}, 'claim_at': {'$lt': cutoff}}).limit(limit):
+        if _expire_hongbao_claim(claim):
+            recovered += 1
+    if recovered:
+        logging.warning(f"⚠️ 已归还中断红包领取占用的名额：{recovered} 个")
+    return recovered
+
+def claim_hongbao(uid, user_id, fullname, timer) -> dict:
+    """
+    领取红包（并发安全）
+
+    - 占位记录带本次领取的 claim_token，只有 token 匹配的领取能写入金额并入账
+    - 过期占位由新的领取接管：作废旧 token 并归还其名额
+
+    Returns:
+        {'status': 'ok' | 'claimed' | 'empty' | 'missing' | 'unavailable', 'money', 'hongbao'}
+    """
+    if not _qb_unique_index:
+        logging.error("❌ qb 唯一索引未建立，暂停受理红包领取（请先执行 /migrate_hongbao_claims）")
+        return {'status': 'unavailable'}
+    token = uuid.uuid4().hex
+    try:
+        qb.insert_one({'uid': uid, 'user_id': user_id, 'fullname': fullname, 'money': None, 'timer': timer,
+                       'claim_token': token, 'claim_at': datetime.now()})
+    except DuplicateKeyError:
+        existing = qb.find_one({'uid': uid, 'user_id': user_id})
+        if existing is None or not _claim_stale(existing) or not _expire_hongbao_claim(existing, token):
+            return {'status': 'claimed'}
+        logging.warning(f"⚠️ 接管中断的红包领取：uid={uid}, user_id={user_id}")
+
+    doc = _take_hongbao_slot(uid, token)
+    if doc is None and _ensure_hongbao_slots(uid):
+        doc = _take_hongbao_slot(uid, token)
+    if doc is None:
+        qb.delete_one({'uid': uid, 'user_id': user_id, 'money': None, 'claim_token': token})
+        return {'status': 'empty' if hongbao.count_documents({'uid': uid}, limit=1) else 'missing'}
+    money = doc['slots'][doc['taken_by'].index(token)]
+    written = qb.update_one({'uid': uid, 'user_id': user_id, 'claim_token': token, 'money': None},
+                            {'$set': {'money': money}, '$unset': {'claim_at': ''}})
+    if written.modified_count == 0:
+        # 本次领取超时已被接管：归还名额，不入账
+        _release_hongbao_slot(uid, token)
+        return {'status': 'claimed'}
+    user.update_one({'user_id': user_id}, [{'$set': {'USDT': {'$round': [{'$add': ['$USDT', money]}, 2]}}}])
+    if doc['claimed'] >= doc['hbsl']:
+        hongbao.update_one({'uid': uid, 'claimed': {'$gte': doc['hbsl']}}, {'$set': {'state': 1}})
+        doc['state'] = 1
+    return {'status': 'ok', 'money': money, 'hongbao': doc}
+
+def get_hongbao_claims(uid) -> list:
+    """已领取记录（金额倒序）"""
+    return list(qb.find({'uid': uid, 'money': {'$ne': None}}, sort=[('money', -1)]))
+
+def migrate_hongbao_claims() -> dict:
+    """
+    一次性迁移（管理员命令 /migrate_hongbao_claims）：归档 qb 中同一用户对同一红包的重复领取记录，再建立唯一索引
+
+    每组保留已写入金额的一条，其余移入 qb_duplicates（保留原文档与归档时间），不直接删除
+    """
+    global _qb_unique_index
+    archive = db_manager.bot_db['qb_duplicates']
+    pipeline = [
+        {'$sort': {'money': -1, '_id': 1}},
+        {'$group': {'_id': {'uid': '$uid', 'user_id': '$user_id'}, 'ids': {'$push': '$_id'}, 'n': {'$sum': 1}}},
+        {'$match': {'n': {'$gt': 1}}},
+    ]
+    groups = archived = 0
+    now = datetime.now()
+    for group in qb.aggregate(pipeline, allowDiskUse=True):
+        groups += 1
+        extra = group['ids'][1:]
+        docs = list(qb.find({'_id': {'$in': extra}}))
+        if docs:
+            archive.bulk_write([pymongo.ReplaceOne({'_id': d['_id']}, dict(d, archived_at=now), upsert=True)
+                                for d in docs], ordered=False)
+            archived += qb.delete_many({'_id': {'$in': [d['_id'] for d in docs]}}).deleted_count
+    qb.create_index([('uid', 1), ('user_id', 1)], unique=True)
+    _qb_unique_index = True
+    result = {'groups': groups, 'archived': archived}
+    logging.info(f"✅ 红包领取记录迁移完成：{result}")
+    return result
+
+def init_hongbao_indexes():
+    """
+    红包索引：qb 唯一索引只在没有重复领取记录时能建立（建立失败不修改数据）；
+    存在历史重复时需管理员执行 /migrate_hongbao_claims，之前暂停受理领取
+    """
+    global _qb_unique_index
+    try:
+        hongbao.create_index('uid')
+        hongbao.create_index([('user_id', 1), ('state', 1)])
+        qb.create_index([('uid', 1), ('money', -1)])
+        qb.create_index('claim_at', sparse=True)
+    except Exception as e:
+        logging.error(f"❌ 红包索引初始化失败：{e}")
+    try:
+        qb.create_index([('uid', 1), ('user_id', 1)], unique=True)
+        _qb_unique_index = True
+    except Exception as e:
+        logging.error(f"❌ 红包领取唯一索引创建失败（存在重复领取记录，请执行 /migrate_hongbao_claims）：{e}")
+
+init_hongbao_indexes()
+
+# ================================ 核心集合索引 ================================
+
+def init_core_indexes():
+    """为商品/库存热点查询创建索引"""
+    try:
+        hb.create_index([("nowuid", 1), ("state", 1)])
+        ejfl.create_index("nowuid")
+        fenlei.create_index("uid")
+        fyb.create_index("text")
+        user.create_index("user_id")
+        # 导出/明细游标按时间倒序扫描
+        gmjlu.create_index([("timer", -1)])
+        # 购买记录键集分页（前缀同时覆盖按 user_id 关联/计数）
+        gmjlu.create_index([("user_id", 1), ("timer", -1), ("_id", -1)])
+        # 销售汇总回填期间写入的待补记订单
+        gmjlu.create_index("rollup_pending", sparse=True)
+        topup.create_index([("status", 1), ("time", -1)])
+        topup.create_index("user_id")
+        stock_alert_log.create_index([("time", -1)])
+        logging.info("✅ 核心集合索引初始化完成")
+        return True
+    except Exception as e:
+        logging.error(f"❌ 核心集合索引初始化失败：{e}")
+        return False
+
+init_core_indexes()
+
 # ================================ 初始化多机器人分销系统 ================================
 
 def init_multi_bot_distribution_system():
@@ -1191,6 +3029,9 @@ def init_multi_bot_distribution_system():
         agent_product_prices.create_index([("agent_bot_id", 1), ("original_nowuid", 1), ("is_active", 1)])
         agent_orders.create_index([("agent_bot_id", 1), ("order_time", -1)])
         agent_withdrawals.create_index([("agent_bot_id", 1), ("status", 1)])
+        for field in AGENT_ANALYTICS_SORT_FIELDS.values():
+            agent_analytics.create_index([(field, -1), ("_id", 1)])
+        agent_analytics.create_index("dirty", sparse=True)
         
         # 总部提现申请表索引
         withdrawal_requests.create_index([("user_id", 1), ("status", 1)])
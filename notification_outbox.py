@@ -0,0 +1,200 @@
+"""
+通知发件箱
+
+- 业务处理（购买/充值/提现/余额调整）只把通知写入 notification_outbox 集合后立即返回，不在用户请求路径上调用 Telegram
+- 每个进程一个发件人（sender），由定时任务取出本进程的待发通知发送；多进程共用一个集合互不干扰
+- 同一接收人、同一主题在合并窗口内的多条通知合并为一条摘要（例如 5 秒内多笔购买 → 每个管理员一条）
+- 发送走 broadcast_engine 的共享限速器：遵守 RetryAfter，瞬时错误重试，失败超过次数后放弃
+- 多段摘要发送前固定成员与分段（batch/parts），逐段记录进度（sent_parts），重试时从未发送的分段继续
+"""
+import os
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardMarkup
+
+from bot_clients import get_bot
+from broadcast_engine import deliver, get_limiter, SENT, BLOCKED
+
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '2'))          # 发件箱检查间隔
+OUTBOX_DIGEST_WINDOW = float(os.getenv('OUTBOX_DIGEST_WINDOW', '5'))        # 合并窗口（秒）
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '3'))            # 单条通知最多发送次数
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '3'))        # 通知记录保留天数（TTL）
+
+MESSAGE_LIMIT = 4000  # Telegram 单条消息 4096 字符，留出余量
+
+PENDING = 'pending'
+SENDING = 'sending'
+DONE = 'sent'
+GIVEN_UP = 'failed'
+
+
+class NotificationOutbox:
+    """
+    通知发件箱
+
+    文档：{sender, token, chat_id, text, topic, digest, title, parse_mode, reply_markup,
+           disable_web_page_preview, status, attempts, created_at, sent_at,
+           batch, parts, sent_parts}（后三项仅多段摘要：所属批次、渲染好的分段、已发送段数）
+    """
+    def __init__(self, collection, sender: str, token: str):
+        self.collection = collection
+        self.sender = sender
+        self.token = token
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        try:
+            self.collection.create_index([('sender', 1), ('status', 1), ('created_at', 1)])
+            self.collection.create_index('created_at', expireAfterSeconds=OUTBOX_RETENTION_DAYS * 86400)
+        except Exception as e:
+            logging.error(f"❌ 通知发件箱索引初始化失败：{e}")
+
+    def enqueue(self, chat_ids, text: str, topic: str = None, digest: str = None, title: str = None,
+                parse_mode: str = 'HTML', reply_markup: InlineKeyboardMarkup = None,
+                disable_web_page_preview: bool = True, token: str = None) -> int:
+        """
+        写入待发通知（每个接收人一条），立即返回
+
+        Args:
+            topic: 合并主题；同一接收人同一主题在合并窗口内的多条通知合并发送（合并后不带按钮）
+            digest: 合并时使用的单行摘要（缺省时使用完整正文）
+            title: 合并摘要的标题（如“🛒 购买通知”）
+            token: 使用其他机器人发送（如代理机器人通知其用户），默认本进程机器人
+        """
+        if isinstance(chat_ids, (int, str)):
+            chat_ids = [chat_ids]
+        now = datetime.now()
+        markup = reply_markup.to_dict() if reply_markup is not None else None
+        docs = [{
+            'sender': self.sender,
+            'token': token,
+            'chat_id': chat_id,
+            'text': text,
+            'topic': topic,
+            'digest': digest,
+            'title': title,
+            'parse_mode': parse_mode,
+            'reply_markup': markup,
+            'disable_web_page_preview': disable_web_page_preview,
+            'status': PENDING,
+            'attempts': 0,
+            'created_at': now,
+        } for chat_id in chat_ids if chat_id]
+        if not docs:
+            return 0
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except Exception as e:
+            logging.error(f"❌ 写入通知发件箱失败：{e}")
+            return 0
+        return len(docs)
+
+    def _due(self, now: datetime) -> list:
+        """
+        取出到期的待发通知：按 (token, chat_id, topic) 分组，组内最早一条超过合并窗口才发送；
+        已固定批次的多段摘要按 batch 分组，立即续发
+        """
+        pending = list(self.collection.find({'sender': self.sender, 'status': PENDING}).sort('created_at', 1).limit(500))
+        groups = {}
+        for doc in pending:
+            if doc.get('batch'):
+                key = ('batch', doc['batch'])
+            else:
+                key = (doc.get('token'), doc['chat_id'], doc.get('topic') or str(doc['_id']))
+            groups.setdefault(key, []).append(doc)
+        window = timedelta(seconds=OUTBOX_DIGEST_WINDOW)
+        return [docs for docs in groups.values()
+                if docs[0].get('batch') or docs[0].get('topic') is None or now - docs[0]['created_at'] >= window]
+
+    @staticmethod
+    def _render(docs: list) -> list:
+        """合并一组通知为若干条消息文本（超长时分段）"""
+        if len(docs) == 1:
+            return [docs[0]['text']]
+        title = docs[0].get('title') or '🔔 通知汇总'
+        header = f"<b>{title}</b>（{len(docs)} 条）\n"
+        parts, current = [], header
+        for doc in docs:
+            line = (doc.get('digest') or doc['text'].strip())
+            entry = f"\n• {line}" if doc.get('digest') else f"\n{line}\n"
+            if len(current) + len(entry) > MESSAGE_LIMIT:
+                parts.append(current)
+                current = header
+            current += entry
+        parts.append(current)
+        return parts
+
+    def drain(self) -> int:
+        """发送所有到期通知，返回发送成功的消息条数"""
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            sent = 0
+            for docs in self._due(datetime.now()):
+                ids = [d['_id'] for d in docs]
+                claimed = self.collection.update_many({'_id': {'$in': ids}, 'status': PENDING},
+                                                      {'$set': {'status': SENDING}, '$inc': {'attempts': 1}})
+                if claimed.modified_count != len(ids):
+                    continue
+                first = docs[0]
+                token = first.get('token') or self.token
+                bot = get_bot(token)
+                single = len(docs) == 1 and first.get('reply_markup')
+                markup = InlineKeyboardMarkup.de_json(first['reply_markup'], bot) if single else None
+                batch = first.get('batch')
+                parts = first.get('parts') or self._render(docs)
+                if len(parts) > 1 and not batch:
+                    # 多段摘要：固定本组成员与分段，之后的进度按段记录
+                    batch = first['_id']
+                    self.collection.update_many({'_id': {'$in': ids}},
+                                                {'$set': {'batch': batch, 'parts': parts, 'sent_parts': 0}})
+                scope = {'batch': batch} if batch else {'_id': {'$in': ids}}
+                ok, unreachable = True, False
+                for index in range(first.get('sent_parts', 0) if batch else 0, len(parts)):
+                    text = parts[index]
+                    status, error = deliver(
+                        lambda chat_id: bot.send_message(
+                            chat_id=chat_id, text=text, parse_mode=first.get('parse_mode'),
+                            reply_markup=markup, disable_web_page_preview=first.get('disable_web_page_preview', True)
+                        ),
+                        first['chat_id'], get_limiter(token)
+                    )
+                    if status == SENT:
+                        sent += 1
+                        if batch:
+                            self.collection.update_many(scope, {'$set': {'sent_parts': index + 1}})
+                    else:
+                        ok, unreachable = False, status == BLOCKED
+                        logging.warning(f"⚠️ 通知发送失败 {first['chat_id']}：{error}")
+                        break
+                if ok:
+                    self.collection.update_many(scope, {'$set': {'status': DONE, 'sent_at': datetime.now()}})
+                else:
+                    # 未超过次数的放回待发，下一轮从未发送的分段重试；接收人不可达（拉黑/注销）直接放弃
+                    retry = not unreachable and first.get('attempts', 0) + 1 < OUTBOX_MAX_ATTEMPTS
+                    self.collection.update_many(scope, {'$set': {'status': PENDING if retry else GIVEN_UP}})
+            return sent
+        finally:
+            self._lock.release()
+
+    def recover(self):
+        """进程重启时把上次中断的 sending 放回待发（通知允许极少量重复，不允许丢失）"""
+        try:
+            self.collection.update_many({'sender': self.sender, 'status': SENDING}, {'$set': {'status': PENDING}})
+        except Exception as e:
+            logging.warning(f"⚠️ 恢复通知发件箱失败：{e}")
+
+    def job(self, context):
+        """job_queue 定时任务入口"""
+        try:
+            self.drain()
+        except Exception as e:
+            logging.error(f"❌ 通知发件箱发送异常：{e}")
+
+    def start(self, job_queue, first: float = 3):
+        """初始化索引、恢复中断的通知并注册定时发送任务"""
+        self.ensure_indexes()
+        self.recover()
+        job_queue.run_repeating(self.job, OUTBOX_POLL_SECONDS, first, name=f'outbox_{self.sender}')
@@ -0,0 +1,210 @@
+"""
+异步出站发送层
+
+- 独立线程运行一个 asyncio 事件循环，长任务（私发、导出、发货、代理入账通知）的 Telegram 发送都提交到这里，
+  立即得到 concurrent.futures.Future，需要结果时再 .result()
+- 显式并发预算：asyncio.Semaphore 限制全进程同时在途的出站请求数，不再依赖 dispatcher 线程数
+- 通过 aiohttp 直接调用 Bot API：每个进程一个 HTTP/1.1 keep-alive 连接池，上千个并发发送只占用一个线程
+  （aiohttp 为必需依赖：pip install aiohttp，未安装时导入即报错）
+- 文件参数在调用线程中读出为 bytes 后再提交，事件循环内不做阻塞 IO
+- Bot API 错误转换为 telegram.error 异常，broadcast_engine.deliver 的限流与重试逻辑保持不变
+"""
+import os
+import json
+import asyncio
+import logging
+import threading
+
+from telegram import Message, TelegramObject
+from telegram.error import RetryAfter, Unauthorized, BadRequest, ChatMigrated, NetworkError, TimedOut
+
+from bot_clients import get_bot
+
+try:
+    import aiohttp
+except ImportError as e:
+    raise ImportError("出站发送层需要 aiohttp，请先安装：pip install aiohttp") from e
+
+OUTBOUND_CONCURRENCY = int(os.getenv('OUTBOUND_CONCURRENCY', '64'))              # 同时在途的出站请求上限
+OUTBOUND_TIMEOUT = float(os.getenv('OUTBOUND_TIMEOUT', '60'))                    # 单次请求超时（秒，含上传）
+
+API_URL = 'https://api.telegram.org/bot{token}/{method}'
+
+
+def api_method(name: str) -> str:
+    """python-telegram-bot 方法名转 Bot API 方法名（send_message → sendMessage）"""
+    head, *rest = name.split('_')
+    return head + ''.join(part.capitalize() for part in rest)
+
+
+def _raise_for(data: dict):
+    """把 Bot API 的错误响应转换为 python-telegram-bot 的异常类型"""
+    description = data.get('description', 'Unknown error')
+    params = data.get('parameters') or {}
+    if params.get('retry_after'):
+        raise RetryAfter(params['retry_after'])
+    if params.get('migrate_to_chat_id'):
+        raise ChatMigrated(params['migrate_to_chat_id'])
+    code = data.get('error_code')
+    if code in (401, 403):
+        raise Unauthorized(description)
+    if code == 400:
+        raise BadRequest(description)
+    raise NetworkError(description)
+
+
+class OutboundSender:
+    """出站发送器（进程内单例 outbound）"""
+    def __init__(self, concurrency: int = OUTBOUND_CONCURRENCY):
+        self.concurrency = concurrency
+        self._loop = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._semaphore = None
+        self._session = None
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total = 0
+        self.errors = 0
+
+    # ---------- 事件循环 ----------
+    def _run_loop(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._ready.set()
+        loop.run_forever()
+
+    def _ensure_loop(self):
+        if self._ready.is_set():
+            return
+        with self._lock:
+            if self._loop is None:
+                threading.Thread(target=self._run_loop, daemon=True, name='OutboundSender').start()
+                logging.info(f"✅ 出站发送层已启动（并发预算 {self.concurrency}，aiohttp keep-alive）")
+        self._ready.wait()
+
+    # ---------- 请求 ----------
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=OUTBOUND_TIMEOUT))
+        return self._session
+
+    @staticmethod
+    def _form(params: dict):
+        """请求参数：普通参数 JSON 编码，文件参数（bytes，由 call 预先读出）走 multipart"""
+        files = {k: v for k, v in params.items() if isinstance(v, (bytes, bytearray))}
+        fields = {}
+        for k, v in params.items():
+            if v is None or k in files or k == 'filename':
+                continue
+            if isinstance(v, TelegramObject):
+                v = v.to_json()
+            elif isinstance(v, (dict, list, bool)):
+                v = json.dumps(v)
+            fields[k] = str(v)
+        if not files:
+            return None, fields
+        form = aiohttp.FormData()
+        for k, v in fields.items():
+            form.add_field(k, v)
+        for k, v in files.items():
+            form.add_field(k, bytes(v), filename=params.get('filename') or k)
+        return form, None
+
+    async def _api_call(self, token: str, method: str, params: dict):
+        form, fields = self._form(params)
+        session = await self._get_session()
+        try:
+            async with session.post(API_URL.format(token=token, method=api_method(method)), data=form or fields) as resp:
+                try:
+                    data = await resp.json(content_type=None)
+                except ValueError:
+                    # 网关错误页（502 HTML 等）：按网络错误处理，由 deliver 退避重试
+                    raise NetworkError(f"Bad response from Telegram: HTTP {resp.status}")
+        except asyncio.TimeoutError:
+            raise TimedOut()
+        except aiohttp.ClientError as e:
+            raise NetworkError(str(e))
+        if not isinstance(data, dict):
+            raise NetworkError(f"Bad response from Telegram: {str(data)[:100]}")
+        if not data.get('ok'):
+            _raise_for(data)
+        result = data.get('result')
+        if isinstance(result, dict) and 'message_id' in result:
+            return Message.de_json(result, get_bot(token))
+        return result
+
+    async def _call(self, token: str, method: str, params: dict):
+        async with self._semaphore:
+            with self._lock:
+                self.in_flight += 1
+                self.total += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                return await self._api_call(token, method, params)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                raise
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+
+    def call(self, token: str, method: str, **params):
+        """
+        提交一次 Bot API 调用，返回 Future（方法名与 python-telegram-bot 的 Bot 方法一致，如 send_message）
+
+        文件参数为 bytes 或已打开的文件对象；文件对象在此读出，返回后即可关闭
+        """
+        for key, value in list(params.items()):
+            if hasattr(value, 'read'):
+                params.setdefault('filename', os.path.basename(getattr(value, 'name', '') or key))
+                params[key] = value.read()
+        self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self._call(token, method, params), self._loop)
+
+    def send_message(self, token: str, chat_id, text: str, **kwargs):
+        return self.call(token, 'send_message', chat_id=chat_id, text=text, **kwargs)
+
+    def send_document(self, token: str, chat_id, document, **kwargs):
+        return self.call(token, 'send_document', chat_id=chat_id, document=document, **kwargs)
+
+    def send_photo(self, token: str, chat_id, photo, **kwargs):
+        return self.call(token, 'send_photo', chat_id=chat_id, photo=photo, **kwargs)
+
+    def send_animation(self, token: str, chat_id, animation, **kwargs):
+        return self.call(token, 'send_animation', chat_id=chat_id, animation=animation, **kwargs)
+
+    def format_metrics(self) -> str:
+        """诊断命令用的出站统计文本"""
+        if not self._ready.is_set():
+            return "• 出站发送层：未启动"
+        with self._lock:
+            return (f"• 出站发送层：在途 {self.in_flight}/{self.concurrency}（峰值 {self.peak_in_flight}）"
+                    f" · 请求 {self.total} · 失败 {self.errors}")
+
+
+def log_failure(future, label: str, on_error=None):
+    """
+    不等待结果的发送：失败时记录日志
+
+    on_error(error) 在事件循环线程中调用（只能提交新的发送，不能阻塞等待）
+    """
+    def _done(f):
+        error = f.exception()
+        if error is not None:
+            logging.warning(f"⚠️ {label}发送失败：{error}")
+            if on_error:
+                try:
+                    on_error(error)
+                except Exception as e:
+                    logging.error(f"❌ {label}失败处理出错：{e}")
+    future.add_done_callback(_done)
+    return future
+
+
+outbound = OutboundSender()